@@ -36,6 +36,7 @@ from helpers.utils import (
     load_adversarial_wrapper
 )
 from helpers.dimension_reduction_methods import load_dimension_reduction_models
+from helpers.embedding_cache import EmbeddingCache
 from detectors.detector_odds_are_odd import (
     fit_odds_are_odd,
     detect_odds_are_odd
@@ -51,6 +52,7 @@ from detectors.detector_lid_paper import (
     DetectorLIDBatch
 )
 from detectors.detector_proposed import DetectorLayerStatistics
+from helpers.knn_index import KNNGraphCache
 from detectors.detector_deep_knn import DeepKNN
 from detectors.detector_trust_score import TrustScore
 
@@ -84,9 +86,11 @@ def main():
                         help='Index of the adversarial attack parameter to use. This indexes the sorted directories '
                              'containing the adversarial data files from different attack parameters.')
     ################ Optional arguments for the proposed method
-    parser.add_argument('--test-statistic', '--ts', choices=TEST_STATS_SUPPORTED, default='multinomial',
-                        help="Test statistic to calculate at the layers for the proposed method. Choices are: {}".
-                        format(', '.join(TEST_STATS_SUPPORTED)))
+    parser.add_argument('--test-statistic', '--ts', choices=TEST_STATS_SUPPORTED, nargs='+', default=['multinomial'],
+                        help="Test statistic(s) to calculate at the layers for the proposed method. Choices are: {}. "
+                             "If multiple test statistics are specified, they are calculated from the same nearest "
+                             "neighbor queries at each layer, and the results of each test statistic are saved "
+                             "separately".format(', '.join(TEST_STATS_SUPPORTED)))
     parser.add_argument('--score-type', '--st', choices=SCORE_TYPES, default='pvalue',
                         help="Score type to use for the proposed method. Choices are: {}".
                         format(', '.join(SCORE_TYPES)))
@@ -116,6 +120,12 @@ def main():
         help="Option that allows low probability classes to be automatically combined into one group for the "
              "multinomial test statistic used with the proposed method"
     )
+    parser.add_argument(
+        '--knn-graph-cache', '--kgc', action='store_true', default=False,
+        help="Option that enables the proposed method to reuse the KNN graphs across the cross-validation folds. "
+             "The KNN index of each fold is obtained by restricting the index built on the overlapping training "
+             "data of the previous folds, instead of building it from scratch"
+    )
     ################ Optional arguments for the proposed method
     parser.add_argument('--layer-trust-score', '--lts', choices=LAYERS_TRUST_SCORE, default='input',
                         help="Which layer to use for the trust score calculation. Choices are: {}".
@@ -129,6 +139,9 @@ def main():
                         help='Path to the saved dimension reduction model file. Specify only if the default path '
                              'needs to be changed.')
     parser.add_argument('--output-dir', '-o', default='', help='directory path for saving the results of detection')
+    parser.add_argument('--embedding-cache-dir', '--ecd', default='',
+                        help='directory of the on-disk cache of the layer embeddings and DNN predictions. The '
+                             'embeddings are reused by runs with the same model, data and method')
     parser.add_argument('--adv-attack', '--aa', choices=['FGSM', 'PGD', 'CW', CUSTOM_ATTACK], default='PGD',
                         help='type of adversarial attack')
     # parser.add_argument('--p-norm', '-p', choices=['0', '2', 'inf'], default='inf',
@@ -140,6 +153,9 @@ def main():
     parser.add_argument('--no-cuda', action='store_true', default=False, help='disables CUDA training')
     parser.add_argument('--gpu', type=str, default='0', help='which gpus to execute code on')
     parser.add_argument('--n-jobs', type=int, default=4, help='number of parallel jobs to use for multiprocessing')
+    parser.add_argument('--n-jobs-layers', type=int, default=1,
+                        help="number of layers that the proposed method processes in parallel. The parallel jobs "
+                             "'--n-jobs' are split among the layers")
     parser.add_argument('--seed', '-s', type=int, default=SEED_DEFAULT, help='seed for random number generation')
     args = parser.parse_args()
 
@@ -169,6 +185,8 @@ def main():
 
     # Method name for results and plots
     method_name = METHOD_NAME_MAP[args.detection_method]
+    # The results of the proposed method with multiple test statistics are saved under one method name per statistic
+    method_names = None
 
     # Dimensionality reduction to the layer embeddings is applied only for methods in certain configurations
     apply_dim_reduc = False
@@ -182,19 +200,29 @@ def main():
             if args.pvalue_fusion == 'fisher':
                 st += '_fis'
 
-        if not args.ood_detection:
-            method_name = '{:.5s}_{:.5s}_{}_adv'.format(method_name, args.test_statistic, st)
-        else:
-            method_name = '{:.5s}_{:.5s}_{}_ood'.format(method_name, args.test_statistic, st)
+        if len(set(args.test_statistic)) < len(args.test_statistic):
+            raise ValueError("Test statistics specified using the option '--test-statistic' should be distinct.")
 
-        if args.use_top_ranked:
-            method_name = '{}_top{:d}'.format(method_name, args.num_layers)
-        elif args.use_deep_layers:
-            method_name = '{}_last{:d}'.format(method_name, args.num_layers)
+        # One method name per test statistic
+        method_names = []
+        for ts in args.test_statistic:
+            if not args.ood_detection:
+                name = '{:.5s}_{:.5s}_{}_adv'.format(method_name, ts, st)
+            else:
+                name = '{:.5s}_{:.5s}_{}_ood'.format(method_name, ts, st)
 
-        # If `n_neighbors` is specified, append that value to the name string
-        if n_neighbors is not None:
-            method_name = '{}_k{:d}'.format(method_name, n_neighbors)
+            if args.use_top_ranked:
+                name = '{}_top{:d}'.format(name, args.num_layers)
+            elif args.use_deep_layers:
+                name = '{}_last{:d}'.format(name, args.num_layers)
+
+            # If `n_neighbors` is specified, append that value to the name string
+            if n_neighbors is not None:
+                name = '{}_k{:d}'.format(name, n_neighbors)
+
+            method_names.append(name)
+
+        method_name = method_names[0]
 
         apply_dim_reduc = True
 
@@ -234,7 +262,8 @@ def main():
             fname = args.modelfile_dim_reduc
         else:
             # Path to the dimension reduction model file
-            fname = get_path_dr_models(args.model_type, args.detection_method, test_statistic=args.test_statistic)
+            fname = get_path_dr_models(args.model_type, args.detection_method,
+                                       test_statistic=args.test_statistic[0])
 
         if not os.path.isfile(fname):
             raise ValueError("Model file for dimension reduction is required, but does not exist: {}".format(fname))
@@ -295,6 +324,16 @@ def main():
 
     # Set model in evaluation mode
     model.eval()
+    # Cache of the layer embeddings and predictions that is shared by the runs with different detection settings
+    embedding_cache = EmbeddingCache(args.embedding_cache_dir, model) if args.embedding_cache_dir else None
+    # Only the last few layers are calculated and stored if the proposed method uses only them. The other layers
+    # are set to None
+    layers_extract = None
+    if (args.detection_method == 'proposed') and args.use_deep_layers:
+        layers_extract = list(range(-args.num_layers, 0))
+    # The dimension reduction of the proposed method is applied to each batch during the extraction, so that only
+    # the reduced dimension layer embeddings are stored
+    transform_extract = model_dim_reduc if (args.detection_method == 'proposed') else None
 
     # Check if the numpy data directory exists
     d = os.path.join(NUMPY_DATA_PATH, args.model_type)
@@ -312,17 +351,24 @@ def main():
         ('pnorm', ATTACK_NORM_MAP[args.adv_attack])
     ]
 
-    # Initialization
+    if method_names is None:
+        method_names = [method_name]
+
+    # Initialization. The scores, labels, and models from the folds are saved per method name
+    scores_folds = {name: [] for name in method_names}
+    labels_folds = {name: [] for name in method_names}
+    models_folds = {name: [] for name in method_names}
+    init_fold = 0
     if args.resume_from_ckpt:
-        scores_folds, labels_folds, models_folds, init_fold = load_detector_checkpoint(output_dir, method_name,
-                                                                                       args.save_detec_model)
+        for name in method_names:
+            scores_folds[name], labels_folds[name], models_folds[name], init_fold = load_detector_checkpoint(
+                output_dir, name, args.save_detec_model
+            )
         print("Loading saved results from a previous run. Completed {:d} fold(s). Resuming from fold {:d}.".
               format(init_fold, init_fold + 1))
-    else:
-        scores_folds = []
-        labels_folds = []
-        models_folds = []
-        init_fold = 0
+
+    # KNN graphs that are reused across the cross-validation folds by the proposed method
+    graph_cache = KNNGraphCache() if args.knn_graph_cache else None
 
     ti = time.time()
     # Cross-validation
@@ -347,11 +393,13 @@ def main():
 
         print("\nCalculating the layer embeddings and DNN predictions for the clean train data split:")
         layer_embeddings_tr, labels_pred_tr = helper_layer_embeddings(
-            model, device, train_fold_loader, args.detection_method, labels_tr
+            model, device, train_fold_loader, args.detection_method, labels_tr, cache=embedding_cache,
+            layers=layers_extract, transform_models=transform_extract
         )
         print("\nCalculating the layer embeddings and DNN predictions for the clean test data split:")
         layer_embeddings_te, labels_pred_te = helper_layer_embeddings(
-            model, device, test_fold_loader, args.detection_method, labels_te
+            model, device, test_fold_loader, args.detection_method, labels_te, cache=embedding_cache,
+            layers=layers_extract, transform_models=transform_extract
         )
         # Delete the data loaders in case they are not used further
         if args.detection_method != 'mahalanobis':
@@ -379,11 +427,13 @@ def main():
                                                    batch_size=args.batch_size, device=device)
         print("\nCalculating the layer embeddings and DNN predictions for the noisy train data split:")
         layer_embeddings_tr_noisy, labels_pred_tr_noisy = helper_layer_embeddings(
-            model, device, noisy_train_fold_loader, args.detection_method, labels_tr_noisy
+            model, device, noisy_train_fold_loader, args.detection_method, labels_tr_noisy, cache=embedding_cache,
+            layers=layers_extract, transform_models=transform_extract
         )
         print("\nCalculating the layer embeddings and DNN predictions for the noisy test data split:")
         layer_embeddings_te_noisy, labels_pred_te_noisy = helper_layer_embeddings(
-            model, device, noisy_test_fold_loader, args.detection_method, labels_te_noisy
+            model, device, noisy_test_fold_loader, args.detection_method, labels_te_noisy, cache=embedding_cache,
+            layers=layers_extract, transform_models=transform_extract
         )
         # Delete the data loaders in case they are not used further
         del noisy_train_fold_loader
@@ -413,13 +463,15 @@ def main():
             # Needed only for the LID method
             print("\nCalculating the layer embeddings and DNN predictions for the adversarial train data split:")
             layer_embeddings_tr_adv, labels_pred_tr_adv = helper_layer_embeddings(
-                model, device, adv_train_fold_loader, args.detection_method, labels_tr_adv
+                model, device, adv_train_fold_loader, args.detection_method, labels_tr_adv, cache=embedding_cache,
+                layers=layers_extract, transform_models=transform_extract
             )
             check_label_mismatch(labels_tr_adv, labels_pred_tr_adv)
 
         print("\nCalculating the layer embeddings and DNN predictions for the adversarial test data split:")
         layer_embeddings_te_adv, labels_pred_te_adv = helper_layer_embeddings(
-            model, device, adv_test_fold_loader, args.detection_method, labels_te_adv
+            model, device, adv_test_fold_loader, args.detection_method, labels_te_adv, cache=embedding_cache,
+            layers=layers_extract, transform_models=transform_extract
         )
         check_label_mismatch(labels_te_adv, labels_pred_te_adv)
         # Delete the data loaders in case they are not used further
@@ -477,7 +529,7 @@ def main():
 
             scores_adv = np.concatenate([scores_adv1, scores_adv2])
             if args.save_detec_model:
-                models_folds.append(det_model)
+                models_folds[method_name].append(det_model)
 
         elif args.detection_method == 'lid_class_cond':
             # Set to `None` to skip noisy data
@@ -507,7 +559,7 @@ def main():
 
             scores_adv = np.concatenate([scores_adv1, scores_adv2])
             if args.save_detec_model:
-                models_folds.append(det_model)
+                models_folds[method_name].append(det_model)
 
         elif args.detection_method == 'proposed':
             nl = len(layer_embeddings_tr)
@@ -522,36 +574,54 @@ def main():
                     print("Using only the last {:d} layer embeddings from the {:d} layers for the proposed method.".
                           format(args.num_layers, nl))
 
-            mod_dr = None if (model_dim_reduc is None) else model_dim_reduc[st_ind:]
+            # Multiple test statistics are calculated in a single pass over the layers
+            multi_statistic = len(args.test_statistic) > 1
             det_model = DetectorLayerStatistics(
-                layer_statistic=args.test_statistic,
+                layer_statistic=args.test_statistic if multi_statistic else args.test_statistic[0],
                 score_type=args.score_type,
                 ood_detection=args.ood_detection,
                 pvalue_fusion=args.pvalue_fusion,
                 use_top_ranked=args.use_top_ranked,
                 num_top_ranked=args.num_layers,
+                # Dimension reduction is already applied during the extraction of the layer embeddings. The models
+                # are kept by the detector, so that a saved detector can transform the layer embeddings it is given
                 skip_dim_reduction=(not apply_dim_reduc),
-                model_dim_reduction=mod_dr,
+                model_dim_reduction=None if (model_dim_reduc is None) else model_dim_reduc[st_ind:],
+                dim_reduction_applied=True,
                 n_neighbors=n_neighbors,
                 n_jobs=args.n_jobs,
+                n_jobs_layers=args.n_jobs_layers,
+                graph_cache=graph_cache,
                 seed_rng=args.seed
             )
             # Fit the detector on clean data from the training fold
-            if args.combine_classes and (args.test_statistic == 'multinomial'):
+            if args.combine_classes and ('multinomial' in args.test_statistic):
                 _ = det_model.fit(layer_embeddings_tr[st_ind:], labels_tr, labels_pred_tr,
                                   combine_low_proba_classes=True)
             else:
                 _ = det_model.fit(layer_embeddings_tr[st_ind:], labels_tr, labels_pred_tr)
 
+            # Adversarial and OOD scores are calculated in a single pass over the layers
+            key_scores = 'scores_ood' if args.ood_detection else 'scores_adver'
             # Scores on clean data from the test fold
-            scores_adv1 = det_model.score(layer_embeddings_te[st_ind:], labels_pred_te, test_layer_pairs=True)
+            results_clean = det_model.score_all(layer_embeddings_te[st_ind:], labels_pred_te, test_layer_pairs=True)
 
             # Scores on adversarial data from the test fold
-            scores_adv2 = det_model.score(layer_embeddings_te_adv[st_ind:], labels_pred_te_adv, test_layer_pairs=True)
-
-            scores_adv = np.concatenate([scores_adv1, scores_adv2])
-            if args.save_detec_model:
-                models_folds.append(det_model)
+            results_adv = det_model.score_all(layer_embeddings_te_adv[st_ind:], labels_pred_te_adv,
+                                              test_layer_pairs=True)
+            if multi_statistic:
+                # Scores and detector of each test statistic
+                scores_adv = dict()
+                for name, ts in zip(method_names, args.test_statistic):
+                    scores_adv[name] = np.concatenate([results_clean[ts][key_scores], results_adv[ts][key_scores]])
+                    if args.save_detec_model:
+                        models_folds[name].append(det_model.detectors[ts])
+            else:
+                scores_adv1 = results_clean[key_scores]
+                scores_adv2 = results_adv[key_scores]
+                scores_adv = np.concatenate([scores_adv1, scores_adv2])
+                if args.save_detec_model:
+                    models_folds[method_name].append(det_model)
 
         elif args.detection_method == 'dknn':
             det_model = DeepKNN(
@@ -573,7 +643,7 @@ def main():
             scores_adv = np.concatenate([scores_adv1, scores_adv2])
             # labels_pred_dknn = np.concatenate([labels_pred_dknn1, labels_pred_dknn2])
             if args.save_detec_model:
-                models_folds.append(det_model)
+                models_folds[method_name].append(det_model)
 
         elif args.detection_method == 'trust':
             ind_layer = config_trust_score['layer']
@@ -596,7 +666,7 @@ def main():
 
             scores_adv = np.concatenate([scores_adv1, scores_adv2])
             if args.save_detec_model:
-                models_folds.append(det_model)
+                models_folds[method_name].append(det_model)
 
         elif args.detection_method == 'mahalanobis':
             # Sub-directory for this fold so that the output files are not overwritten
@@ -622,24 +692,30 @@ def main():
         else:
             raise ValueError("Unknown detection method name '{}'".format(args.detection_method))
 
-        # Sanity check
-        if scores_adv.shape[0] != labels_detec.shape[0]:
-            raise ValueError(
-                "Detection scores and labels do not have the same length ({:d} != {:d}); method = {}, fold = {:d}".
-                    format(scores_adv.shape[0], labels_detec.shape[0], args.detection_method, i + 1)
-            )
+        if not isinstance(scores_adv, dict):
+            scores_adv = {method_name: scores_adv}
+
+        for name in method_names:
+            # Sanity check
+            if scores_adv[name].shape[0] != labels_detec.shape[0]:
+                raise ValueError(
+                    "Detection scores and labels do not have the same length ({:d} != {:d}); method = {}, fold = {:d}".
+                        format(scores_adv[name].shape[0], labels_detec.shape[0], name, i + 1)
+                )
 
-        scores_folds.append(scores_adv)
-        labels_folds.append(labels_detec)
-        save_detector_checkpoint(scores_folds, labels_folds, models_folds, output_dir, method_name,
-                                 args.save_detec_model)
+            scores_folds[name].append(scores_adv[name])
+            labels_folds[name].append(labels_detec)
+            save_detector_checkpoint(scores_folds[name], labels_folds[name], models_folds[name], output_dir, name,
+                                     args.save_detec_model)
 
     print("\nCalculating performance metrics for different proportion of attack samples:")
-    fname = os.path.join(output_dir, 'detection_metrics_{}.pkl'.format(method_name))
-    results_dict = metrics_varying_positive_class_proportion(
-        scores_folds, labels_folds, output_file=fname, max_pos_proportion=args.max_attack_prop, log_scale=False
-    )
-    print("Performance metrics saved to the file: {}".format(fname))
+    for name in method_names:
+        fname = os.path.join(output_dir, 'detection_metrics_{}.pkl'.format(name))
+        results_dict = metrics_varying_positive_class_proportion(
+            scores_folds[name], labels_folds[name], output_file=fname, max_pos_proportion=args.max_attack_prop,
+            log_scale=False
+        )
+        print("Performance metrics saved to the file: {}".format(fname))
     tf = time.time()
     print("Total time taken: {:.4f} minutes".format((tf - ti) / 60.))
 
@@ -39,15 +39,11 @@ from helpers.dimension_reduction_methods import (
     transform_data_from_model,
     load_dimension_reduction_models
 )
-from helpers.knn_index import KNNIndex, helper_knn_distance
+from helpers.knn_index import KNNIndex, PartitionedKNNIndex, helper_knn_distance, use_partitioned_index
 from helpers.lid_estimators import lid_mle_amsaleg
 from helpers.utils import get_num_jobs
 from sklearn.linear_model import LogisticRegressionCV
 from sklearn.preprocessing import MinMaxScaler
-try:
-    import cPickle as pickle
-except:
-    import pickle
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 logger = logging.getLogger(__name__)
@@ -100,10 +96,11 @@ class DetectorLID:
                                         problem separating adversarial from non-adversarial samples.
         :param low_memory: Set to True to enable the low memory option of the `NN-descent` method. Note that this
                            is likely to increase the running time.
-        :param save_knn_indices_to_file: Set to True in order to save the KNN indices from each layer to a pickle
-                                         file to reduce memory usage. This may not be needed when the data size
-                                         and/or the number of layers is small. It avoids potential out-of-memory
-                                         errors at the expense of time taken to write and read the files.
+        :param save_knn_indices_to_file: Set to True in order to save the KNN indices from each layer to files
+                                         (see `KNNIndex.save`) to reduce memory usage. This may not be needed when
+                                         the data size and/or the number of layers is small. It avoids potential
+                                         out-of-memory errors at the expense of time taken to write and read the
+                                         files.
         :param seed_rng: int value specifying the seed for the random number generator. This is passed around to
                          all the classes/functions that require random number generation. Set this to a fixed value
                          for reproducible results.
@@ -273,10 +270,9 @@ class DetectorLID:
             features_lid_adversarial[:, i] = lid_mle_amsaleg(nn_distances)
 
             if self.save_knn_indices_to_file:
-                logger.info("Saving the KNN index from layer {:d} to a pickle file".format(i + 1))
-                self.temp_knn_files[i] = os.path.join(self.temp_direc, 'knn_index_layer_{:d}.pkl'.format(i + 1))
-                with open(self.temp_knn_files[i], 'wb') as fp:
-                    pickle.dump(self.index_knn[i], fp)
+                logger.info("Saving the KNN index from layer {:d} to a directory".format(i + 1))
+                self.temp_knn_files[i] = os.path.join(self.temp_direc, 'knn_index_layer_{:d}'.format(i + 1))
+                self.index_knn[i].save(self.temp_knn_files[i])
 
                 # Free up the allocated memory
                 self.index_knn[i] = None
@@ -371,8 +367,7 @@ class DetectorLID:
                 data_proj = layer_embeddings[i]
 
             if self.save_knn_indices_to_file:
-                with open(self.temp_knn_files[i], 'rb') as fp:
-                    self.index_knn[i] = pickle.load(fp)
+                self.index_knn[i] = KNNIndex.load(self.temp_knn_files[i], mmap=True)
 
             _, nn_distances = self.index_knn[i].query(data_proj, k=self.n_neighbors)
             features_lid[:, i] = lid_mle_amsaleg(nn_distances)
@@ -493,6 +488,7 @@ class DetectorLIDClassCond:
                  balanced_classification=True,
                  low_memory=False,
                  save_knn_indices_to_file=True,
+                 partitioned_index=None,
                  seed_rng=SEED_DEFAULT):
         """
 
@@ -526,9 +522,15 @@ class DetectorLIDClassCond:
         :param low_memory: Set to True to enable the low memory option of the `NN-descent` method. Note that this
                            is likely to increase the running time.
         :param save_knn_indices_to_file: Set to True in order to save the KNN indices from each layer and from each
-                                         class to a pickle file to reduce memory usage. This may not be needed when
-                                         the data size and/or the number of layers is small. It avoids potential
-                                         out-of-memory errors at the expense of time taken to write and read the files.
+                                         class to files (see `KNNIndex.save`) to reduce memory usage. This may not
+                                         be needed when the data size and/or the number of layers is small. It avoids
+                                         potential out-of-memory errors at the expense of time taken to write and
+                                         read the files.
+        :param partitioned_index: None or a bool value. Set to True in order to use a single exact KNN index per
+                                  layer over all the normal samples partitioned by their class
+                                  (`PartitionedKNNIndex`), instead of a separate KNN index per layer and class.
+                                  Requires a metric from `METRICS_EXACT_KNN` without `metric_kwargs`. If `None`, it
+                                  is used when `approx_nearest_neighbors` is False and these requirements are met.
         :param seed_rng: int value specifying the seed for the random number generator. This is passed around to
                          all the classes/functions that require random number generation. Set this to a fixed value
                          for reproducible results.
@@ -546,6 +548,7 @@ class DetectorLIDClassCond:
         self.balanced_classification = balanced_classification
         self.low_memory = low_memory
         self.save_knn_indices_to_file = save_knn_indices_to_file
+        self.partitioned_index = partitioned_index
         self.seed_rng = seed_rng
 
         np.random.seed(self.seed_rng)
@@ -579,6 +582,10 @@ class DetectorLIDClassCond:
         self.n_neighbors_per_class = dict()
         # KNN index
         self.index_knn = None
+        # Set to True in `fit` if a single KNN index partitioned by the class is used per layer. In this case,
+        # `self.index_knn[i]` is a `PartitionedKNNIndex` instead of a dict of `KNNIndex` per class
+        self.use_partitioned = False
+        self.class_index = dict()
         # Logistic classification model for normal vs. adversarial
         self.model_logistic = None
         # Feature scaler
@@ -690,6 +697,9 @@ class DetectorLIDClassCond:
             self.temp_knn_files = [''] * self.n_layers
 
         # KNN indices for the layer embeddings from each layer and each class
+        self.use_partitioned = use_partitioned_index(self.partitioned_index, self.metric, self.metric_kwargs,
+                                                     self.approx_nearest_neighbors)
+        self.class_index = {c: j for j, c in enumerate(self.labels_unique)}
         self.index_knn = [dict() for _ in range(self.n_layers)]
         features_lid_normal = np.zeros((self.n_samples[0], self.n_layers))
         features_lid_noisy = np.zeros((self.n_samples[1], self.n_layers))
@@ -717,7 +727,11 @@ class DetectorLIDClassCond:
                 else:
                     data_noisy = None
 
-            for c in self.labels_unique:
+            if self.use_partitioned:
+                self._fit_layer_partitioned(i, data_normal, data_noisy, data_adver,
+                                            features_lid_normal, features_lid_noisy, features_lid_adversarial)
+
+            for c in ([] if self.use_partitioned else self.labels_unique):
                 logger.info("Building a KNN index on the feature embeddings of normal samples from class {}".
                             format(c))
                 self.index_knn[i][c] = KNNIndex(
@@ -770,10 +784,13 @@ class DetectorLIDClassCond:
                     features_lid_adversarial[self.indices_pred_adver[c], i] = lid_mle_amsaleg(nn_distances)
 
             if self.save_knn_indices_to_file:
-                logger.info("Saving the KNN indices per class from layer {:d} to a pickle file".format(i + 1))
-                self.temp_knn_files[i] = os.path.join(self.temp_direc, 'knn_indices_layer_{:d}.pkl'.format(i + 1))
-                with open(self.temp_knn_files[i], 'wb') as fp:
-                    pickle.dump(self.index_knn[i], fp)
+                logger.info("Saving the KNN indices per class from layer {:d} to a directory".format(i + 1))
+                self.temp_knn_files[i] = os.path.join(self.temp_direc, 'knn_indices_layer_{:d}'.format(i + 1))
+                if self.use_partitioned:
+                    self.index_knn[i].save(self.temp_knn_files[i])
+                else:
+                    for j, c in enumerate(self.labels_unique):
+                        self.index_knn[i][c].save(os.path.join(self.temp_knn_files[i], 'class_{:d}'.format(j)))
 
                 # Free up the allocated memory
                 self.index_knn[i] = None
@@ -836,6 +853,41 @@ class DetectorLIDClassCond:
         else:
             return self, scores_normal, scores_adversarial
 
+    def _fit_layer_partitioned(self, i, data_normal, data_noisy, data_adver,
+                               features_lid_normal, features_lid_noisy, features_lid_adversarial):
+        """
+        Build a single KNN index partitioned by the true class on the normal embeddings from layer `i`, and calculate
+        the class-conditional LID features of the normal, noisy, and adversarial samples at this layer. The feature
+        arrays are updated in-place.
+        """
+        logger.info("Building a KNN index partitioned by the class on the feature embeddings of normal samples.")
+        self.index_knn[i] = PartitionedKNNIndex(
+            data_normal, [self.indices_true[c] for c in self.labels_unique],
+            n_neighbors=max(self.n_neighbors_per_class.values()), metric=self.metric, n_jobs=self.n_jobs
+        )
+        logger.info("Calculating LID estimates for the normal, noisy, and adversarial layer embeddings.")
+        # Nearest neighbors of the normal samples from each class. A sample is excluded only from the neighbors of
+        # its own (true) class
+        _, nn_dist_normal = self.index_knn[i].query_self()
+        _, nn_dist_adver = self.index_knn[i].query(data_adver)
+        nn_dist_noisy = None
+        if data_noisy is not None:
+            _, nn_dist_noisy = self.index_knn[i].query(data_noisy)
+
+        for j, c in enumerate(self.labels_unique):
+            k = self.n_neighbors_per_class[c]
+            ind = self.indices_pred_normal[c]
+            if ind.shape[0]:
+                features_lid_normal[ind, i] = lid_mle_amsaleg(nn_dist_normal[ind, j, :k])
+
+            if nn_dist_noisy is not None and self.indices_pred_noisy[c].shape[0]:
+                ind = self.indices_pred_noisy[c]
+                features_lid_noisy[ind, i] = lid_mle_amsaleg(nn_dist_noisy[ind, j, :k])
+
+            ind = self.indices_pred_adver[c]
+            if ind.shape[0]:
+                features_lid_adversarial[ind, i] = lid_mle_amsaleg(nn_dist_adver[ind, j, :k])
+
     def score(self, layer_embeddings, labels_pred, cleanup=True):
         """
         Given a list of layer embeddings for test samples, extract the layer-wise LID feature vector and return the
@@ -869,14 +921,30 @@ class DetectorLIDClassCond:
 
             if self.save_knn_indices_to_file:
                 # logger.info("Loading the KNN indices per class from file")
-                with open(self.temp_knn_files[i], 'rb') as fp:
-                    self.index_knn[i] = pickle.load(fp)
+                if self.use_partitioned:
+                    self.index_knn[i] = PartitionedKNNIndex.load(self.temp_knn_files[i], mmap=True)
+                else:
+                    self.index_knn[i] = {
+                        c: KNNIndex.load(os.path.join(self.temp_knn_files[i], 'class_{:d}'.format(j)), mmap=True)
+                        for j, c in enumerate(self.labels_unique)
+                    }
+
+            if self.use_partitioned:
+                # Nearest neighbors from every class in one query. The column of the predicted class is selected
+                # for each sample
+                _, nn_distances_part = self.index_knn[i].query(data_proj)
 
             for c in self.labels_unique:
                 ind = np.where(labels_pred == c)[0]
-                if ind.shape[0]:
+                if ind.shape[0] == 0:
+                    continue
+
+                if self.use_partitioned:
+                    nn_distances = nn_distances_part[ind, self.class_index[c], :self.n_neighbors_per_class[c]]
+                else:
                     _, nn_distances = self.index_knn[i][c].query(data_proj[ind, :], k=self.n_neighbors_per_class[c])
-                    features_lid[ind, i] = lid_mle_amsaleg(nn_distances)
+
+                features_lid[ind, i] = lid_mle_amsaleg(nn_distances)
 
             if self.save_knn_indices_to_file:
                 # Free up the allocated memory
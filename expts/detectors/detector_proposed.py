@@ -13,7 +13,8 @@ from helpers.constants import (
     NUM_TOP_RANKED,
     TEST_STATS_SUPPORTED,
     SCORE_TYPES,
-    NUM_RANDOM_SAMPLES
+    NUM_RANDOM_SAMPLES,
+    PVALUE_MIN
 )
 from helpers.dimension_reduction_methods import (
     transform_data_from_model,
@@ -22,7 +23,8 @@ from helpers.dimension_reduction_methods import (
 from helpers.utils import (
     log_sum_exp,
     combine_and_vectorize,
-    extract_layer_embeddings
+    extract_layer_embeddings,
+    get_num_jobs
 )
 from detectors.pvalue_estimation import (
     pvalue_score,
@@ -34,7 +36,8 @@ from detectors.test_statistics_layers import (
     LIDScore,
     LLEScore,
     DistanceScore,
-    TrustScore
+    TrustScore,
+    SharedNeighbors
 )
 from helpers.density_model_layer_statistics import (
     train_log_normal_mixture,
@@ -45,6 +48,16 @@ from detectors.localized_pvalue_estimation import averaged_KLPE_anomaly_detectio
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 logger = logging.getLogger(__name__)
 
+# Test statistic class corresponding to each name in `TEST_STATS_SUPPORTED`
+TEST_STATISTIC_CLASSES = {
+    'multinomial': MultinomialScore,
+    'binomial': BinomialScore,
+    'lid': LIDScore,
+    'lle': LLEScore,
+    'distance': DistanceScore,
+    'trust': TrustScore
+}
+
 
 def transform_layer_embeddings(embeddings_in, transform_models):
     """
@@ -85,6 +98,14 @@ class DetectorLayerStatistics:
 
     Fisher's method for combining p-values from multiple tests:
         https://en.wikipedia.org/wiki/Fisher%27s_method
+
+    If a list of test statistics is specified, the detector runs in the multi-statistic mode. One detector per test
+    statistic is fit on the same layer embeddings, and the test statistics of a layer share their nearest neighbors
+    (see `SharedNeighbors`). For the training data and for each test data, one global KNN query and one query
+    restricted to each predicted and true class are run per layer, and all the test statistics are calculated from
+    the resulting neighbor arrays. A test statistic whose nearest neighbor settings differ from those of the detector
+    (e.g. LID with a metric other than 'euclidean') finds its neighbors separately. The neighbors are shared only if
+    the layers are processed sequentially (`n_jobs_layers = 1`).
     """
     _name = 'proposed'
     def __init__(self,
@@ -96,16 +117,23 @@ class DetectorLayerStatistics:
                  num_top_ranked=NUM_TOP_RANKED,
                  skip_dim_reduction=False,
                  model_dim_reduction=None,
+                 dim_reduction_applied=False,
                  neighborhood_constant=NEIGHBORHOOD_CONST, n_neighbors=None,
                  metric=METRIC_DEF, metric_kwargs=None,
                  approx_nearest_neighbors=True,
                  n_jobs=1,
+                 n_jobs_layers=1,
                  low_memory=False,
+                 graph_cache=None,
+                 cascade_layer_order=None,
+                 cascade_max_layer_score=None,
                  seed_rng=SEED_DEFAULT):
         """
 
         :param layer_statistic: Type of test statistic to calculate at the layers. Valid values are 'multinomial',
-                                'binomial', 'lid', and 'lle'.
+                                'binomial', 'lid', 'lle', 'distance', and 'trust'. A list of these values selects
+                                the multi-statistic mode, in which the methods `fit` and `score` handle all the
+                                listed test statistics in one pass over the layers.
         :param score_type: Name of the scoring method to use. Valid options are: 'density' and 'pvalue'.
         :param ood_detection: Set to True to perform out-of-distribution detection instead of adversarial detection.
         :param pvalue_fusion: Method for combining the p-values across the layers. Options are 'harmonic_mean'
@@ -121,6 +149,13 @@ class DetectorLayerStatistics:
                                     2. Path to a file containing the saved dimension reduction model. This will be
                                        a pickle file that loads into a list of model dictionaries; (OR)
                                     3. The dimension reduction model loaded into memory from the pickle file.
+        :param dim_reduction_applied: Set to True if the layer embeddings passed to the methods `fit` and `score`
+                                      are already transformed by the dimension reduction models, e.g. during their
+                                      extraction (see the input `transform_models` of `extract_layer_embeddings`).
+                                      The models are then kept by the detector (attribute `transform_models`), e.g.
+                                      when it is saved, but they are not applied again. Layer embeddings that are
+                                      not transformed should be transformed using `transform_layer_embeddings` with
+                                      these models before they are scored.
         :param neighborhood_constant: float value in (0, 1), that specifies the number of nearest neighbors as a
                                       function of the number of samples (data size). If `N` is the number of samples,
                                       then the number of neighbors is set to `N^neighborhood_constant`. It is
@@ -135,32 +170,73 @@ class DetectorLayerStatistics:
                                          find the nearest neighbors. The NN-descent method is used for approximate
                                          nearest neighbor searches.
         :param n_jobs: Number of parallel jobs or processes. Set to -1 to use all the available cpu cores.
+        :param n_jobs_layers: Number of layers that are processed in parallel. If this is larger than 1, the test
+                              statistics of the layers are fit and scored by worker processes that access the layer
+                              embeddings via shared memory, and the `n_jobs` parallel jobs are split equally among
+                              the workers. The layers are processed sequentially if a `graph_cache` is specified,
+                              or if the test statistics share KNN indices (multi-statistic mode).
         :param low_memory: Set to True to enable the low memory option of the `NN-descent` method. Note that this
                            is likely to increase the running time.
+        :param graph_cache: None or a `KNNGraphCache` object that is shared by the detectors of the cross-validation
+                            folds. If specified, the KNN indices of each layer are obtained by restricting the indices
+                            built on the overlapping training data of the other folds, which is much faster than
+                            building them from scratch.
+        :param cascade_layer_order: None or a list with the order in which the layers are evaluated in the cascade
+                                    mode of the method `score` (see the input `cascade_threshold`), e.g. with the
+                                    cheapest or the most informative layers first. Every layer should appear
+                                    exactly once. By default, the layers are evaluated from the first to the last.
+        :param cascade_max_layer_score: None or a float value with the upper bound on the negative log p-value of a
+                                        layer that is assumed for the layers that are not yet evaluated in the
+                                        cascade mode. The default value `-log(PVALUE_MIN)` is the largest value that
+                                        the p-value estimates can take, and then the cascade mode does not change
+                                        any decision. A smaller value allows more samples to exit early, but the
+                                        decision of a sample changes if one of its skipped layers has a larger
+                                        negative log p-value. This value should be chosen on validation data by
+                                        comparing the decisions with those of the full scoring
+                                        (`cascade_threshold = None`).
         :param seed_rng: int value specifying the seed for the random number generator. This is passed around to
                          all the classes/functions that require random number generation. Set this to a fixed value
                          for reproducible results.
         """
-        self.layer_statistic = layer_statistic.lower()
+        # A list of test statistics selects the multi-statistic mode
+        self.multi_statistic = not isinstance(layer_statistic, str)
+        if self.multi_statistic:
+            self.layer_statistic = [v.lower() for v in layer_statistic]
+        else:
+            self.layer_statistic = layer_statistic.lower()
+
         self.score_type = score_type.lower()
         self.ood_detection = ood_detection
         self.pvalue_fusion = pvalue_fusion
         self.use_top_ranked = use_top_ranked
         self.num_top_ranked = num_top_ranked
         self.skip_dim_reduction = skip_dim_reduction
+        self.dim_reduction_applied = dim_reduction_applied
         self.neighborhood_constant = neighborhood_constant
         self.n_neighbors = n_neighbors
         self.metric = metric
         self.metric_kwargs = metric_kwargs
         self.approx_nearest_neighbors = approx_nearest_neighbors
         self.n_jobs = n_jobs
+        self.n_jobs_layers = n_jobs_layers
         self.low_memory = low_memory
+        self.graph_cache = graph_cache
+        self.cascade_layer_order = cascade_layer_order
+        if cascade_max_layer_score is None:
+            self.cascade_max_layer_score = -np.log(PVALUE_MIN)
+        else:
+            self.cascade_max_layer_score = cascade_max_layer_score
+
         self.seed_rng = seed_rng
 
         np.random.seed(self.seed_rng)
-        if self.layer_statistic not in TEST_STATS_SUPPORTED:
-            raise ValueError("Invalid value '{}' for the input argument 'layer_statistic'.".
-                             format(self.layer_statistic))
+        layer_statistics = self.layer_statistic if self.multi_statistic else [self.layer_statistic]
+        for v in layer_statistics:
+            if v not in TEST_STATS_SUPPORTED:
+                raise ValueError("Invalid value '{}' for the input argument 'layer_statistic'.".format(v))
+
+        if len(set(layer_statistics)) < len(layer_statistics) or (not layer_statistics):
+            raise ValueError("Input 'layer_statistic' should be a non-empty list of distinct test statistics.")
 
         if self.score_type not in SCORE_TYPES:
             raise ValueError("Invalid value '{}' for the input argument 'score_type'.".format(self.score_type))
@@ -168,10 +244,10 @@ class DetectorLayerStatistics:
         if self.pvalue_fusion not in ['harmonic_mean', 'fisher']:
             raise ValueError("Invalid value '{}' for the input argument 'pvalue_fusion'.".format(self.pvalue_fusion))
 
-        if self.layer_statistic in {'lid', 'lle'}:
-            if not self.skip_dim_reduction:
+        for v in layer_statistics:
+            if (v in {'lid', 'lle'}) and (not self.skip_dim_reduction):
                 logger.warning("Option 'skip_dim_reduction' is set to False for the test statistic '{}'. Making sure "
-                               "that this is the intended setting.".format(self.layer_statistic))
+                               "that this is the intended setting.".format(v))
 
         # Load the dimension reduction models per-layer if required
         self.transform_models = None
@@ -191,8 +267,10 @@ class DetectorLayerStatistics:
         self.labels_unique = None
         self.n_classes = None
         self.n_samples = None
-        # List of test statistic model instances for each layer
+        # List of test statistic model instances for each layer. This is empty while the models are held by the
+        # worker processes of the layer-parallel executor
         self.test_stats_models = []
+        self.executor = None
         # dict mapping each class `c` to the joint density model of the test statistics conditioned on the predicted
         # or true class being `c`
         self.density_models_pred = dict()
@@ -209,6 +287,11 @@ class DetectorLayerStatistics:
         # the distribution under the null hypothesis of no adversarial or OOD data
         self.test_stats_pred_null = None
         self.test_stats_true_null = None
+        # Multi-statistic mode: dict mapping each test statistic to its detector
+        self.detectors = dict()
+        # List with the `SharedNeighbors` object of each layer, which is shared with the other test statistics. This
+        # is set only while fitting the detector of one statistic in the multi-statistic mode
+        self.shared_neighbors = None
 
     def fit(self, layer_embeddings, labels, labels_pred, **kwargs):
         """
@@ -224,8 +307,52 @@ class DetectorLayerStatistics:
         :param kwargs: dict with additional keyword arguments that can be passed to the `fit` method of the test
                        statistic class.
 
+        :return: Instance of the class with all parameters fit to the data. In the multi-statistic mode, the test
+                 statistics of the training data are available from the attributes `test_stats_pred_null` and
+                 `test_stats_true_null` as dicts keyed by the name of the test statistic.
+        """
+        return self._fit(layer_embeddings, labels, labels_pred, False, **kwargs)
+
+    def update(self, layer_embeddings, labels, labels_pred, **kwargs):
+        """
+        Update the detector with new natural (non-adversarial) samples added to its training data. The KNN indices
+        of the test statistics at each layer are extended with the new samples (see `KNNIndex.add`) instead of
+        being built from scratch, and the numbers of nearest neighbors from the previous fit are kept. The rest of
+        the detector (null distribution of the test statistics, density or p-value models) is fit again on the
+        test statistics of all the samples.
+
+        NOTE: the layers are updated sequentially. If the layers were fit in parallel (`n_jobs_layers > 1`), the
+        test statistic models are retrieved from the worker processes and the workers are stopped.
+
+        :param layer_embeddings: same format as the method `fit`. The first `n` rows of the array from each layer
+                                 should be the data from the previous call to `fit` or `update`, followed by the new
+                                 samples.
+        :param labels: numpy array of labels, in the same order as `layer_embeddings`.
+        :param labels_pred: numpy array of class predictions made by the DNN, in the same order as
+                            `layer_embeddings`.
+        :param kwargs: same as the method `fit`.
+
         :return: Instance of the class with all parameters fit to the data.
         """
+        if self.n_layers is None:
+            raise ValueError("The method 'fit' should be called before 'update'.")
+
+        self._check_num_layers(layer_embeddings)
+        if labels.shape[0] < self.n_samples:
+            raise ValueError("Expecting at least the {:d} samples from the previous fit, but received {:d} samples.".
+                             format(self.n_samples, labels.shape[0]))
+
+        logger.info("Updating the detector with {:d} new samples.".format(labels.shape[0] - self.n_samples))
+        return self._fit(layer_embeddings, labels, labels_pred, True, **kwargs)
+
+    def _fit(self, layer_embeddings, labels, labels_pred, update, **kwargs):
+        """
+        Implementation of the methods `fit` and `update`. Set `update = True` to update the fitted test statistic
+        models with the new samples instead of fitting new models.
+        """
+        if self.multi_statistic:
+            return self._fit_multi(layer_embeddings, labels, labels_pred, update, **kwargs)
+
         self.n_layers = len(layer_embeddings)
         self.labels_unique = np.unique(labels)
         self.n_classes = len(self.labels_unique)
@@ -270,97 +397,17 @@ class DetectorLayerStatistics:
 
         self.log_class_priors = np.log(self.log_class_priors) - np.log(self.n_samples)
 
-        for i in range(self.n_layers):
-            if self.transform_models:
-                logger.info("Transforming the embeddings from layer {:d}.".format(i + 1))
-                data_proj = transform_data_from_model(layer_embeddings[i], self.transform_models[i])
-                logger.info("Input dimension = {:d}, projected dimension = {:d}".
-                            format(layer_embeddings[i].shape[1], data_proj.shape[1]))
-            else:
-                data_proj = layer_embeddings[i]
-
-            logger.info("Parameter estimation and test statistics calculation for layer {:d}:".format(i + 1))
-            ts_obj = None
-            # Bootstrap p-values are used only if `self.use_top_ranked = True` because in this case the test
-            # statistics across the layers are ranked based on the p-values
-            kwargs_fit = {'bootstrap': self.use_top_ranked}
-            if self.layer_statistic == 'multinomial':
-                ts_obj = MultinomialScore(
-                    neighborhood_constant=self.neighborhood_constant,
-                    n_neighbors=self.n_neighbors,
-                    metric=self.metric,
-                    metric_kwargs=self.metric_kwargs,
-                    shared_nearest_neighbors=False,
-                    approx_nearest_neighbors=self.approx_nearest_neighbors,
-                    n_jobs=self.n_jobs,
-                    low_memory=self.low_memory,
-                    seed_rng=self.seed_rng
-                )
-                if 'combine_low_proba_classes' in kwargs:
-                    kwargs_fit['combine_low_proba_classes'] = kwargs['combine_low_proba_classes']
-                if 'n_classes_multinom' in kwargs:
-                    kwargs_fit['n_classes_multinom'] = kwargs['n_classes_multinom']
-
-            elif self.layer_statistic == 'binomial':
-                ts_obj = BinomialScore(
-                    neighborhood_constant=self.neighborhood_constant,
-                    n_neighbors=self.n_neighbors,
-                    metric=self.metric,
-                    metric_kwargs=self.metric_kwargs,
-                    shared_nearest_neighbors=False,
-                    approx_nearest_neighbors=self.approx_nearest_neighbors,
-                    n_jobs=self.n_jobs,
-                    low_memory=self.low_memory,
-                    seed_rng=self.seed_rng
-                )
-            elif self.layer_statistic == 'lid':
-                ts_obj = LIDScore(
-                    neighborhood_constant=self.neighborhood_constant,
-                    n_neighbors=self.n_neighbors,
-                    metric='euclidean',     # use 'euclidean' metric for LID estimation
-                    metric_kwargs=None,
-                    approx_nearest_neighbors=self.approx_nearest_neighbors,
-                    n_jobs=self.n_jobs,
-                    low_memory=self.low_memory,
-                    seed_rng=self.seed_rng
-                )
-            elif self.layer_statistic == 'lle':
-                ts_obj = LLEScore(
-                    neighborhood_constant=self.neighborhood_constant,
-                    n_neighbors=self.n_neighbors,
-                    metric=self.metric,
-                    metric_kwargs=self.metric_kwargs,
-                    approx_nearest_neighbors=self.approx_nearest_neighbors,
-                    n_jobs=self.n_jobs,
-                    low_memory=self.low_memory,
-                    seed_rng=self.seed_rng
-                )
-            elif self.layer_statistic == 'distance':
-                ts_obj = DistanceScore(
-                    neighborhood_constant=self.neighborhood_constant,
-                    n_neighbors=self.n_neighbors,
-                    metric=self.metric,
-                    metric_kwargs=self.metric_kwargs,
-                    approx_nearest_neighbors=self.approx_nearest_neighbors,
-                    n_jobs=self.n_jobs,
-                    low_memory=self.low_memory,
-                    seed_rng=self.seed_rng
-                )
-            elif self.layer_statistic == 'trust':
-                ts_obj = TrustScore(
-                    neighborhood_constant=self.neighborhood_constant,
-                    n_neighbors=self.n_neighbors,
-                    metric=self.metric,
-                    metric_kwargs=self.metric_kwargs,
-                    approx_nearest_neighbors=self.approx_nearest_neighbors,
-                    n_jobs=self.n_jobs,
-                    low_memory=self.low_memory,
-                    seed_rng=self.seed_rng
-                )
-
-            test_stats_temp, pvalues_temp = ts_obj.fit(
-                data_proj, labels, labels_pred, labels_unique=self.labels_unique, **kwargs_fit
-            )
+        # Bootstrap p-values are used only if `self.use_top_ranked = True` because in this case the test
+        # statistics across the layers are ranked based on the p-values
+        kwargs_fit = {'bootstrap': self.use_top_ranked}
+        if self.layer_statistic == 'multinomial':
+            if 'combine_low_proba_classes' in kwargs:
+                kwargs_fit['combine_low_proba_classes'] = kwargs['combine_low_proba_classes']
+            if 'n_classes_multinom' in kwargs:
+                kwargs_fit['n_classes_multinom'] = kwargs['n_classes_multinom']
+
+        results = self._fit_layers(layer_embeddings, labels, labels_pred, kwargs_fit, update=update)
+        for i, (test_stats_temp, pvalues_temp) in enumerate(results):
             '''
             - `test_stats_temp` will be a numpy array of shape `(self.n_samples, self.n_classes + 1)` with a vector 
             of test statistics for each sample.
@@ -370,7 +417,6 @@ class DetectorLayerStatistics:
             - `pvalues_temp` is also a numpy array of the same shape with the negative log transformed p-values 
             corresponding to the test statistics.
             '''
-            self.test_stats_models.append(ts_obj)
             for j, c in enumerate(self.labels_unique):
                 # Test statistics and negative log p-values from layer `i`
                 test_stats_pred[c][:, i] = test_stats_temp[indices_pred[c], 0]
@@ -453,7 +499,7 @@ class DetectorLayerStatistics:
         return self
 
     def score(self, layer_embeddings, labels_pred, return_corrected_predictions=False, start_layer=0,
-              test_layer_pairs=True, is_train=False):
+              test_layer_pairs=True, is_train=False, cascade_threshold=None):
         """
         Given the layer embeddings (including possibly the input itself) and the predicted classes for test data,
         score them on how likely they are to be adversarial or out-of-distribution (OOD). Larger values of the
@@ -475,8 +521,21 @@ class DetectorLayerStatistics:
                                  layers. These additional p-values are used by the method which combines p-values
                                  using Fisher's method, harmonic mean of p-values etc.
         :param is_train: Set to True if the inputs are the same non-adversarial inputs used with the `fit` method.
-
-        :return: (scores [, corrected_classes])
+        :param cascade_threshold: None or a float threshold on the scores, which selects the cascade mode. This
+                                  mode is supported only with `score_type = 'pvalue'` and `use_top_ranked = False`.
+                                  The layers are evaluated one at a time in the order `self.cascade_layer_order`,
+                                  and the fused score of each sample is bounded by assuming that its unevaluated
+                                  layers have negative log p-values in `[0, self.cascade_max_layer_score]`. A sample
+                                  is not evaluated on the remaining layers once both bounds are on the same side of
+                                  the threshold, i.e. its detection decision can no longer change. The scores of
+                                  these samples are set to the bound on the side of their decision (the lower bound
+                                  if the score is above the threshold, and the upper bound otherwise). The method
+                                  `score_all` also returns the number of layers evaluated for each sample. This mode
+                                  does not support layer pairs (`test_layer_pairs` should be False) and the training
+                                  data (`is_train` should be False).
+
+        :return: (scores [, corrected_classes]). In the multi-statistic mode, a dict mapping the name of each test
+                 statistic to these values is returned.
             - scores: numpy array of scores for detection or ranking. The array should have shape
                       `(labels_pred.shape[0], )` and larger values correspond to a higher higher probability that
                       the sample is adversarial or OOD. Score corresponding to OOD detection is returned if
@@ -485,11 +544,64 @@ class DetectorLayerStatistics:
             - corrected_classes: numpy array of the corrected class predictions. Has same shape and dtype as the
                                  array `labels_pred`.
         """
-        n_test = labels_pred.shape[0]
-        l = len(layer_embeddings)
-        if l != self.n_layers:
-            raise ValueError("Expecting {:d} layers in the input data, but received {:d}".format(self.n_layers, l))
+        if self.multi_statistic:
+            # Dimension reduction is applied once and shared by the detectors of the test statistics
+            self._check_num_layers(layer_embeddings)
+            if self._apply_dim_reduction():
+                layer_embeddings = transform_layer_embeddings(layer_embeddings, self.transform_models)
+
+            return {v: det.score(layer_embeddings, labels_pred,
+                                 return_corrected_predictions=return_corrected_predictions, start_layer=start_layer,
+                                 test_layer_pairs=test_layer_pairs, is_train=is_train,
+                                 cascade_threshold=cascade_threshold)
+                    for v, det in self.detectors.items()}
+
+        results = self.score_all(layer_embeddings, labels_pred, start_layer=start_layer,
+                                 test_layer_pairs=test_layer_pairs, is_train=is_train,
+                                 cascade_threshold=cascade_threshold)
+        scores = results['scores_ood'] if self.ood_detection else results['scores_adver']
+        if return_corrected_predictions:
+            return scores, results['corrected_classes']
+        else:
+            return scores
+
+    def score_all(self, layer_embeddings, labels_pred, start_layer=0, test_layer_pairs=True, is_train=False,
+                  cascade_threshold=None):
+        """
+        Same as the method `score`, but the adversarial scores, the OOD scores, the corrected class predictions, and
+        the per-layer p-values are all returned from a single pass over the layers. This avoids computing the
+        layer test statistics twice when both adversarial and OOD detection are performed on the same inputs.
+
+        The inputs are the same as the method `score`.
+        :return: dict with the following keys. In the multi-statistic mode, a dict mapping the name of each test
+                 statistic to this dict is returned.
+            - 'scores_adver': numpy array of shape `(labels_pred.shape[0], )` with the adversarial detection scores.
+            - 'scores_ood': numpy array of the same shape with the OOD detection scores.
+            - 'corrected_classes': numpy array of the corrected class predictions. Has same shape and dtype as the
+                                   array `labels_pred`.
+            - 'pvalues_layers': numpy array of shape `(labels_pred.shape[0], n_classes + 1, n_layers)` with the
+                                negative log p-values of the test statistics at each layer. Index 0 of the second
+                                axis is conditioned on the predicted class, and index `j + 1` is conditioned on the
+                                candidate true class `labels_unique[j]`. In the cascade mode, the layers that are
+                                not evaluated for a sample have NaN values.
+            - 'n_layers_used': numpy array of shape `(labels_pred.shape[0], )` with the number of layers evaluated
+                               for each sample. This is smaller than the number of layers only in the cascade mode.
+        """
+        self._check_num_layers(layer_embeddings)
+        if self.multi_statistic:
+            if self._apply_dim_reduction():
+                layer_embeddings = transform_layer_embeddings(layer_embeddings, self.transform_models)
 
+            return {v: det.score_all(layer_embeddings, labels_pred, start_layer=start_layer,
+                                     test_layer_pairs=test_layer_pairs, is_train=is_train,
+                                     cascade_threshold=cascade_threshold)
+                    for v, det in self.detectors.items()}
+
+        if cascade_threshold is not None:
+            return self._score_cascade(layer_embeddings, labels_pred, cascade_threshold, start_layer,
+                                       test_layer_pairs, is_train)
+
+        n_test = labels_pred.shape[0]
         # Should bootstrap resampling be used to estimate the p-values at each layer?
         bootstrap = True
         if self.score_type in ('density', 'klpe'):
@@ -497,105 +609,438 @@ class DetectorLayerStatistics:
                 # The p-values estimated are never used in this case. Therefore, skipping bootstrap to make it faster
                 bootstrap = False
 
-        # Test statistics at each layer conditioned on the predicted class and candidate true classes
-        test_stats_pred = np.zeros((n_test, self.n_layers))
-        pvalues_pred = np.zeros((n_test, self.n_layers))
-        test_stats_true = {c: np.zeros((n_test, self.n_layers)) for c in self.labels_unique}
-        pvalues_true = {c: np.zeros((n_test, self.n_layers)) for c in self.labels_unique}
-        for i in range(self.n_layers):
-            if self.transform_models:
-                # Dimension reduction
-                data_proj = transform_data_from_model(layer_embeddings[i], self.transform_models[i])
-            else:
-                data_proj = layer_embeddings[i]
-
-            # Test statistics and negative log p-values for layer `i`
-            test_stats_temp, pvalues_temp = self.test_stats_models[i].score(data_proj, labels_pred, is_train=is_train,
-                                                                            bootstrap=bootstrap)
-            # `test_stats_temp` and `pvalues_temp` will have shape `(n_test, self.n_classes + 1)`
-
-            test_stats_pred[:, i] = test_stats_temp[:, 0]
-            pvalues_pred[:, i] = pvalues_temp[:, 0]
-            for j, c in enumerate(self.labels_unique):
-                test_stats_true[c][:, i] = test_stats_temp[:, j + 1]
-                pvalues_true[c][:, i] = pvalues_temp[:, j + 1]
+        results = self._score_layers(layer_embeddings, labels_pred, is_train, bootstrap)
+        # Test statistics and negative log p-values at each layer, as arrays of shape
+        # `(n_test, self.n_classes + 1, self.n_layers)`. Index 0 of the second axis corresponds to the predicted
+        # class and index `j + 1` corresponds to `self.labels_unique[j]` being the candidate true class
+        test_stats = np.stack([v[0] for v in results], axis=2)
+        pvalues = np.stack([v[1] for v in results], axis=2)
+        pvalues_layers = pvalues
 
         if self.use_top_ranked:
             # For the test statistics conditioned on the predicted class, take the largest `self.num_top_ranked`
-            # negative log p-values across the layers
-            test_stats_pred, pvalues_pred = self._get_top_ranked(test_stats_pred, pvalues_pred, reverse=True)
-
-            # For the test statistics conditioned on the true class, take the smallest `self.num_top_ranked`
-            # negative log p-values across the layers
-            for c in self.labels_unique:
-                test_stats_true[c], pvalues_true[c] = self._get_top_ranked(test_stats_true[c], pvalues_true[c])
+            # negative log p-values across the layers. For the test statistics conditioned on the true class, take
+            # the smallest `self.num_top_ranked` negative log p-values across the layers
+            reverse = np.zeros(1 + self.n_classes, dtype=bool)
+            reverse[0] = True
+            test_stats, pvalues = self._get_top_ranked(test_stats, pvalues, reverse=reverse)
 
         # Adversarial or OOD scores for the test samples and the corrected class predictions
         if self.score_type == 'density':
             scores_adver, scores_ood, corrected_classes = self._score_density_based(
-                labels_pred, test_stats_pred, test_stats_true,
-                return_corrected_predictions=return_corrected_predictions
+                labels_pred, test_stats, return_corrected_predictions=True
             )
         elif self.score_type == 'pvalue':
             if test_layer_pairs:
-                n_pairs = int(0.5 * self.n_layers * (self.n_layers - 1))
+                nl = test_stats.shape[2]
+                n_pairs = int(0.5 * nl * (nl - 1))
                 # logger.info("Estimating p-values for the test statistics from {:d} layer pairs.".format(n_pairs))
-                pvalues_pred_pairs = np.zeros((n_test, n_pairs))
-                pvalues_true_pairs = dict()
-                for c in self.labels_unique:
+                pvalues_pairs = np.zeros((n_test, 1 + self.n_classes, n_pairs))
+                for j, c in enumerate(self.labels_unique):
                     # Samples predicted into class `c`
                     ind = np.where(labels_pred == c)[0]
-                    pvalues_pred_pairs[ind, :] = pvalue_score_all_pairs(
-                        self.test_stats_pred_null[c], test_stats_pred[ind, :], log_transform=True, bootstrap=bootstrap
+                    pvalues_pairs[ind, 0, :] = pvalue_score_all_pairs(
+                        self.test_stats_pred_null[c], test_stats[ind, 0, :], log_transform=True, bootstrap=bootstrap
                     )
-                    pvalues_true_pairs[c] = pvalue_score_all_pairs(
-                        self.test_stats_true_null[c], test_stats_true[c], log_transform=True, bootstrap=bootstrap
+                    pvalues_pairs[:, j + 1, :] = pvalue_score_all_pairs(
+                        self.test_stats_true_null[c], test_stats[:, j + 1, :], log_transform=True,
+                        bootstrap=bootstrap
                     )
-                    # Append columns corresponding to the p-values from the layer pairs
-                    pvalues_true[c] = np.hstack((pvalues_true[c], pvalues_true_pairs[c]))
 
-                # Append columns corresponding to the p-values from the layer pairs
-                pvalues_pred = np.hstack((pvalues_pred, pvalues_pred_pairs))
+                # Append the p-values from the layer pairs along the last axis
+                pvalues = np.concatenate((pvalues, pvalues_pairs), axis=2)
 
             scores_adver, scores_ood, corrected_classes = self._score_pvalue_based(
-                labels_pred, pvalues_pred, pvalues_true,
-                return_corrected_predictions=return_corrected_predictions, start_layer=start_layer
+                labels_pred, pvalues, return_corrected_predictions=True,
+                start_layer=start_layer
             )
         elif self.score_type == 'klpe':
             scores_adver, scores_ood, corrected_classes = self._score_klpe(
-                labels_pred, test_stats_pred, test_stats_true,
-                return_corrected_predictions=return_corrected_predictions
+                labels_pred, test_stats, return_corrected_predictions=True
             )
         else:
             raise ValueError("Invalid score type '{}'".format(self.score_type))
 
-        if return_corrected_predictions:
+        return {
+            'scores_adver': scores_adver,
+            'scores_ood': scores_ood,
+            'corrected_classes': corrected_classes,
+            'pvalues_layers': pvalues_layers,
+            'n_layers_used': np.full(n_test, self.n_layers)
+        }
+
+    def _score_cascade(self, layer_embeddings, labels_pred, threshold, start_layer, test_layer_pairs, is_train):
+        """
+        Cascade mode of the method `score_all` (see the input `cascade_threshold` of the method `score`). The
+        layers are evaluated one at a time, and only on the samples whose detection decision at the threshold is
+        not yet fixed by the bounds on their fused score.
+
+        :return: dict in the same format as the method `score_all`.
+        """
+        if self.score_type != 'pvalue' or self.use_top_ranked:
+            raise ValueError("The cascade mode is supported only with score type 'pvalue' and without the top-ranked "
+                             "test statistics.")
+
+        if test_layer_pairs:
+            raise ValueError("The cascade mode does not support the test statistics from layer pairs. Set "
+                             "'test_layer_pairs' to False.")
+
+        if is_train:
+            # The test statistics of the training data depend on all the training samples. Scoring them on subsets
+            # of the samples is not supported
+            raise ValueError("The cascade mode is not supported on the training data ('is_train' = True).")
+
+        order = list(range(self.n_layers)) if (self.cascade_layer_order is None) else list(self.cascade_layer_order)
+        if sorted(order) != list(range(self.n_layers)):
+            raise ValueError("Input 'cascade_layer_order' should have each of the {:d} layers exactly once.".
+                             format(self.n_layers))
+
+        # Only the layers included in the p-value fusion are evaluated
+        mask_layers = np.zeros(self.n_layers, dtype=np.bool)
+        mask_layers[start_layer:] = True
+        order = [i for i in order if mask_layers[i]]
+
+        n_test = labels_pred.shape[0]
+        n_cols = 1 + self.n_classes
+        pvalues_layers = np.full((n_test, n_cols, self.n_layers), np.nan)
+        n_layers_used = np.zeros(n_test, dtype=np.int64)
+        scores_adver = np.zeros(n_test)
+        scores_ood = np.zeros(n_test)
+        corrected_classes = copy.copy(labels_pred)
+        # The fused score is non-decreasing in the negative log p-values conditioned on the predicted class, and
+        # non-increasing in those conditioned on the true classes. The bounds on the scores are found by setting the
+        # negative log p-values of the unevaluated layers to the limits of their range
+        fill_lower = np.full(n_cols, self.cascade_max_layer_score)
+        fill_lower[0] = 0.
+        fill_upper = self.cascade_max_layer_score - fill_lower
+        ind_active = np.arange(n_test)
+        for k, i in enumerate(order):
+            if ind_active.shape[0] == 0:
+                break
+
+            _, pvalues_layers[ind_active, :, i] = self._score_layer_subset(layer_embeddings, i, ind_active,
+                                                                           labels_pred[ind_active], is_train)
+            n_layers_used[ind_active] += 1
+            pvalues = pvalues_layers[ind_active][:, :, order[:(k + 1)]]
+            n_rem = len(order) - k - 1
+            bounds = []
+            for fill in (fill_lower, fill_upper):
+                arr_fill = np.broadcast_to(fill[np.newaxis, :, np.newaxis], (ind_active.shape[0], n_cols, n_rem))
+                bounds.append(self._score_pvalue_based(labels_pred[ind_active],
+                                                       np.concatenate((pvalues, arr_fill), axis=2),
+                                                       return_corrected_predictions=True))
+
+            (adver_lower, ood_lower, _), (adver_upper, ood_upper, classes) = bounds
             if self.ood_detection:
-                return scores_ood, corrected_classes
+                is_above = ood_lower >= threshold
+                is_below = ood_upper < threshold
             else:
-                return scores_adver, corrected_classes
+                is_above = adver_lower >= threshold
+                is_below = adver_upper < threshold
+
+            mask_done = is_above | is_below
+            if n_rem == 0:
+                mask_done[:] = True
+
+            ind = ind_active[mask_done]
+            scores_adver[ind] = np.where(is_above[mask_done], adver_lower[mask_done], adver_upper[mask_done])
+            scores_ood[ind] = np.where(is_above[mask_done], ood_lower[mask_done], ood_upper[mask_done])
+            # The corrected class predictions are based on the evaluated layers
+            corrected_classes[ind] = classes[mask_done]
+            ind_active = ind_active[~mask_done]
+
+        logger.info("Cascade scoring: average number of layers evaluated per sample = {:.2f} (out of {:d}).".
+                    format(np.mean(n_layers_used), len(order)))
+        return {
+            'scores_adver': scores_adver,
+            'scores_ood': scores_ood,
+            'corrected_classes': corrected_classes,
+            'pvalues_layers': pvalues_layers,
+            'n_layers_used': n_layers_used
+        }
+
+    def _check_num_layers(self, layer_embeddings):
+        l = len(layer_embeddings)
+        if l != self.n_layers:
+            raise ValueError("Expecting {:d} layers in the input data, but received {:d}".format(self.n_layers, l))
+
+    def _test_statistic_args(self, i, shared_neighbors=None):
+        """
+        Class and constructor arguments of the test statistic for layer `i`.
+
+        :param i: index of the layer.
+        :param shared_neighbors: None or the `SharedNeighbors` object shared with the other test statistics of the
+                                 layer.
+        :return: (cls, kwargs_ts)
+        """
+        kwargs_ts = {
+            'neighborhood_constant': self.neighborhood_constant,
+            'n_neighbors': self.n_neighbors,
+            'metric': self.metric,
+            'metric_kwargs': self.metric_kwargs,
+            'approx_nearest_neighbors': self.approx_nearest_neighbors,
+            'n_jobs': self.n_jobs,
+            'low_memory': self.low_memory,
+            'graph_cache': self.graph_cache,
+            'graph_cache_key': i,
+            'shared_neighbors': shared_neighbors,
+            'seed_rng': self.seed_rng
+        }
+        if self.layer_statistic in ('multinomial', 'binomial'):
+            kwargs_ts['shared_nearest_neighbors'] = False
+        elif self.layer_statistic == 'lid':
+            # use 'euclidean' metric for LID estimation
+            kwargs_ts['metric'] = 'euclidean'
+            kwargs_ts['metric_kwargs'] = None
+
+        return TEST_STATISTIC_CLASSES[self.layer_statistic], kwargs_ts
+
+    def _num_layer_workers(self):
+        """
+        Number of worker processes used to process the layers in parallel. Returns 1 if the layers should be
+        processed sequentially.
+        """
+        if (self.n_jobs_layers <= 1) or (self.n_layers < 2):
+            return 1
+
+        if (self.graph_cache is not None) or (self.shared_neighbors is not None):
+            logger.info("The KNN indices are shared between the folds or test statistics. Processing the layers "
+                        "sequentially.")
+            return 1
+
+        return min(self.n_jobs_layers, self.n_layers)
+
+    def _apply_dim_reduction(self):
+        # The dimension reduction models are not applied if the inputs are already transformed
+        return bool(self.transform_models) and (not self.dim_reduction_applied)
+
+    def _transform_layer(self, layer_embeddings, i, ind=None):
+        data = layer_embeddings[i] if (ind is None) else layer_embeddings[i][ind]
+        if self._apply_dim_reduction():
+            # Dimension reduction
+            return transform_data_from_model(data, self.transform_models[i])
         else:
-            if self.ood_detection:
-                return scores_ood
+            return data
+
+    def _fit_layers(self, layer_embeddings, labels, labels_pred, kwargs_fit, update=False):
+        """
+        Fit the test statistic of each layer, either sequentially or in parallel using worker processes.
+
+        :param layer_embeddings: same as the method `fit`.
+        :param labels: same as the method `fit`.
+        :param labels_pred: same as the method `fit`.
+        :param kwargs_fit: dict with keyword arguments for the `fit` method of the test statistics.
+        :param update: Set to True in order to update the fitted test statistic models using their method
+                       `fit_update`. This is done sequentially.
+        :return: list with the tuple `(test_stats, p_values)` of each layer.
+        """
+        models_prev = self.test_stats_models
+        if self.executor is not None:
+            if update:
+                models_prev = self.executor.get_models(self.n_layers)
+
+            self.executor.close()
+            self.executor = None
+
+        self.test_stats_models = []
+        n_workers = 1 if update else self._num_layer_workers()
+        if n_workers > 1:
+            # Imported only when needed, since the worker processes are not used by default
+            from detectors.layer_parallel import LayerParallelExecutor
+
+            # Split the parallel jobs between the layers (worker processes) and the test statistic of each layer
+            self.executor = LayerParallelExecutor(n_workers, n_jobs=max(1, get_num_jobs(self.n_jobs) // n_workers))
+            logger.info("Parameter estimation and test statistics calculation for {:d} layers in parallel.".
+                        format(self.n_layers))
+            specs, buffers = self.executor.share(
+                self._transform_layer(layer_embeddings, i) for i in range(self.n_layers)
+            )
+            try:
+                return self.executor.fit(specs, [self._test_statistic_args(i) + (kwargs_fit, )
+                                                 for i in range(self.n_layers)],
+                                         labels, labels_pred, self.labels_unique)
+            finally:
+                self.executor.release(buffers)
+
+        results = []
+        for i in range(self.n_layers):
+            data_proj = self._transform_layer(layer_embeddings, i)
+            if self._apply_dim_reduction():
+                logger.info("Transformed the embeddings from layer {:d}. Input dimension = {:d}, projected "
+                            "dimension = {:d}".format(i + 1, layer_embeddings[i].shape[1], data_proj.shape[1]))
+
+            logger.info("Parameter estimation and test statistics calculation for layer {:d}:".format(i + 1))
+            shared_neighbors = None if (self.shared_neighbors is None) else self.shared_neighbors[i]
+            if update:
+                ts_obj = models_prev[i]
+                ts_obj.shared_neighbors = shared_neighbors
+                results.append(ts_obj.fit_update(data_proj, labels, labels_pred, labels_unique=self.labels_unique,
+                                                 **kwargs_fit))
             else:
-                return scores_adver
+                cls, kwargs_ts = self._test_statistic_args(i, shared_neighbors=shared_neighbors)
+                ts_obj = cls(**kwargs_ts)
+                results.append(ts_obj.fit(data_proj, labels, labels_pred, labels_unique=self.labels_unique,
+                                          **kwargs_fit))
+
+            # The shared neighbors are only needed while fitting. The test statistic keeps views of their queries
+            ts_obj.shared_neighbors = None
+            self.test_stats_models.append(ts_obj)
+
+        return results
+
+    def _score_layers(self, layer_embeddings, labels_pred, is_train, bootstrap):
+        """
+        Calculate the test statistics and p-values of each layer, either sequentially or in parallel using the
+        worker processes that fit the test statistics.
+
+        :return: list with the tuple `(test_stats, p_values)` of each layer.
+        """
+        if self.executor is not None:
+            specs, buffers = self.executor.share(
+                self._transform_layer(layer_embeddings, i) for i in range(self.n_layers)
+            )
+            try:
+                return self.executor.score(specs, labels_pred, is_train=is_train, bootstrap=bootstrap)
+            finally:
+                self.executor.release(buffers)
+
+        return [self.test_stats_models[i].score(self._transform_layer(layer_embeddings, i), labels_pred,
+                                                is_train=is_train, bootstrap=bootstrap)
+                for i in range(self.n_layers)]
+
+    def _score_layer_subset(self, layer_embeddings, i, ind, labels_pred, is_train):
+        """
+        Calculate the test statistics and p-values of layer `i` for the subset of samples `ind`.
+
+        :return: tuple `(test_stats, p_values)`.
+        """
+        data = self._transform_layer(layer_embeddings, i, ind=ind)
+        if self.executor is not None:
+            specs, buffers = self.executor.share([data])
+            try:
+                return self.executor.score(specs, labels_pred, layers=[i], is_train=is_train, bootstrap=True)[0]
+            finally:
+                self.executor.release(buffers)
+
+        return self.test_stats_models[i].score(data, labels_pred, is_train=is_train, bootstrap=True)
+
+    def __getstate__(self):
+        # The worker processes are not pickled. The test statistic models are retrieved from them instead
+        state = self.__dict__.copy()
+        if self.executor is not None:
+            state['test_stats_models'] = self.executor.get_models(self.n_layers)
+
+        state['executor'] = None
+        return state
+
+    def _fit_multi(self, layer_embeddings, labels, labels_pred, update, **kwargs):
+        """
+        Fit method for the multi-statistic mode. The layer embeddings are transformed once, and a detector is fit for
+        each test statistic with the nearest neighbors of each layer shared by all the test statistics. If `update`
+        is True, the detector of each test statistic is updated instead (see the method `update`). In this case, the
+        shared neighbors are found again on all the samples.
+
+        Inputs are the same as the method `fit`.
+        :return: Instance of the class with all parameters fit to the data.
+        """
+        self.n_layers = len(layer_embeddings)
+        self.labels_unique = np.unique(labels)
+        self.n_classes = len(self.labels_unique)
+        self.n_samples = labels.shape[0]
+        if self._apply_dim_reduction():
+            layer_embeddings = transform_layer_embeddings(layer_embeddings, self.transform_models)
+
+        shared_neighbors = None
+        if update or (self.n_jobs_layers <= 1) or (self.n_layers < 2):
+            # Nearest neighbors of each layer shared by the test statistics
+            shared_neighbors = [
+                SharedNeighbors(
+                    layer_embeddings[i], labels, labels_pred, labels_unique=self.labels_unique,
+                    layer_statistics=self.layer_statistic,
+                    neighborhood_constant=self.neighborhood_constant,
+                    n_neighbors=self.n_neighbors,
+                    metric=self.metric,
+                    metric_kwargs=self.metric_kwargs,
+                    approx_nearest_neighbors=self.approx_nearest_neighbors,
+                    n_jobs=self.n_jobs,
+                    low_memory=self.low_memory,
+                    graph_cache=self.graph_cache,
+                    graph_cache_key=i,
+                    seed_rng=self.seed_rng
+                ) for i in range(self.n_layers)
+            ]
+        else:
+            logger.warning("The test statistics do not share their nearest neighbors when the layers are processed in "
+                           "parallel (n_jobs_layers = {:d}). Each test statistic finds its neighbors separately. Set "
+                           "n_jobs_layers = 1 to share the neighbors.".format(self.n_jobs_layers))
+
+        detectors_prev = self.detectors
+        self.detectors = dict()
+        self.test_stats_pred_null = dict()
+        self.test_stats_true_null = dict()
+        for v in self.layer_statistic:
+            if update:
+                logger.info("Updating the detector based on the test statistic '{}':".format(v))
+                det = detectors_prev[v]
+                det.shared_neighbors = shared_neighbors
+                det.update(layer_embeddings, labels, labels_pred, **kwargs)
+                det.shared_neighbors = None
+                self.detectors[v] = det
+                self.test_stats_pred_null[v] = det.test_stats_pred_null
+                self.test_stats_true_null[v] = det.test_stats_true_null
+                continue
+
+            logger.info("Fitting the detector based on the test statistic '{}':".format(v))
+            det = DetectorLayerStatistics(
+                layer_statistic=v,
+                score_type=self.score_type,
+                ood_detection=self.ood_detection,
+                pvalue_fusion=self.pvalue_fusion,
+                use_top_ranked=self.use_top_ranked,
+                num_top_ranked=self.num_top_ranked,
+                # The layer embeddings are transformed once by this detector. The detector of each test statistic
+                # keeps the models, so that it can be saved and used on its own
+                skip_dim_reduction=self.skip_dim_reduction,
+                model_dim_reduction=self.transform_models,
+                dim_reduction_applied=True,
+                neighborhood_constant=self.neighborhood_constant,
+                n_neighbors=self.n_neighbors,
+                metric=self.metric,
+                metric_kwargs=self.metric_kwargs,
+                approx_nearest_neighbors=self.approx_nearest_neighbors,
+                n_jobs=self.n_jobs,
+                n_jobs_layers=self.n_jobs_layers,
+                low_memory=self.low_memory,
+                graph_cache=self.graph_cache,
+                cascade_layer_order=self.cascade_layer_order,
+                cascade_max_layer_score=self.cascade_max_layer_score,
+                seed_rng=self.seed_rng
+            )
+            det.shared_neighbors = shared_neighbors
+            det.fit(layer_embeddings, labels, labels_pred, **kwargs)
+            det.shared_neighbors = None
+
+            self.detectors[v] = det
+            self.test_stats_pred_null[v] = det.test_stats_pred_null
+            self.test_stats_true_null[v] = det.test_stats_true_null
 
+        if shared_neighbors is not None:
+            # The neighbors of the training data are no longer needed
+            for obj in shared_neighbors:
+                obj.clear()
+
+        return self
 
-    def _score_density_based(self, labels_pred, test_stats_pred, test_stats_true,
-                             return_corrected_predictions=False):
+    def _score_density_based(self, labels_pred, test_stats, return_corrected_predictions=False):
         """
         Scoring method based on modeling the joint probability density of the test statistics, conditioned on the
         predicted and true class.
 
         :param labels_pred: Same as the method `score`.
-        :param test_stats_pred: numpy array with the test statistics from the different layers, conditioned on the
-                                predicted class of the test samples. Is a numpy array of shape `(n_test, n_layers)`,
-                                where `n_test` and `n_layers` are the number of test samples and number of layers
-                                respectively.
-        :param test_stats_true: dict with the test statistics from the different layers, conditioned on each candidate
-                                true class (since this is unknown at test time). The class labels are the keys of the
-                                dict and the values are numpy arrays of shape `(n_test, n_layers)` similar to
-                                `test_stats_pred`.
+        :param test_stats: numpy array of shape `(n_test, n_classes + 1, n_layers)` with the test statistics from
+                           the different layers. Index 0 of the second axis is conditioned on the predicted class of
+                           the test samples, and index `j + 1` is conditioned on the candidate true class
+                           `self.labels_unique[j]` (since this is unknown at test time).
         :param return_corrected_predictions: Same as the method `score`.
         :return:
         """
@@ -603,145 +1048,66 @@ class DetectorLayerStatistics:
         # Log of the multivariate p-value estimate of the test statistics under the distribution of each
         # candidate true class
         log_pvalues_true = np.zeros((n_test, self.n_classes))
-        for i, c in enumerate(self.labels_unique):
-            v = -1. * score_log_normal_mixture(test_stats_true[c], self.density_models_true[c])
-            log_pvalues_true[:, i] = np.log(
+        for j, c in enumerate(self.labels_unique):
+            v = -1. * score_log_normal_mixture(test_stats[:, j + 1, :], self.density_models_true[c])
+            log_pvalues_true[:, j] = np.log(
                 pvalue_score(self.samples_neg_log_dens_true[c], v, log_transform=False, bootstrap=False)
             )
 
-        # Adversarial or OOD scores for the test samples and the corrected class predictions
-        scores_adver = np.zeros(n_test)
+        # Score for OOD detection, which is the negative log p-value under the distribution of the predicted class
         scores_ood = np.zeros(n_test)
-        corrected_classes = copy.copy(labels_pred)
-        preds_unique = self.labels_unique if (n_test > 1) else [labels_pred[0]]
-        cnt_par = 0
-        for c in preds_unique:
-            # Scoring samples that are predicted into class `c`
-            ind = np.where(labels_pred == c)[0]
-            n_pred = ind.shape[0]
-            if n_pred == 0:
-                continue
-
-            # Score for OOD detection
-            v = -1. * score_log_normal_mixture(test_stats_pred[ind, :], self.density_models_pred[c])
+        for c, ind in self._indices_per_prediction(labels_pred):
+            v = -1. * score_log_normal_mixture(test_stats[ind, 0, :], self.density_models_pred[c])
             # `pvalue_score` returns negative log of the p-values
             scores_ood[ind] = pvalue_score(self.samples_neg_log_dens_pred[c], v, log_transform=True, bootstrap=False)
 
-            # Mask to include all classes, except the predicted class `c`
-            i = np.where(self.labels_unique == c)[0][0]
-            mask_excl = np.ones(self.n_classes, dtype=np.bool)
-            mask_excl[i] = False
-            # Score for adversarial detection
-            tmp_arr = log_pvalues_true[ind, :]
-            scores_adver[ind] = np.max(tmp_arr[:, mask_excl], axis=1) + scores_ood[ind]
-
-            # Corrected prediction is the class corresponding to the maximum log p-value conditioned that class
-            # being the true class
-            if return_corrected_predictions:
-                corrected_classes[ind] = [self.labels_unique[j] for j in np.argmax(tmp_arr, axis=1)]
-
-            # Break if we have already covered all the test samples
-            cnt_par += n_pred
-            if cnt_par >= n_test:
-                break
+        return self._combine_class_scores(labels_pred, log_pvalues_true, scores_ood, return_corrected_predictions)
 
-        return scores_adver, scores_ood, corrected_classes
-
-    def _score_pvalue_based(self, labels_pred, pvalues_pred, pvalues_true, return_corrected_predictions=False,
-                            start_layer=0):
+    def _score_pvalue_based(self, labels_pred, pvalues, return_corrected_predictions=False, start_layer=0):
         """
         Scoring method based on combining the p-values of the test statistics calculated from the layer embeddings.
 
         :param labels_pred: Same as the method `score`.
-        :param pvalues_pred: numpy array with the negative log p-values from the different layers and layer pairs,
-                             conditioned on the predicted class of the test samples. Is a numpy array of shape
-                             `(n_test, n_layers)`, where `n_test` and `n_layers` are the number of test samples
-                             and number of layers (layer pairs) respectively.
-        :param pvalues_true: dict with the negative log p-values from the different layers, conditioned on each
-                             candidate true class (since this is unknown at test time). The class labels are the keys
-                             of the dict and the values are numpy arrays of shape `(n_test, n_layers)` similar to
-                             `pvalues_pred`.
+        :param pvalues: numpy array of shape `(n_test, n_classes + 1, n_layers)` with the negative log p-values
+                        from the different layers and layer pairs. Index 0 of the second axis is conditioned on the
+                        predicted class of the test samples, and index `j + 1` is conditioned on the candidate true
+                        class `self.labels_unique[j]` (since this is unknown at test time).
         :param return_corrected_predictions: Same as the method `score`.
         :param start_layer: Starting index of the layers to include in the p-value fusion. Set to 0 to include all
                             the layers. Set to negative values such as -1, -2, -3 using the same convention as
                             python indexing. For example, a value of `-3` implies the last 3 layers are included.
         :return:
         """
-        n_test, nl = pvalues_pred.shape
+        n_test, n_cols, nl = pvalues.shape
         # Equal weight to all the layers or layer pairs
         weights = (1. / nl) * np.ones(nl)
         log_weights = np.log(weights)
         mask_layers = np.zeros(nl, dtype=np.bool)
         mask_layers[start_layer:] = True
 
-        # Log of the combined p-values
-        pvalues_comb_pred = np.zeros(n_test)
-        pvalues_comb_true = np.zeros((n_test, self.n_classes))
+        # Log of the combined p-values, of shape `(n_test, n_classes + 1)`
         if self.pvalue_fusion == 'fisher':
-            pvalues_comb_pred = -1 * np.sum(pvalues_pred[:, mask_layers], axis=1)
-            for i, c in enumerate(self.labels_unique):
-                pvalues_comb_true[:, i] = -1 * np.sum(pvalues_true[c][:, mask_layers], axis=1)
+            pvalues_comb = -1 * np.sum(pvalues[:, :, mask_layers], axis=2)
         elif self.pvalue_fusion == 'harmonic_mean':
-            # log of the combined p-values
-            arr_temp = log_weights + pvalues_pred
+            arr_temp = (log_weights + pvalues)[:, :, mask_layers]
             offset = np.log(np.sum(weights[mask_layers]))
-            pvalues_comb_pred = offset - log_sum_exp(arr_temp[:, mask_layers])
-            for i, c in enumerate(self.labels_unique):
-                arr_temp = log_weights + pvalues_true[c]
-                pvalues_comb_true[:, i] = offset - log_sum_exp(arr_temp[:, mask_layers])
+            pvalues_comb = offset - log_sum_exp(arr_temp.reshape(n_test * n_cols, -1)).reshape(n_test, n_cols)
         else:
             raise ValueError("Invalid value '{}' for the input argument 'pvalue_fusion'.".format(self.pvalue_fusion))
 
-        # Adversarial or OOD scores for the test samples and the corrected class predictions
-        scores_adver = np.zeros(n_test)
-        scores_ood = np.zeros(n_test)
-        corrected_classes = copy.copy(labels_pred)
-        preds_unique = self.labels_unique if (n_test > 1) else [labels_pred[0]]
-        cnt_par = 0
-        for c in preds_unique:
-            # Scoring samples that are predicted into class `c`
-            ind = np.where(labels_pred == c)[0]
-            n_pred = ind.shape[0]
-            if n_pred == 0:
-                continue
-
-            # OOD score
-            scores_ood[ind] = -1 * pvalues_comb_pred[ind]
-
-            # Adversarial score
-            # Mask to include all classes, except the predicted class `c`
-            i = np.where(self.labels_unique == c)[0][0]
-            mask_excl = np.ones(self.n_classes, dtype=np.bool)
-            mask_excl[i] = False
-            arr_temp = pvalues_comb_true[ind, :]
-            scores_adver[ind] = np.max(arr_temp[:, mask_excl], axis=1) - pvalues_comb_pred[ind]
-
-            # Corrected class prediction based on the maximum p-value conditioned on the candidate true class
-            if return_corrected_predictions:
-                corrected_classes[ind] = [self.labels_unique[j] for j in np.argmax(arr_temp, axis=1)]
+        # OOD score is the negative log of the combined p-value conditioned on the predicted class
+        return self._combine_class_scores(labels_pred, pvalues_comb[:, 1:], -1 * pvalues_comb[:, 0],
+                                          return_corrected_predictions)
 
-            # Break if we have already covered all the test samples
-            cnt_par += n_pred
-            if cnt_par >= n_test:
-                break
-
-        return scores_adver, scores_ood, corrected_classes
-
-    def _score_klpe(self, labels_pred, test_stats_pred, test_stats_true, return_corrected_predictions=False):
+    def _score_klpe(self, labels_pred, test_stats, return_corrected_predictions=False):
         """
         Scoring method based on the averaged localized p-value estimation method, which estimates the p-value of
         the joint (multivariate) distribution of the test statistics across the layers conditioned on the
         predicted and true class.
 
         :param labels_pred: Same as the method `score`.
-        :param test_stats_pred: numpy array with the test statistics from the different layers, conditioned on the
-                                predicted class of the test samples. Is a numpy array of shape `(n_test, n_layers)`,
-                                where `n_test` and `n_layers` are the number of test samples and number of layers
-                                respectively.
-        :param test_stats_true: dict with the test statistics from the different layers, conditioned on each candidate
-                                true class (since this is unknown at test time). The class labels are the keys of the
-                                dict and the values are numpy arrays of shape `(n_test, n_layers)` similar to
-                                `test_stats_pred`.
+        :param test_stats: numpy array of shape `(n_test, n_classes + 1, n_layers)` with the test statistics from
+                           the different layers, in the same format as the method `_score_density_based`.
         :param return_corrected_predictions: Same as the method `score`.
         :return:
         """
@@ -749,63 +1115,78 @@ class DetectorLayerStatistics:
         # Log of the multivariate p-value estimate of the test statistics under the distribution of each
         # candidate true class
         log_pvalues_true = np.zeros((n_test, self.n_classes))
-        for i, c in enumerate(self.labels_unique):
-            log_pvalues_true[:, i] = -1. * self.klpe_models_true[c].score(test_stats_true[c])
+        for j, c in enumerate(self.labels_unique):
+            log_pvalues_true[:, j] = -1. * self.klpe_models_true[c].score(test_stats[:, j + 1, :])
 
-        # Adversarial or OOD scores for the test samples and the corrected class predictions
-        scores_adver = np.zeros(n_test)
+        # OOD score is the negative log of the multivariate p-value estimate of the test statistics under the
+        # distribution of the predicted class
         scores_ood = np.zeros(n_test)
-        corrected_classes = copy.copy(labels_pred)
-        preds_unique = self.labels_unique if (n_test > 1) else [labels_pred[0]]
-        cnt_par = 0
-        for c in preds_unique:
-            # Scoring samples that are predicted into class `c`
-            ind = np.where(labels_pred == c)[0]
-            n_pred = ind.shape[0]
-            if n_pred == 0:
-                continue
+        for c, ind in self._indices_per_prediction(labels_pred):
+            scores_ood[ind] = self.klpe_models_pred[c].score(test_stats[ind, 0, :])
 
-            # OOD score is the negative log of the multivariate p-value estimate of the test statistics under the
-            # distribution of the predicted class `c`
-            scores_ood[ind] = self.klpe_models_pred[c].score(test_stats_pred[ind, :])
-
-            # Adversarial score
-            # Mask to include all classes, except the predicted class `c`
-            i = np.where(self.labels_unique == c)[0][0]
-            mask_excl = np.ones(self.n_classes, dtype=np.bool)
-            mask_excl[i] = False
-            tmp_arr = log_pvalues_true[ind, :]
-            scores_adver[ind] = np.max(tmp_arr[:, mask_excl], axis=1) + scores_ood[ind]
-
-            # Corrected prediction is the class corresponding to the maximum log p-value conditioned that class
-            # being the true class
-            if return_corrected_predictions:
-                corrected_classes[ind] = [self.labels_unique[j] for j in np.argmax(tmp_arr, axis=1)]
-
-            # Break if we have already covered all the test samples
-            cnt_par += n_pred
-            if cnt_par >= n_test:
-                break
+        return self._combine_class_scores(labels_pred, log_pvalues_true, scores_ood, return_corrected_predictions)
+
+    def _indices_per_prediction(self, labels_pred):
+        """
+        Generator over the distinct predicted classes and the indices of the samples predicted into each of them.
+        """
+        for c in np.unique(labels_pred):
+            if c in self.labels_unique:
+                yield c, np.where(labels_pred == c)[0]
+
+    def _combine_class_scores(self, labels_pred, log_pvalues_true, scores_ood, return_corrected_predictions=False):
+        """
+        Adversarial score and corrected class prediction of each sample from the log p-values conditioned on the
+        candidate true classes, and the OOD score conditioned on the predicted class.
+
+        The adversarial score is the largest log p-value conditioned on a true class other than the predicted class,
+        plus the OOD score. The corrected prediction is the class with the largest log p-value conditioned on it
+        being the true class. Samples predicted into a class that is not seen during training have zero scores.
+
+        :param labels_pred: Same as the method `score`.
+        :param log_pvalues_true: numpy array of shape `(n_test, n_classes)` with the log p-values conditioned on
+                                 each candidate true class.
+        :param scores_ood: numpy array of shape `(n_test, )` with the OOD scores.
+        :param return_corrected_predictions: Same as the method `score`.
+
+        :return: (scores_adver, scores_ood, corrected_classes)
+        """
+        n_test = labels_pred.shape[0]
+        # Index of the predicted class of each sample in `self.labels_unique`
+        ind_pred = np.clip(np.searchsorted(self.labels_unique, labels_pred), 0, self.n_classes - 1)
+        mask_valid = self.labels_unique[ind_pred] == labels_pred
+
+        # Exclude the predicted class from the maximum over the true classes
+        arr_temp = np.array(log_pvalues_true, dtype=np.float64)
+        arr_temp[np.arange(n_test), ind_pred] = -np.inf
+        scores_adver = np.where(mask_valid, np.max(arr_temp, axis=1) + scores_ood, 0.)
+        scores_ood = np.where(mask_valid, scores_ood, 0.)
+
+        corrected_classes = copy.copy(labels_pred)
+        if return_corrected_predictions:
+            ind = np.argmax(log_pvalues_true, axis=1)
+            corrected_classes[mask_valid] = self.labels_unique[ind[mask_valid]]
 
         return scores_adver, scores_ood, corrected_classes
 
     def _get_top_ranked(self, test_stats, p_values, reverse=False):
         """
-        Get the top-ranked (largest or smallest) test statistics across the layers. Ranking is done based on the
-        p-values.
+        Get the top-ranked (largest or smallest) test statistics across the layers, i.e. along the last axis.
+        Ranking is done based on the p-values.
 
-        :param test_stats: numpy array of shape `(n, d)`, where `n` is the number of samples and `d` is the
-                           number of test statistics.
+        :param test_stats: numpy array of shape `(n, d)` or `(n, n_classes + 1, d)`, where `n` is the number of
+                           samples and `d` is the number of test statistics.
         :param p_values: numpy array with the p-values corresponding to the test statistics. Has same shape
                          as `test_stats`.
-        :param reverse: set to True to get the largest scores.
+        :param reverse: set to True to get the largest scores. Can also be a boolean numpy array with the shape of
+                        `p_values` excluding the last axis (or broadcastable to it), in order to get the largest
+                        scores only at selected positions, e.g. `(n_classes + 1, )` for the conditioning classes.
         :return:
         """
-        if reverse:
-            ind = np.fliplr(np.argsort(p_values, axis=1))
-        else:
-            ind = np.argsort(p_values, axis=1)
+        ind = np.argsort(p_values, axis=-1)
+        reverse = np.broadcast_to(reverse, p_values.shape[:-1])
+        ind = np.where(reverse[..., np.newaxis], ind[..., ::-1], ind)
 
-        test_stats = np.take_along_axis(test_stats, ind, axis=1)[:, :self.num_top_ranked]
-        p_values = np.take_along_axis(p_values, ind, axis=1)[:, :self.num_top_ranked]
+        test_stats = np.take_along_axis(test_stats, ind, axis=-1)[..., :self.num_top_ranked]
+        p_values = np.take_along_axis(p_values, ind, axis=-1)[..., :self.num_top_ranked]
         return test_stats, p_values
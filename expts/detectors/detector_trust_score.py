@@ -25,7 +25,7 @@ from helpers.dimension_reduction_methods import (
     transform_data_from_model,
     load_dimension_reduction_models
 )
-from helpers.knn_index import KNNIndex
+from helpers.knn_index import KNNIndex, PartitionedKNNIndex, use_partitioned_index
 from helpers.utils import get_num_jobs
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
@@ -49,6 +49,7 @@ class TrustScore:
                  model_dim_reduction=None,
                  n_jobs=1,
                  low_memory=False,
+                 partitioned_index=None,
                  seed_rng=SEED_DEFAULT):
         """
         :param alpha: float value in (0, 1) specifying the proportion of outliers. This defines the `1 - alpha`
@@ -75,6 +76,11 @@ class TrustScore:
         :param n_jobs: Number of parallel jobs or processes. Set to -1 to use all the available cpu cores.
         :param low_memory: Set to True to enable the low memory option of the `NN-descent` method. Note that this
                            is likely to increase the running time.
+        :param partitioned_index: None or a bool value. Set to True in order to use a single exact KNN index over all
+                                  the samples partitioned by their class (`PartitionedKNNIndex`), instead of a
+                                  separate KNN index per class. Requires a metric from `METRICS_EXACT_KNN` without
+                                  `metric_kwargs`. If `None`, it is used when `approx_nearest_neighbors` is False and
+                                  these requirements are met.
         :param seed_rng: int value specifying the seed for the random number generator. This is passed around to
                          all the classes/functions that require random number generation. Set this to a fixed value
                          for reproducible results.
@@ -89,6 +95,7 @@ class TrustScore:
         self.model_dim_reduction = model_dim_reduction
         self.n_jobs = get_num_jobs(n_jobs)
         self.low_memory = low_memory
+        self.partitioned_index = partitioned_index
         self.seed_rng = seed_rng
 
         np.random.seed(self.seed_rng)
@@ -104,6 +111,9 @@ class TrustScore:
         self.n_samples = None
         # KNN index for the alpha-high density samples from each class
         self.index_knn = None
+        # Single KNN index with the alpha-high density samples partitioned by class. Used instead of `self.index_knn`
+        # if `self._use_partitioned_index()` is True
+        self.index_knn_partitioned = None
         # Threshold on the k-NN radius for each class
         self.epsilon = None
         # Trust scores on the training data
@@ -145,6 +155,25 @@ class TrustScore:
             dim = data.shape[1]
             logger.info("Applying dimension reduction to the data. Projected dimension = {:d}.".format(dim))
 
+        if self._use_partitioned_index():
+            distance_level_sets = self._fit_partitioned(data, labels)
+        else:
+            distance_level_sets = self._fit_per_class(data, labels)
+
+        self.scores_estim = self._score_helper(distance_level_sets, labels_pred)
+        return self
+
+    def _use_partitioned_index(self):
+        return use_partitioned_index(self.partitioned_index, self.metric, self.metric_kwargs,
+                                     self.approx_nearest_neighbors)
+
+    def _fit_per_class(self, data, labels):
+        """
+        Build a KNN index for the `1 - alpha` level set of each class, and calculate the distance from each sample
+        to the level sets.
+
+        :return: numpy array of shape `(n, n_classes)` with the distances to the level sets.
+        """
         # Distance from each sample in `data` to the `1 - alpha` level sets corresponding to each class
         distance_level_sets = np.zeros((self.n_samples, self.n_classes))
         self.index_knn = dict()
@@ -222,8 +251,54 @@ class TrustScore:
                 _, dist_temp = self.index_knn[c_hat].query(data_sub, k=1)
                 distance_level_sets[indices_sub[c], j] = dist_temp[:, 0]
 
-        self.scores_estim = self._score_helper(distance_level_sets, labels_pred)
-        return self
+        return distance_level_sets
+
+    def _fit_partitioned(self, data, labels):
+        """
+        Same as `_fit_per_class`, but using a single KNN index over all the samples partitioned by their class. The
+        nearest neighbors from all the classes are found in one query.
+        """
+        self.epsilon = dict()
+        indices_sub = [np.where(labels == c)[0] for c in self.labels_unique]
+        logger.info("Building a KNN index partitioned by the class for all the samples.")
+        self.index_knn_partitioned = PartitionedKNNIndex(
+            data, indices_sub, n_neighbors=self.n_neighbors, metric=self.metric, n_jobs=self.n_jobs
+        )
+        # Distances to the k nearest neighbors of each sample from each class, excluding the sample itself
+        _, nn_distances = self.index_knn_partitioned.query_self(k=self.n_neighbors)
+        # Distance to the nearest neighbor from each class
+        distance_level_sets = nn_distances[:, :, 0]
+        indices_level = []
+        num_excl = 0
+        for j, c in enumerate(self.labels_unique):
+            # Radius or distance to the k-th nearest neighbor for each sample from class `c`
+            radius_arr = nn_distances[indices_sub[j], j, self.n_neighbors - 1]
+            if self.alpha > 0.:
+                self.epsilon[c] = np.percentile(radius_arr, 100 * (1 - self.alpha), interpolation='midpoint')
+                mask_incl = radius_arr <= self.epsilon[c]
+            else:
+                # Slightly larger value than the largest radius
+                self.epsilon[c] = 1.0001 * np.max(radius_arr)
+                mask_incl = np.ones(indices_sub[j].shape[0], dtype=np.bool)
+
+            n = indices_sub[j].shape[0] - np.sum(mask_incl)
+            if n:
+                logger.info("Excluding {:d} samples from class '{}' with radius larger than {:.6f}.".
+                            format(n, c, self.epsilon[c]))
+
+            indices_level.append(indices_sub[j][mask_incl])
+            num_excl += n
+
+        if num_excl:
+            logger.info("Building a KNN index partitioned by the class with the samples in the level sets.")
+            self.index_knn_partitioned = PartitionedKNNIndex(
+                data, indices_level, n_neighbors=1, metric=self.metric, n_jobs=self.n_jobs
+            )
+            # Distance to the nearest neighbor from the level set of each class
+            _, nn_distances = self.index_knn_partitioned.query_self(k=1)
+            distance_level_sets = nn_distances[:, :, 0]
+
+        return distance_level_sets
 
     def score(self, data_test, labels_pred, is_train=False):
         """
@@ -261,11 +336,16 @@ class TrustScore:
         if self.model_dim_reduction:
             data_test = transform_data_from_model(data_test, self.model_dim_reduction)
 
-        distance_level_sets = np.zeros((data_test.shape[0], self.n_classes))
-        for j, c in enumerate(self.labels_unique):
-            # Distance of each test sample to its nearest neighbor from the level set for class `c`
-            _, dist_temp = self.index_knn[c].query(data_test, k=1)
-            distance_level_sets[:, j] = dist_temp[:, 0]
+        if self.index_knn_partitioned is not None:
+            # Distance of each test sample to its nearest neighbor from the level set of every class in one query
+            _, nn_distances = self.index_knn_partitioned.query(data_test, k=1)
+            distance_level_sets = nn_distances[:, :, 0]
+        else:
+            distance_level_sets = np.zeros((data_test.shape[0], self.n_classes))
+            for j, c in enumerate(self.labels_unique):
+                # Distance of each test sample to its nearest neighbor from the level set for class `c`
+                _, dist_temp = self.index_knn[c].query(data_test, k=1)
+                distance_level_sets[:, j] = dist_temp[:, 0]
 
         # Trust score calculation
         return self._score_helper(distance_level_sets, labels_pred)
@@ -0,0 +1,383 @@
+"""
+Layer-parallel execution of the test statistics of `DetectorLayerStatistics`.
+
+The test statistic of each layer is fit and scored in a persistent worker process. The layer embeddings are placed
+in shared memory (`multiprocessing.shared_memory`), and the workers operate on zero-copy numpy views of them. On
+Python versions older than 3.8, which do not have `multiprocessing.shared_memory`, the layer embeddings are instead
+written to memory-mapped files in a temporary directory, and the workers map them in copy-on-write mode. The
+fitted test statistic models stay in the worker that fit them (layer `i` is assigned to worker `i % n_workers`),
+so that only the small arrays of test statistics and p-values are sent back to the main process. The models can be
+retrieved from the workers using the method `get_models`, e.g. in order to save the detector.
+
+The worker processes are started using the 'spawn' method, which is safe to use with the thread pools of numba
+and pytorch in the main process. The number of numba threads of each worker is set using `numba.set_num_threads`,
+or using the environment variable `NUMBA_NUM_THREADS` with numba versions older than 0.49 that do not have it.
+
+NOTE: starting the workers and the just-in-time compilation of the numba functions in each worker have a fixed cost
+that is paid again every time the detector is fit. Use `n_jobs_layers > 1` only when each worker gets its own CPU
+cores.
+
+USAGE:
+```
+from detectors.layer_parallel import LayerParallelExecutor, release_shared_arrays
+from detectors.test_statistics_layers import MultinomialScore
+
+executor = LayerParallelExecutor(n_workers=4, n_jobs=4)
+# `layer_embeddings` is a list of numpy arrays, one per layer
+specs, buffers = executor.share(layer_embeddings)
+args = [(MultinomialScore, {'n_neighbors': 20}, {}) for _ in layer_embeddings]
+# List of `(test_stats, p_values)` per layer
+results = executor.fit(specs, args, labels, labels_pred, np.unique(labels))
+release_shared_arrays(buffers)
+
+specs, buffers = executor.share(layer_embeddings_test)
+results = executor.score(specs, labels_pred_test, is_train=False, bootstrap=True)
+release_shared_arrays(buffers)
+executor.close()
+
+# USAGE with the detector: the layers are fit and scored by 4 worker processes, each using 16 / 4 = 4 jobs
+det_model = DetectorLayerStatistics(layer_statistic='multinomial', n_jobs=16, n_jobs_layers=4, ...)
+
+```
+"""
+import numpy as np
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+try:
+    # Requires python 3.8 or newer
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+logger = logging.getLogger(__name__)
+
+
+class _SharedFile:
+    """
+    Memory-mapped file in a temporary directory, which replaces a `SharedMemory` block on python versions older than
+    3.8. It has the same `name`, `close`, and `unlink` attributes used by this module.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def close(self):
+        pass
+
+    def unlink(self):
+        # The workers that have already mapped the file can continue to use it
+        shutil.rmtree(os.path.dirname(self.name), ignore_errors=True)
+
+
+def share_array(arr):
+    """
+    Copy a numpy array into a new shared memory block, or into a memory-mapped file if
+    `multiprocessing.shared_memory` is not available.
+
+    :param arr: numpy array.
+    :return: (spec, shm)
+        - spec: tuple `(name, shape, dtype)` that is used to attach to the shared array from another process.
+        - shm: `SharedMemory` (or `_SharedFile`) object. It should be released using `release_shared_arrays` once
+               the workers no longer need to attach to it.
+    """
+    arr = np.ascontiguousarray(arr)
+    if shared_memory is None:
+        shm = _SharedFile(os.path.join(tempfile.mkdtemp(prefix='layer_parallel_'), 'data.npy'))
+        if arr.size:
+            view = np.lib.format.open_memmap(shm.name, mode='w+', dtype=arr.dtype, shape=arr.shape)
+            view[:] = arr
+            view.flush()
+            del view
+        else:
+            # Memory-mapping an empty array is not supported
+            np.save(shm.name, arr)
+
+        return (shm.name, arr.shape, arr.dtype.str), shm
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+    view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    view[:] = arr
+    return (shm.name, arr.shape, arr.dtype.str), shm
+
+
+def attach_shared_array(spec):
+    """
+    Attach to a shared array created by `share_array`.
+
+    :param spec: tuple `(name, shape, dtype)` returned by `share_array`.
+    :return: (shm, arr), where `arr` is a numpy array view of the shared memory block `shm`. The `shm` object
+             should be kept alive as long as `arr` is used. If `multiprocessing.shared_memory` is not available,
+             `shm` is None and `arr` is a copy-on-write memory map of the file.
+    """
+    name, shape, dtype = spec
+    if shared_memory is None:
+        if np.prod(shape) == 0:
+            return None, np.load(name)
+
+        # Copy-on-write, so that in-place changes by a worker are not seen by the other workers
+        return None, np.load(name, mmap_mode='c')
+
+    # The block is owned (and unlinked) by the main process. The spawned workers share the resource tracker of the
+    # main process, so attaching to the block does not register it again
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def release_shared_arrays(buffers):
+    """
+    Close and unlink the shared memory blocks created by the main process. The workers that are still attached to
+    a block can continue to use it.
+
+    :param buffers: list of `SharedMemory` (or `_SharedFile`) objects.
+    :return: None
+    """
+    for shm in buffers:
+        shm.close()
+        shm.unlink()
+
+
+def _close_shared(shm):
+    if shm is None:
+        return
+
+    try:
+        shm.close()
+    except BufferError:
+        # A view of the block is still referenced. The block is closed when it is garbage collected
+        pass
+
+
+def _worker_loop(conn, n_jobs):
+    """
+    Main loop of a worker process. Commands are received as tuples `(command, args)` and the results are sent back
+    as tuples `(status, result)`.
+    """
+    try:
+        import numba
+        # `set_num_threads` requires numba 0.49 or newer. Otherwise, the number of threads is set by the environment
+        # variable `NUMBA_NUM_THREADS`, which is set by the main process when it starts the worker
+        numba.set_num_threads(max(1, min(n_jobs, numba.config.NUMBA_NUM_THREADS)))
+    except (ImportError, AttributeError):
+        pass
+
+    # Fitted test statistic models and the shared memory blocks of their training data, keyed by the layer index
+    models = dict()
+    buffers = dict()
+    while True:
+        command, args = conn.recv()
+        if command == 'stop':
+            break
+
+        try:
+            if command == 'fit':
+                i, spec, cls, kwargs_ts, kwargs_fit, labels, labels_pred, labels_unique = args
+                shm, data = attach_shared_array(spec)
+                kwargs_ts = dict(kwargs_ts, n_jobs=n_jobs)
+                models[i] = cls(**kwargs_ts)
+                result = models[i].fit(data, labels, labels_pred, labels_unique=labels_unique, **kwargs_fit)
+                # The model may keep references to the training data
+                buffers[i] = shm
+            elif command == 'score':
+                i, spec, labels_pred, kwargs_score = args
+                shm, data = attach_shared_array(spec)
+                result = models[i].score(data, labels_pred, **kwargs_score)
+                del data
+                _close_shared(shm)
+            elif command == 'get':
+                result = [models[i] for i in args]
+            else:
+                raise ValueError("Invalid command '{}'.".format(command))
+
+            conn.send(('ok', result))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+
+    for shm in buffers.values():
+        _close_shared(shm)
+
+    conn.close()
+
+
+class LayerParallelExecutor:
+    """
+    Pool of persistent worker processes that fit and score the test statistics of the layers in parallel.
+    """
+    def __init__(self, n_workers, n_jobs=1):
+        """
+        :param n_workers: number of worker processes. Layer `i` is handled by worker `i % n_workers`.
+        :param n_jobs: number of parallel jobs (threads) used by each worker for the intra-layer parallelism.
+        """
+        self.n_workers = max(1, n_workers)
+        self.n_jobs = max(1, n_jobs)
+        ctx = multiprocessing.get_context('spawn')
+        self.conns = []
+        self.processes = []
+        # The spawned workers inherit the environment of the main process. The variable `NUMBA_NUM_THREADS` must be
+        # set before numba is imported by a worker, and it is restored once the workers have started
+        num_threads_env = os.environ.get('NUMBA_NUM_THREADS')
+        os.environ['NUMBA_NUM_THREADS'] = str(self.n_jobs)
+        try:
+            for _ in range(self.n_workers):
+                conn_main, conn_worker = ctx.Pipe()
+                p = ctx.Process(target=_worker_loop, args=(conn_worker, self.n_jobs), daemon=True)
+                p.start()
+                conn_worker.close()
+                self.conns.append(conn_main)
+                self.processes.append(p)
+        finally:
+            if num_threads_env is None:
+                del os.environ['NUMBA_NUM_THREADS']
+            else:
+                os.environ['NUMBA_NUM_THREADS'] = num_threads_env
+
+        logger.info("Started {:d} worker processes for the layers, each using {:d} parallel job(s).".
+                    format(self.n_workers, self.n_jobs))
+
+    @staticmethod
+    def release(buffers):
+        """
+        Release the shared arrays created by the method `share`. Same as `release_shared_arrays`.
+
+        :param buffers: list of objects returned by the method `share`.
+        :return: None
+        """
+        release_shared_arrays(buffers)
+
+    @staticmethod
+    def share(arrays):
+        """
+        Place a list of numpy arrays in shared memory.
+
+        :param arrays: list of numpy arrays.
+        :return: (specs, buffers), lists with the specification of each shared array and the `SharedMemory`
+                 objects, which should be released using the method `release` after the call that uses them.
+        """
+        specs, buffers = [], []
+        for arr in arrays:
+            spec, shm = share_array(arr)
+            specs.append(spec)
+            buffers.append(shm)
+
+        return specs, buffers
+
+    def fit(self, specs, args_layers, labels, labels_pred, labels_unique):
+        """
+        Fit the test statistic of each layer in the worker processes.
+
+        :param specs: list with the specification of the shared array of each layer.
+        :param args_layers: list with a tuple `(cls, kwargs_ts, kwargs_fit)` for each layer, where `cls` is the test
+                            statistic class, `kwargs_ts` are the keyword arguments of its constructor, and
+                            `kwargs_fit` are the keyword arguments of its `fit` method.
+        :param labels: numpy array with the true labels.
+        :param labels_pred: numpy array with the predicted labels.
+        :param labels_unique: numpy array with the unique labels.
+
+        :return: list with the tuple `(test_stats, p_values)` returned by the `fit` method of each layer.
+        """
+        tasks = [('fit', (i, specs[i], cls, kwargs_ts, kwargs_fit, labels, labels_pred, labels_unique))
+                 for i, (cls, kwargs_ts, kwargs_fit) in enumerate(args_layers)]
+        return self._run(tasks)
+
+    def score(self, specs, labels_pred, layers=None, **kwargs):
+        """
+        Score the data of each layer using the test statistics fitted by the workers.
+
+        :param specs: list with the specification of the shared array of each layer.
+        :param labels_pred: numpy array with the predicted labels.
+        :param layers: None or a list with the index of the layer corresponding to each item of `specs`. By
+                       default, `specs[i]` is the data of layer `i`.
+        :param kwargs: keyword arguments of the `score` method of the test statistics.
+
+        :return: list with the tuple `(test_stats, p_values)` returned by the `score` method of each layer.
+        """
+        if layers is None:
+            layers = range(len(specs))
+
+        tasks = [('score', (i, spec, labels_pred, kwargs)) for i, spec in zip(layers, specs)]
+        return self._run(tasks)
+
+    def get_models(self, n_layers):
+        """
+        Retrieve the fitted test statistic models of all the layers from the workers.
+
+        :param n_layers: number of layers.
+        :return: list of test statistic models.
+        """
+        tasks = [('get', list(range(j, n_layers, self.n_workers))) for j in range(min(self.n_workers, n_layers))]
+        for j, task in enumerate(tasks):
+            self.conns[j].send(task)
+
+        models = [None] * n_layers
+        for j in range(len(tasks)):
+            for i, m in zip(tasks[j][1], self._receive(j)):
+                models[i] = m
+
+        return models
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        for conn, p in zip(self.conns, self.processes):
+            try:
+                conn.send(('stop', None))
+                conn.close()
+            except (OSError, ValueError):
+                pass
+
+            p.join(timeout=10)
+            if p.is_alive():
+                p.terminate()
+
+        self.conns = []
+        self.processes = []
+
+    def __del__(self):
+        self.close()
+
+    def _receive(self, j):
+        status, result = self.conns[j].recv()
+        if status != 'ok':
+            raise RuntimeError("Error in the worker process {:d}:\n{}".format(j, result))
+
+        return result
+
+    def _run(self, tasks):
+        # Layer `i` is handled by worker `i % n_workers`. Each worker runs one task at a time, and it is sent the next
+        # task of its layers as soon as it returns a result. The layer index is the first argument of every task
+        pending = [[t for t, task in enumerate(tasks) if task[1][0] % self.n_workers == j]
+                   for j in range(self.n_workers)]
+        active = dict()
+        for j in range(self.n_workers):
+            if pending[j]:
+                i = pending[j].pop(0)
+                self.conns[j].send(tasks[i])
+                active[self.conns[j]] = (j, i)
+
+        results = [None] * len(tasks)
+        error = None
+        while active:
+            for conn in wait(list(active.keys())):
+                j, i = active.pop(conn)
+                try:
+                    results[i] = self._receive(j)
+                except RuntimeError as ex:
+                    # Stop sending tasks, but collect the results of the running tasks to keep the workers in sync
+                    error = ex
+                    pending = [[] for _ in range(self.n_workers)]
+
+                if pending[j]:
+                    i = pending[j].pop(0)
+                    conn.send(tasks[i])
+                    active[conn] = (j, i)
+
+        if error is not None:
+            raise error
+
+        return results
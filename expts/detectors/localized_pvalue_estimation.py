@@ -26,7 +26,7 @@ from helpers.constants import (
     SEED_DEFAULT,
     METRIC_DEF
 )
-from detectors.pvalue_estimation import pvalue_score
+from detectors.pvalue_estimation import NullDistributionTable
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 logger = logging.getLogger(__name__)
@@ -48,6 +48,19 @@ def helper_distance(data1, data2, nn_indices, metric, metric_kwargs, k, i):
     return np.mean(pd[(k - 1):])
 
 
+def neighborhood_range(n_neighbors):
+    """
+    Range of nearest neighbors `(low, high)` over which the averaged K-LPE distance statistic is calculated for a
+    given number of neighbors. The statistic is the average distance to the neighbors ranked `low` to `high`.
+
+    :param n_neighbors: int value specifying the number of nearest neighbors.
+    :return: tuple of int values `(low, high)`.
+    """
+    low = n_neighbors - int(np.floor(0.5 * (n_neighbors - 1)))
+    high = n_neighbors + int(np.floor(0.5 * n_neighbors))
+    return low, high
+
+
 class averaged_KLPE_anomaly_detection:
     def __init__(self,
                  neighborhood_constant=NEIGHBORHOOD_CONST, n_neighbors=None,
@@ -98,6 +111,7 @@ class averaged_KLPE_anomaly_detection:
         self.neighborhood_range = None
         self.index_knn = None
         self.dist_stat_nominal = None
+        self.null_table = None
         np.random.seed(self.seed_rng)
 
     def fit(self, data):
@@ -119,8 +133,7 @@ class averaged_KLPE_anomaly_detection:
             self.n_neighbors = int(np.ceil(N ** self.neighborhood_constant))
 
         # The distance statistic is averaged over this neighborhood range
-        low = self.n_neighbors - int(np.floor(0.5 * (self.n_neighbors - 1)))
-        high = self.n_neighbors + int(np.floor(0.5 * self.n_neighbors))
+        low, high = neighborhood_range(self.n_neighbors)
         self.neighborhood_range = (low, high)
         logger.info("Number of samples: {:d}. Number of features: {:d}".format(N, d))
         logger.info("Range of nearest neighbors used for the averaged K-LPE statistic: ({:d}, {:d})".
@@ -137,6 +150,8 @@ class averaged_KLPE_anomaly_detection:
         )
         # Compute the distance statistic for every data point
         self.dist_stat_nominal = self.distance_statistic(data, exclude_self=True)
+        # Lookup table of the null distribution of the distance statistic for p-value estimation
+        self.null_table = NullDistributionTable(self.dist_stat_nominal)
 
     def score(self, data_test, exclude_self=False, return_distances=False):
         """
@@ -156,7 +171,7 @@ class averaged_KLPE_anomaly_detection:
         # Calculate the k-nearest neighbors based distance statistic
         dist_stat_test = self.distance_statistic(data_test, exclude_self=exclude_self)
         # Negative log of the empirical p-value
-        p = pvalue_score(self.dist_stat_nominal, dist_stat_test, log_transform=True, bootstrap=True)
+        p = self.null_table.pvalue(dist_stat_test, log_transform=True, bootstrap=True)
 
         if return_distances:
             return p, dist_stat_test
@@ -1,60 +1,248 @@
 # Functions for empirical p-value estimation
 import numpy as np
 from numba import njit, prange
-from helpers.constants import NUM_BOOTSTRAP
+from helpers.constants import NUM_BOOTSTRAP, PVALUE_MIN
+
+
+def resampled_null_counts(n_samp, bootstrap=True, n_bootstrap=NUM_BOOTSTRAP):
+    """
+    Number of times each of the `n_samp` (sorted) null scores is counted by the empirical p-value estimate.
+    Every null score is counted once by the plain estimate. The `n_bootstrap` bootstrap resamples (with
+    replacement) of the null scores together draw `n_samp * n_bootstrap` scores uniformly at random, which is the
+    same as drawing the count of each score from a single multinomial distribution. Averaging the p-values over
+    the original sample and the resamples is then the same as using these pooled counts.
+
+    :param n_samp: int number of scores from the null distribution.
+    :param bootstrap: Set to True to include the counts from the bootstrap resamples.
+    :param n_bootstrap: number of bootstrap resamples to use.
+
+    :return: (counts, n_total)
+        - counts: numpy array of shape `(n_samp, )` with the number of times each null score is counted.
+        - n_total: total number of counts, i.e. `counts.sum()`.
+    """
+    counts = np.ones(n_samp)
+    if bootstrap and n_samp > 0:
+        counts += np.random.multinomial(n_samp * n_bootstrap, np.full(n_samp, 1. / n_samp))
+        n_total = n_samp * (n_bootstrap + 1.)
+    else:
+        n_total = float(n_samp)
+
+    return counts, n_total
+
+
+def tail_probabilities(scores_null_sorted, counts, n_total):
+    """
+    Upper tail probabilities of the empirical null distribution evaluated at each of the sorted null scores.
+
+    :param scores_null_sorted: numpy array of shape `(m, )` with the null scores sorted in increasing order.
+    :param counts: numpy array of shape `(m, )` with the number of times each sorted null score is counted.
+    :param n_total: total number of counts.
+
+    :return: numpy array `tail` of shape `(m + 1, )`, where `tail[j]` is the proportion of (weighted) null scores
+             at positions `j, j + 1, . . ., m - 1`. The last element `tail[m]` is 0.
+    """
+    n_samp = scores_null_sorted.shape[0]
+    tail = np.zeros(n_samp + 1)
+    tail[:n_samp] = np.cumsum(counts[::-1])[::-1] / n_total
+    return tail
+
+
+def pvalue_from_tail(scores_null_sorted, tail, scores_obs, log_transform=False):
+    """
+    Empirical p-values of the observed scores given the sorted null scores and their upper tail probabilities
+    (see the function `tail_probabilities`). The p-value of a score `s` is the probability of a null score `>= s`,
+    which is looked up using a binary search on the sorted null scores.
+
+    :param scores_null_sorted: numpy array of shape `(m, )` with the null scores sorted in increasing order.
+    :param tail: numpy array of shape `(m + 1, )` with the upper tail probabilities.
+    :param scores_obs: numpy array of shape `(n, )` with the observed scores.
+    :param log_transform: set to True to apply negative log transform to the p-values.
+
+    :return: numpy array with the p-values or negative-log-transformed p-values. Has the same shape as `scores_obs`.
+    """
+    eps = PVALUE_MIN
+    # Position of the first null score that is `>=` each observed score
+    pos = np.searchsorted(scores_null_sorted, scores_obs, side='left')
+    p = tail[pos]
+    # Comparisons with NaN are false. Hence, no null score is counted for an observed NaN score
+    p[np.isnan(scores_obs)] = 0.
+    p[p < eps] = eps
+    if log_transform:
+        return -np.log(p)
+    else:
+        return p
 
 
-@njit(parallel=True)
 def pvalue_score(scores_null, scores_obs, log_transform=False, bootstrap=True, n_bootstrap=NUM_BOOTSTRAP):
     """
     Calculate the empirical p-values of the observed scores `scores_obs` with respect to the scores from the
     null distribution `scores_null`. Bootstrap resampling can be used to get better estimates of the p-values.
 
+    The null scores are sorted once and each observed score is located using a binary search, which takes
+    `O((n + m) log m)` time. The bootstrap resamples are represented by the number of times each null score is
+    drawn (see `resampled_null_counts`) rather than by an explicit matrix of resampled indices.
+
     :param scores_null: numpy array of shape `(m, )` with the scores from the null distribution.
     :param scores_obs: numpy array of shape `(n, )` with the observed scores.
     :param log_transform: set to True to apply negative log transform to the p-values.
     :param bootstrap: Set to True to calculate a bootstrap resampled estimate of the p-value.
     :param n_bootstrap: number of bootstrap resamples to use.
-    :param n_jobs: number of jobs to execute in parallel.
 
     :return: numpy array with the p-values or negative-log-transformed p-values. Has the same shape as `scores_obs`.
     """
-    eps = 1e-16
     n_samp = scores_null.shape[0]
-    n_obs = scores_obs.shape[0]
-    p = np.zeros(n_obs)
-    for i in prange(n_obs):
-        for j in range(n_samp):
-            if scores_null[j] >= scores_obs[i]:
-                p[i] += 1.
+    # NaN values are placed at the end by the sort. They are never counted, but are included in the total count
+    scores_null_sorted = np.sort(scores_null)
+    n_valid = n_samp - np.count_nonzero(np.isnan(scores_null))
+    scores_null_sorted = scores_null_sorted[:n_valid]
+    counts, n_total = resampled_null_counts(n_samp, bootstrap=bootstrap, n_bootstrap=n_bootstrap)
+    tail = tail_probabilities(scores_null_sorted, counts[:n_valid], n_total)
+    return pvalue_from_tail(scores_null_sorted, tail, np.asarray(scores_obs, dtype=np.float64),
+                            log_transform=log_transform)
 
-        p[i] = p[i] / n_samp
 
-    if bootstrap:
-        ind_null_repl = np.random.choice(np.arange(n_samp), size=(n_bootstrap, n_samp), replace=True)
-        p_sum = p
-        for b in prange(n_bootstrap):
-            p_curr = np.zeros(n_obs)
-            for i in range(n_obs):
-                for j in ind_null_repl[b, :]:
-                    if scores_null[j] >= scores_obs[i]:
-                        p_curr[i] += 1.
+class NullDistributionTable:
+    """
+    Compact, read-only lookup table for the empirical null distribution of a scalar score. It is built once
+    (e.g. when a test statistic is fit), and it maps observed scores to (negative-log) p-values with a single
+    vectorized binary search.
 
-                p_curr[i] = p_curr[i] / n_samp
+    The table stores the distinct null scores in increasing order along with the upper tail probabilities at each
+    of them. Tail probabilities are stored both for the plain estimate and for the bootstrap-averaged estimate,
+    so `pvalue` supports the same `bootstrap` option as `pvalue_score`.
 
-            p_sum += p_curr
+    USAGE:
+    ```
+    table = NullDistributionTable(scores_null)
+    p = table.pvalue(scores_obs, log_transform=True)
+    ```
+    """
+    def __init__(self, scores_null, n_bootstrap=NUM_BOOTSTRAP):
+        """
+        :param scores_null: numpy array of shape `(m, )` with the scores from the null distribution.
+        :param n_bootstrap: number of bootstrap resamples to use.
+        """
+        n_samp = scores_null.shape[0]
+        n_valid = n_samp - np.count_nonzero(np.isnan(scores_null))
+        scores_null_sorted = np.sort(scores_null)[:n_valid]
+        # Position of the first occurrence of each distinct null score
+        self.values, ind_first = np.unique(scores_null_sorted, return_index=True)
+        ind_first = np.append(ind_first, n_valid)
 
-        # Average p-value from the bootstrap replications
-        p = p_sum / (n_bootstrap + 1.)
+        counts, n_total = resampled_null_counts(n_samp, bootstrap=False)
+        self.tail = tail_probabilities(scores_null_sorted, counts[:n_valid], n_total)[ind_first]
+        counts, n_total = resampled_null_counts(n_samp, bootstrap=True, n_bootstrap=n_bootstrap)
+        self.tail_bootstrap = tail_probabilities(scores_null_sorted, counts[:n_valid], n_total)[ind_first]
+        for arr in (self.values, self.tail, self.tail_bootstrap):
+            arr.flags.writeable = False
 
-    p[p < eps] = eps
-    if log_transform:
-        return -np.log(p)
-    else:
-        return p
+    def pvalue(self, scores_obs, log_transform=False, bootstrap=True):
+        """
+        Empirical p-values of the observed scores with respect to the null distribution.
+
+        :param scores_obs: numpy array of shape `(n, )` with the observed scores.
+        :param log_transform: set to True to apply negative log transform to the p-values.
+        :param bootstrap: Set to True to use the bootstrap resampled estimate of the p-value.
+
+        :return: numpy array with the p-values or negative-log-transformed p-values. Has the same shape as
+                 `scores_obs`.
+        """
+        return pvalue_from_tail(self.values, self.tail_bootstrap if bootstrap else self.tail,
+                                np.asarray(scores_obs, dtype=np.float64), log_transform=log_transform)
+
+
+def column_ranks(scores_null, scores_obs):
+    """
+    Per-column ranks of the null scores and binary search positions of the observed scores. These are shared by
+    all the layer pairs (column pairs) in `pvalue_score_all_pairs`.
+
+    A null score `scores_null[j, c]` is `>=` an observed score `scores_obs[i, c]` if and only if
+    `rank_null[j, c] >= pos_obs[i, c]`. Hence, the bivariate p-values can be calculated using integer ranks alone.
+
+    :param scores_null: numpy array of shape `(m, L)` with the scores from the null distribution.
+    :param scores_obs: numpy array of shape `(n, L)` with the observed scores.
+
+    :return: (rank_null, order_null, pos_obs, order_obs), where
+        - rank_null: int numpy array of shape `(m, L)` with the rank of each null score in its column.
+        - order_null: int numpy array of shape `(m, L)` with the indices that sort each column of `scores_null`.
+        - pos_obs: int numpy array of shape `(n, L)` with the position of the first null score `>=` each
+                   observed score in the sorted column.
+        - order_obs: int numpy array of shape `(n, L)` with the indices that sort each column of `pos_obs` in
+                     decreasing order.
+    """
+    m, n_feat = scores_null.shape
+    n = scores_obs.shape[0]
+    order_null = np.argsort(scores_null, axis=0, kind='mergesort')
+    rank_null = np.empty((m, n_feat), dtype=np.int64)
+    pos_obs = np.empty((n, n_feat), dtype=np.int64)
+    for c in range(n_feat):
+        rank_null[order_null[:, c], c] = np.arange(m)
+        pos_obs[:, c] = np.searchsorted(scores_null[order_null[:, c], c], scores_obs[:, c], side='left')
+
+    order_obs = np.argsort(-pos_obs, axis=0, kind='mergesort')
+    return rank_null, order_null, pos_obs, order_obs
 
 
 @njit(parallel=True)
+def dominance_counts_pairs(rank_null, order_null, pos_obs, order_obs, nan_null, nan_obs, pairs, weights):
+    """
+    Weighted count of the null scores that dominate (are `>=` in both coordinates) each observed score, for every
+    column pair. Uses a sweep over the first column of the pair in decreasing order and a Fenwick (binary indexed)
+    tree over the ranks of the second column. Takes `O((n + m) log m)` time per pair, and the pairs are processed
+    in parallel.
+
+    :param rank_null: see the function `column_ranks`.
+    :param order_null: see the function `column_ranks`.
+    :param pos_obs: see the function `column_ranks`.
+    :param order_obs: see the function `column_ranks`.
+    :param nan_null: boolean numpy array of shape `(m, L)` indicating the NaN null scores.
+    :param nan_obs: boolean numpy array of shape `(n, L)` indicating the NaN observed scores.
+    :param pairs: int numpy array of shape `(n_pairs, 2)` with the column indices of each pair.
+    :param weights: numpy array of shape `(n_pairs, m)` with the number of times each null score is counted
+                    for each pair.
+
+    :return: numpy array of shape `(n, n_pairs)` with the weighted dominance counts.
+    """
+    m = rank_null.shape[0]
+    n = pos_obs.shape[0]
+    n_pairs = pairs.shape[0]
+    counts = np.zeros((n, n_pairs))
+    for k in prange(n_pairs):
+        a = pairs[k, 0]
+        b = pairs[k, 1]
+        # Fenwick tree indexed by the reversed rank of the second column, so that prefix sums count the null
+        # scores with a larger rank
+        tree = np.zeros(m + 1)
+        t = m - 1
+        for r in range(n):
+            i = order_obs[r, a]
+            # Insert the null scores that are `>=` the observed score in the first column
+            while t >= pos_obs[i, a]:
+                j = order_null[t, a]
+                t -= 1
+                if nan_null[j, a] or nan_null[j, b]:
+                    continue
+
+                u = m - rank_null[j, b]
+                while u <= m:
+                    tree[u] += weights[k, j]
+                    u += u & (-u)
+
+            if nan_obs[i, a] or nan_obs[i, b]:
+                continue
+
+            # Sum of the inserted null scores that are `>=` the observed score in the second column
+            u = m - pos_obs[i, b]
+            s = 0.
+            while u > 0:
+                s += tree[u]
+                u -= u & (-u)
+
+            counts[i, k] = s
+
+    return counts
+
+
 def pvalue_score_bivar(scores_null, scores_obs, log_transform=False, bootstrap=True, n_bootstrap=NUM_BOOTSTRAP):
     """
     Calculate the empirical p-values of the bivariate observed scores `scores_obs` with respect to the scores from
@@ -65,56 +253,45 @@ def pvalue_score_bivar(scores_null, scores_obs, log_transform=False, bootstrap=T
     :param log_transform: set to True to apply negative log transform to the p-values.
     :param bootstrap: Set to True to calculate a bootstrap resampled estimate of the p-value.
     :param n_bootstrap: number of bootstrap resamples to use.
-    :param n_jobs: number of jobs to execute in parallel.
 
     :return: numpy array with the p-values or negative-log-transformed p-values. Has shape `(scores_obs.shape[0], )`.
     """
-    eps = 1e-16
-    n_samp = scores_null.shape[0]
-    n_obs = scores_obs.shape[0]
-    p = np.zeros(n_obs)
-    for i in prange(n_obs):
-        for j in range(n_samp):
-            if (scores_null[j, 0] >= scores_obs[i, 0]) and (scores_null[j, 1] >= scores_obs[i, 1]):
-                p[i] += 1.
+    return pvalue_score_all_pairs(scores_null, scores_obs, log_transform=log_transform, bootstrap=bootstrap,
+                                  n_bootstrap=n_bootstrap)[:, 0]
 
-        p[i] = p[i] / n_samp
 
-    if bootstrap:
-        ind_null_repl = np.random.choice(np.arange(n_samp), size=(n_bootstrap, n_samp), replace=True)
-        p_sum = p
-        for b in prange(n_bootstrap):
-            p_curr = np.zeros(n_obs)
-            for i in range(n_obs):
-                for j in ind_null_repl[b, :]:
-                    if (scores_null[j, 0] >= scores_obs[i, 0]) and (scores_null[j, 1] >= scores_obs[i, 1]):
-                        p_curr[i] += 1.
+def pvalue_score_all_pairs(scores_null, scores_obs, log_transform=False, bootstrap=True, n_bootstrap=NUM_BOOTSTRAP):
+    """
+    Calculate the empirical p-values of the observed scores from every pair of columns (e.g. layers) with respect
+    to the scores from the null distribution. The per-column ranks are calculated once and shared by all the pairs,
+    which are then processed in a single parallel pass (see `dominance_counts_pairs`).
 
-                p_curr[i] = p_curr[i] / n_samp
+    :param scores_null: numpy array of shape `(m, L)` with the scores from the null distribution.
+    :param scores_obs: numpy array of shape `(n, L)` with the observed scores.
+    :param log_transform: set to True to apply negative log transform to the p-values.
+    :param bootstrap: Set to True to calculate a bootstrap resampled estimate of the p-value.
+    :param n_bootstrap: number of bootstrap resamples to use.
 
-            p_sum += p_curr
+    :return: numpy array with the p-values or negative-log-transformed p-values. Has shape `(n, L (L - 1) / 2)`.
+             The column pairs `(i, j)` with `i < j` are ordered lexicographically.
+    """
+    eps = PVALUE_MIN
+    n_samp, n_feat = scores_null.shape
+    pairs = np.array([[i, j] for i in range(n_feat - 1) for j in range(i + 1, n_feat)], dtype=np.int64)
+    n_pairs = pairs.shape[0]
+    if n_pairs == 0:
+        return np.zeros((scores_obs.shape[0], 0))
 
-        # Average p-value from the bootstrap replications
-        p = p_sum / (n_bootstrap + 1.)
+    # Bootstrap resamples are drawn independently for each pair
+    weights = np.zeros((n_pairs, n_samp))
+    for k in range(n_pairs):
+        weights[k, :], n_total = resampled_null_counts(n_samp, bootstrap=bootstrap, n_bootstrap=n_bootstrap)
 
+    rank_null, order_null, pos_obs, order_obs = column_ranks(scores_null, scores_obs)
+    p = dominance_counts_pairs(rank_null, order_null, pos_obs, order_obs, np.isnan(scores_null),
+                               np.isnan(scores_obs), pairs, weights) / n_total
     p[p < eps] = eps
     if log_transform:
         return -np.log(p)
     else:
         return p
-
-
-def pvalue_score_all_pairs(scores_null, scores_obs, log_transform=False, bootstrap=True, n_bootstrap=NUM_BOOTSTRAP):
-    n_obs, n_feat = scores_obs.shape
-    n_pairs = int(0.5 * n_feat * (n_feat - 1))
-    p_vals = np.zeros((n_obs, n_pairs))
-    k = 0
-    for i in range(n_feat - 1):
-        for j in range(i + 1, n_feat):
-            p_vals[:, k] = pvalue_score_bivar(
-                scores_null[:, [i, j]], scores_obs[:, [i, j]], log_transform=log_transform,
-                bootstrap=bootstrap, n_bootstrap=n_bootstrap
-            )
-            k += 1
-
-    return p_vals
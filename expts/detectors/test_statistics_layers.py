@@ -5,14 +5,12 @@ Test statistics to be calculated at the different layers of the trained deep neu
 import numpy as np
 import sys
 from abc import ABC, abstractmethod
-import multiprocessing
-from functools import partial
 from numba import njit, prange
 from scipy.stats import binom
 import logging
 import copy
 from sklearn.preprocessing import MinMaxScaler
-from helpers.knn_index import KNNIndex, helper_knn_distance
+from helpers.knn_index import KNNIndex, PartitionedKNNIndex, QueryCache, helper_knn_distance, use_partitioned_index
 from helpers.knn_classifier import neighbors_label_counts
 from helpers.multinomial import (
     multinomial_estimation,
@@ -21,26 +19,430 @@ from helpers.multinomial import (
 from helpers.lid_estimators import lid_mle_amsaleg
 from helpers.dimension_reduction_methods import (
     pca_wrapper,
-    helper_reconstruction_error
+    solve_lle_weights_batch
 )
 from detectors.pvalue_estimation import (
     pvalue_score,
-    pvalue_score_all_pairs
+    pvalue_score_all_pairs,
+    NullDistributionTable
 )
-from detectors.localized_pvalue_estimation import averaged_KLPE_anomaly_detection
+from detectors.localized_pvalue_estimation import averaged_KLPE_anomaly_detection, neighborhood_range
 from helpers.utils import get_num_jobs
 from helpers.constants import (
     NEIGHBORHOOD_CONST,
     SEED_DEFAULT,
     METRIC_DEF,
     NUM_BOOTSTRAP,
-    PCA_CUTOFF
+    PCA_CUTOFF,
+    TEST_STATS_SUPPORTED
 )
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 logger = logging.getLogger(__name__)
 
 
+def distance_ratio_partitioned(distances, col):
+    """
+    Ratio of the nearest-neighbor distance to the partition (class) `col`, and the smallest nearest-neighbor
+    distance to any other partition. This is the distance ratio of the trust score.
+
+    :param distances: numpy array of shape `(n, m)` with the nearest-neighbor distance of each sample to each of the
+                      `m` partitions.
+    :param col: index of the partition in the numerator.
+
+    :return: numpy array of shape `(n, )` with the distance ratios.
+    """
+    v = np.clip(np.min(np.delete(distances, col, axis=1), axis=1), sys.float_info.epsilon, None)
+    return distances[:, col] / v
+
+
+def multinomial_lrt_all(data_counts, log_params, log_params_rem, mask_classes, mask_all, is_multi, rows_pred,
+                        n_neighbors):
+    """
+    Multinomial likelihood ratio test statistic of each sample conditioned on its predicted class and on each
+    candidate true class, calculated in one pass over the samples. The parameters conditioned on the `m` predicted
+    classes and the `m` true classes are stacked into `2 m` rows, where row `i` (or `m + i`) corresponds to the
+    predicted (or true) class `i`.
+
+    :param data_counts: numpy array of shape `(n, m)` with the class label counts among the neighbors of each sample.
+    :param log_params: numpy array of shape `(2 m, m)` with the log of `n_neighbors` times the multinomial
+                       probability parameters.
+    :param log_params_rem: numpy array of shape `(2 m, )` with the log of `n_neighbors` times the cumulative
+                           probability of the classes that are not distinct (grouped into one class).
+    :param mask_classes: boolean numpy array of shape `(2 m, m)` indicating the distinct classes.
+    :param mask_all: boolean numpy array of shape `(2 m, )` that is True if all the classes are distinct.
+    :param is_multi: boolean numpy array of shape `(2 m, )` that is True if the multinomial test statistic is used.
+                     Otherwise, the statistic is the proportion of neighbors with a label different from the class.
+    :param rows_pred: integer numpy array of shape `(n, )` with the encoded predicted class of each sample.
+    :param n_neighbors: number of nearest neighbors.
+
+    :return: numpy array of shape `(n, m + 1)` with the test statistics. Column 0 is conditioned on the predicted
+             class and column `i + 1` is conditioned on the true class `i`.
+    """
+    # The compiled function does not check the array bounds
+    n, m = data_counts.shape
+    if rows_pred.shape[0] != n:
+        raise ValueError("Inputs 'data_counts' and 'rows_pred' have different number of samples ({:d} != {:d}).".
+                         format(n, rows_pred.shape[0]))
+    if (log_params.shape != (2 * m, m)) or (mask_classes.shape != (2 * m, m)):
+        raise ValueError("Inputs 'log_params' and 'mask_classes' should have shape ({:d}, {:d}).".format(2 * m, m))
+    if (n > 0) and ((np.min(rows_pred) < 0) or (np.max(rows_pred) >= m)):
+        raise ValueError("Input 'rows_pred' should have values in the range [0, {:d}].".format(m - 1))
+
+    return _multinomial_lrt_all(data_counts, log_params, log_params_rem, mask_classes, mask_all, is_multi,
+                                rows_pred, n_neighbors)
+
+
+@njit(parallel=True)
+def _multinomial_lrt_all(data_counts, log_params, log_params_rem, mask_classes, mask_all, is_multi, rows_pred,
+                         n_neighbors):
+    # Compiled implementation of `multinomial_lrt_all`
+    n, m = data_counts.shape
+    eps = np.finfo(np.float64).eps
+    scores = np.zeros((n, m + 1))
+    for r in prange(n):
+        log_counts = np.empty(m)
+        for c in range(m):
+            log_counts[c] = np.log(max(data_counts[r, c], eps))
+
+        for j in range(m + 1):
+            q = rows_pred[r] if (j == 0) else (m + j - 1)
+            i = q - m if (q >= m) else q
+            if not is_multi[q]:
+                scores[r, j] = (n_neighbors - data_counts[r, i]) / n_neighbors
+                continue
+
+            v = 0.
+            counts_rem = float(n_neighbors)
+            for c in range(m):
+                if mask_classes[q, c]:
+                    v += data_counts[r, c] * (log_counts[c] - log_params[q, c])
+                    counts_rem -= data_counts[r, c]
+
+            if not mask_all[q]:
+                # Cumulative count of the classes that are grouped into one class
+                v += counts_rem * (np.log(max(counts_rem, eps)) - log_params_rem[q])
+
+            scores[r, j] = v
+
+    return scores
+
+
+class SharedNeighbors:
+    """
+    Nearest neighbors of the samples from one layer, shared by the test statistics calculated on the layer in the
+    multi-statistic mode of `DetectorLayerStatistics`. The neighbors of a set of points are found by two queries:
+    - a global query for the neighbors among all the training samples, used by the multinomial and binomial
+      statistics.
+    - a class-restricted query for the neighbors within each of the `2 m` partitions of the training samples given
+      by their predicted class (first `m` partitions) and their true class (last `m` partitions), where `m` is the
+      number of classes. This is used by the LID, LLE, distance, and trust statistics.
+
+    Each query is run once for the training data and once for each test data, with the largest number of neighbors
+    required by the test statistics. The test statistics get their neighbors by slicing these arrays through a
+    `SharedNeighborsView`, which has the query interface of a KNN index.
+
+    The class-restricted query uses a `PartitionedKNNIndex` for exact search. For approximate search, a `KNNIndex`
+    is built per partition and the results are merged into the same array format.
+    """
+    def __init__(self, features, labels, labels_pred, labels_unique=None, layer_statistics=None,
+                 neighborhood_constant=NEIGHBORHOOD_CONST, n_neighbors=None,
+                 metric=METRIC_DEF, metric_kwargs=None,
+                 approx_nearest_neighbors=True,
+                 n_jobs=1,
+                 low_memory=False,
+                 partitioned_index=None,
+                 graph_cache=None,
+                 graph_cache_key=None,
+                 seed_rng=SEED_DEFAULT):
+        """
+
+        :param features: numpy array of shape `(N, d)` with the training feature vectors of the layer.
+        :param labels: numpy array of shape `(N, )` with the true labels per sample.
+        :param labels_pred: numpy array of shape `(N, )` with the predicted labels per sample.
+        :param labels_unique: None or a numpy array with the unique labels. This should be the same as the one passed
+                              to the `fit` method of the test statistics.
+        :param layer_statistics: list with the names of the test statistics that share the neighbors. This is used
+                                 to set the number of neighbors of each query.
+        :param neighborhood_constant: same as `TestStatistic`.
+        :param n_neighbors: same as `TestStatistic`.
+        :param metric: same as `TestStatistic`.
+        :param metric_kwargs: same as `TestStatistic`.
+        :param approx_nearest_neighbors: same as `TestStatistic`.
+        :param n_jobs: same as `TestStatistic`.
+        :param low_memory: same as `TestStatistic`.
+        :param partitioned_index: same as `TestStatistic`. Used only for the class-restricted query.
+        :param graph_cache: same as `TestStatistic`.
+        :param graph_cache_key: same as `TestStatistic`.
+        :param seed_rng: int value specifying the seed for the random number generator.
+        """
+        if labels_unique is None:
+            labels_unique = np.unique(labels)
+
+        self.labels_unique = labels_unique
+        self.n_classes = len(labels_unique)
+        self.metric = metric
+        self.metric_kwargs = metric_kwargs
+        self.approx_nearest_neighbors = approx_nearest_neighbors
+        self.n_jobs = get_num_jobs(n_jobs)
+        self.low_memory = low_memory
+        self.graph_cache = graph_cache
+        self.graph_cache_key = graph_cache_key
+        self.seed_rng = seed_rng
+        self.use_partitioned = use_partitioned_index(partitioned_index, metric, metric_kwargs,
+                                                     approx_nearest_neighbors)
+        if (graph_cache is not None) and (partitioned_index is None):
+            # The per-partition KNN indices are obtained from the graph cache instead
+            self.use_partitioned = False
+
+        self.features = features
+        self.key_train = QueryCache.hash_key(features)
+        self.partitions = [np.where(labels_pred == c)[0] for c in labels_unique] + \
+                          [np.where(labels == c)[0] for c in labels_unique]
+        for c, ind in zip(list(labels_unique) * 2, self.partitions):
+            if ind.shape[0] == 0:
+                raise ValueError("No predicted or labeled samples from class '{}'. Cannot proceed.".format(c))
+
+        # Number of neighbors of the global and the class-restricted queries, set to the largest number required by
+        # the test statistics. A query for more neighbors is run again with the larger number
+        def _num_neighbors(n):
+            return n_neighbors if (n_neighbors is not None) else int(np.ceil(n ** neighborhood_constant))
+
+        k = max(_num_neighbors(ind.shape[0]) for ind in self.partitions)
+        required_class = {
+            'lid': k,
+            'lle': min(k, max(features.shape[1] - 1, 1)),
+            'distance': neighborhood_range(k)[1],
+            'trust': 1
+        }
+        layer_statistics = layer_statistics or TEST_STATS_SUPPORTED
+        self.n_neighbors_all = 1
+        if ('multinomial' in layer_statistics) or ('binomial' in layer_statistics):
+            self.n_neighbors_all = _num_neighbors(features.shape[0])
+
+        self.n_neighbors_class = max([required_class.get(v, 1) for v in layer_statistics])
+        # The neighbors of a training sample within a partition that it does not belong to are used only by the LID
+        # and trust statistics. With approximate search, only the number required by them is queried
+        required_other = {'lid': k, 'trust': 1}
+        self.n_neighbors_other = max([required_other.get(v, 0) for v in layer_statistics])
+
+        self.index_all = None
+        self.index_class = None
+        self.indices_partition = [None] * len(self.partitions)
+        # Results of the last query on the training data and on the test data of each kind, as tuples
+        # `(key, nn_indices, nn_distances)`
+        self.results = dict()
+
+    def supports(self, ts_obj, features):
+        """
+        Check if the test statistic `ts_obj` can use the shared neighbors for the given training features.
+
+        :param ts_obj: `TestStatistic` object.
+        :param features: numpy array with the training features passed to the `fit` method of the test statistic.
+        :return: bool value.
+        """
+        if (ts_obj.metric != self.metric) or (ts_obj.metric_kwargs != self.metric_kwargs) or \
+                ts_obj.shared_nearest_neighbors or \
+                (ts_obj.approx_nearest_neighbors != self.approx_nearest_neighbors):
+            logger.warning("The nearest neighbor settings of the test statistic '{}' differ from those of the shared "
+                           "neighbors. Finding its neighbors separately.".format(ts_obj.__class__.__name__))
+            return False
+
+        if (features is not self.features) and (QueryCache.hash_key(features) != self.key_train):
+            logger.warning("The test statistic '{}' is fit on different data than the shared neighbors. Finding its "
+                           "neighbors separately.".format(ts_obj.__class__.__name__))
+            return False
+
+        return True
+
+    def view_all(self):
+        """
+        View of the global query, with the interface of a `KNNIndex`.
+        """
+        return SharedNeighborsView(self, 'all')
+
+    def view_class(self, pred=True):
+        """
+        View of the class-restricted query, with the interface of a `PartitionedKNNIndex`.
+
+        :param pred: Set to True to include the partitions given by the predicted class, followed by the partitions
+                     given by the true class. Set to False to include only the partitions given by the true class.
+        """
+        return SharedNeighborsView(self, 'class', None if pred else slice(self.n_classes, 2 * self.n_classes))
+
+    def query(self, kind, data=None, k=None):
+        """
+        Nearest neighbors of the training samples or of the test samples from one of the queries. The result of the
+        last query on the training data and on the test data is kept, so that the test statistics sharing the
+        neighbors slice the same arrays instead of repeating the query.
+
+        :param kind: 'all' for the global query or 'class' for the class-restricted query.
+        :param data: None to get the neighbors of the training samples, where each sample is excluded from its own
+                     neighbors. Otherwise, a numpy array of shape `(n, d)` with the test feature vectors.
+        :param k: None or an int value specifying the number of neighbors. If `None`, the number of neighbors of the
+                  query is used.
+
+        :return: (nn_indices, nn_distances), where
+            - nn_indices: numpy array of indices of the nearest neighbors. Has shape `(n, k)` for the global query
+                          and `(n, 2 m, k)` for the class-restricted query. The indices refer to the rows of the
+                          training features.
+            - nn_distances: numpy array of distances of the nearest neighbors, with the same shape as `nn_indices`.
+            Partitions with less than `k` samples are padded with the index -1 and the distance `np.inf`. With
+            approximate search, this is also the case for the neighbors of a training sample within a partition that
+            it does not belong to, beyond the number required by the test statistics.
+        """
+        k_query = self.n_neighbors_all if (kind == 'all') else self.n_neighbors_class
+        if k is None:
+            k = k_query
+
+        key = self.key_train if (data is None) else QueryCache.hash_key(data)
+        res = self.results.get((kind, data is None))
+        if (res is None) or (res[0] != key) or (res[1].shape[-1] < k):
+            k_query = max(k, k_query)
+            if kind == 'all':
+                nn_indices, nn_distances = self._query_all(data, k_query)
+            else:
+                nn_indices, nn_distances = self._query_class(data, k_query)
+
+            res = (key, nn_indices, nn_distances)
+            self.results[(kind, data is None)] = res
+
+        return res[1][..., :k], res[2][..., :k]
+
+    def clear(self):
+        """
+        Clear the results of the last queries.
+        """
+        self.results = dict()
+
+    def _knn_index_args(self, n_neighbors):
+        return {
+            'n_neighbors': n_neighbors,
+            'metric': self.metric,
+            'metric_kwargs': self.metric_kwargs,
+            'shared_nearest_neighbors': False,
+            'approx_nearest_neighbors': self.approx_nearest_neighbors,
+            'n_jobs': self.n_jobs,
+            'low_memory': self.low_memory,
+            'seed_rng': self.seed_rng
+        }
+
+    def _build_knn_index(self, features, n_neighbors, name):
+        kwargs = self._knn_index_args(n_neighbors)
+        if self.graph_cache is None:
+            return KNNIndex(features, **kwargs)
+        else:
+            return self.graph_cache.get_index((self.graph_cache_key, self.__class__.__name__, name), features,
+                                              **kwargs)
+
+    def _query_all(self, data, k):
+        if (self.index_all is None) or (self.index_all.nn_indices.shape[1] < k):
+            logger.info("Building a KNN index on all the samples for the shared nearest neighbor queries.")
+            self.index_all = self._build_knn_index(self.features, k, 'all')
+
+        if data is None:
+            return self.index_all.query_self(k=k)
+        else:
+            return self.index_all.query(data, k=k)
+
+    def _query_class(self, data, k):
+        if self.use_partitioned:
+            if self.index_class is None:
+                logger.info("Building a KNN index partitioned by the predicted and true class for the shared "
+                            "nearest neighbor queries.")
+                self.index_class = PartitionedKNNIndex(self.features, self.partitions, n_neighbors=k,
+                                                       metric=self.metric, n_jobs=self.n_jobs)
+            if data is None:
+                return self.index_class.query_self(k=k)
+            else:
+                return self.index_class.query(data, k=k)
+
+        # A KNN index per partition. The neighbors of the training samples from a partition exclude the sample itself,
+        # and the neighbors of the other training samples are found by querying the index for at most
+        # `self.n_neighbors_other` neighbors
+        n = self.features.shape[0] if (data is None) else data.shape[0]
+        nn_indices = np.full((n, len(self.partitions), k), -1, dtype=np.int64)
+        nn_distances = np.full((n, len(self.partitions), k), np.inf)
+        for p, rows in enumerate(self.partitions):
+            index = self._get_index_partition(p, k)
+            n_part = rows.shape[0]
+            if data is None:
+                k_self = min(k, n_part - 1)
+                if k_self > 0:
+                    ind, dist = index.query_self(k=k_self)
+                    nn_indices[rows, p, :k_self] = rows[ind]
+                    nn_distances[rows, p, :k_self] = dist
+
+                rows_query = np.setdiff1d(np.arange(n), rows, assume_unique=True)
+                data_query = self.features[rows_query, :]
+                k_query = min(k, n_part, self.n_neighbors_other)
+            else:
+                rows_query = np.arange(n)
+                data_query = data
+                k_query = min(k, n_part)
+
+            if rows_query.shape[0] and k_query:
+                ind, dist = index.query(data_query, k=k_query)
+                nn_indices[rows_query, p, :k_query] = rows[ind]
+                nn_distances[rows_query, p, :k_query] = dist
+
+        return nn_indices, nn_distances
+
+    def _get_index_partition(self, p, k):
+        index = self.indices_partition[p]
+        rows = self.partitions[p]
+        k_index = max(min(k, rows.shape[0] - 1), 1)
+        if (index is None) or (index.nn_indices.shape[1] < k_index):
+            # Partitions with the same samples (e.g. a predicted and a true class without misclassified samples)
+            # share the index
+            q = next((q for q in range(p) if np.array_equal(self.partitions[q], rows)), None)
+            if (q is not None) and (self.indices_partition[q].nn_indices.shape[1] >= k_index):
+                index = self.indices_partition[q]
+            else:
+                name = ('pred', self.labels_unique[p]) if (p < self.n_classes) else \
+                    ('true', self.labels_unique[p - self.n_classes])
+                index = self._build_knn_index(self.features[rows, :], k_index, name)
+
+            self.indices_partition[p] = index
+
+        return index
+
+    def __getstate__(self):
+        # The query results and the graph cache are not pickled
+        state = self.__dict__.copy()
+        state['results'] = dict()
+        state['graph_cache'] = None
+        return state
+
+
+class SharedNeighborsView:
+    """
+    View of the global or the class-restricted query of a `SharedNeighbors` object, with the query interface of a
+    `KNNIndex` (global query) or a `PartitionedKNNIndex` (class-restricted query).
+    """
+    def __init__(self, shared_neighbors, kind, partitions=None):
+        """
+        :param shared_neighbors: `SharedNeighbors` object.
+        :param kind: 'all' for the global query or 'class' for the class-restricted query.
+        :param partitions: None or a slice that selects a subset of the partitions of the class-restricted query.
+        """
+        self.shared_neighbors = shared_neighbors
+        self.kind = kind
+        self.partitions = partitions
+
+    def query(self, data, k=None):
+        return self._select(*self.shared_neighbors.query(self.kind, data=data, k=k))
+
+    def query_self(self, k=None):
+        return self._select(*self.shared_neighbors.query(self.kind, data=None, k=k))
+
+    def _select(self, nn_indices, nn_distances):
+        if self.partitions is None:
+            return nn_indices, nn_distances
+        else:
+            return nn_indices[:, self.partitions, :], nn_distances[:, self.partitions, :]
+
+
 class TestStatistic(ABC):
     """
     Skeleton class for different potential test statistics using the DNN layer representations.
@@ -52,6 +454,10 @@ class TestStatistic(ABC):
                  approx_nearest_neighbors=True,
                  n_jobs=1,
                  low_memory=False,
+                 partitioned_index=None,
+                 graph_cache=None,
+                 graph_cache_key=None,
+                 shared_neighbors=None,
                  seed_rng=SEED_DEFAULT):
         """
 
@@ -74,17 +480,41 @@ class TestStatistic(ABC):
         :param n_jobs: Number of parallel jobs or processes. Set to -1 to use all the available cpu cores.
         :param low_memory: Set to True to enable the low memory option of the `NN-descent` method. Note that this
                            is likely to increase the running time.
+        :param partitioned_index: None or a bool value. Set to True in order to use a single exact KNN index over all
+                                  the training samples tagged by their class (`PartitionedKNNIndex`), instead of
+                                  building and querying a separate KNN index per class. This is used by the test
+                                  statistics that support it, and requires a metric from `METRICS_EXACT_KNN` without
+                                  the SNN distance. If `None`, it is used when `approx_nearest_neighbors` is False,
+                                  `graph_cache` is not specified, and these requirements are met.
+        :param graph_cache: None or a `KNNGraphCache` object shared across the cross-validation folds. If specified,
+                            the KNN indices are obtained from the cache by restricting the indices built on the
+                            overlapping training data of the other folds, instead of building them from scratch.
+                            The partitioned index (`partitioned_index`) does not use the cache, so it is not used
+                            by default when a cache is specified.
+        :param graph_cache_key: hashable key that identifies the data used by this test statistic in
+                                `graph_cache`, e.g. the layer index.
+        :param shared_neighbors: None or a `SharedNeighbors` object that is shared by the test statistics calculated
+                                 on the same layer data (see `DetectorLayerStatistics` with multiple statistics). If
+                                 specified, the nearest neighbors are obtained by slicing the results of its global
+                                 and class-restricted queries, instead of building and querying KNN indices. It is
+                                 not used if the nearest neighbor settings or the training data differ.
         :param seed_rng: int value specifying the seed for the random number generator.
         """
         super(TestStatistic, self).__init__()
         self.neighborhood_constant = neighborhood_constant
         self.n_neighbors = n_neighbors
+        # Number of neighbors specified as input. `self.n_neighbors` is set by the `fit` method if this is `None`
+        self.n_neighbors_input = n_neighbors
         self.metric = metric
         self.metric_kwargs = metric_kwargs
         self.shared_nearest_neighbors = shared_nearest_neighbors
         self.approx_nearest_neighbors = approx_nearest_neighbors
         self.n_jobs = get_num_jobs(n_jobs)
         self.low_memory = low_memory
+        self.partitioned_index = partitioned_index
+        self.graph_cache = graph_cache
+        self.graph_cache_key = graph_cache_key
+        self.shared_neighbors = shared_neighbors
         self.seed_rng = seed_rng
 
         self.dim = None
@@ -93,6 +523,18 @@ class TestStatistic(ABC):
         self.n_classes = None
         self.label_encoder = None
         self.index_knn = None
+        # Lookup tables of the null distribution of the training scores from each predicted and true class.
+        # These are built at the end of the `fit` method by subclasses that use them
+        self.null_tables_pred = dict()
+        self.null_tables_true = dict()
+        # KNN indices built by `_build_knn_index` and the numbers of neighbors selected by `_num_neighbors` in the
+        # last fit, keyed by the name of the set of samples. These are reused by `fit_update`
+        self.knn_indices = dict()
+        self.n_neighbors_selected = dict()
+        self.knn_indices_prev = dict()
+        self.updating = False
+        # Hash keys of the training data, used by `fit_update` to check that the new data extends it
+        self.train_keys = None
         np.random.seed(self.seed_rng)
 
     @abstractmethod
@@ -113,6 +555,10 @@ class TestStatistic(ABC):
         :return:
         """
         self.n_train, self.dim = features.shape
+        self.train_keys = self._data_keys(features, labels, labels_pred)
+        if (self.shared_neighbors is not None) and (not self.shared_neighbors.supports(self, features)):
+            self.shared_neighbors = None
+
         if labels_unique is None:
             self.labels_unique = np.unique(labels)
         else:
@@ -127,7 +573,7 @@ class TestStatistic(ABC):
         # Number of nearest neighbors
         if self.n_neighbors is None:
             # Set number of nearest neighbors based on the data size and the neighborhood constant
-            self.n_neighbors = int(np.ceil(self.n_train ** self.neighborhood_constant))
+            self.n_neighbors = self._num_neighbors(self.n_train, 'all')
 
     @abstractmethod
     def score(self, features_test, labels_pred_test, is_train=False, log_transform=True, bootstrap=True):
@@ -145,6 +591,157 @@ class TestStatistic(ABC):
         """
         raise NotImplementedError
 
+    def fit_update(self, features, labels, labels_pred, **kwargs):
+        """
+        Fit the test statistic on the training data extended with new samples, without building the KNN indices
+        from scratch. The KNN indices built in the previous fit are extended with the new samples using
+        `KNNIndex.add`, and the numbers of nearest neighbors selected in the previous fit are kept. Models that do
+        not use these KNN indices (e.g. the partitioned index for exact search) are fit again as in `fit`.
+
+        :param features: numpy array of shape `(N, d)` with the feature vectors. The first `self.n_train` rows
+                         should be the feature vectors from the previous fit, followed by the new samples.
+        :param labels: numpy array of shape `(N, )` with the true labels per sample, in the same order as
+                       `features`.
+        :param labels_pred: numpy array of shape `(N, )` with the predicted labels per sample, in the same order as
+                            `features`.
+        :param kwargs: keyword arguments of the `fit` method.
+
+        :return: same as the `fit` method.
+        """
+        if self.train_keys is None:
+            raise ValueError("The method 'fit' should be called before 'fit_update'.")
+
+        n = self.n_train
+        if (features.shape[0] < n) or (self._data_keys(features[:n], labels[:n], labels_pred[:n]) != self.train_keys):
+            raise ValueError("The first {:d} rows of the inputs should be the data from the previous fit.".format(n))
+
+        self.knn_indices_prev, self.knn_indices = self.knn_indices, dict()
+        self.n_neighbors = self.n_neighbors_input
+        self.updating = True
+        try:
+            return self.fit(features, labels, labels_pred, **kwargs)
+        finally:
+            self.knn_indices_prev = dict()
+            self.updating = False
+
+    @staticmethod
+    def _data_keys(features, labels, labels_pred):
+        return tuple(QueryCache.hash_key(arr) for arr in (features, labels, labels_pred))
+
+    def _num_neighbors(self, n, name):
+        """
+        Number of nearest neighbors for a set of `n` samples based on the neighborhood constant. In `fit_update`,
+        the number of neighbors selected in the previous fit for the same set of samples is kept, so that its KNN
+        index can be extended with the new samples.
+
+        :param n: number of samples.
+        :param name: hashable name of the set of samples, e.g. `('pred', c)` for the samples predicted into class `c`.
+        :return: int value.
+        """
+        k = self.n_neighbors_selected.get(name) if self.updating else None
+        if k is None:
+            k = int(np.ceil(n ** self.neighborhood_constant))
+
+        self.n_neighbors_selected[name] = k
+        return k
+
+    def _use_partitioned_index(self):
+        """
+        Check if a single `PartitionedKNNIndex` should be used for the class-conditional nearest neighbor queries.
+        This is always the case with shared neighbors, whose class-restricted query has the same format.
+        """
+        if self.shared_neighbors is not None:
+            return True
+
+        if self.graph_cache is not None:
+            if self.partitioned_index is None:
+                # The per-class KNN indices are obtained from the graph cache instead
+                return False
+
+            if self.partitioned_index:
+                logger.warning("The partitioned KNN index does not use the graph cache. It is built from scratch.")
+
+        return use_partitioned_index(self.partitioned_index, self.metric, self.metric_kwargs,
+                                     self.approx_nearest_neighbors, self.shared_nearest_neighbors)
+
+    def _build_knn_index(self, features, n_neighbors, name):
+        """
+        Build a KNN index on the given features using the nearest neighbor settings of the test statistic. If a
+        graph cache is specified, the index is obtained from the cache. If shared neighbors are specified, a view of
+        their global query is returned for the index on all the samples (`name = 'all'`). In `fit_update`, the index
+        with the same name from the previous fit is extended with the new samples, which are the rows of `features`
+        following the indexed points.
+
+        :param features: numpy array of shape `(N, d)` with the feature vectors.
+        :param n_neighbors: number of nearest neighbors.
+        :param name: hashable name of the index, e.g. `('pred', c)` for the samples predicted into class `c`.
+
+        :return: `KNNIndex` object.
+        """
+        kwargs = {
+            'n_neighbors': n_neighbors,
+            'metric': self.metric,
+            'metric_kwargs': self.metric_kwargs,
+            'shared_nearest_neighbors': self.shared_nearest_neighbors,
+            'approx_nearest_neighbors': self.approx_nearest_neighbors,
+            'n_jobs': self.n_jobs,
+            'low_memory': self.low_memory,
+            'seed_rng': self.seed_rng
+        }
+        if (self.shared_neighbors is not None) and (name == 'all'):
+            return self.shared_neighbors.view_all()
+
+        index = self.knn_indices_prev.get(name)
+        if (index is not None) and (index.nn_indices.shape[1] >= n_neighbors) and \
+                (index.nn_indices.shape[0] <= features.shape[0]) and (not index.shared_nearest_neighbors):
+            n = index.nn_indices.shape[0]
+            if n < features.shape[0]:
+                logger.info("Adding {:d} samples to the KNN index with {:d} samples.".format(features.shape[0] - n, n))
+                index.add(features[n:])
+        elif self.graph_cache is None:
+            index = KNNIndex(features, **kwargs)
+        else:
+            index = self.graph_cache.get_index((self.graph_cache_key, self.__class__.__name__, name), features,
+                                               **kwargs)
+        self.knn_indices[name] = index
+        return index
+
+    def _build_partitioned_index(self, features, n_neighbors, pred=True):
+        """
+        Build a `PartitionedKNNIndex` on the given features, partitioned by the predicted class (first `m`
+        partitions) and the true class (last `m` partitions) of the samples. If shared neighbors are specified, a
+        view of their class-restricted query is returned instead.
+
+        Requires the attributes `self.indices_pred` and `self.indices_true` to be set.
+        :param features: numpy array of shape `(N, d)` with the feature vectors.
+        :param n_neighbors: number of nearest neighbors.
+        :param pred: Set to False to include only the partitions given by the true class.
+
+        :return: `PartitionedKNNIndex` or `SharedNeighborsView` object.
+        """
+        if self.shared_neighbors is not None:
+            return self.shared_neighbors.view_class(pred=pred)
+
+        partitions = [self.indices_true[c] for c in self.labels_unique]
+        if pred:
+            partitions = [self.indices_pred[c] for c in self.labels_unique] + partitions
+
+        return PartitionedKNNIndex(features, partitions, n_neighbors=n_neighbors, metric=self.metric,
+                                   n_jobs=self.n_jobs)
+
+    def _build_null_tables(self):
+        """
+        Build the lookup tables of the null distribution for the scores conditioned on each predicted class and each
+        true class. These are calculated from the scores of the training data `self.scores_train`, and are used by
+        the `score` method to calculate the p-values of the test scores.
+
+        Requires the attributes `self.scores_train`, `self.indices_pred`, and `self.indices_true` to be set.
+        :return: None
+        """
+        for i, c in enumerate(self.labels_unique):
+            self.null_tables_pred[c] = NullDistributionTable(self.scores_train[self.indices_pred[c], 0])
+            self.null_tables_true[c] = NullDistributionTable(self.scores_train[self.indices_true[c], i + 1])
+
 
 class MultinomialScore(TestStatistic):
     """
@@ -161,6 +758,9 @@ class MultinomialScore(TestStatistic):
             approx_nearest_neighbors=kwargs.get('approx_nearest_neighbors', True),
             n_jobs=kwargs.get('n_jobs', 1),
             low_memory=kwargs.get('low_memory', False),
+            graph_cache=kwargs.get('graph_cache', None),
+            graph_cache_key=kwargs.get('graph_cache_key', None),
+            shared_neighbors=kwargs.get('shared_neighbors', None),
             seed_rng=kwargs.get('seed_rng', SEED_DEFAULT)
         )
         # Encoded labels of train data
@@ -237,15 +837,7 @@ class MultinomialScore(TestStatistic):
                 raise ValueError("Invalid value {:d} for the argument 'n_classes_multinom'".format(n_classes_multinom))
 
         logger.info("Building a KNN index for nearest neighbor queries.")
-        self.index_knn = KNNIndex(
-            features, n_neighbors=self.n_neighbors,
-            metric=self.metric, metric_kwargs=self.metric_kwargs,
-            shared_nearest_neighbors=self.shared_nearest_neighbors,
-            approx_nearest_neighbors=self.approx_nearest_neighbors,
-            n_jobs=self.n_jobs,
-            low_memory=self.low_memory,
-            seed_rng=self.seed_rng
-        )
+        self.index_knn = self._build_knn_index(features, self.n_neighbors, 'all')
         # Indices of the nearest neighbors of the points (rows) from `features`
         nn_indices, _ = self.index_knn.query_self(k=self.n_neighbors)
 
@@ -317,6 +909,7 @@ class MultinomialScore(TestStatistic):
 
         # Calculate the scores and p-values for each sample
         self.scores_train, p_values = self.score(features, labels_pred, is_train=True, bootstrap=bootstrap)
+        self._build_null_tables()
         return self.scores_train, p_values
 
     def score(self, features_test, labels_pred_test, is_train=False, log_transform=True, bootstrap=True):
@@ -347,31 +940,21 @@ class MultinomialScore(TestStatistic):
             nn_indices, _ = self.index_knn.query(features_test, k=self.n_neighbors)
             _, data_counts = neighbors_label_counts(nn_indices, self.labels_train_enc, self.n_classes)
 
-        scores = np.zeros((n_test, 1 + self.n_classes))
+        # Test statistics conditioned on the predicted class and on each candidate true class
+        scores = multinomial_lrt_all(
+            data_counts, *self._lrt_params(), self.label_encoder(labels_pred_test).astype(np.int64), self.n_neighbors
+        )
         p_values = np.zeros((n_test, 1 + self.n_classes))
         preds_unique = self.labels_unique if (n_test > 1) else [labels_pred_test[0]]
         cnt_par = 0
         for c_hat in preds_unique:
-            i = self.label_encoder([c_hat])[0]
             # Index of samples predicted into class `c_hat`
             ind = np.where(labels_pred_test == c_hat)[0]
             if ind.shape[0]:
-                if self.type_test_stat_pred[i] == 'multi':
-                    # Likelihood ratio statistic conditioned on the predicted class `c_hat`
-                    scores[ind, 0] = self.multinomial_lrt(
-                        data_counts[ind, :], self.proba_params_pred[i, :], self.mask_included_pred[i, :],
-                        self.n_neighbors
-                    )
-                else:
-                    # Score is the proportion of samples in the neighborhood that have a different label than the
-                    # predicted class `c_hat`
-                    scores[ind, 0] = (1. / self.n_neighbors) * (self.n_neighbors - data_counts[ind, i])
-
                 # Empirical p-value estimates
                 if not is_train:
-                    p_values[ind, 0] = pvalue_score(
-                        self.scores_train[self.indices_pred[c_hat], 0], scores[ind, 0], log_transform=log_transform,
-                        bootstrap=bootstrap
+                    p_values[ind, 0] = self.null_tables_pred[c_hat].pvalue(
+                        scores[ind, 0], log_transform=log_transform, bootstrap=bootstrap
                     )
                 else:
                     p_values[ind, 0] = pvalue_score(
@@ -383,20 +966,10 @@ class MultinomialScore(TestStatistic):
                     break
 
         for i, c in enumerate(self.labels_unique):
-            if self.type_test_stat_true[i] == 'multi':
-                # Likelihood ratio statistic conditioned on the candidate true class `c`
-                scores[:, i + 1] = self.multinomial_lrt(
-                    data_counts, self.proba_params_true[i, :], self.mask_included_true[i, :], self.n_neighbors
-                )
-            else:
-                # Score is the proportion of samples in the neighborhood that have a different label from `c`
-                scores[:, i + 1] = (1. / self.n_neighbors) * (self.n_neighbors - data_counts[:, i])
-
             # Empirical p-value estimates
             if not is_train:
-                p_values[:, i + 1] = pvalue_score(
-                    self.scores_train[self.indices_true[c], i + 1], scores[:, i + 1], log_transform=log_transform,
-                    bootstrap=bootstrap
+                p_values[:, i + 1] = self.null_tables_true[c].pvalue(
+                    scores[:, i + 1], log_transform=log_transform, bootstrap=bootstrap
                 )
             else:
                 p_values[:, i + 1] = pvalue_score(
@@ -406,29 +979,22 @@ class MultinomialScore(TestStatistic):
 
         return scores, p_values
 
-    @staticmethod
-    def multinomial_lrt(data_counts, proba_params, mask_classes, n_neighbors):
-        # Multinomial likelihood ratio test statistic
-        if np.all(mask_classes):
-            # All classes are distinct
-            mat = data_counts * (np.log(np.clip(data_counts, sys.float_info.epsilon, None)) -
-                                 np.log(n_neighbors * proba_params))
-        else:
-            # Counts from the distinct classes
-            data_counts_sel = data_counts[:, mask_classes]
-            # Adjoin the cumulative count from the remaining classes as a new column
-            counts_rem = n_neighbors - np.sum(data_counts_sel, axis=1)
-            data_counts_sel = np.hstack((data_counts_sel, counts_rem[:, np.newaxis]))
-
-            # Probability parameters from the distinct classes
-            p = proba_params[mask_classes]
-            # Append the cumulative probability from the remaining classes
-            p = np.append(p, max(1. - np.sum(p), sys.float_info.epsilon))
-
-            mat = data_counts_sel * (np.log(np.clip(data_counts_sel, sys.float_info.epsilon, None)) -
-                                     np.log(n_neighbors * p))
+    def _lrt_params(self):
+        """
+        Parameters conditioned on the predicted and the true classes stacked in the format expected by the function
+        `multinomial_lrt_all`.
 
-        return np.sum(mat, axis=1)
+        :return: (log_params, log_params_rem, mask_classes, mask_all, is_multi)
+        """
+        proba_params = np.vstack((self.proba_params_pred, self.proba_params_true))
+        mask_classes = np.vstack((self.mask_included_pred, self.mask_included_true))
+        log_params = np.log(self.n_neighbors * proba_params)
+        # Cumulative probability of the classes that are grouped into one class
+        proba_rem = 1. - np.sum(np.where(mask_classes, proba_params, 0.), axis=1)
+        log_params_rem = np.log(self.n_neighbors * np.clip(proba_rem, sys.float_info.epsilon, None))
+        mask_all = np.all(mask_classes, axis=1)
+        is_multi = np.array([v == 'multi' for v in (self.type_test_stat_pred + self.type_test_stat_true)])
+        return log_params, log_params_rem, mask_classes, mask_all, is_multi
 
     @staticmethod
     def set_distinct_classes(proba, ind_class, n_classes, n_classes_multinom, combine_low_proba_classes):
@@ -476,6 +1042,9 @@ class BinomialScore(TestStatistic):
             approx_nearest_neighbors=kwargs.get('approx_nearest_neighbors', True),
             n_jobs=kwargs.get('n_jobs', 1),
             low_memory=kwargs.get('low_memory', False),
+            graph_cache=kwargs.get('graph_cache', None),
+            graph_cache_key=kwargs.get('graph_cache_key', None),
+            shared_neighbors=kwargs.get('shared_neighbors', None),
             seed_rng=kwargs.get('seed_rng', SEED_DEFAULT)
         )
         # Encoded labels of train data
@@ -517,15 +1086,7 @@ class BinomialScore(TestStatistic):
         super(BinomialScore, self).fit(features, labels, labels_pred, labels_unique=labels_unique)
 
         logger.info("Building a KNN index for nearest neighbor queries.")
-        self.index_knn = KNNIndex(
-            features, n_neighbors=self.n_neighbors,
-            metric=self.metric, metric_kwargs=self.metric_kwargs,
-            shared_nearest_neighbors=self.shared_nearest_neighbors,
-            approx_nearest_neighbors=self.approx_nearest_neighbors,
-            n_jobs=self.n_jobs,
-            low_memory=self.low_memory,
-            seed_rng=self.seed_rng
-        )
+        self.index_knn = self._build_knn_index(features, self.n_neighbors, 'all')
         # Indices of the nearest neighbors of the points (rows) from `features`
         nn_indices, _ = self.index_knn.query_self(k=self.n_neighbors)
 
@@ -563,6 +1124,7 @@ class BinomialScore(TestStatistic):
 
         # Calculate the scores and p-values for each sample
         self.scores_train, p_values = self.score(features, labels_pred, is_train=True, bootstrap=bootstrap)
+        self._build_null_tables()
         return self.scores_train, p_values
 
     def score(self, features_test, labels_pred_test, is_train=False, log_transform=True, bootstrap=True):
@@ -610,9 +1172,8 @@ class BinomialScore(TestStatistic):
                 if not is_train:
                     # `self.scores_train[self.indices_pred[c_hat], 0]` are the scores from the training data that
                     # were predicted into class `c_hat`
-                    p_values[ind, 0] = pvalue_score(
-                        self.scores_train[self.indices_pred[c_hat], 0], scores[ind, 0], log_transform=log_transform,
-                        bootstrap=bootstrap
+                    p_values[ind, 0] = self.null_tables_pred[c_hat].pvalue(
+                        scores[ind, 0], log_transform=log_transform, bootstrap=bootstrap
                     )
                 else:
                     p_values[ind, 0] = pvalue_score(
@@ -629,9 +1190,8 @@ class BinomialScore(TestStatistic):
 
             # Empirical p-value estimates
             if not is_train:
-                p_values[:, i + 1] = pvalue_score(
-                    self.scores_train[self.indices_true[c], i + 1], scores[:, i + 1], log_transform=log_transform,
-                    bootstrap=bootstrap
+                p_values[:, i + 1] = self.null_tables_true[c].pvalue(
+                    scores[:, i + 1], log_transform=log_transform, bootstrap=bootstrap
                 )
             else:
                 p_values[:, i + 1] = pvalue_score(
@@ -682,6 +1242,10 @@ class LIDScore(TestStatistic):
             approx_nearest_neighbors=kwargs.get('approx_nearest_neighbors', True),
             n_jobs=kwargs.get('n_jobs', 1),
             low_memory=kwargs.get('low_memory', False),
+            partitioned_index=kwargs.get('partitioned_index', None),
+            graph_cache=kwargs.get('graph_cache', None),
+            graph_cache_key=kwargs.get('graph_cache_key', None),
+            shared_neighbors=kwargs.get('shared_neighbors', None),
             seed_rng=kwargs.get('seed_rng', SEED_DEFAULT)
         )
 
@@ -692,6 +1256,9 @@ class LIDScore(TestStatistic):
         self.n_neighbors_per_class = dict()
         # KNN indices for the data points from each class
         self.index_knn = dict()
+        # Single KNN index with the data points partitioned by class. Used instead of `self.index_knn` if
+        # `self._use_partitioned_index()` is True
+        self.index_knn_partitioned = None
         # LID estimates conditioned on different predicted and true classes for the train samples
         self.lid_estimates_train = None
         # Scores for the training data
@@ -737,75 +1304,107 @@ class LIDScore(TestStatistic):
                 features, cutoff=pca_cutoff, seed_rng=self.seed_rng
             )
             self.dim = features.shape[1]
+            # The shared neighbors are found in the original feature space
+            self.shared_neighbors = None
 
         # Column 0 corresponds to the LID estimates conditioned on the predicted class.
         # Column `i` for `i = 1, 2, . . .` correspond to the LID estimates conditioned on the true class being `i - 1`
         self.lid_estimates_train = np.zeros((self.n_train, 1 + self.n_classes))
 
-        logger.info("Building KNN indices for nearest neighbor queries from each class.")
-        for i, c in enumerate(self.labels_unique):
-            logger.info("Processing class {}:".format(c))
-            # Labeled samples from class `c`
-            ind = np.where(labels == c)[0]
-            self.indices_true[c] = ind
-            n_true = ind.shape[0]
-            # Number of neighbors for the labeled samples from class `c`
-            if set_n_neighbors:
-                self.n_neighbors_per_class[c] = int(np.ceil(n_true ** self.neighborhood_constant))
-            else:
-                self.n_neighbors_per_class[c] = self.n_neighbors
+        if self._use_partitioned_index():
+            self._fit_partitioned(features, labels, labels_pred, set_n_neighbors)
+        else:
+            logger.info("Building KNN indices for nearest neighbor queries from each class.")
+            for i, c in enumerate(self.labels_unique):
+                logger.info("Processing class {}:".format(c))
+                # Labeled samples from class `c`
+                ind = np.where(labels == c)[0]
+                self.indices_true[c] = ind
+                n_true = ind.shape[0]
+                # Number of neighbors for the labeled samples from class `c`
+                if set_n_neighbors:
+                    self.n_neighbors_per_class[c] = self._num_neighbors(n_true, ('true', c))
+                else:
+                    self.n_neighbors_per_class[c] = self.n_neighbors
 
-            if n_true:
-                # KNN index for the labeled samples from class `c`
-                self.index_knn[c] = KNNIndex(
-                    features[ind, :], n_neighbors=self.n_neighbors_per_class[c],
-                    metric=self.metric, metric_kwargs=self.metric_kwargs,
-                    shared_nearest_neighbors=self.shared_nearest_neighbors,
-                    approx_nearest_neighbors=self.approx_nearest_neighbors,
-                    n_jobs=self.n_jobs,
-                    low_memory=self.low_memory,
-                    seed_rng=self.seed_rng
-                )
-                # LID estimates for the labeled samples from class `c`
-                _, nn_distances = self.index_knn[c].query_self(k=self.n_neighbors_per_class[c])
-                self.lid_estimates_train[ind, i + 1] = lid_mle_amsaleg(nn_distances)
+                if n_true:
+                    # KNN index for the labeled samples from class `c`
+                    self.index_knn[c] = self._build_knn_index(
+                        features[ind, :], self.n_neighbors_per_class[c], ('true', c)
+                    )
+                    # LID estimates for the labeled samples from class `c`
+                    _, nn_distances = self.index_knn[c].query_self(k=self.n_neighbors_per_class[c])
+                    self.lid_estimates_train[ind, i + 1] = lid_mle_amsaleg(nn_distances)
+
+                    # Commenting this block out to avoid unneccessary computation.
+                    # The reconstruction errors for these samples are not used anywhere else.
+                    '''
+                    # LID estimates for the samples not labeled as class `c`
+                    ind_comp = np.where(labels != c)[0]
+                    _, nn_distances = self.index_knn[c].query(features[ind_comp, :], k=self.n_neighbors_per_class[c])
+                    self.lid_estimates_train[ind_comp, i + 1] = lid_mle_amsaleg(nn_distances)
+                    '''
+                else:
+                    raise ValueError("No labeled samples from class '{}'. Cannot proceed.".format(c))
+
+                # Samples predicted into class `c`
+                ind = np.where(labels_pred == c)[0]
+                self.indices_pred[c] = ind
+                n_pred = ind.shape[0]
+                if n_pred:
+                    # Distance to nearest neighbors of samples predicted into class `c` that are also labeled as
+                    # class `c`. These samples will be a part of the KNN index
+                    nn_distances = helper_knn_distance(self.indices_pred[c], self.indices_true[c], nn_distances)
+
+                    # Distance to nearest neighbors of samples predicted into class `c` that are not labeled as
+                    # class `c`. These samples will not be a part of the KNN index
+                    mask = (nn_distances[:, 0] < 0.)
+                    if np.any(mask):
+                        ind_comp = self.indices_pred[c][mask]
+                        _, temp_arr = self.index_knn[c].query(features[ind_comp, :], k=self.n_neighbors_per_class[c])
+                        nn_distances[mask, :] = temp_arr
+
+                    # LID estimates from the k nearest neighbor distances of each sample
+                    self.lid_estimates_train[ind, 0] = lid_mle_amsaleg(nn_distances)
+                else:
+                    raise ValueError("No predicted samples from class '{}'. Cannot proceed.".format(c))
 
-                # Commenting this block out to avoid unneccessary computation.
-                # The reconstruction errors for these samples are not used anywhere else.
-                '''
-                # LID estimates for the samples not labeled as class `c`
-                ind_comp = np.where(labels != c)[0]
-                _, nn_distances = self.index_knn[c].query(features[ind_comp, :], k=self.n_neighbors_per_class[c])
-                self.lid_estimates_train[ind_comp, i + 1] = lid_mle_amsaleg(nn_distances)
-                '''
-            else:
+        # Calculate the scores and p-values for each sample
+        self.scores_train, p_values = self.score(features, labels_pred, is_train=True, bootstrap=bootstrap)
+        self._build_null_tables()
+        return self.scores_train, p_values
+
+    def _fit_partitioned(self, features, labels, labels_pred, set_n_neighbors):
+        """
+        Calculate the LID estimates of the training samples conditioned on each class using a single KNN index
+        over all the samples, partitioned by their true class.
+        """
+        for c in self.labels_unique:
+            self.indices_true[c] = np.where(labels == c)[0]
+            self.indices_pred[c] = np.where(labels_pred == c)[0]
+            if self.indices_true[c].shape[0] == 0:
                 raise ValueError("No labeled samples from class '{}'. Cannot proceed.".format(c))
+            if self.indices_pred[c].shape[0] == 0:
+                raise ValueError("No predicted samples from class '{}'. Cannot proceed.".format(c))
 
-            # Samples predicted into class `c`
-            ind = np.where(labels_pred == c)[0]
-            self.indices_pred[c] = ind
-            n_pred = ind.shape[0]
-            if n_pred:
-                # Distance to nearest neighbors of samples predicted into class `c` that are also labeled as
-                # class `c`. These samples will be a part of the KNN index
-                nn_distances = helper_knn_distance(self.indices_pred[c], self.indices_true[c], nn_distances)
-
-                # Distance to nearest neighbors of samples predicted into class `c` that are not labeled as
-                # class `c`. These samples will not be a part of the KNN index
-                mask = (nn_distances[:, 0] < 0.)
-                if np.any(mask):
-                    ind_comp = self.indices_pred[c][mask]
-                    _, temp_arr = self.index_knn[c].query(features[ind_comp, :], k=self.n_neighbors_per_class[c])
-                    nn_distances[mask, :] = temp_arr
-
-                # LID estimates from the k nearest neighbor distances of each sample
-                self.lid_estimates_train[ind, 0] = lid_mle_amsaleg(nn_distances)
+            if set_n_neighbors:
+                self.n_neighbors_per_class[c] = self._num_neighbors(self.indices_true[c].shape[0], ('true', c))
             else:
-                raise ValueError("No predicted samples from class '{}'. Cannot proceed.".format(c))
+                self.n_neighbors_per_class[c] = self.n_neighbors
 
-        # Calculate the scores and p-values for each sample
-        self.scores_train, p_values = self.score(features, labels_pred, is_train=True, bootstrap=bootstrap)
-        return self.scores_train, p_values
+        logger.info("Building a KNN index partitioned by the class for nearest neighbor queries from each class.")
+        k = max(self.n_neighbors_per_class.values())
+        self.index_knn_partitioned = self._build_partitioned_index(features, k, pred=False)
+        # Distances to the nearest neighbors of each sample from each class, excluding the sample itself
+        _, nn_distances = self.index_knn_partitioned.query_self(k=k)
+        for i, c in enumerate(self.labels_unique):
+            k = self.n_neighbors_per_class[c]
+            # LID estimates for the labeled samples from class `c`
+            ind = self.indices_true[c]
+            self.lid_estimates_train[ind, i + 1] = lid_mle_amsaleg(nn_distances[ind, i, :k])
+            # LID estimates for the samples predicted into class `c`
+            ind = self.indices_pred[c]
+            self.lid_estimates_train[ind, 0] = lid_mle_amsaleg(nn_distances[ind, i, :k])
 
     def score(self, features_test, labels_pred_test, is_train=False, log_transform=True, bootstrap=True):
         """
@@ -834,6 +1433,11 @@ class LIDScore(TestStatistic):
 
         scores = np.zeros((n_test, 1 + self.n_classes))
         p_values = np.zeros((n_test, 1 + self.n_classes))
+        nn_distances_part = None
+        if (self.index_knn_partitioned is not None) and (not is_train):
+            # Nearest neighbors of the test samples from all the classes in a single query
+            _, nn_distances_part = self.index_knn_partitioned.query(features_test)
+
         preds_unique = self.labels_unique if (n_test > 1) else [labels_pred_test[0]]
         cnt_par = 0
         for c_hat in preds_unique:
@@ -842,13 +1446,17 @@ class LIDScore(TestStatistic):
             if ind.shape[0]:
                 if not is_train:
                     # LID estimate relative to the samples predicted into class `c_hat`
-                    _, nn_distances = self.index_knn[c_hat].query(features_test[ind, :],
-                                                                  k=self.n_neighbors_per_class[c_hat])
+                    if nn_distances_part is None:
+                        _, nn_distances = self.index_knn[c_hat].query(features_test[ind, :],
+                                                                      k=self.n_neighbors_per_class[c_hat])
+                    else:
+                        nn_distances = nn_distances_part[ind, int(self.label_encoder(c_hat)),
+                                                         :self.n_neighbors_per_class[c_hat]]
+
                     scores[ind, 0] = lid_mle_amsaleg(nn_distances)
                     # p-value of the LID estimates
-                    p_values[ind, 0] = pvalue_score(
-                        self.scores_train[self.indices_pred[c_hat], 0], scores[ind, 0], log_transform=log_transform,
-                        bootstrap=bootstrap
+                    p_values[ind, 0] = self.null_tables_pred[c_hat].pvalue(
+                        scores[ind, 0], log_transform=log_transform, bootstrap=bootstrap
                     )
                 else:
                     # Precomputed LID estimates
@@ -865,12 +1473,15 @@ class LIDScore(TestStatistic):
         for i, c in enumerate(self.labels_unique):
             if not is_train:
                 # LID estimates relative to the samples labeled as class `c`
-                _, nn_distances = self.index_knn[c].query(features_test, k=self.n_neighbors_per_class[c])
+                if nn_distances_part is None:
+                    _, nn_distances = self.index_knn[c].query(features_test, k=self.n_neighbors_per_class[c])
+                else:
+                    nn_distances = nn_distances_part[:, i, :self.n_neighbors_per_class[c]]
+
                 scores[:, i + 1] = lid_mle_amsaleg(nn_distances)
                 # p-value of the LID estimates
-                p_values[:, i + 1] = pvalue_score(
-                    self.scores_train[self.indices_true[c], i + 1], scores[:, i + 1], log_transform=log_transform,
-                    bootstrap=bootstrap
+                p_values[:, i + 1] = self.null_tables_true[c].pvalue(
+                    scores[:, i + 1], log_transform=log_transform, bootstrap=bootstrap
                 )
             else:
                 # Precomputed LID estimates
@@ -901,6 +1512,9 @@ class DistanceScore(TestStatistic):
             approx_nearest_neighbors=kwargs.get('approx_nearest_neighbors', True),
             n_jobs=kwargs.get('n_jobs', 1),
             low_memory=kwargs.get('low_memory', False),
+            graph_cache=kwargs.get('graph_cache', None),
+            graph_cache_key=kwargs.get('graph_cache_key', None),
+            shared_neighbors=kwargs.get('shared_neighbors', None),
             seed_rng=kwargs.get('seed_rng', SEED_DEFAULT)
         )
 
@@ -911,6 +1525,11 @@ class DistanceScore(TestStatistic):
         self.klpe_models_true = dict()
         # Average distance score for the train samples
         self.distances_avg_train = None
+        # Range of nearest neighbors of the average distance for each predicted and true class. These are used along
+        # with `self.index_knn_partitioned` when the statistic is calculated from shared neighbors
+        self.neighborhood_range_pred = dict()
+        self.neighborhood_range_true = dict()
+        self.index_knn_partitioned = None
         # Scores on the training data
         self.scores_train = None
         # Index of train samples from each class based on the true class and predicted class
@@ -965,6 +1584,13 @@ class DistanceScore(TestStatistic):
         else:
             kwargs_lpe['n_neighbors'] = self.n_neighbors
 
+        if self.shared_neighbors is not None:
+            self._fit_shared(labels, labels_pred, set_n_neighbors)
+            # Calculate the scores and p-values for each sample
+            self.scores_train, p_values = self.score(features, labels_pred, is_train=True, bootstrap=bootstrap)
+            self._build_null_tables()
+            return self.scores_train, p_values
+
         for i, c in enumerate(self.labels_unique):
             logger.info("Fitting localized p-value estimation models for class {}:".format(c))
             # Samples predicted into class `c`
@@ -1001,6 +1627,50 @@ class DistanceScore(TestStatistic):
         self.scores_train, p_values = self.score(features, labels_pred, is_train=True, bootstrap=bootstrap)
         return self.scores_train, p_values
 
+    def _fit_shared(self, labels, labels_pred, set_n_neighbors):
+        """
+        Calculate the average distance statistic of the training samples from the class-restricted query of the
+        shared neighbors. The statistic conditioned on a class is the same as that of the localized p-value
+        estimation model fit on the samples from the class.
+        """
+        for c in self.labels_unique:
+            self.indices_pred[c] = np.where(labels_pred == c)[0]
+            self.indices_true[c] = np.where(labels == c)[0]
+            if self.indices_pred[c].shape[0] == 0:
+                raise ValueError("No predicted samples from class '{}'. Cannot proceed.".format(c))
+            if self.indices_true[c].shape[0] == 0:
+                raise ValueError("No labeled samples from class '{}'. Cannot proceed.".format(c))
+
+            if set_n_neighbors:
+                # Same as the localized p-value estimation models, which are fit again by `fit_update`
+                k_pred = int(np.ceil(self.indices_pred[c].shape[0] ** self.neighborhood_constant))
+                k_true = int(np.ceil(self.indices_true[c].shape[0] ** self.neighborhood_constant))
+            else:
+                k_pred = k_true = self.n_neighbors
+
+            self.neighborhood_range_pred[c] = neighborhood_range(k_pred)
+            self.neighborhood_range_true[c] = neighborhood_range(k_true)
+
+        self.index_knn_partitioned = self.shared_neighbors.view_class()
+        # Distances to the nearest neighbors of each sample from each predicted and true class, excluding the sample
+        # itself
+        _, nn_distances = self.index_knn_partitioned.query_self(k=self._max_neighborhood())
+        for i, c in enumerate(self.labels_unique):
+            ind = self.indices_pred[c]
+            self.distances_avg_train[ind, 0] = self._average_distance(nn_distances[ind, i, :],
+                                                                      self.neighborhood_range_pred[c])
+            ind = self.indices_true[c]
+            self.distances_avg_train[ind, i + 1] = self._average_distance(nn_distances[ind, self.n_classes + i, :],
+                                                                          self.neighborhood_range_true[c])
+
+    def _max_neighborhood(self):
+        return max(v[1] for d in (self.neighborhood_range_pred, self.neighborhood_range_true) for v in d.values())
+
+    @staticmethod
+    def _average_distance(nn_distances, nbhd_range):
+        # Average distance to the neighbors ranked `low` to `high`
+        return np.mean(nn_distances[:, (nbhd_range[0] - 1):nbhd_range[1]], axis=1)
+
     def score(self, features_test, labels_pred_test, is_train=False, log_transform=True, bootstrap=True):
         """
         Given the test feature vectors and their corresponding predicted labels, calculate a vector of scores for
@@ -1028,6 +1698,9 @@ class DistanceScore(TestStatistic):
 
         scores = np.zeros((n_test, 1 + self.n_classes))
         p_values = np.zeros((n_test, 1 + self.n_classes))
+        if (self.index_knn_partitioned is not None) and (not is_train):
+            return self._score_shared(features_test, labels_pred_test, log_transform, bootstrap)
+
         preds_unique = self.labels_unique if (n_test > 1) else [labels_pred_test[0]]
         cnt_par = 0
         for c_hat in preds_unique:
@@ -1066,6 +1739,33 @@ class DistanceScore(TestStatistic):
 
         return scores, p_values
 
+    def _score_shared(self, features_test, labels_pred_test, log_transform, bootstrap):
+        """
+        Scores and p-values of the test samples from the class-restricted query of the shared neighbors. The inputs
+        and the returned values are the same as the method `score`.
+        """
+        n_test = labels_pred_test.shape[0]
+        scores = np.zeros((n_test, 1 + self.n_classes))
+        p_values = np.zeros((n_test, 1 + self.n_classes))
+        # Distances to the nearest neighbors of the test samples from each predicted and true class in a single query
+        _, nn_distances = self.index_knn_partitioned.query(features_test, k=self._max_neighborhood())
+        for i, c in enumerate(self.labels_unique):
+            # Index of samples predicted into class `c`
+            ind = np.where(labels_pred_test == c)[0]
+            if ind.shape[0]:
+                scores[ind, 0] = self._average_distance(nn_distances[ind, i, :], self.neighborhood_range_pred[c])
+                p_values[ind, 0] = self.null_tables_pred[c].pvalue(
+                    scores[ind, 0], log_transform=log_transform, bootstrap=bootstrap
+                )
+
+            scores[:, i + 1] = self._average_distance(nn_distances[:, self.n_classes + i, :],
+                                                      self.neighborhood_range_true[c])
+            p_values[:, i + 1] = self.null_tables_true[c].pvalue(
+                scores[:, i + 1], log_transform=log_transform, bootstrap=bootstrap
+            )
+
+        return scores, p_values
+
 
 class TrustScore(TestStatistic):
     """
@@ -1081,6 +1781,10 @@ class TrustScore(TestStatistic):
             approx_nearest_neighbors=kwargs.get('approx_nearest_neighbors', True),
             n_jobs=kwargs.get('n_jobs', 1),
             low_memory=kwargs.get('low_memory', False),
+            partitioned_index=kwargs.get('partitioned_index', None),
+            graph_cache=kwargs.get('graph_cache', None),
+            graph_cache_key=kwargs.get('graph_cache_key', None),
+            shared_neighbors=kwargs.get('shared_neighbors', None),
             seed_rng=kwargs.get('seed_rng', SEED_DEFAULT)
         )
 
@@ -1092,6 +1796,9 @@ class TrustScore(TestStatistic):
         # KNN indices for the data points from each predicted class and true class
         self.index_knn_pred = dict()
         self.index_knn_true = dict()
+        # Single KNN index with the data points partitioned by their predicted class and their true class. Used
+        # instead of `self.index_knn_pred` and `self.index_knn_true` if `self._use_partitioned_index()` is True
+        self.index_knn_partitioned = None
         # Distance ratio similar to the trust score calculated on the training data
         self.distance_ratio_train = None
         # Scores for the training data
@@ -1135,98 +1842,118 @@ class TrustScore(TestStatistic):
         # being `i - 1`
         self.distance_ratio_train = np.zeros((self.n_train, 1 + self.n_classes))
 
-        logger.info("Building KNN indices for nearest neighbor queries from each predicted and each true class.")
-        for i, c in enumerate(self.labels_unique):
-            logger.info("Processing class {}:".format(c))
-            # Samples predicted into class `c`
-            ind = np.where(labels_pred == c)[0]
-            self.indices_pred[c] = ind
-            n_pred = ind.shape[0]
-            # Number of neighbors for the samples predicted into class `c`
-            if set_n_neighbors:
-                self.n_neighbors_pred[c] = int(np.ceil(n_pred ** self.neighborhood_constant))
-            else:
-                self.n_neighbors_pred[c] = self.n_neighbors
-
-            if n_pred:
-                # KNN index for the samples predicted into class `c`
-                self.index_knn_pred[c] = KNNIndex(
-                    features[ind, :], n_neighbors=self.n_neighbors_pred[c],
-                    metric=self.metric, metric_kwargs=self.metric_kwargs,
-                    shared_nearest_neighbors=self.shared_nearest_neighbors,
-                    approx_nearest_neighbors=self.approx_nearest_neighbors,
-                    n_jobs=self.n_jobs,
-                    low_memory=self.low_memory,
-                    seed_rng=self.seed_rng
-                )
-                # Nearest-neighbor distance to the samples predicted into class `c`
-                _, nn_distance = self.index_knn_pred[c].query_self(k=1)
-                self.distance_ratio_train[ind, 0] = nn_distance[:, 0]
-            else:
-                raise ValueError("No predicted samples from class '{}'. Cannot proceed.".format(c))
+        if self._use_partitioned_index():
+            self._fit_partitioned(features, labels, labels_pred)
+        else:
+            logger.info("Building KNN indices for nearest neighbor queries from each predicted and each true class.")
+            for i, c in enumerate(self.labels_unique):
+                logger.info("Processing class {}:".format(c))
+                # Samples predicted into class `c`
+                ind = np.where(labels_pred == c)[0]
+                self.indices_pred[c] = ind
+                n_pred = ind.shape[0]
+                # Number of neighbors for the samples predicted into class `c`
+                if set_n_neighbors:
+                    self.n_neighbors_pred[c] = self._num_neighbors(n_pred, ('pred', c))
+                else:
+                    self.n_neighbors_pred[c] = self.n_neighbors
 
-            # Labeled samples from class `c`
-            ind = np.where(labels == c)[0]
-            self.indices_true[c] = ind
-            n_true = ind.shape[0]
-            # Number of neighbors for the labeled samples from class `c`
-            if set_n_neighbors:
-                self.n_neighbors_true[c] = int(np.ceil(n_true ** self.neighborhood_constant))
-            else:
-                self.n_neighbors_true[c] = self.n_neighbors
+                if n_pred:
+                    # KNN index for the samples predicted into class `c`
+                    self.index_knn_pred[c] = self._build_knn_index(
+                        features[ind, :], self.n_neighbors_pred[c], ('pred', c)
+                    )
+                    # Nearest-neighbor distance to the samples predicted into class `c`
+                    _, nn_distance = self.index_knn_pred[c].query_self(k=1)
+                    self.distance_ratio_train[ind, 0] = nn_distance[:, 0]
+                else:
+                    raise ValueError("No predicted samples from class '{}'. Cannot proceed.".format(c))
+
+                # Labeled samples from class `c`
+                ind = np.where(labels == c)[0]
+                self.indices_true[c] = ind
+                n_true = ind.shape[0]
+                # Number of neighbors for the labeled samples from class `c`
+                if set_n_neighbors:
+                    self.n_neighbors_true[c] = self._num_neighbors(n_true, ('true', c))
+                else:
+                    self.n_neighbors_true[c] = self.n_neighbors
 
-            if n_true:
-                # KNN index for the labeled samples from class `c`
-                self.index_knn_true[c] = KNNIndex(
-                    features[ind, :], n_neighbors=self.n_neighbors_true[c],
-                    metric=self.metric, metric_kwargs=self.metric_kwargs,
-                    shared_nearest_neighbors=self.shared_nearest_neighbors,
-                    approx_nearest_neighbors=self.approx_nearest_neighbors,
-                    n_jobs=self.n_jobs,
-                    low_memory=self.low_memory,
-                    seed_rng=self.seed_rng
-                )
-                # Nearest-neighbor distance to the labeled samples from class `c`
-                _, nn_distance = self.index_knn_true[c].query_self(k=1)
-                self.distance_ratio_train[ind, i + 1] = nn_distance[:, 0]
-            else:
-                raise ValueError("No labeled samples from class '{}'. Cannot proceed.".format(c))
+                if n_true:
+                    # KNN index for the labeled samples from class `c`
+                    self.index_knn_true[c] = self._build_knn_index(
+                        features[ind, :], self.n_neighbors_true[c], ('true', c)
+                    )
+                    # Nearest-neighbor distance to the labeled samples from class `c`
+                    _, nn_distance = self.index_knn_true[c].query_self(k=1)
+                    self.distance_ratio_train[ind, i + 1] = nn_distance[:, 0]
+                else:
+                    raise ValueError("No labeled samples from class '{}'. Cannot proceed.".format(c))
+
+            # Loop over each class and calculate the denominator of the distance ratio in the trust score
+            for i, c in enumerate(self.labels_unique):
+                # Samples predicted into class `c`
+                ind1 = self.indices_pred[c]
+                features_temp1 = features[ind1, :]
+                dist_temp1 = np.zeros((ind1.shape[0], self.n_classes - 1))
+                # Labeled samples from class `c`
+                ind2 = self.indices_true[c]
+                features_temp2 = features[ind2, :]
+                dist_temp2 = np.zeros((ind2.shape[0], self.n_classes - 1))
+                j = 0
+                # Loop over every class other than `c`
+                for k in self.labels_unique:
+                    if k == c:
+                        continue
 
-        # Loop over each class and calculate the denominator of the distance ratio in the trust score
-        for i, c in enumerate(self.labels_unique):
-            # Samples predicted into class `c`
-            ind1 = self.indices_pred[c]
-            features_temp1 = features[ind1, :]
-            dist_temp1 = np.zeros((ind1.shape[0], self.n_classes - 1))
-            # Labeled samples from class `c`
-            ind2 = self.indices_true[c]
-            features_temp2 = features[ind2, :]
-            dist_temp2 = np.zeros((ind2.shape[0], self.n_classes - 1))
-            j = 0
-            # Loop over every class other than `c`
-            for k in self.labels_unique:
-                if k == c:
-                    continue
-
-                # Nearest-neighbor distance from the set of samples predicted into class `k`
-                _, nn_distance = self.index_knn_pred[k].query(features_temp1, k=1)
-                dist_temp1[:, j] = nn_distance[:, 0]
-                # Nearest-neighbor distance from the set of labeled samples from class `k`
-                _, nn_distance = self.index_knn_true[k].query(features_temp2, k=1)
-                dist_temp2[:, j] = nn_distance[:, 0]
-                j += 1
+                    # Nearest-neighbor distance from the set of samples predicted into class `k`
+                    _, nn_distance = self.index_knn_pred[k].query(features_temp1, k=1)
+                    dist_temp1[:, j] = nn_distance[:, 0]
+                    # Nearest-neighbor distance from the set of labeled samples from class `k`
+                    _, nn_distance = self.index_knn_true[k].query(features_temp2, k=1)
+                    dist_temp2[:, j] = nn_distance[:, 0]
+                    j += 1
 
-            # Distance ratio for the samples predicted into class `c`
-            v = np.clip(np.min(dist_temp1, axis=1), sys.float_info.epsilon, None)
-            self.distance_ratio_train[ind1, 0] = self.distance_ratio_train[ind1, 0] / v
-            # Distance ratio for the labeled samples from class `c`
-            v = np.clip(np.min(dist_temp2, axis=1), sys.float_info.epsilon, None)
-            self.distance_ratio_train[ind2, i + 1] = self.distance_ratio_train[ind2, i + 1] / v
+                # Distance ratio for the samples predicted into class `c`
+                v = np.clip(np.min(dist_temp1, axis=1), sys.float_info.epsilon, None)
+                self.distance_ratio_train[ind1, 0] = self.distance_ratio_train[ind1, 0] / v
+                # Distance ratio for the labeled samples from class `c`
+                v = np.clip(np.min(dist_temp2, axis=1), sys.float_info.epsilon, None)
+                self.distance_ratio_train[ind2, i + 1] = self.distance_ratio_train[ind2, i + 1] / v
 
         # Calculate the scores and p-values for each samples
         self.scores_train, p_values = self.score(features, labels_pred, is_train=True, bootstrap=bootstrap)
+        self._build_null_tables()
         return self.scores_train, p_values
 
+    def _fit_partitioned(self, features, labels, labels_pred):
+        """
+        Calculate the distance ratios of the training samples using a single KNN index over all the samples,
+        partitioned by their predicted class (first `m` partitions) and their true class (last `m` partitions).
+        """
+        for c in self.labels_unique:
+            self.indices_pred[c] = np.where(labels_pred == c)[0]
+            self.indices_true[c] = np.where(labels == c)[0]
+            if self.indices_pred[c].shape[0] == 0:
+                raise ValueError("No predicted samples from class '{}'. Cannot proceed.".format(c))
+            if self.indices_true[c].shape[0] == 0:
+                raise ValueError("No labeled samples from class '{}'. Cannot proceed.".format(c))
+
+        logger.info("Building a KNN index partitioned by the predicted and true class for nearest neighbor queries "
+                    "from each class.")
+        self.index_knn_partitioned = self._build_partitioned_index(features, 1)
+        # Nearest-neighbor distance of each sample to each partition, excluding the sample itself
+        _, nn_distance = self.index_knn_partitioned.query_self(k=1)
+        dist_pred = nn_distance[:, :self.n_classes, 0]
+        dist_true = nn_distance[:, self.n_classes:, 0]
+        for i, c in enumerate(self.labels_unique):
+            # Distance ratio for the samples predicted into class `c`
+            ind = self.indices_pred[c]
+            self.distance_ratio_train[ind, 0] = distance_ratio_partitioned(dist_pred[ind, :], i)
+            # Distance ratio for the labeled samples from class `c`
+            ind = self.indices_true[c]
+            self.distance_ratio_train[ind, i + 1] = distance_ratio_partitioned(dist_true[ind, :], i)
+
     def score(self, features_test, labels_pred_test, is_train=False, log_transform=True, bootstrap=True):
         """
         Given the test feature vectors and their corresponding predicted labels, calculate a vector of scores for
@@ -1253,13 +1980,27 @@ class TrustScore(TestStatistic):
 
         scores = np.zeros((n_test, 1 + self.n_classes))
         p_values = np.zeros((n_test, 1 + self.n_classes))
+        dist_pred = dist_true = None
+        if (self.index_knn_partitioned is not None) and (not is_train):
+            # Nearest-neighbor distance of the test samples to each predicted and true class in a single query
+            _, nn_distance = self.index_knn_partitioned.query(features_test, k=1)
+            dist_pred = nn_distance[:, :self.n_classes, 0]
+            dist_true = nn_distance[:, self.n_classes:, 0]
+
         preds_unique = self.labels_unique if (n_test > 1) else [labels_pred_test[0]]
         cnt_par = 0
         for c_hat in preds_unique:
             # Index of samples predicted into class `c_hat`
             ind = np.where(labels_pred_test == c_hat)[0]
             if ind.shape[0]:
-                if not is_train:
+                if (not is_train) and (dist_pred is not None):
+                    # Distance ratio
+                    scores[ind, 0] = distance_ratio_partitioned(dist_pred[ind, :], int(self.label_encoder(c_hat)))
+                    # p-value of the distance ratio
+                    p_values[ind, 0] = self.null_tables_pred[c_hat].pvalue(
+                        scores[ind, 0], log_transform=log_transform, bootstrap=bootstrap
+                    )
+                elif not is_train:
                     temp_arr = features_test[ind, :]
                     # Nearest-neighbor distance to the samples predicted into class `c_hat`
                     _, nn_distance = self.index_knn_pred[c_hat].query(temp_arr, k=1)
@@ -1281,9 +2022,8 @@ class TrustScore(TestStatistic):
                     v = np.clip(np.min(dist_temp, axis=1), sys.float_info.epsilon, None)
                     scores[ind, 0] = scores[ind, 0] / v
                     # p-value of the distance ratio
-                    p_values[ind, 0] = pvalue_score(
-                        self.scores_train[self.indices_pred[c_hat], 0], scores[ind, 0], log_transform=log_transform,
-                        bootstrap=bootstrap
+                    p_values[ind, 0] = self.null_tables_pred[c_hat].pvalue(
+                        scores[ind, 0], log_transform=log_transform, bootstrap=bootstrap
                     )
                 else:
                     # Precomputed distance ratios
@@ -1298,7 +2038,14 @@ class TrustScore(TestStatistic):
                     break
 
         for i, c in enumerate(self.labels_unique):
-            if not is_train:
+            if (not is_train) and (dist_true is not None):
+                # Distance ratio
+                scores[:, i + 1] = distance_ratio_partitioned(dist_true, i)
+                # p-value of the distance ratio
+                p_values[:, i + 1] = self.null_tables_true[c].pvalue(
+                    scores[:, i + 1], log_transform=log_transform, bootstrap=bootstrap
+                )
+            elif not is_train:
                 # Nearest-neighbor distance to the labeled samples from class `c`
                 _, nn_distance = self.index_knn_true[c].query(features_test, k=1)
                 scores[:, i + 1] = nn_distance[:, 0]
@@ -1310,7 +2057,8 @@ class TrustScore(TestStatistic):
                     if k == c:
                         continue
 
-                    # Nearest-neighbor distance to the labeled samples from class `k`
+                    # Nearest-neighbor distance to the labeled samples from class `k`. The same query is repeated for
+                    # every class `c`, and it is answered from the query cache of the exact KNN indices
                     _, nn_distance = self.index_knn_true[k].query(features_test, k=1)
                     dist_temp[:, j] = nn_distance[:, 0]
                     j += 1
@@ -1319,9 +2067,8 @@ class TrustScore(TestStatistic):
                 v = np.clip(np.min(dist_temp, axis=1), sys.float_info.epsilon, None)
                 scores[:, i + 1] = scores[:, i + 1] / v
                 # p-value of the distance ratio
-                p_values[:, i + 1] = pvalue_score(
-                    self.scores_train[self.indices_true[c], i + 1], scores[:, i + 1], log_transform=log_transform,
-                    bootstrap=bootstrap
+                p_values[:, i + 1] = self.null_tables_true[c].pvalue(
+                    scores[:, i + 1], log_transform=log_transform, bootstrap=bootstrap
                 )
             else:
                 # Precomputed distance ratios
@@ -1353,6 +2100,10 @@ class LLEScore(TestStatistic):
             approx_nearest_neighbors=kwargs.get('approx_nearest_neighbors', True),
             n_jobs=kwargs.get('n_jobs', 1),
             low_memory=kwargs.get('low_memory', False),
+            partitioned_index=kwargs.get('partitioned_index', None),
+            graph_cache=kwargs.get('graph_cache', None),
+            graph_cache_key=kwargs.get('graph_cache_key', None),
+            shared_neighbors=kwargs.get('shared_neighbors', None),
             seed_rng=kwargs.get('seed_rng', SEED_DEFAULT)
         )
 
@@ -1376,6 +2127,11 @@ class LLEScore(TestStatistic):
         # Feature vectors used to build the KNN graph for each predicted class and true class
         self.features_knn_pred = dict()
         self.features_knn_true = dict()
+        # Single KNN index with the data points partitioned by their predicted class (first `m` partitions) and their
+        # true class (last `m` partitions), and the feature vectors of all the data points. Used instead of the
+        # indices and features per class if `self._use_partitioned_index()` is True
+        self.index_knn_partitioned = None
+        self.features_knn = None
 
     def fit(self, features, labels, labels_pred, labels_unique=None, bootstrap=False,
             min_dim_pca=10000, pca_cutoff=PCA_CUTOFF, reg_eps=0.001):
@@ -1417,97 +2173,140 @@ class LLEScore(TestStatistic):
                 features, cutoff=pca_cutoff, seed_rng=self.seed_rng
             )
             self.dim = features.shape[1]
+            # The shared neighbors are found in the original feature space
+            self.shared_neighbors = None
 
         # Column 0 corresponds to the LLE reconstruction errors conditioned on the predicted class.
         # Column `i` for `i = 1, 2, . . .` correspond to the LLE reconstruction errors conditioned on the true
         # class being `i - 1`
         self.errors_lle_train = np.zeros((self.n_train, 1 + self.n_classes))
 
-        logger.info("Building KNN indices for nearest neighbor queries from each predicted and each true class.")
-        for i, c in enumerate(self.labels_unique):
-            logger.info("Processing class {}:".format(c))
-            # Samples predicted into class `c`
-            ind = np.where(labels_pred == c)[0]
-            self.indices_pred[c] = ind
-            n_pred = ind.shape[0]
-            # Number of neighbors for the samples predicted into class `c`
-            if set_n_neighbors:
-                self.n_neighbors_pred[c] = int(np.ceil(n_pred ** self.neighborhood_constant))
-            else:
-                self.n_neighbors_pred[c] = self.n_neighbors
+        if self._use_partitioned_index():
+            self._fit_partitioned(features, labels, labels_pred, set_n_neighbors)
+        else:
+            logger.info("Building KNN indices for nearest neighbor queries from each predicted and each true class.")
+            for i, c in enumerate(self.labels_unique):
+                logger.info("Processing class {}:".format(c))
+                # Samples predicted into class `c`
+                ind = np.where(labels_pred == c)[0]
+                self.indices_pred[c] = ind
+                n_pred = ind.shape[0]
+                # Number of neighbors for the samples predicted into class `c`
+                if set_n_neighbors:
+                    self.n_neighbors_pred[c] = self._num_neighbors(n_pred, ('pred', c))
+                else:
+                    self.n_neighbors_pred[c] = self.n_neighbors
+
+                # Number of neighbors should not exceed the number of dimensions in order to avoid a singular gram
+                # matrix
+                if self.n_neighbors_pred[c] >= self.dim:
+                    self.n_neighbors_pred[c] = max(self.dim - 1, 1)
+
+                if n_pred:
+                    # KNN index for the samples predicted into class `c`
+                    self.features_knn_pred[c] = features[ind, :]
+                    self.index_knn_pred[c] = self._build_knn_index(
+                        self.features_knn_pred[c], self.n_neighbors_pred[c], ('pred', c)
+                    )
+                    # # LLE reconstruction errors of the points from `self.features_knn_pred[c]`
+                    nn_indices, _ = self.index_knn_pred[c].query_self(k=self.n_neighbors_pred[c])
+                    self.errors_lle_train[ind, 0] = self._calc_reconstruction_errors(
+                        self.features_knn_pred[c], self.features_knn_pred[c], nn_indices
+                    )
+                else:
+                    raise ValueError("No predicted samples from class '{}'. Cannot proceed.".format(c))
+
+                # Labeled samples from class `c`
+                ind = np.where(labels == c)[0]
+                self.indices_true[c] = ind
+                n_true = ind.shape[0]
+                # Number of neighbors for the labeled samples from class `c`
+                if set_n_neighbors:
+                    self.n_neighbors_true[c] = self._num_neighbors(n_true, ('true', c))
+                else:
+                    self.n_neighbors_true[c] = self.n_neighbors
+
+                # Number of neighbors should not exceed the number of dimensions in order to avoid a singular gram
+                # matrix
+                if self.n_neighbors_true[c] >= self.dim:
+                    self.n_neighbors_true[c] = max(self.dim - 1, 1)
+
+                if n_true:
+                    # KNN index for the labeled samples from class `c`
+                    self.features_knn_true[c] = features[ind, :]
+                    self.index_knn_true[c] = self._build_knn_index(
+                        self.features_knn_true[c], self.n_neighbors_true[c], ('true', c)
+                    )
+                    # LLE reconstruction errors for the labeled samples from class `c`
+                    nn_indices, _ = self.index_knn_true[c].query_self(k=self.n_neighbors_true[c])
+                    self.errors_lle_train[ind, i + 1] = self._calc_reconstruction_errors(
+                        self.features_knn_true[c], self.features_knn_true[c], nn_indices
+                    )
+                    # Commenting this block out to avoid unneccessary computation.
+                    # The reconstruction errors for these samples are not used anywhere else.
+                    '''
+                    # LLE reconstruction errors for the labeled samples not from class `c`
+                    ind_comp = np.where(labels != c)[0]
+                    temp_arr = features[ind_comp, :]
+                    nn_indices, _ = self.index_knn_true[c].query(temp_arr, k=self.n_neighbors_true[c])
+                    self.errors_lle_train[ind_comp, i + 1] = self._calc_reconstruction_errors(
+                        temp_arr, self.features_knn_true[c], nn_indices
+                    )
+                    '''
+                else:
+                    raise ValueError("No labeled samples from class '{}'. Cannot proceed.".format(c))
 
-            # Number of neighbors should not exceed the number of dimensions in order to avoid a singular gram matrix
-            if self.n_neighbors_pred[c] >= self.dim:
-                self.n_neighbors_pred[c] = max(self.dim - 1, 1)
+        # Calculate the scores and p-values for each samples
+        self.scores_train, p_values = self.score(features, labels_pred, is_train=True, bootstrap=bootstrap)
+        self._build_null_tables()
+        return self.scores_train, p_values
 
-            if n_pred:
-                # KNN index for the samples predicted into class `c`
-                self.features_knn_pred[c] = features[ind, :]
-                self.index_knn_pred[c] = KNNIndex(
-                    self.features_knn_pred[c], n_neighbors=self.n_neighbors_pred[c],
-                    metric=self.metric, metric_kwargs=self.metric_kwargs,
-                    shared_nearest_neighbors=self.shared_nearest_neighbors,
-                    approx_nearest_neighbors=self.approx_nearest_neighbors,
-                    n_jobs=self.n_jobs,
-                    low_memory=self.low_memory,
-                    seed_rng=self.seed_rng
-                )
-                # # LLE reconstruction errors of the points from `self.features_knn_pred[c]`
-                nn_indices, _ = self.index_knn_pred[c].query_self(k=self.n_neighbors_pred[c])
-                self.errors_lle_train[ind, 0] = self._calc_reconstruction_errors(
-                    self.features_knn_pred[c], self.features_knn_pred[c], nn_indices
-                )
-            else:
+    def _fit_partitioned(self, features, labels, labels_pred, set_n_neighbors):
+        """
+        Calculate the LLE reconstruction errors of the training samples conditioned on each class using a single
+        KNN index over all the samples, partitioned by their predicted class and their true class.
+        """
+        for c in self.labels_unique:
+            self.indices_pred[c] = np.where(labels_pred == c)[0]
+            self.indices_true[c] = np.where(labels == c)[0]
+            if self.indices_pred[c].shape[0] == 0:
                 raise ValueError("No predicted samples from class '{}'. Cannot proceed.".format(c))
+            if self.indices_true[c].shape[0] == 0:
+                raise ValueError("No labeled samples from class '{}'. Cannot proceed.".format(c))
 
-            # Labeled samples from class `c`
-            ind = np.where(labels == c)[0]
-            self.indices_true[c] = ind
-            n_true = ind.shape[0]
-            # Number of neighbors for the labeled samples from class `c`
             if set_n_neighbors:
-                self.n_neighbors_true[c] = int(np.ceil(n_true ** self.neighborhood_constant))
+                self.n_neighbors_pred[c] = self._num_neighbors(self.indices_pred[c].shape[0], ('pred', c))
+                self.n_neighbors_true[c] = self._num_neighbors(self.indices_true[c].shape[0], ('true', c))
             else:
+                self.n_neighbors_pred[c] = self.n_neighbors
                 self.n_neighbors_true[c] = self.n_neighbors
 
             # Number of neighbors should not exceed the number of dimensions in order to avoid a singular gram matrix
+            if self.n_neighbors_pred[c] >= self.dim:
+                self.n_neighbors_pred[c] = max(self.dim - 1, 1)
             if self.n_neighbors_true[c] >= self.dim:
                 self.n_neighbors_true[c] = max(self.dim - 1, 1)
 
-            if n_true:
-                # KNN index for the labeled samples from class `c`
-                self.features_knn_true[c] = features[ind, :]
-                self.index_knn_true[c] = KNNIndex(
-                    self.features_knn_true[c], n_neighbors=self.n_neighbors_true[c],
-                    metric=self.metric, metric_kwargs=self.metric_kwargs,
-                    shared_nearest_neighbors=self.shared_nearest_neighbors,
-                    approx_nearest_neighbors=self.approx_nearest_neighbors,
-                    n_jobs=self.n_jobs,
-                    low_memory=self.low_memory,
-                    seed_rng=self.seed_rng
-                )
-                # LLE reconstruction errors for the labeled samples from class `c`
-                nn_indices, _ = self.index_knn_true[c].query_self(k=self.n_neighbors_true[c])
-                self.errors_lle_train[ind, i + 1] = self._calc_reconstruction_errors(
-                    self.features_knn_true[c], self.features_knn_true[c], nn_indices
-                )
-                # Commenting this block out to avoid unneccessary computation.
-                # The reconstruction errors for these samples are not used anywhere else.
-                '''
-                # LLE reconstruction errors for the labeled samples not from class `c`
-                ind_comp = np.where(labels != c)[0]
-                temp_arr = features[ind_comp, :]
-                nn_indices, _ = self.index_knn_true[c].query(temp_arr, k=self.n_neighbors_true[c])
-                self.errors_lle_train[ind_comp, i + 1] = self._calc_reconstruction_errors(
-                    temp_arr, self.features_knn_true[c], nn_indices
-                )
-                '''
-            else:
-                raise ValueError("No labeled samples from class '{}'. Cannot proceed.".format(c))
-
-        # Calculate the scores and p-values for each samples
-        self.scores_train, p_values = self.score(features, labels_pred, is_train=True, bootstrap=bootstrap)
-        return self.scores_train, p_values
+        logger.info("Building a KNN index partitioned by the predicted and true class for nearest neighbor queries "
+                    "from each class.")
+        m = self.n_classes
+        self.features_knn = features
+        k = max(max(self.n_neighbors_pred.values()), max(self.n_neighbors_true.values()))
+        self.index_knn_partitioned = self._build_partitioned_index(features, k)
+        # Nearest neighbors of each sample from each predicted and true class, excluding the sample itself. The
+        # neighbor indices refer to the rows of `self.features_knn`
+        nn_indices, _ = self.index_knn_partitioned.query_self(k=k)
+        for i, c in enumerate(self.labels_unique):
+            # LLE reconstruction errors of the samples predicted into class `c`
+            ind = self.indices_pred[c]
+            self.errors_lle_train[ind, 0] = self._calc_reconstruction_errors(
+                features[ind, :], features, nn_indices[ind, i, :self.n_neighbors_pred[c]]
+            )
+            # LLE reconstruction errors of the labeled samples from class `c`
+            ind = self.indices_true[c]
+            self.errors_lle_train[ind, i + 1] = self._calc_reconstruction_errors(
+                features[ind, :], features, nn_indices[ind, m + i, :self.n_neighbors_true[c]]
+            )
 
     def score(self, features_test, labels_pred_test, is_train=False, log_transform=True, bootstrap=True):
         """
@@ -1536,6 +2335,11 @@ class LLEScore(TestStatistic):
 
         scores = np.zeros((n_test, 1 + self.n_classes))
         p_values = np.zeros((n_test, 1 + self.n_classes))
+        nn_indices_part = None
+        if (self.index_knn_partitioned is not None) and (not is_train):
+            # Nearest neighbors of the test samples from all the predicted and true classes in a single query
+            nn_indices_part, _ = self.index_knn_partitioned.query(features_test)
+
         preds_unique = self.labels_unique if (n_test > 1) else [labels_pred_test[0]]
         cnt_par = 0
         for c_hat in preds_unique:
@@ -1545,14 +2349,18 @@ class LLEScore(TestStatistic):
                 if not is_train:
                     # LLE reconstruction errors relative to the samples predicted into class `c_hat`
                     temp_arr = features_test[ind, :]
-                    nn_indices, _ = self.index_knn_pred[c_hat].query(temp_arr, k=self.n_neighbors_pred[c_hat])
-                    scores[ind, 0] = self._calc_reconstruction_errors(
-                        temp_arr, self.features_knn_pred[c_hat], nn_indices
-                    )
+                    if nn_indices_part is None:
+                        nn_indices, _ = self.index_knn_pred[c_hat].query(temp_arr, k=self.n_neighbors_pred[c_hat])
+                        features_knn = self.features_knn_pred[c_hat]
+                    else:
+                        nn_indices = nn_indices_part[ind, int(self.label_encoder(c_hat)),
+                                                     :self.n_neighbors_pred[c_hat]]
+                        features_knn = self.features_knn
+
+                    scores[ind, 0] = self._calc_reconstruction_errors(temp_arr, features_knn, nn_indices)
                     # p-value of the LLE reconstruction errors
-                    p_values[ind, 0] = pvalue_score(
-                        self.scores_train[self.indices_pred[c_hat], 0], scores[ind, 0], log_transform=log_transform,
-                        bootstrap=bootstrap
+                    p_values[ind, 0] = self.null_tables_pred[c_hat].pvalue(
+                        scores[ind, 0], log_transform=log_transform, bootstrap=bootstrap
                     )
                 else:
                     # Precomputed LLE reconstruction errors
@@ -1569,14 +2377,17 @@ class LLEScore(TestStatistic):
         for i, c in enumerate(self.labels_unique):
             if not is_train:
                 # LLE reconstruction errors relative to the samples labeled as class `c`
-                nn_indices, _ = self.index_knn_true[c].query(features_test, k=self.n_neighbors_true[c])
-                scores[:, i + 1] = self._calc_reconstruction_errors(
-                    features_test, self.features_knn_true[c], nn_indices
-                )
+                if nn_indices_part is None:
+                    nn_indices, _ = self.index_knn_true[c].query(features_test, k=self.n_neighbors_true[c])
+                    features_knn = self.features_knn_true[c]
+                else:
+                    nn_indices = nn_indices_part[:, self.n_classes + i, :self.n_neighbors_true[c]]
+                    features_knn = self.features_knn
+
+                scores[:, i + 1] = self._calc_reconstruction_errors(features_test, features_knn, nn_indices)
                 # p-value of the LLE reconstruction errors
-                p_values[:, i + 1] = pvalue_score(
-                    self.scores_train[self.indices_true[c], i + 1], scores[:, i + 1], log_transform=log_transform,
-                    bootstrap=bootstrap
+                p_values[:, i + 1] = self.null_tables_true[c].pvalue(
+                    scores[:, i + 1], log_transform=log_transform, bootstrap=bootstrap
                 )
             else:
                 # Precomputed LLE reconstruction errors
@@ -1601,15 +2412,6 @@ class LLEScore(TestStatistic):
         :return:
             - array with the norm of the reconstruction errors. Has shape `(N, )`.
         """
-        N = nn_indices.shape[0]
-        if self.n_jobs == 1:
-            w = [helper_reconstruction_error(features, features_knn, nn_indices, self.reg_eps, i) for i in range(N)]
-        else:
-            helper_partial = partial(helper_reconstruction_error, features, features_knn, nn_indices, self.reg_eps)
-            pool_obj = multiprocessing.Pool(processes=self.n_jobs)
-            w = []
-            _ = pool_obj.map_async(helper_partial, range(N), callback=w.extend)
-            pool_obj.close()
-            pool_obj.join()
-
-        return np.array(w)
+        _, errors = solve_lle_weights_batch(features, features_knn, nn_indices, reg_eps=self.reg_eps,
+                                            return_errors=True)
+        return errors
@@ -27,6 +27,42 @@ NEIGHBORHOOD_CONST = 0.4
 MIN_N_NEIGHBORS = 20
 RHO = 0.5
 
+# Memory budget (in MB) of the cache of nearest neighbor query results kept by each exact KNN index. The budget is
+# small because each index (e.g. one per class and layer) has its own cache. The approximate indices do not cache
+# their query results by default
+QUERY_CACHE_MB = 16
+
+# Factor by which the number of neighbors of the KNN graphs kept by `KNNGraphCache` is increased. The extra
+# neighbors replace the ones that are not part of a subset of the data, e.g. the training set of a fold
+GRAPH_CACHE_NEIGHBORS_FACTOR = 1.5
+
+# Approximate memory (in MB) used by each tile of the exact KNN search based on matrix multiplication
+EXACT_KNN_TILE_MB = 64
+
+# Fast-math flags of the numba kernels of the nearest neighbor search. The flags 'nnan' and 'ninf' are excluded,
+# because the kernels compare the distances with `inf`, which is used for the missing neighbors
+FASTMATH_FLAGS = {'reassoc', 'contract', 'arcp'}
+
+# Constants used by the inverted file (IVF) index.
+# Number of inverted lists, `n_lists = IVF_LISTS_CONST * sqrt(N)`
+IVF_LISTS_CONST = 1.0
+# Number of inverted lists (nearest to the query point) that are searched
+IVF_NPROBE = 8
+# Maximum number of samples per inverted list used to train the coarse quantizer
+IVF_TRAIN_SAMPLES_PER_LIST = 64
+IVF_KMEANS_MAX_ITER = 20
+
+# Constants used by the product quantization (PQ) compression of the IVF index.
+# Number of dimensions per PQ subspace. Each subspace is encoded with one byte
+PQ_SUBSPACE_DIM = 8
+PQ_NUM_CENTROIDS = 256
+PQ_TRAIN_SAMPLES = 20000
+PQ_KMEANS_ITER = 10
+# Number of iterations of optimized product quantization (OPQ)
+PQ_OPQ_ITER = 4
+# Number of candidates (relative to `k`) found using the compressed codes that are re-ranked using exact distances
+PQ_RERANK_FACTOR = 4
+
 SEED_DEFAULT = 123
 
 # Default batch size
@@ -58,9 +94,16 @@ METHOD_INTRINSIC_DIM = 'lid_mle'
 METHOD_DIM_REDUCTION = 'NPP'
 MAX_SAMPLES_DIM_REDUCTION = 10000
 
+# Approximate memory (in MB) of each chunk of rows read from the memory-mapped adversarial and clean data files to
+# calculate the perturbation norms
+LOAD_CHUNK_MB = 64
+
 # Cumulative variance cutoff for PCA
 PCA_CUTOFF = 0.995
 
+# Approximate memory (in MB) used by each batch of the neighborhood Gram matrices in the LLE weight solver
+LLE_BATCH_MB = 64
+
 # Proportion of noisy samples to include in the training or test folds of cross-validation
 NOISE_PROPORTION = 0.05
 
@@ -121,6 +164,10 @@ NUM_RANDOM_SAMPLES = 20000
 # Number of bootstrap resamples
 NUM_BOOTSTRAP = 100
 
+# Smallest p-value returned by the empirical p-value estimates. The negative log p-values are therefore bounded
+# above by `-log(PVALUE_MIN)`
+PVALUE_MIN = 1e-16
+
 # Plot colors and markers
 # https://matplotlib.org/2.0.2/examples/color/named_colors.html
 COLORS = ['r', 'b', 'c', 'orange', 'g', 'm', 'lawngreen', 'grey', 'hotpink', 'y', 'steelblue', 'tan',
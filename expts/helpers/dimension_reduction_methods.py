@@ -32,13 +32,15 @@ from sklearn.decomposition import PCA
 from sklearn.metrics import pairwise_distances
 import multiprocessing
 from functools import partial
+from numba import njit, prange
 from helpers.lid_estimators import estimate_intrinsic_dimension
 from helpers.knn_index import KNNIndex
 from helpers.utils import get_num_jobs
 from helpers.constants import (
     NEIGHBORHOOD_CONST,
     SEED_DEFAULT,
-    METRIC_DEF
+    METRIC_DEF,
+    LLE_BATCH_MB
 )
 import logging
 try:
@@ -606,16 +608,7 @@ class NeighborhoodPreservingProjection:
         # Find the `self.n_neighbors` nearest neighbors of each point
         nn_indices, nn_distances = self.index_knn.query_self(k=self.n_neighbors)
         N, K = nn_indices.shape
-
-        if self.n_jobs == 1:
-            w = [helper_solve_lle(data, nn_indices, self.reg_eps, i) for i in range(N)]
-        else:
-            helper_partial = partial(helper_solve_lle, data, nn_indices, self.reg_eps)
-            pool_obj = multiprocessing.Pool(processes=self.n_jobs)
-            w = []
-            _ = pool_obj.map_async(helper_partial, range(N), callback=w.extend)
-            pool_obj.close()
-            pool_obj.join()
+        w = solve_lle_weights_batch(data, data, nn_indices, reg_eps=self.reg_eps)
 
         # Create a sparse matrix of size `(N, N)` for the adjacency matrix
         row_ind = np.array([[i] * (K + 1) for i in range(N)], dtype=np.int).ravel()
@@ -629,63 +622,167 @@ class NeighborhoodPreservingProjection:
         self.iterated_laplacian_matrix = sparse.csr_matrix.dot(mat_tmp.transpose(), mat_tmp)
 
 
-def solve_lle_weights(x, neighbors, reg_eps=0.001):
+@njit(parallel=True)
+def cholesky_solve_ones(G):
     """
-    Solve for the optimal weights that reconstruct a point using its nearest neighbors. The weights are constrained
-    to be non-negative and sum to 1. This is the first step of locally linear embedding (LLE).
-
-    :param x: numpy array of shape `(dim, )`, where `dim` is the feature dimension.
-    :param neighbors: numpy array of shape `(k, dim)`, where `k` is the number of neighbors.
-    :param reg_eps: value close to 0 that is used to regularize any singular matrix.
-    :return: numpy array with the optimal weights of shape `(k, )`.
+    Solve the linear systems `G[i] w[i] = 1` for a batch of symmetric positive definite matrices using the Cholesky
+    decomposition of each matrix.
+
+    :param G: numpy array of shape `(n, k, k)` with the matrices.
+    :return: (w, success)
+        - w: numpy array of shape `(n, k)` with the solutions.
+        - success: boolean numpy array of shape `(n, )` that is False for the matrices that are not (numerically)
+                   positive definite. The corresponding rows of `w` are set to 0.
     """
-    # Gram matrix of the neighborhood of the point
-    Z = x - neighbors
-    G = np.dot(Z, Z.T)
-    k = G.shape[0]
+    n, k, _ = G.shape
+    w = np.zeros((n, k))
+    success = np.ones(n, dtype=np.bool_)
+    for i in prange(n):
+        # Lower triangular Cholesky factor `L` such that `G[i] = L L^T`
+        L = np.zeros((k, k))
+        for a in range(k):
+            v = G[i, a, a]
+            for b in range(a):
+                v -= L[a, b] * L[a, b]
 
-    eps = sys.float_info.epsilon
-    # Trace of G is the sum of squared distance from `x` to its neighbors
-    G_diag = G.diagonal()
-    tr_G = np.sum(G_diag)
-    max_diag_G = np.max(G_diag)
-    if tr_G < eps or max_diag_G < eps:
-        # Equal weight to all the neighbors
-        return (1. / k) * np.ones(k)
+            if v <= 0.:
+                success[i] = False
+                break
+
+            L[a, a] = np.sqrt(v)
+            for r in range(a + 1, k):
+                v = G[i, r, a]
+                for b in range(a):
+                    v -= L[r, b] * L[a, b]
+
+                L[r, a] = v / L[a, a]
+
+        if not success[i]:
+            continue
+
+        # Forward substitution `L y = 1`, followed by back substitution `L^T w = y`
+        y = np.zeros(k)
+        for a in range(k):
+            v = 1.
+            for b in range(a):
+                v -= L[a, b] * y[b]
 
-    # Normalize the diagonal values to the range [0, 1]. Then look for really small values
-    mask = G_diag < (eps * max_diag_G)
-    if np.any(mask):
-        # One or more of the neighbors are very close to the point `x`. In this case, we assign equal weight to
-        # such overlapping neighbors
-        w = np.zeros(k)
-        w[mask] = 1.
-        return w / np.sum(w)
+            y[a] = v / L[a, a]
 
-    # Check for large value of condition number of `G`
-    if np.linalg.cond(G) > 1e6:
-        # Add a small perturbation to the diagonal of `G` to ensure that it is not singular
-        np.fill_diagonal(G, G_diag + reg_eps * tr_G)
+        for a in range(k - 1, -1, -1):
+            v = y[a]
+            for b in range(a + 1, k):
+                v -= L[b, a] * w[i, b]
 
-    # Solve for the optimal weights, ensure they are non-negative, and normalize them to sum to 1
-    w = solve(G, np.ones(k), assume_a='pos')
-    w = np.clip(w, 0., None)
-    return w / np.sum(w)
+            w[i, a] = v / L[a, a]
 
+    return w, success
 
-def helper_solve_lle(data, nn_indices, reg_eps, n):
-    return solve_lle_weights(data[n, :], data[nn_indices[n, :], :], reg_eps=reg_eps)
 
+def solve_lle_weights_batch(data, data_knn, nn_indices, reg_eps=0.001, return_errors=False):
+    """
+    Solve for the optimal weights that reconstruct each point using its nearest neighbors. The weights are
+    constrained to be non-negative and sum to 1. This is the first step of locally linear embedding (LLE).
+
+    The Gram matrices of the neighborhoods of a batch of points are calculated as one tensor of shape `(n, k, k)`.
+    The following rules are applied to each point:
+    - If all the neighbors overlap with the point, they are given equal weights.
+    - Else, if some of the neighbors are very close to the point, these neighbors are given equal weights.
+    - Else, the Gram matrix is regularized by adding `reg_eps` times its trace to the diagonal if its condition
+      number is larger than `1e6`, and the weights are found by solving a linear system using the Cholesky
+      decomposition. A matrix that is still not positive definite is regularized before solving.
+
+    :param data: numpy array of shape `(n, d)` with the points.
+    :param data_knn: numpy array of shape `(m, d)` with the points used for the KNN graph construction.
+    :param nn_indices: numpy array of shape `(n, k)` with the index of the nearest neighbors of each point from
+                       `data` in `data_knn`.
+    :param reg_eps: value close to 0 that is used to regularize any singular matrix.
+    :param return_errors: Set to True to also return the norm of the reconstruction error of each point.
+
+    :return: numpy array of shape `(n, k)` with the optimal weights. If `return_errors = True`, a numpy array of
+             shape `(n, )` with the norm of the reconstruction errors is also returned.
+    """
+    n, k = nn_indices.shape
+    d = data.shape[1]
+    eps = sys.float_info.epsilon
+    weights = np.zeros((n, k))
+    errors = np.zeros(n)
+    ind_diag = np.arange(k)
+    # Number of points per batch based on the memory used by the neighbors and the Gram matrices
+    n_rows = max(1, int(LLE_BATCH_MB * (2 ** 20) / (8. * k * (d + k))))
+    for st in range(0, n, n_rows):
+        rows = slice(st, min(st + n_rows, n))
+        x = np.asarray(data[rows], dtype=np.float64)
+        # Nearest neighbors of the batch of points, of shape `(n_batch, k, d)`
+        y = np.asarray(data_knn[nn_indices[rows]], dtype=np.float64)
+        Z = x[:, np.newaxis, :] - y
+        # Gram matrices of the neighborhoods, of shape `(n_batch, k, k)`
+        G = np.matmul(Z, np.transpose(Z, (0, 2, 1)))
+        # Trace of G is the sum of squared distance from a point to its neighbors
+        G_diag = G[:, ind_diag, ind_diag]
+        tr_G = np.sum(G_diag, axis=1)
+        max_diag_G = np.max(G_diag, axis=1)
+
+        w = np.zeros((x.shape[0], k))
+        # Equal weight to all the neighbors
+        mask_equal = (tr_G < eps) | (max_diag_G < eps)
+        w[mask_equal, :] = 1. / k
+
+        # Normalize the diagonal values to the range [0, 1]. Then look for really small values. If one or more of the
+        # neighbors are very close to the point, we assign equal weight to such overlapping neighbors
+        mask_close = G_diag < (eps * max_diag_G[:, np.newaxis])
+        mask_overlap = np.any(mask_close, axis=1) & (~mask_equal)
+        if np.any(mask_overlap):
+            mask_close = mask_close[mask_overlap]
+            w[mask_overlap, :] = mask_close / np.sum(mask_close, axis=1, keepdims=True)
+
+        mask_solve = ~(mask_equal | mask_overlap)
+        if np.any(mask_solve):
+            G = G[mask_solve]
+            tr_G = tr_G[mask_solve]
+            # Condition number of the symmetric Gram matrices from the magnitude of their eigenvalues
+            ev = np.abs(np.linalg.eigvalsh(G))
+            with np.errstate(divide='ignore'):
+                cond = np.max(ev, axis=1) / np.min(ev, axis=1)
+
+            # Add a small perturbation to the diagonal of `G` to ensure that it is not singular
+            ind = np.where(cond > 1e6)[0]
+            G[ind[:, np.newaxis], ind_diag, ind_diag] += reg_eps * tr_G[ind, np.newaxis]
+            w_solve, success = cholesky_solve_ones(G)
+            if not np.all(success):
+                ind = np.where(~success)[0]
+                G_fail = G[ind]
+                G_fail[:, ind_diag, ind_diag] += reg_eps * tr_G[ind, np.newaxis]
+                w_solve[ind], _ = cholesky_solve_ones(G_fail)
+
+            # Ensure the weights are non-negative, and normalize them to sum to 1
+            w_solve = np.clip(w_solve, 0., None)
+            w[mask_solve, :] = w_solve / np.sum(w_solve, axis=1, keepdims=True)
+
+        weights[rows] = w
+        if return_errors:
+            # Euclidean norm of the error in the LLE reconstruction
+            e = x - np.einsum('ij,ijk->ik', w, y)
+            errors[rows] = np.sqrt(np.sum(e ** 2, axis=1))
+
+    if return_errors:
+        return weights, errors
+
+    return weights
 
-def helper_reconstruction_error(data, data_knn, nn_indices, reg_eps, n):
-    # Euclidean norm of the error in the LLE reconstruction
-    x = data[n, :]
-    # nearest neighbors of `x`
-    y = data_knn[nn_indices[n, :], :]
-    w = solve_lle_weights(x, y, reg_eps=reg_eps)
-    e = x - np.dot(w, y)
 
-    return np.sum(e ** 2) ** 0.5
+def solve_lle_weights(x, neighbors, reg_eps=0.001):
+    """
+    Solve for the optimal weights that reconstruct a point using its nearest neighbors. The weights are constrained
+    to be non-negative and sum to 1. This is the first step of locally linear embedding (LLE).
+
+    :param x: numpy array of shape `(dim, )`, where `dim` is the feature dimension.
+    :param neighbors: numpy array of shape `(k, dim)`, where `k` is the number of neighbors.
+    :param reg_eps: value close to 0 that is used to regularize any singular matrix.
+    :return: numpy array with the optimal weights of shape `(k, )`.
+    """
+    k = neighbors.shape[0]
+    return solve_lle_weights_batch(x[np.newaxis, :], neighbors, np.arange(k)[np.newaxis, :], reg_eps=reg_eps)[0]
 
 
 def transform_data_from_model(data, model_dict):
@@ -0,0 +1,221 @@
+"""
+Content-addressed on-disk cache of the layer embeddings and the predictions of a DNN.
+
+An entry is keyed by a hash of the model parameters, a hash of the data set (inputs and labels), and the set of
+layers, i.e. the method of the model that returns the layer embeddings (see `helpers.utils.layer_function_name`).
+If the dimension reduction models are applied during the extraction, the key also includes a hash of the models.
+The same key therefore identifies the same forward pass, independent of the script, the cross-validation fold, or
+the detection settings such as the test statistic and score type. Each entry is a directory with the embeddings of
+each layer as a `.npy` file and the predicted labels. The layer embeddings are written directly into the files
+during the extraction, and they are loaded as memory-mapped arrays.
+
+An entry is first written to a temporary directory, which is renamed once the entry is complete. Entries of runs
+that were interrupted are therefore never used.
+
+USAGE:
+```
+from helpers.embedding_cache import EmbeddingCache
+from helpers.utils import helper_layer_embeddings
+
+cache = EmbeddingCache('/path/to/cache', model)
+# The DNN is run only if the embeddings of this model, data, and set of layers are not already cached
+layer_embeddings, labels_pred = helper_layer_embeddings(model, device, data_loader, 'proposed', labels,
+                                                        cache=cache)
+
+```
+"""
+import numpy as np
+import os
+import sys
+import glob
+import shutil
+import hashlib
+import logging
+from torch.utils.data import SequentialSampler
+from helpers.utils import loader_num_samples
+
+logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+logger = logging.getLogger(__name__)
+
+
+def hash_array(data, h):
+    """
+    Update the hash object `h` with the contents, shape, and type of the numpy array `data`.
+    """
+    data = np.ascontiguousarray(data)
+    h.update(str((data.shape, data.dtype.str)).encode())
+    h.update(data.view(np.uint8).reshape(-1))
+
+
+def loader_arrays(data_loader):
+    """
+    Numpy arrays of the tensors (e.g. the inputs and labels) of the data set of a data loader.
+
+    :param data_loader: torch data loader whose data set is a `TensorDataset`, possibly wrapped by `MyDataset`.
+    :return: list of numpy arrays.
+    """
+    dataset = data_loader.dataset
+    # Data set wrapped by `helpers.utils.MyDataset`
+    if (not hasattr(dataset, 'tensors')) and hasattr(dataset, 'dataset'):
+        dataset = dataset.dataset
+
+    if not hasattr(dataset, 'tensors'):
+        raise ValueError("Embedding cache requires a data loader of a 'TensorDataset', but received '{}'.".
+                         format(type(dataset).__name__))
+
+    return [v.detach().cpu().numpy() for v in dataset.tensors]
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of the layer embeddings and predictions of a DNN model, keyed by the contents of the model
+    parameters, the data, and the set of layers.
+    """
+    def __init__(self, cache_dir, model):
+        """
+        :param cache_dir: path to the directory of the cache. It is created if it does not exist.
+        :param model: torch NN model. The cache key includes a hash of its class name and parameters.
+        """
+        self.cache_dir = cache_dir
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        h = hashlib.blake2b(digest_size=16)
+        h.update(type(model).__name__.encode())
+        for name, v in model.state_dict().items():
+            h.update(name.encode())
+            hash_array(v.detach().cpu().numpy(), h)
+
+        self.model_hash = h.hexdigest()
+
+    def make_key(self, data_loader, layer_set, transform_models=None):
+        """
+        Key of the cache entry for the data set of the given data loader and the set of layers.
+
+        :param data_loader: torch data loader object (see the function `loader_arrays`). It should return the
+                            samples of its data set in order, i.e. without a custom sampler, shuffling, or a custom
+                            batch sampler.
+        :param layer_set: string with the name of the set of layers, e.g. the name of the method of the model that
+                          returns the layer embeddings.
+        :param transform_models: None or the list of dimension reduction model dicts that are applied to the
+                                 layer embeddings during the extraction.
+        :return: string key.
+        """
+        if (data_loader.batch_size is None) or (not isinstance(data_loader.sampler, SequentialSampler)):
+            raise ValueError("Embedding cache requires a data loader that returns the samples of its data set in "
+                             "order, without a custom sampler, shuffling, or a custom batch sampler.")
+
+        h = hashlib.blake2b(digest_size=16)
+        h.update(self.model_hash.encode())
+        h.update(layer_set.encode())
+        # The last incomplete batch may be dropped by the data loader
+        h.update(str(loader_num_samples(data_loader)).encode())
+        if transform_models is not None:
+            for md in transform_models:
+                h.update(b'none' if (md is None) else b'model')
+                if md is not None:
+                    hash_array(md['mean_data'], h)
+                    hash_array(md['transform'], h)
+
+        for arr in loader_arrays(data_loader):
+            hash_array(arr, h)
+
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def temp_path(self, key):
+        """
+        Path to a new temporary directory, in which the entry `key` is written before it is saved.
+        """
+        path = os.path.join(self.cache_dir, 'tmp_{}_{:d}'.format(key, os.getpid()))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+        os.makedirs(path)
+        return path
+
+    def load(self, key):
+        """
+        Load a cache entry.
+
+        :param key: string key returned by the method `make_key`.
+        :return: None if the entry is not cached. Otherwise, a tuple `(layer_embeddings, labels_pred)`, where
+                 `layer_embeddings` is a list of memory-mapped arrays, one per layer. The arrays are opened in
+                 copy-on-write mode, so any modifications are not written to the cache. The list has None for
+                 the layers that were not selected during the extraction. An entry whose layer embeddings do not
+                 have one row per prediction is removed, and None is returned.
+        """
+        path = self.entry_path(key)
+        if not os.path.isdir(path):
+            return None
+
+        fname = os.path.join(path, 'num_layers.npy')
+        if os.path.isfile(fname):
+            n_layers = int(np.load(fname))
+        else:
+            n_layers = len(glob.glob(os.path.join(path, 'layer_*.npy')))
+
+        # The layers that were not selected during the extraction have no file
+        layer_embeddings = []
+        for i in range(n_layers):
+            fname = os.path.join(path, 'layer_{:d}.npy'.format(i))
+            layer_embeddings.append(np.load(fname, mmap_mode='c') if os.path.isfile(fname) else None)
+
+        labels_pred = np.load(os.path.join(path, 'labels_pred.npy'))
+        n_rows = [v.shape[0] for v in layer_embeddings if v is not None]
+        if any(n != labels_pred.shape[0] for n in n_rows):
+            logger.warning("Removing the cache entry {} because the number of rows of the layer embeddings {} does "
+                           "not match the number of predictions ({:d}).".format(path, n_rows, labels_pred.shape[0]))
+            del layer_embeddings
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+
+        logger.info("Loaded the embeddings of {:d} layers and the predictions of {:d} samples from the cache "
+                    "entry: {}".format(n_layers, labels_pred.shape[0], path))
+        return layer_embeddings, labels_pred
+
+    def save(self, key, temp_path, layer_embeddings, labels_pred):
+        """
+        Save a cache entry whose layer embeddings are written to the files `layer_<i>.npy` in `temp_path`. The
+        layer embeddings are trimmed to one row per prediction. The arrays that are not already in these files
+        (e.g. arrays in memory) are written to them.
+
+        :param key: string key returned by the method `make_key`.
+        :param temp_path: path to the temporary directory returned by the method `temp_path`.
+        :param layer_embeddings: list of the layer embeddings, usually memory-mapped arrays in `temp_path`, with
+                                 None for the layers that are not selected.
+        :param labels_pred: numpy array of the predicted labels.
+        :return: tuple `(layer_embeddings, labels_pred)` loaded from the saved entry.
+        """
+        n_samples = labels_pred.shape[0]
+        for i, v in enumerate(layer_embeddings):
+            if v is None:
+                continue
+
+            if v.shape[0] < n_samples:
+                raise ValueError("Layer embeddings {:d} have {:d} rows, but there are {:d} predictions.".
+                                 format(i, v.shape[0], n_samples))
+
+            fname = os.path.join(temp_path, 'layer_{:d}.npy'.format(i))
+            if (isinstance(v, np.memmap) and (v.shape[0] == n_samples) and v.filename and os.path.isfile(fname)
+                    and os.path.samefile(v.filename, fname)):
+                # Written in place during the extraction
+                v.flush()
+            else:
+                # Written to a new file, which then replaces the file that may be mapped by `v`
+                fname_temp = os.path.join(temp_path, 'layer_{:d}_temp.npy'.format(i))
+                np.save(fname_temp, v[:n_samples])
+                os.replace(fname_temp, fname)
+
+        np.save(os.path.join(temp_path, 'labels_pred.npy'), labels_pred)
+        np.save(os.path.join(temp_path, 'num_layers.npy'), len(layer_embeddings))
+        path = self.entry_path(key)
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # The same entry was saved by another run in the meantime
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+        return self.load(key)
@@ -15,6 +15,7 @@ from helpers.utils import (
     get_data_bounds
 )
 from helpers.knn_index import KNNIndex
+from detectors.detector_proposed import transform_layer_embeddings
 
 INFTY = 1e20
 NORM_REG = 1e-16
@@ -371,6 +372,10 @@ def check_adv_detec(x_embeddings, labels, labels_pred_dnn, model_detector, is_nu
     if model_detector._name == 'dknn':
         _, labels_pred = model_detector.score(x_embeddings)
     elif model_detector._name == 'proposed':
+        if model_detector.transform_models and model_detector.dim_reduction_applied:
+            # The detector was fit on layer embeddings that were transformed during their extraction
+            x_embeddings = transform_layer_embeddings(x_embeddings, model_detector.transform_models)
+
         _, labels_pred = model_detector.score(x_embeddings, labels_pred_dnn, return_corrected_predictions=True)
     else:
         raise ValueError("Received model from unknown detection method")
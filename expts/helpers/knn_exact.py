@@ -0,0 +1,341 @@
+"""
+Exact (brute-force) K nearest neighbors search for the cosine and euclidean distance metrics using tiled matrix
+multiplications (BLAS) in the precision of the input data.
+
+The interface follows that of `sklearn.neighbors.NearestNeighbors`, so that it can be used as a drop-in
+replacement for brute-force search by the class `KNNIndex`.
+
+USAGE:
+```
+from helpers.knn_exact import ExactNearestNeighbors
+
+index = ExactNearestNeighbors(n_neighbors=10, metric='cosine', n_jobs=4).fit(data)
+nn_distances, nn_indices = index.kneighbors(data_test, n_neighbors=5)
+
+```
+"""
+import numpy as np
+from numba import njit, prange
+from helpers.constants import (
+    METRIC_DEF,
+    EXACT_KNN_TILE_MB,
+    FASTMATH_FLAGS
+)
+
+# Distance metrics supported by the class `ExactNearestNeighbors`
+METRICS_EXACT_KNN = ['cosine', 'euclidean']
+
+
+@njit(parallel=True, fastmath=FASTMATH_FLAGS)
+def smallest_k_rows(dots, offsets, scale, k):
+    """
+    Find the column indices of the `k` smallest values in each row of the matrix `offsets[j] + scale * dots[i, j]`,
+    without calculating the full matrix. A sorted buffer of the `k` smallest values seen so far is maintained for
+    each row, and a value is inserted only if it is smaller than the largest value in the buffer. The rows are
+    processed in parallel.
+
+    :param dots: numpy array of shape `(n, N)`.
+    :param offsets: numpy array of shape `(N, )`.
+    :param scale: float scale factor.
+    :param k: number of values to select per row. Should be `<= N`.
+
+    :return: numpy array of shape `(n, k)` with the column indices, which are not sorted by their value.
+    """
+    n, N = dots.shape
+    ind_sel = np.zeros((n, k), dtype=np.int64)
+    for i in prange(n):
+        vals = np.full(k, np.inf)
+        inds = np.zeros(k, dtype=np.int64)
+        for j in range(N):
+            v = offsets[j] + scale * dots[i, j]
+            if v < vals[k - 1]:
+                # Insertion into the sorted buffer
+                t = k - 1
+                while t > 0 and vals[t - 1] > v:
+                    vals[t] = vals[t - 1]
+                    inds[t] = inds[t - 1]
+                    t -= 1
+
+                vals[t] = v
+                inds[t] = j
+
+        ind_sel[i, :] = inds
+
+    return ind_sel
+
+
+@njit(parallel=True, fastmath=FASTMATH_FLAGS)
+def partitioned_smallest_k_rows(dots, offsets, scale, member_ptr, member_part, n_partitions, k, row_offset):
+    """
+    Partitioned version of the function `smallest_k_rows`. Each column belongs to zero or more partitions, and the
+    `k` smallest values in each row are found separately within each partition in a single pass over the row.
+
+    :param dots: numpy array of shape `(n, N)`.
+    :param offsets: numpy array of shape `(N, )`.
+    :param scale: float scale factor.
+    :param member_ptr: numpy array of shape `(N + 1, )`. The partitions of column `j` are given by
+                       `member_part[member_ptr[j]:member_ptr[j + 1]]`.
+    :param member_part: numpy array with the partition indices of the columns.
+    :param n_partitions: number of partitions.
+    :param k: number of values to select per row and partition.
+    :param row_offset: If this is non-negative, the column `row_offset + i` is excluded for row `i`. This is used
+                       to exclude the points from their own neighbors when the query points are the indexed points.
+
+    :return: numpy array of shape `(n, n_partitions, k)` with the column indices, which are not sorted by their
+             value. Partitions with less than `k` columns are padded with -1.
+    """
+    n, N = dots.shape
+    ind_sel = np.full((n, n_partitions, k), -1, dtype=np.int64)
+    for i in prange(n):
+        vals = np.full((n_partitions, k), np.inf)
+        inds = np.full((n_partitions, k), -1, dtype=np.int64)
+        for j in range(N):
+            if (member_ptr[j] == member_ptr[j + 1]) or (row_offset >= 0 and j == row_offset + i):
+                continue
+
+            v = offsets[j] + scale * dots[i, j]
+            for q in range(member_ptr[j], member_ptr[j + 1]):
+                p = member_part[q]
+                if v < vals[p, k - 1]:
+                    t = k - 1
+                    while t > 0 and vals[p, t - 1] > v:
+                        vals[p, t] = vals[p, t - 1]
+                        inds[p, t] = inds[p, t - 1]
+                        t -= 1
+
+                    vals[p, t] = v
+                    inds[p, t] = j
+
+        ind_sel[i, :, :] = inds
+
+    return ind_sel
+
+
+class ExactNearestNeighbors:
+    """
+    Exact K nearest neighbors search for the cosine and euclidean distance metrics. The data keeps its floating
+    point precision (integer data is converted to double precision), and it is normalized to unit length once for
+    the cosine metric. Queries are processed in tiles of rows: the distances from a tile to all the data points are
+    calculated with one matrix multiplication, and the nearest neighbors are selected in a single pass over each
+    row (see `smallest_k_rows`). The matrix multiplication (BLAS) and the selection (numba) are parallelized
+    within each tile, and the tiles are processed one after the other. Processing the tiles in a thread pool
+    instead calls the parallel numba functions concurrently from several threads, which is not supported by the
+    default threading layer of numba and was found to hang.
+    The distances to the selected neighbors are recalculated in double precision to avoid the cancellation errors
+    of the matrix multiplication form. The distance of a point to itself is therefore 0.
+    """
+    def __init__(self, n_neighbors=5, metric=METRIC_DEF, n_jobs=1, tile_mb=EXACT_KNN_TILE_MB):
+        """
+        :param n_neighbors: default number of nearest neighbors to query.
+        :param metric: distance metric. Should be one of `METRICS_EXACT_KNN`.
+        :param n_jobs: number of parallel jobs. It is saved with the index, but the number of threads of BLAS and
+                       numba is set by their own configuration.
+        :param tile_mb: approximate memory in MB used by the distance matrix of a tile.
+        """
+        if metric not in METRICS_EXACT_KNN:
+            raise ValueError("Metric '{}' is not supported. Supported metrics are: {}".
+                             format(metric, ', '.join(METRICS_EXACT_KNN)))
+
+        self.n_neighbors = n_neighbors
+        self.metric = metric
+        self.n_jobs = max(1, n_jobs)
+        self.tile_mb = tile_mb
+        # Data in floating point precision (normalized to unit length for the cosine metric)
+        self.data = None
+        # Squared norm of the rows of `self.data`. Only used by the euclidean metric
+        self.sq_norms = None
+
+    def fit(self, data):
+        """
+        :param data: numpy data array of shape `(N, d)`, where `N` is the number of samples and `d` is the number
+                     of dimensions (features).
+        :return: self
+        """
+        self.data = self._prepare(data)
+        if self.metric == 'euclidean':
+            self.sq_norms = np.einsum('ij,ij->i', self.data, self.data)
+
+        return self
+
+    def add(self, data):
+        """
+        Add new data points, which are assigned the indices `N, N + 1, . . .`, where `N` is the current number of
+        data points.
+        """
+        data = self._prepare(data)
+        self.data = np.concatenate([self.data, data])
+        if self.metric == 'euclidean':
+            self.sq_norms = np.concatenate([self.sq_norms, np.einsum('ij,ij->i', data, data)])
+
+    def select(self, rows):
+        """
+        Keep only the data points with the given indices. Point `rows[i]` is re-indexed to `i`.
+
+        :param rows: integer numpy array with the indices of the points to keep.
+        """
+        self.data = np.ascontiguousarray(self.data[rows, :])
+        if self.metric == 'euclidean':
+            self.sq_norms = self.sq_norms[rows]
+
+    def _prepare(self, data):
+        # The query points are converted to the type of the indexed data
+        if self.data is None:
+            dtype = np.result_type(np.asarray(data).dtype, np.float32)
+        else:
+            dtype = self.data.dtype
+
+        data = np.array(data, dtype=dtype, order='C')
+        if self.metric == 'cosine':
+            norms = np.sqrt(np.einsum('ij,ij->i', data, data, dtype=np.float64))
+            # Zero vectors are left as is, which gives them a cosine distance of 1 to every point
+            norms[norms <= 0.] = 1.
+            data /= norms[:, np.newaxis].astype(dtype)
+
+        return data
+
+    def kneighbors(self, data, n_neighbors=None):
+        """
+        Query for the `k` nearest neighbors of each point in `data`.
+
+        :param data: numpy data array of shape `(n, d)`, where `n` is the number of samples and `d` is the number
+                     of dimensions (features).
+        :param n_neighbors: number of nearest neighbors `k`. Set to `self.n_neighbors` if not specified.
+
+        :return: (nn_distances, nn_indices), where
+            - nn_distances: numpy array of distances of the nearest neighbors. Has shape `(n, k)`.
+            - nn_indices: numpy array of indices of the nearest neighbors. Has shape `(n, k)`.
+            The neighbors of each point are sorted by increasing distance.
+        """
+        if n_neighbors is None:
+            n_neighbors = self.n_neighbors
+
+        N = self.data.shape[0]
+        if n_neighbors > N:
+            raise ValueError("Number of neighbors {:d} cannot be larger than the number of samples {:d}".
+                             format(n_neighbors, N))
+
+        data = self._prepare(data)
+        n, d = data.shape
+        nn_indices = np.zeros((n, n_neighbors), dtype=np.int64)
+        nn_distances = np.zeros((n, n_neighbors))
+        # A few extra candidates are selected using the matrix multiplication and re-ranked in double precision
+        n_cand = min(N, n_neighbors + max(5, n_neighbors // 4))
+        # Number of rows per tile such that the tile of distances, and the candidate points gathered for
+        # re-ranking, each take about `self.tile_mb` MB
+        rows_tile = max(1, int(self.tile_mb * (2 ** 20) / (8. * max(N, n_cand * d))))
+
+        def process_tile(start):
+            end = min(start + rows_tile, n)
+            nn_indices[start:end, :], nn_distances[start:end, :] = self._search_tile(data[start:end, :],
+                                                                                     n_neighbors, n_cand)
+
+        self._run_tiles(process_tile, range(0, n, rows_tile))
+        return nn_distances, nn_indices
+
+    def kneighbors_partitioned(self, data, member_ptr, member_part, n_partitions, n_neighbors, exclude_self=False):
+        """
+        Query for the `k` nearest neighbors of each point in `data` within each partition of the data points. The
+        distances to all the data points are calculated once per query point, and the neighbors within all the
+        partitions are selected in the same pass.
+
+        :param data: numpy data array of shape `(n, d)`, where `n` is the number of samples and `d` is the number
+                     of dimensions (features).
+        :param member_ptr: numpy array of shape `(N + 1, )`, where `N` is the number of data points. The partitions
+                           of data point `j` are given by `member_part[member_ptr[j]:member_ptr[j + 1]]`.
+        :param member_part: numpy array with the partition indices of the data points.
+        :param n_partitions: number of partitions.
+        :param n_neighbors: number of nearest neighbors `k`.
+        :param exclude_self: Set to True if `data` are the indexed data points, in order to exclude each point
+                             from its own neighbors.
+
+        :return: (nn_distances, nn_indices), where
+            - nn_distances: numpy array of distances of the nearest neighbors. Has shape `(n, n_partitions, k)`.
+            - nn_indices: numpy array of indices of the nearest neighbors. Has shape `(n, n_partitions, k)`.
+            The neighbors are sorted by increasing distance. Partitions with less than `k` points are padded with
+            the index -1 and the distance `np.inf`.
+        """
+        N = self.data.shape[0]
+        data = self._prepare(data)
+        n, d = data.shape
+        if exclude_self and (n != N):
+            raise ValueError("Number of query points should be equal to the number of data points if "
+                             "'exclude_self' is True.")
+
+        k = n_neighbors
+        nn_indices = np.zeros((n, n_partitions, k), dtype=np.int64)
+        nn_distances = np.zeros((n, n_partitions, k))
+        n_cand = k + max(5, k // 4)
+        rows_tile = max(1, int(self.tile_mb * (2 ** 20) / (8. * max(N, n_partitions * n_cand * d))))
+        if self.metric == 'cosine':
+            offsets, scale = np.zeros(N, dtype=self.data.dtype), -1.
+        else:
+            offsets, scale = self.sq_norms, -2.
+
+        def process_tile(start):
+            end = min(start + rows_tile, n)
+            data_tile = data[start:end, :]
+            ind_cand = partitioned_smallest_k_rows(np.dot(data_tile, self.data.T), offsets, scale,
+                                                   member_ptr, member_part, n_partitions, n_cand,
+                                                   start if exclude_self else -1)
+            # Re-rank the candidates using distances in double precision
+            ind_cand = ind_cand.reshape(end - start, -1)
+            mask_missing = ind_cand < 0
+            dist_cand = self._distances(data_tile, np.where(mask_missing, 0, ind_cand))
+            dist_cand[mask_missing] = np.inf
+            ind_cand = ind_cand.reshape(end - start, n_partitions, n_cand)
+            dist_cand = dist_cand.reshape(end - start, n_partitions, n_cand)
+            ind_sort = np.argsort(dist_cand, axis=2, kind='mergesort')[:, :, :k]
+            nn_indices[start:end, :, :] = np.take_along_axis(ind_cand, ind_sort, axis=2)
+            nn_distances[start:end, :, :] = np.take_along_axis(dist_cand, ind_sort, axis=2)
+
+        self._run_tiles(process_tile, range(0, n, rows_tile))
+        return nn_distances, nn_indices
+
+    @staticmethod
+    def _run_tiles(process_tile, starts):
+        # Each tile is parallelized internally (see the class docstring)
+        for start in starts:
+            process_tile(start)
+
+    def _search_tile(self, data_tile, k, n_cand):
+        """
+        Nearest neighbors of the rows of a single tile, selected from `n_cand` candidates per row.
+        """
+        N = self.data.shape[0]
+        if n_cand < N:
+            dots = np.dot(data_tile, self.data.T)
+            # Select the candidates based on a score that is monotonically increasing in the distance
+            if self.metric == 'cosine':
+                # Negative cosine similarity
+                ind_cand = smallest_k_rows(dots, np.zeros(N, dtype=self.data.dtype), -1., n_cand)
+            else:
+                # Squared euclidean distance without the constant squared norm of the query point
+                ind_cand = smallest_k_rows(dots, self.sq_norms, -2., n_cand)
+        else:
+            ind_cand = np.tile(np.arange(N), (data_tile.shape[0], 1))
+
+        dist_cand = self._distances(data_tile, ind_cand)
+        ind_sort = np.argsort(dist_cand, axis=1, kind='mergesort')[:, :k]
+        rows = np.arange(data_tile.shape[0])[:, np.newaxis]
+        return ind_cand[rows, ind_sort], dist_cand[rows, ind_sort]
+
+    def _distances(self, data_tile, ind_cand):
+        """
+        Distances in double precision from each row of `data_tile` to the data points indexed by the
+        corresponding row of `ind_cand`.
+        """
+        x = data_tile.astype(np.float64)[:, np.newaxis, :]
+        y = self.data[ind_cand, :].astype(np.float64)
+        if self.metric == 'cosine':
+            # The points are normalized again in double precision. For unit vectors, the cosine distance
+            # `1 - <x, y>` is equal to `||x - y||^2 / 2`, which does not suffer from cancellation for close points
+            norm_x = np.linalg.norm(x, axis=2, keepdims=True)
+            norm_y = np.linalg.norm(y, axis=2, keepdims=True)
+            diff = y / np.where(norm_y > 0., norm_y, 1.) - x / np.where(norm_x > 0., norm_x, 1.)
+            dist = 0.5 * np.einsum('ijk,ijk->ij', diff, diff)
+            # Zero vectors have a cosine distance of 1 to every point
+            dist[np.logical_or(norm_x[:, :, 0] <= 0., norm_y[:, :, 0] <= 0.)] = 1.
+            return np.clip(dist, 0., 2.)
+        else:
+            diff = y - x
+            return np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
@@ -1,6 +1,7 @@
 """
 Class for construction of a K nearest neighbors index with support for custom distance metrics and
-shared nearest neighbors (SNN) distance.
+shared nearest neighbors (SNN) distance, a class-partitioned exact KNN index, and a cache of KNN indices that are
+reused across overlapping data sets (e.g. cross-validation folds).
 
 USAGE:
 ```
@@ -9,22 +10,64 @@ from knn_index import KNNIndex
 index = KNNIndex(data, **kwargs)
 nn_indices, nn_distances = index.query(data_test, k=5)
 
+# Approximate search using an inverted file index instead of NN-descent
+index = KNNIndex(data, backend='ivf', backend_kwargs={'nprobe': 16})
+
+# Add and remove points without rebuilding the index
+ids_new = index.add(data_new)
+index.remove(ids_new)
+
+# Exact nearest neighbors within each class in a single pass. The results have shape `(n, n_classes, k)`
+index = PartitionedKNNIndex(data, [np.where(labels == c)[0] for c in labels_unique], n_neighbors=5)
+nn_indices, nn_distances = index.query(data_test)
+
+# Reuse the KNN graph across the training sets of cross-validation folds
+cache = KNNGraphCache()
+index = cache.get_index(layer, data_fold, n_neighbors=5)
+
+# Save the index to a directory and load it back with the arrays memory-mapped
+index.save(path)
+index = KNNIndex.load(path, mmap=True)
+
 ```
 """
+import os
+import sys
+import json
+import copy
+import logging
+import hashlib
+from collections import OrderedDict
 import numpy as np
 from pynndescent import NNDescent
+from pynndescent.distances import named_distances
 from sklearn.neighbors import NearestNeighbors
-from helpers.metrics_custom import (
-    distance_SNN,
-    remove_self_neighbors
+from sklearn import config_context
+from scipy.sparse import csr_matrix
+from numba import njit, prange
+import helpers.metrics_custom as metrics_custom
+from helpers.knn_exact import (
+    ExactNearestNeighbors,
+    METRICS_EXACT_KNN
+)
+from helpers.knn_ivf import (
+    IVFIndex,
+    METRICS_IVF
 )
+from helpers.knn_pq import ProductQuantizer
+from helpers.knn_snn import SNNIndex
+from helpers.metrics_custom import remove_self_neighbors
 from helpers.utils import get_num_jobs
 from helpers.constants import (
     NEIGHBORHOOD_CONST,
     MIN_N_NEIGHBORS,
     RHO,
     SEED_DEFAULT,
-    METRIC_DEF
+    METRIC_DEF,
+    QUERY_CACHE_MB,
+    GRAPH_CACHE_NEIGHBORS_FACTOR,
+    PQ_SUBSPACE_DIM,
+    PQ_RERANK_FACTOR
 )
 import warnings
 from numba import NumbaPendingDeprecationWarning
@@ -32,6 +75,415 @@ from numba import NumbaPendingDeprecationWarning
 # Suppress numba warnings
 warnings.filterwarnings('ignore', '', NumbaPendingDeprecationWarning)
 
+logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+logger = logging.getLogger(__name__)
+
+
+# Version of the on-disk format written by `KNNIndex.save`
+KNN_INDEX_FORMAT_VERSION = 1
+KNN_INDEX_HEADER_FILE = 'header.json'
+
+# Backends for the approximate nearest neighbor search
+KNN_BACKENDS = ['nndescent', 'ivf']
+
+# Factor by which the number of neighbors queried for the points added to an approximate index is increased. The
+# additional neighbors are used to update the nearest neighbors of the existing points
+ADD_REVERSE_FACTOR = 3
+
+
+def metric_to_name(metric):
+    """
+    Name used to save a distance metric in the header of a saved KNN index. Metrics specified by a string are
+    saved as is. Callable metrics are supported only if they are defined in `helpers.metrics_custom`.
+    """
+    if not callable(metric):
+        return metric
+
+    name = getattr(metric, '__name__', None)
+    if (name is None) or (getattr(metrics_custom, name, None) is not metric):
+        raise ValueError("Callable metric '{}' is not defined in 'helpers.metrics_custom' and cannot be saved.".
+                         format(name))
+
+    return 'metrics_custom.' + name
+
+
+def metric_from_name(name):
+    """
+    Inverse of the function `metric_to_name`.
+    """
+    if name.startswith('metrics_custom.'):
+        return getattr(metrics_custom, name.split('.', 1)[1])
+    else:
+        return name
+
+
+def metric_kwargs_from_json(metric_kwargs):
+    # JSON does not have tuples. Numba compiled metrics expect tuples in place of lists (e.g. for the shape)
+    if metric_kwargs is None:
+        return None
+
+    return {k: (tuple(v) if isinstance(v, list) else v) for k, v in metric_kwargs.items()}
+
+
+def save_array(direc, name, arr):
+    """
+    Save a numpy array to the file `<name>.npy` in the directory `direc`, and return the file name.
+    """
+    fname = name + '.npy'
+    np.save(os.path.join(direc, fname), np.ascontiguousarray(arr), allow_pickle=False)
+    return fname
+
+
+def load_array(direc, fname, mmap_mode):
+    return np.load(os.path.join(direc, fname), mmap_mode=mmap_mode, allow_pickle=False)
+
+
+def save_nndescent(index, direc):
+    """
+    Save the state of a `pynndescent.NNDescent` object that is required for querying. This includes the data
+    matrix, the neighbor graph, the search graph, and the random projection trees that initialize the search.
+
+    :param index: `NNDescent` object.
+    :param direc: directory where the arrays are saved.
+
+    :return: dict with the metadata and the file names of the saved arrays.
+    """
+    if getattr(index, '_is_sparse', False):
+        raise ValueError("Saving a KNN index built on sparse data is not supported.")
+
+    # The search graph is otherwise created lazily by the first query
+    index._init_search_graph()
+    meta = {
+        'type': 'nndescent',
+        'metric': metric_to_name(index.metric),
+        'metric_kwds': index.metric_kwds,
+        'n_neighbors': int(index.n_neighbors),
+        'dim': int(index.dim),
+        'prune_level': index.prune_level,
+        'tree_init': bool(index.tree_init),
+        'angular_trees': bool(index._angular_trees),
+        'n_samples': int(index._raw_data.shape[0]),
+        'arrays': {
+            'data': save_array(direc, 'data', index._raw_data),
+            'neighbor_graph_indices': save_array(direc, 'neighbor_graph_indices', index._neighbor_graph[0]),
+            'neighbor_graph_distances': save_array(direc, 'neighbor_graph_distances', index._neighbor_graph[1]),
+            'search_graph_indptr': save_array(direc, 'search_graph_indptr', index._search_graph.indptr),
+            'search_graph_indices': save_array(direc, 'search_graph_indices', index._search_graph.indices),
+            'search_graph_data': save_array(direc, 'search_graph_data', index._search_graph.data),
+            'rng_state': save_array(direc, 'rng_state', index.rng_state)
+        },
+        'rp_forest': None
+    }
+    if index._rp_forest is not None:
+        # Each tree is a named tuple of arrays (and possibly scalars, depending on the version of `pynndescent`)
+        meta['rp_forest'] = []
+        for t, tree in enumerate(index._rp_forest):
+            fields = dict()
+            for name, val in zip(tree._fields, tree):
+                if isinstance(val, np.ndarray):
+                    fields[name] = {'array': save_array(direc, 'rp_tree_{:d}_{}'.format(t, name), val)}
+                else:
+                    fields[name] = {'value': val}
+
+            meta['rp_forest'].append(fields)
+
+    return meta
+
+
+def load_nndescent(meta, direc, mmap_mode):
+    """
+    Create a `pynndescent.NNDescent` object from the state saved by the function `save_nndescent`, without
+    running the NN-descent method again.
+
+    :param meta: dict with the metadata returned by `save_nndescent`.
+    :param direc: directory where the arrays are saved.
+    :param mmap_mode: `mmap_mode` argument passed to `np.load`.
+
+    :return: `NNDescent` object that can be queried.
+    """
+    from pynndescent.rp_trees import FlatTree
+
+    arrays = {k: load_array(direc, v, mmap_mode) for k, v in meta['arrays'].items()}
+    index = NNDescent.__new__(NNDescent)
+    index.metric = metric_from_name(meta['metric'])
+    index.metric_kwds = metric_kwargs_from_json(meta['metric_kwds'])
+    index.n_neighbors = meta['n_neighbors']
+    index.dim = meta['dim']
+    index.prune_level = meta['prune_level']
+    index.tree_init = meta['tree_init']
+    index._angular_trees = meta['angular_trees']
+    index._is_sparse = False
+    index._raw_data = arrays['data']
+    index._neighbor_graph = (arrays['neighbor_graph_indices'], arrays['neighbor_graph_distances'])
+    index._search_graph = csr_matrix(
+        (arrays['search_graph_data'], arrays['search_graph_indices'], arrays['search_graph_indptr']),
+        shape=(meta['n_samples'], meta['n_samples']), copy=False
+    )
+    index.rng_state = np.array(arrays['rng_state'])
+    if callable(index.metric):
+        index._distance_func = index.metric
+    else:
+        index._distance_func = named_distances[index.metric]
+
+    index._dist_args = tuple((index.metric_kwds or {}).values())
+    if meta['rp_forest'] is None:
+        index._rp_forest = None
+    else:
+        index._rp_forest = []
+        for fields in meta['rp_forest']:
+            tree = {name: (load_array(direc, v['array'], mmap_mode) if ('array' in v) else v['value'])
+                    for name, v in fields.items()}
+            index._rp_forest.append(FlatTree(**tree))
+
+    return index
+
+
+def save_exact_index(index, direc):
+    """
+    Save the state of an exact KNN index (`ExactNearestNeighbors` or `sklearn.neighbors.NearestNeighbors` with
+    brute-force search).
+
+    :param index: `ExactNearestNeighbors` or `NearestNeighbors` object.
+    :param direc: directory where the arrays are saved.
+
+    :return: dict with the metadata and the file names of the saved arrays.
+    """
+    if isinstance(index, ExactNearestNeighbors):
+        return {
+            'type': 'exact_blas',
+            'metric': index.metric,
+            'n_neighbors': int(index.n_neighbors),
+            'n_jobs': index.n_jobs,
+            'tile_mb': index.tile_mb,
+            'arrays': {'data': save_array(direc, 'data', index.data),
+                       'sq_norms': (None if index.sq_norms is None else
+                                    save_array(direc, 'sq_norms', index.sq_norms))}
+        }
+
+    return {
+        'type': 'exact',
+        'metric': metric_to_name(index.metric),
+        'metric_kwds': index.metric_params,
+        'n_neighbors': int(index.n_neighbors),
+        'n_jobs': index.n_jobs,
+        'arrays': {'data': save_array(direc, 'data', index._fit_X)}
+    }
+
+
+def load_exact_index(meta, direc, mmap_mode):
+    """
+    Create an exact KNN index from the state saved by the function `save_exact_index`. Fitting the brute-force
+    index only stores a reference to the (memory-mapped) data.
+    """
+    if meta['type'] == 'exact_blas':
+        index = ExactNearestNeighbors(n_neighbors=meta['n_neighbors'], metric=meta['metric'],
+                                      n_jobs=meta['n_jobs'], tile_mb=meta['tile_mb'])
+        # The saved data is already converted (and normalized), so it is not passed through `fit`
+        index.data = load_array(direc, meta['arrays']['data'], mmap_mode)
+        if meta['arrays']['sq_norms'] is not None:
+            index.sq_norms = load_array(direc, meta['arrays']['sq_norms'], mmap_mode)
+
+        return index
+
+    index = NearestNeighbors(
+        n_neighbors=meta['n_neighbors'],
+        algorithm='brute',
+        metric=metric_from_name(meta['metric']),
+        metric_params=metric_kwargs_from_json(meta['metric_kwds']),
+        n_jobs=meta['n_jobs']
+    )
+    return index.fit(load_array(direc, meta['arrays']['data'], mmap_mode))
+
+
+def save_snn_index(index, direc):
+    """
+    Save the state of an `SNNIndex`.
+
+    :param index: `SNNIndex` object.
+    :param direc: directory where the arrays are saved.
+
+    :return: dict with the metadata and the file names of the saved arrays.
+    """
+    return {
+        'type': 'snn',
+        'n_neighbors': int(index.n_neighbors),
+        'n_jobs': index.n_jobs,
+        'arrays': {name: save_array(direc, name, getattr(index, name))
+                   for name in ('neighbors', 'sizes', 'inv_ptr', 'inv_ids')}
+    }
+
+
+def load_snn_index(meta, direc, mmap_mode):
+    """
+    Create an `SNNIndex` from the state saved by the function `save_snn_index`.
+    """
+    index = SNNIndex(n_neighbors=meta['n_neighbors'], n_jobs=meta['n_jobs'])
+    for name, fname in meta['arrays'].items():
+        setattr(index, name, load_array(direc, fname, mmap_mode))
+
+    return index
+
+
+def save_ivf_index(index, direc):
+    """
+    Save the state of an `IVFIndex` object, i.e. the centroids and the inverted lists, and the product quantizer
+    if compression is used.
+
+    :param index: `IVFIndex` object.
+    :param direc: directory where the arrays are saved.
+
+    :return: dict with the metadata and the file names of the saved arrays.
+    """
+    meta = {
+        'type': 'ivf',
+        'metric': index.metric,
+        'n_lists': int(index.n_lists),
+        'nprobe': int(index.nprobe),
+        'max_iter': index.max_iter,
+        'train_samples_per_list': index.train_samples_per_list,
+        'seed_rng': index.seed_rng,
+        'arrays': {
+            'centroids': save_array(direc, 'centroids', index.centroids),
+            'list_ptr': save_array(direc, 'list_ptr', index.list_ptr),
+            'list_ids': save_array(direc, 'list_ids', index.list_ids),
+            'list_data': save_array(direc, 'list_data', index.list_data)
+        },
+        'compression': index.compression,
+        'subspace_dim': index.subspace_dim,
+        'rerank_factor': index.rerank_factor,
+        'pq': None
+    }
+    if index.pq is not None:
+        pq = index.pq
+        meta['arrays']['list_codes'] = save_array(direc, 'list_codes', index.list_codes)
+        meta['pq'] = {
+            'dim': int(pq.dim),
+            'n_subspaces': int(pq.n_subspaces),
+            'n_centroids': int(pq.n_centroids),
+            'opq_iter': pq.opq_iter,
+            'kmeans_iter': pq.kmeans_iter,
+            'train_samples': pq.train_samples,
+            'seed_rng': pq.seed_rng,
+            'arrays': {
+                'codebooks': save_array(direc, 'pq_codebooks', pq.codebooks),
+                'rotation': (None if pq.rotation is None else save_array(direc, 'pq_rotation', pq.rotation))
+            }
+        }
+
+    return meta
+
+
+def load_ivf_index(meta, direc, mmap_mode):
+    """
+    Create an `IVFIndex` object from the state saved by the function `save_ivf_index`, without training the
+    coarse quantizer again.
+    """
+    index = IVFIndex(n_lists=meta['n_lists'], nprobe=meta['nprobe'], metric=meta['metric'],
+                     max_iter=meta['max_iter'], train_samples_per_list=meta['train_samples_per_list'],
+                     compression=meta.get('compression'), subspace_dim=meta.get('subspace_dim', PQ_SUBSPACE_DIM),
+                     rerank_factor=meta.get('rerank_factor', PQ_RERANK_FACTOR), seed_rng=meta['seed_rng'])
+    for name, fname in meta['arrays'].items():
+        setattr(index, name, load_array(direc, fname, mmap_mode))
+
+    meta_pq = meta.get('pq')
+    if meta_pq is not None:
+        pq = ProductQuantizer(subspace_dim=index.subspace_dim, n_centroids=meta_pq['n_centroids'],
+                              opq_iter=meta_pq['opq_iter'], kmeans_iter=meta_pq['kmeans_iter'],
+                              train_samples=meta_pq['train_samples'], seed_rng=meta_pq['seed_rng'])
+        pq.dim = meta_pq['dim']
+        pq.n_subspaces = meta_pq['n_subspaces']
+        # The codebooks and the rotation are small, and are read into memory
+        pq.codebooks = load_array(direc, meta_pq['arrays']['codebooks'], None)
+        if meta_pq['arrays']['rotation'] is not None:
+            pq.rotation = load_array(direc, meta_pq['arrays']['rotation'], None)
+
+        index.pq = pq
+        # Only the codes are held in memory. The original data used for re-ranking stays memory-mapped
+        index.list_codes = np.array(index.list_codes)
+        index.list_data = load_array(direc, meta['arrays']['list_data'], 'r')
+
+    return index
+
+
+class QueryCache:
+    """
+    Least recently used (LRU) cache of nearest neighbor query results, keyed by a hash of the contents of the
+    query data. A result stored for `k_max` neighbors is used to answer any query on the same data with
+    `k <= k_max` by slicing. The oldest entries are evicted when the total size of the cached arrays exceeds the
+    memory budget.
+    """
+    def __init__(self, max_memory_mb=QUERY_CACHE_MB):
+        """
+        :param max_memory_mb: memory budget of the cache in MB. Set to 0 to disable the cache.
+        """
+        self.max_bytes = int(max_memory_mb * (2 ** 20))
+        self.n_bytes = 0
+        self.entries = OrderedDict()
+
+    def __getstate__(self):
+        # The cached results are not saved when the KNN index is pickled
+        state = self.__dict__.copy()
+        state['n_bytes'] = 0
+        state['entries'] = OrderedDict()
+        return state
+
+    @staticmethod
+    def hash_key(data):
+        """
+        Key based on the contents, shape, and type of the query data array.
+        """
+        data = np.ascontiguousarray(data)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(str((data.shape, data.dtype.str)).encode())
+        h.update(data.view(np.uint8).reshape(-1))
+        return h.hexdigest()
+
+    def get(self, key, k):
+        """
+        Get the cached result for `k` neighbors. Returns `None` if there is no cached result with at least `k`
+        neighbors.
+        """
+        val = self.entries.get(key)
+        if (val is None) or (val[0].shape[1] < k):
+            return None
+
+        self.entries.move_to_end(key)
+        # Copies are returned so that the cached arrays are not modified by the caller
+        return val[0][:, :k].copy(), val[1][:, :k].copy()
+
+    def put(self, key, nn_indices, nn_distances):
+        if self.max_bytes <= 0:
+            return
+
+        sz = nn_indices.nbytes + nn_distances.nbytes
+        if sz > self.max_bytes:
+            return
+
+        val = self.entries.pop(key, None)
+        if val is not None:
+            self.n_bytes -= (val[0].nbytes + val[1].nbytes)
+
+        self.entries[key] = (nn_indices.copy(), nn_distances.copy())
+        self.n_bytes += sz
+        while self.n_bytes > self.max_bytes:
+            _, val = self.entries.popitem(last=False)
+            self.n_bytes -= (val[0].nbytes + val[1].nbytes)
+
+    def clear(self):
+        self.entries.clear()
+        self.n_bytes = 0
+
+
+def default_query_cache_mb(query_cache_mb, approx_nearest_neighbors):
+    """
+    Memory budget in MB of the query cache of a KNN index. If `query_cache_mb` is None, the cache is enabled with
+    the budget `QUERY_CACHE_MB` only for the exact search.
+    """
+    if query_cache_mb is not None:
+        return query_cache_mb
+
+    return 0 if approx_nearest_neighbors else QUERY_CACHE_MB
+
 
 def helper_knn_distance(indices1, indices2, distances2):
     """
@@ -48,6 +500,196 @@ def helper_knn_distance(indices1, indices2, distances2):
     return np.array([ind_dist_map.get(i, val_def) for i in indices1])
 
 
+@njit
+def merge_neighbors(nn_indices, nn_distances, rows, cand_indices, cand_distances):
+    """
+    Merge candidate neighbors into the sorted nearest neighbor lists of the given rows (in-place). Candidates that
+    are invalid (index -1), equal to the row itself, already in the list, or farther than the current `k`-th
+    neighbor are skipped. Rows may repeat, so this is not parallelized.
+
+    :param nn_indices: integer numpy array of shape `(N, k)`. Missing neighbors have index -1 and are placed at
+                       the end of the row.
+    :param nn_distances: float numpy array of shape `(N, k)`, with `inf` for the missing neighbors.
+    :param rows: integer numpy array of shape `(n, )` with the rows to update.
+    :param cand_indices: integer numpy array of shape `(n, m)` with the candidate neighbors of each row.
+    :param cand_distances: float numpy array of shape `(n, m)` with the candidate distances.
+
+    :return: number of candidates inserted.
+    """
+    k = nn_indices.shape[1]
+    n_ins = 0
+    for r in range(rows.shape[0]):
+        i = rows[r]
+        for a in range(cand_indices.shape[1]):
+            c = cand_indices[r, a]
+            d = cand_distances[r, a]
+            if (c < 0) or (c == i) or (not (d < nn_distances[i, k - 1])):
+                continue
+
+            dup = False
+            for b in range(k):
+                if nn_indices[i, b] == c:
+                    dup = True
+                    break
+
+            if dup:
+                continue
+
+            # Shift the farther neighbors to the right and insert the candidate
+            j = k - 1
+            while (j > 0) and (nn_distances[i, j - 1] > d):
+                nn_indices[i, j] = nn_indices[i, j - 1]
+                nn_distances[i, j] = nn_distances[i, j - 1]
+                j -= 1
+
+            nn_indices[i, j] = c
+            nn_distances[i, j] = d
+            n_ins += 1
+
+    return n_ins
+
+
+def make_local_join(dist):
+    """
+    Create a numba function that runs a local join (as in the NN-descent method) for a given distance function.
+    For each row, the neighbors of its neighbors are compared to the row, and the closer ones are merged into its
+    nearest neighbor list.
+
+    :param dist: numba distance function with the signature `dist(x, y, *dist_args)`.
+    :return: numba function `local_join(data, nn_indices, nn_distances, rows, dist_args)` that updates the
+             nearest neighbor lists of `rows` in-place.
+    """
+    @njit(parallel=True)
+    def local_join(data, nn_indices, nn_distances, rows, dist_args):
+        n, k = rows.shape[0], nn_indices.shape[1]
+        # Read the neighbors of neighbors from a copy so that the rows updated in parallel are not read
+        nn_indices_old = nn_indices.copy()
+        for r in prange(n):
+            i = rows[r]
+            for t in range(k * k):
+                j = nn_indices_old[i, t // k]
+                if j < 0:
+                    continue
+
+                c = nn_indices_old[j, t % k]
+                if (c < 0) or (c == i):
+                    continue
+
+                dup = False
+                for b in range(k):
+                    if nn_indices[i, b] == c:
+                        dup = True
+                        break
+
+                if dup:
+                    continue
+
+                d = dist(data[i], data[c], *dist_args)
+                if not (d < nn_distances[i, k - 1]):
+                    continue
+
+                b = k - 1
+                while (b > 0) and (nn_distances[i, b - 1] > d):
+                    nn_indices[i, b] = nn_indices[i, b - 1]
+                    nn_distances[i, b] = nn_distances[i, b - 1]
+                    b -= 1
+
+                nn_indices[i, b] = c
+                nn_distances[i, b] = d
+
+    return local_join
+
+
+# Compiled local join functions keyed by the distance function
+LOCAL_JOIN_FUNCTIONS = {}
+
+
+def nndescent_local_join(index, nn_indices, nn_distances, rows):
+    """
+    Local join on the data of an `NNDescent` index using its distance function. See `make_local_join`.
+    """
+    func = LOCAL_JOIN_FUNCTIONS.get(index._distance_func)
+    if func is None:
+        func = LOCAL_JOIN_FUNCTIONS[index._distance_func] = make_local_join(index._distance_func)
+
+    func(index._raw_data, nn_indices, nn_distances, np.asarray(rows, dtype=np.int64), index._dist_args)
+
+
+def compact_neighbors(nn_indices, nn_distances):
+    """
+    Move the missing neighbors (index -1) to the end of each row, with their distance set to `inf`.
+    """
+    mask = nn_indices < 0
+    nn_distances[mask] = np.inf
+    order = np.argsort(mask, axis=1, kind='stable')
+    return np.take_along_axis(nn_indices, order, axis=1), np.take_along_axis(nn_distances, order, axis=1)
+
+
+def index_data(index, rows):
+    """
+    Data points with the given row indices stored in a KNN index (approximate or exact).
+    """
+    if isinstance(index, NNDescent):
+        return np.asarray(index._raw_data[rows, :])
+    elif isinstance(index, IVFIndex):
+        return index.get_data(rows)
+    elif isinstance(index, ExactNearestNeighbors):
+        return np.asarray(index.data[rows, :])
+    else:
+        return np.asarray(index._fit_X[rows, :])
+
+
+def insert_into_index(index, data):
+    """
+    Append new data points to a KNN index. The new points are assigned the indices following the existing ones.
+    For an `NNDescent` index, only the data is updated. Its neighbor graph should be updated separately
+    (see `KNNIndex.add`).
+    """
+    if isinstance(index, NNDescent):
+        index._raw_data = np.concatenate([index._raw_data, np.asarray(data, dtype=index._raw_data.dtype)])
+    elif isinstance(index, (IVFIndex, ExactNearestNeighbors)):
+        index.add(data)
+    else:
+        index.fit(np.concatenate([index._fit_X, data]))
+
+
+def select_from_index(index, rows):
+    """
+    Keep only the data points with the given indices in a KNN index. Point `rows[i]` is re-indexed to `i`. For an
+    `NNDescent` index, the indices in the leaves of the random projection trees are also updated. Its neighbor graph
+    should be updated separately (see `KNNIndex.remove`).
+
+    :param index: KNN index.
+    :param rows: integer numpy array with the indices of the points to keep.
+    :return: None
+    """
+    if isinstance(index, NNDescent):
+        if index._rp_forest is not None:
+            # Map the old indices to the new ones. Removed points are mapped to -1, which marks an empty slot in
+            # the tree leaves
+            id_map = -1 * np.ones(index._raw_data.shape[0] + 1, dtype=np.int64)
+            id_map[rows] = np.arange(len(rows))
+            index._rp_forest = [tree._replace(indices=id_map[tree.indices].astype(tree.indices.dtype))
+                                for tree in index._rp_forest]
+
+        index._raw_data = np.ascontiguousarray(index._raw_data[rows, :])
+    elif isinstance(index, (IVFIndex, ExactNearestNeighbors)):
+        index.select(rows)
+    else:
+        index.fit(index._fit_X[rows, :])
+
+
+def exact_index_like(index, data):
+    """
+    Exact KNN index with the same metric as `index` built on the given data.
+    """
+    if isinstance(index, ExactNearestNeighbors):
+        return ExactNearestNeighbors(n_neighbors=index.n_neighbors, metric=index.metric, n_jobs=index.n_jobs,
+                                     tile_mb=index.tile_mb).fit(data)
+    else:
+        return NearestNeighbors(**index.get_params()).fit(data)
+
+
 class KNNIndex:
     """
     Class for construction of a K nearest neighbors index with support for custom distance metrics and
@@ -58,8 +700,11 @@ class KNNIndex:
                  metric=METRIC_DEF, metric_kwargs=None,
                  shared_nearest_neighbors=False,
                  approx_nearest_neighbors=True,
+                 backend='nndescent',
+                 backend_kwargs=None,
                  n_jobs=1,
                  low_memory=False,
+                 query_cache_mb=None,
                  seed_rng=SEED_DEFAULT):
         """
         :param data: numpy array with the data samples. Has shape `(N, d)`, where `N` is the number of samples and
@@ -80,9 +725,28 @@ class KNNIndex:
         :param approx_nearest_neighbors: Set to True in order to use an approximate nearest neighbor algorithm to
                                          find the nearest neighbors. This is recommended when the number of points is
                                          large and/or when the dimension of the data is high.
+        :param backend: backend used for the approximate nearest neighbor search. Should be one of
+                        `KNN_BACKENDS`. This is used only if `approx_nearest_neighbors` is True. The options are:
+                        - 'nndescent': graph-based search using the `NN-descent` method.
+                        - 'ivf': inverted file index (see `helpers.knn_ivf.IVFIndex`), which supports the cosine
+                          and euclidean metrics. It is faster to build on large data sets. If the SNN distance is
+                          used, only the index based on the primary distance metric uses this backend.
+        :param backend_kwargs: optional keyword arguments of the backend specified in the form of a dictionary.
+                               For the 'ivf' backend, these are the arguments of `IVFIndex`. The arguments
+                               `n_lists`, `nprobe`, `max_iter`, and `train_samples_per_list` trade off recall for
+                               speed. Setting `compression` to 'pq' or 'opq' stores the data as product
+                               quantization codes (with the original data memory-mapped for exact re-ranking),
+                               which greatly reduces the memory used by the index.
         :param n_jobs: Number of parallel jobs or processes. Set to -1 to use all the available cpu cores.
         :param low_memory: Set to True to enable the low memory option of the `NN-descent` method. Note that this
                            is likely to increase the running time.
+        :param query_cache_mb: None or the memory budget in MB for caching the results of the `query` method. If
+                               positive, repeated queries on the same data with the same or a smaller number of
+                               neighbors are answered from the cache. The budget applies to each index separately,
+                               and the value 0 disables the cache. By default (None), the budget is
+                               `QUERY_CACHE_MB` for the exact search, whose results are deterministic, and the cache
+                               is disabled for the approximate search. The approximate (NN-descent) search is
+                               randomized, so a cached result can differ from the result of repeating the search.
         :param seed_rng: int value specifying the seed for the random number generator.
         """
         self.neighborhood_constant = neighborhood_constant
@@ -91,9 +755,21 @@ class KNNIndex:
         self.metric_kwargs = metric_kwargs
         self.shared_nearest_neighbors = shared_nearest_neighbors
         self.approx_nearest_neighbors = approx_nearest_neighbors
+        self.backend = backend
+        self.backend_kwargs = backend_kwargs
         self.n_jobs = get_num_jobs(n_jobs)
         self.low_memory = low_memory
         self.seed_rng = seed_rng
+        self.query_cache = QueryCache(max_memory_mb=default_query_cache_mb(query_cache_mb,
+                                                                           self.approx_nearest_neighbors))
+        if self.backend not in KNN_BACKENDS:
+            raise ValueError("Invalid value '{}' for the input 'backend'. Supported values are: {}".
+                             format(self.backend, ', '.join(KNN_BACKENDS)))
+
+        if self.approx_nearest_neighbors and (self.backend == 'ivf'):
+            if (self.metric not in METRICS_IVF) or self.metric_kwargs:
+                raise ValueError("Backend 'ivf' does not support the metric '{}'. Supported metrics are: {}".
+                                 format(self.metric, ', '.join(METRICS_IVF)))
 
         N, d = data.shape
         if self.n_neighbors is None:
@@ -127,7 +803,11 @@ class KNNIndex:
             k = max(1 + self.n_neighbors, min_n_neighbors)
 
         # KNN index based on the primary distance metric
-        if self.approx_nearest_neighbors:
+        if self.approx_nearest_neighbors and (self.backend == 'ivf'):
+            index_knn_primary = IVFIndex(metric=self.metric, seed_rng=self.seed_rng,
+                                         **(self.backend_kwargs or {})).fit(data)
+            self.nn_indices, self.nn_distances = remove_self_neighbors(*index_knn_primary.query(data, k=k))
+        elif self.approx_nearest_neighbors:
             params = {
                 'metric': self.metric,
                 'metric_kwds': self.metric_kwargs,
@@ -143,13 +823,18 @@ class KNNIndex:
                                                                        index_knn_primary._neighbor_graph[1])
         else:
             # Exact KNN graph
-            index_knn_primary = NearestNeighbors(
-                n_neighbors=k,
-                algorithm='brute',
-                metric=self.metric,
-                metric_params=self.metric_kwargs,
-                n_jobs=self.n_jobs
-            )
+            if (self.metric in METRICS_EXACT_KNN) and (not self.metric_kwargs):
+                # Exact search based on matrix multiplication for the cosine and euclidean metrics
+                index_knn_primary = ExactNearestNeighbors(n_neighbors=k, metric=self.metric, n_jobs=self.n_jobs)
+            else:
+                index_knn_primary = NearestNeighbors(
+                    n_neighbors=k,
+                    algorithm='brute',
+                    metric=self.metric,
+                    metric_params=self.metric_kwargs,
+                    n_jobs=self.n_jobs
+                )
+
             index_knn_primary.fit(data)
 
             self.nn_indices, self.nn_distances = remove_self_neighbors(
@@ -157,42 +842,126 @@ class KNNIndex:
             )
 
         if self.shared_nearest_neighbors:
-            # Construct a second KNN index that uses the shared nearest neighbor distance
+            # Construct a second KNN index that uses the shared nearest neighbor distance. The search is exact and
+            # is based on the inverted graph of the primary nearest neighbors
             data_neighbors = self.nn_indices[:, 0:self.n_neighbors_snn]
-            if self.approx_nearest_neighbors:
-                params = {
-                    'metric': distance_SNN,
-                    'n_neighbors': max(1 + self.n_neighbors, min_n_neighbors),
-                    'rho': rho,
-                    'random_state': self.seed_rng,
-                    'n_jobs': self.n_jobs,
-                    'low_memory': self.low_memory
-                }
-                index_knn_secondary = NNDescent(data_neighbors, **params)
-
-                # Save the nearest neighbor information of the data used to build the KNN index
-                self.nn_indices, self.nn_distances = remove_self_neighbors(index_knn_secondary._neighbor_graph[0],
-                                                                           index_knn_secondary._neighbor_graph[1])
-            else:
-                index_knn_secondary = NearestNeighbors(
-                    n_neighbors=(1 + self.n_neighbors),
-                    algorithm='brute',
-                    metric=distance_SNN,
-                    n_jobs=self.n_jobs
-                )
-                index_knn_secondary.fit(data_neighbors)
-
-                # Save the nearest neighbor information of the data used to build the KNN index
-                self.nn_indices, self.nn_distances = remove_self_neighbors(
-                    *self._query(data_neighbors, index_knn_secondary, 1 + self.n_neighbors)
-                )
+            k = max(1 + self.n_neighbors, min_n_neighbors)
+            index_knn_secondary = SNNIndex(n_neighbors=k, n_jobs=self.n_jobs).fit(data_neighbors)
 
+            # Save the nearest neighbor information of the data used to build the KNN index
+            self.nn_indices, self.nn_distances = remove_self_neighbors(*index_knn_secondary.query(data_neighbors, k=k))
             index_knn = [index_knn_primary, index_knn_secondary]
         else:
             index_knn = [index_knn_primary]
 
         return index_knn
 
+    def save(self, path):
+        """
+        Save the KNN index to the directory `path`, which is created if it does not exist. All the arrays (data
+        matrix, neighbor graph, search graph, and search tree arrays) are saved as raw `.npy` files, and the
+        parameters are saved to a small JSON header file. Use the method `load` to load the saved index.
+
+        :param path: directory path.
+        :return: None
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        header = {
+            'format_version': KNN_INDEX_FORMAT_VERSION,
+            'params': {
+                'neighborhood_constant': self.neighborhood_constant,
+                'n_neighbors': int(self.n_neighbors),
+                'n_neighbors_snn': int(self.n_neighbors_snn),
+                'metric': metric_to_name(self.metric),
+                'metric_kwargs': self.metric_kwargs,
+                'shared_nearest_neighbors': self.shared_nearest_neighbors,
+                'approx_nearest_neighbors': self.approx_nearest_neighbors,
+                'backend': self.backend,
+                'backend_kwargs': self.backend_kwargs,
+                'n_jobs': self.n_jobs,
+                'low_memory': self.low_memory,
+                'query_cache_mb': self.query_cache.max_bytes / float(2 ** 20),
+                'seed_rng': self.seed_rng
+            },
+            'arrays': {
+                'nn_indices': save_array(path, 'nn_indices', self.nn_indices),
+                'nn_distances': save_array(path, 'nn_distances', self.nn_distances)
+            },
+            'indices': []
+        }
+        for j, index in enumerate(self.index_knn):
+            direc = os.path.join(path, 'index_{:d}'.format(j))
+            if not os.path.isdir(direc):
+                os.makedirs(direc)
+
+            if isinstance(index, NNDescent):
+                header['indices'].append(save_nndescent(index, direc))
+            elif isinstance(index, IVFIndex):
+                header['indices'].append(save_ivf_index(index, direc))
+            elif isinstance(index, SNNIndex):
+                header['indices'].append(save_snn_index(index, direc))
+            else:
+                header['indices'].append(save_exact_index(index, direc))
+
+        with open(os.path.join(path, KNN_INDEX_HEADER_FILE), 'w') as fp:
+            json.dump(header, fp, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a KNN index saved by the method `save`. Neighbor graph construction is not repeated.
+
+        :param path: directory path.
+        :param mmap: Set to True in order to memory-map the arrays in read-only mode instead of reading them into
+                     memory. The data is then paged in lazily as it is accessed, and the pages can be shared by
+                     multiple processes that load the same index.
+
+        :return: `KNNIndex` object.
+        """
+        with open(os.path.join(path, KNN_INDEX_HEADER_FILE), 'r') as fp:
+            header = json.load(fp)
+
+        if header.get('format_version') != KNN_INDEX_FORMAT_VERSION:
+            raise ValueError("Unsupported format version '{}' of the saved KNN index.".
+                             format(header.get('format_version')))
+
+        mmap_mode = 'r' if mmap else None
+        params = header['params']
+        obj = cls.__new__(cls)
+        obj.neighborhood_constant = params['neighborhood_constant']
+        obj.n_neighbors = params['n_neighbors']
+        obj.n_neighbors_snn = params['n_neighbors_snn']
+        obj.metric = metric_from_name(params['metric'])
+        obj.metric_kwargs = metric_kwargs_from_json(params['metric_kwargs'])
+        obj.shared_nearest_neighbors = params['shared_nearest_neighbors']
+        obj.approx_nearest_neighbors = params['approx_nearest_neighbors']
+        obj.backend = params.get('backend', 'nndescent')
+        obj.backend_kwargs = params.get('backend_kwargs')
+        obj.n_jobs = params['n_jobs']
+        obj.low_memory = params['low_memory']
+        obj.seed_rng = params['seed_rng']
+        obj.query_cache = QueryCache(max_memory_mb=default_query_cache_mb(params.get('query_cache_mb'),
+                                                                          obj.approx_nearest_neighbors))
+        # The neighbors of the indexed points are small compared to the data. They are read into memory because the
+        # numba functions with explicit signatures (e.g. `neighbors_label_counts`) do not accept read-only arrays
+        obj.nn_indices = load_array(path, header['arrays']['nn_indices'], None)
+        obj.nn_distances = load_array(path, header['arrays']['nn_distances'], None)
+        obj.index_knn = []
+        for j, meta in enumerate(header['indices']):
+            direc = os.path.join(path, 'index_{:d}'.format(j))
+            if meta['type'] == 'nndescent':
+                obj.index_knn.append(load_nndescent(meta, direc, mmap_mode))
+            elif meta['type'] == 'ivf':
+                obj.index_knn.append(load_ivf_index(meta, direc, mmap_mode))
+            elif meta['type'] == 'snn':
+                obj.index_knn.append(load_snn_index(meta, direc, mmap_mode))
+            else:
+                obj.index_knn.append(load_exact_index(meta, direc, mmap_mode))
+
+        return obj
+
     def query_self(self, rows=None, k=None):
         """
         Query the nearest neighbors of the points used to construct the KNN index. The index of the points whose
@@ -212,14 +981,19 @@ class KNNIndex:
         else:
             return self.nn_indices[rows, :k], self.nn_distances[rows, :k]
 
-    def query(self, data, k=None):
+    def query(self, data, k=None, max_memory_mb=None):
         """
-        Query for the `k` nearest neighbors of each point in `data`.
+        Query for the `k` nearest neighbors of each point in `data`. If the query cache is enabled (see the
+        argument `query_cache_mb`), a repeated query on the same data with the same or a smaller `k` does not
+        repeat the search.
 
         :param data: numpy data array of shape `(N, d)`, where `N` is the number of samples and `d` is the number
                      of dimensions (features).
         :param k: number of nearest neighbors to query. If not specified or set to `None`, `k` will be
                   set to `self.n_neighbors`.
+        :param max_memory_mb: None or a memory budget in MB for the intermediate arrays of the search. If specified,
+                              the data is queried in chunks of rows (see `query_iter`) and the results are written
+                              into preallocated output arrays. If `None`, all the rows are queried in one call.
 
         :return: (nn_indices, nn_distances), where
             - nn_indices: numpy array of indices of the nearest neighbors. Has shape `(data.shape[0], k)`.
@@ -228,6 +1002,324 @@ class KNNIndex:
         if k is None:
             k = self.n_neighbors
 
+        use_cache = self.query_cache.max_bytes > 0
+        if use_cache:
+            key = QueryCache.hash_key(data)
+            res = self.query_cache.get(key, k)
+            if res is not None:
+                return res
+
+        if max_memory_mb is None:
+            nn_indices, nn_distances = self._search(data, k)
+        else:
+            # Query in chunks of rows and write the results into preallocated arrays
+            n = data.shape[0]
+            nn_indices = nn_distances = None
+            start = 0
+            for ind_chunk, dist_chunk in self.query_iter(data, k=k, max_memory_mb=max_memory_mb):
+                if nn_indices is None:
+                    nn_indices = np.empty((n, k), dtype=ind_chunk.dtype)
+                    nn_distances = np.empty((n, k), dtype=dist_chunk.dtype)
+
+                end = start + ind_chunk.shape[0]
+                nn_indices[start:end, :] = ind_chunk
+                nn_distances[start:end, :] = dist_chunk
+                start = end
+
+            if nn_indices is None:
+                # No rows in the query data
+                nn_indices, nn_distances = self._search(data, k)
+
+        if use_cache:
+            self.query_cache.put(key, nn_indices, nn_distances)
+
+        return nn_indices, nn_distances
+
+    def query_iter(self, data, k=None, chunk_rows=None, max_memory_mb=None):
+        """
+        Generator that queries the `k` nearest neighbors of the points in `data` in chunks of rows, so that the
+        memory used by the search is bounded. The results are not cached.
+
+        :param data: numpy data array of shape `(N, d)`, where `N` is the number of samples and `d` is the number
+                     of dimensions (features). This can also be a memory-mapped array.
+        :param k: number of nearest neighbors to query. If not specified or set to `None`, `k` will be
+                  set to `self.n_neighbors`.
+        :param chunk_rows: None or an int value specifying the number of rows in each chunk. If `None`, this is
+                           set based on `max_memory_mb`.
+        :param max_memory_mb: None or a memory budget in MB for the intermediate arrays of the search. It is used
+                              to set the number of rows per chunk (if `chunk_rows` is not specified), and it is
+                              also passed as the working memory to scikit-learn for the exact search. If both
+                              `chunk_rows` and `max_memory_mb` are `None`, all the rows are queried in one chunk.
+
+        :return: yields a tuple `(nn_indices, nn_distances)` for each chunk of consecutive rows, where
+            - nn_indices: numpy array of indices of the nearest neighbors. Has shape `(n_chunk, k)`.
+            - nn_distances: numpy array of distances of the nearest neighbors. Has shape `(n_chunk, k)`.
+        """
+        if k is None:
+            k = self.n_neighbors
+
+        n = data.shape[0]
+        if chunk_rows is None:
+            if max_memory_mb is None:
+                chunk_rows = n
+            else:
+                chunk_rows = int(max_memory_mb * (2 ** 20) / self._bytes_per_query_row(data.shape[1], k))
+
+        chunk_rows = max(1, chunk_rows)
+        for start in range(0, n, chunk_rows):
+            data_chunk = np.asarray(data[start:(start + chunk_rows)])
+            if (max_memory_mb is not None) and (not self.approx_nearest_neighbors):
+                # The chunk is searched inside the context, but it is yielded after leaving it, so that the global
+                # scikit-learn configuration of the caller is not changed between the chunks
+                with config_context(working_memory=max_memory_mb):
+                    result = self._search(data_chunk, k)
+            else:
+                result = self._search(data_chunk, k)
+
+            yield result
+
+    def add(self, data):
+        """
+        Add new points to the KNN index without rebuilding it. The new points are assigned the indices
+        `N, N + 1, . . .`, where `N` is the current number of indexed points. The nearest neighbors of the new points
+        are found by querying the index, and the nearest neighbors of the existing points are updated with the new
+        points (exactly if `approx_nearest_neighbors` is False). For the 'nndescent' backend, the neighbor graph is
+        updated using local joins as in the `NN-descent` method. The results of `query_self` are updated accordingly.
+
+        :param data: numpy data array of shape `(n, d)` with the new points.
+        :return: numpy array with the indices of the new points.
+        """
+        if self.shared_nearest_neighbors:
+            raise ValueError("Adding points is not supported with the shared nearest neighbors (SNN) distance.")
+
+        index = self.index_knn[0]
+        N, k = self.nn_indices.shape
+        n = data.shape[0]
+        ids_new = np.arange(N, N + n)
+        nn_indices = np.concatenate([self.nn_indices, -1 * np.ones((n, k), dtype=self.nn_indices.dtype)])
+        nn_distances = np.concatenate([self.nn_distances, np.full((n, k), np.inf, dtype=self.nn_distances.dtype)])
+        if isinstance(index, NNDescent):
+            # Neighbors of the new points among the existing points. A larger number of neighbors is queried for
+            # the reverse update, since the nearest neighbor relation is not symmetric
+            ind, dist = self._query(data, index, min(ADD_REVERSE_FACTOR * k, N))
+            merge_neighbors(nn_indices, nn_distances, ids_new, ind, dist)
+            insert_into_index(index, data)
+            self._merge_reverse(nn_indices, nn_distances, ids_new, ind, dist)
+            # Local joins on the new points, their neighbors, and the existing points that have a new point as a
+            # neighbor (reverse neighbors). This finds the new points that are neighbors of each other, and the
+            # existing points whose new neighbors were missed by the reverse update. The other points are not
+            # affected by the new points
+            rows = np.union1d(ids_new, nn_indices[ids_new, :].ravel())
+            rows = np.union1d(rows, np.where(np.any(nn_indices[:N, :] >= N, axis=1))[0])
+            nndescent_local_join(index, nn_indices, nn_distances, rows[rows >= 0])
+            self._merge_reverse(nn_indices, nn_distances, ids_new, nn_indices[ids_new, :], nn_distances[ids_new, :])
+            # Points that still have missing neighbors are queried on the updated search graph
+            self._refill_neighbors(nn_indices, nn_distances, np.where(nn_indices[:, -1] < 0)[0])
+        else:
+            insert_into_index(index, data)
+            # The new points are part of the index, so one extra neighbor is queried. For the approximate search, a
+            # larger number of neighbors is queried for the reverse update
+            k_query = (ADD_REVERSE_FACTOR * k) if self.approx_nearest_neighbors else k
+            ind, dist = self._query(data, index, min(k_query, N + n - 1) + 1)
+            merge_neighbors(nn_indices, nn_distances, ids_new, ind, dist)
+            if self.approx_nearest_neighbors:
+                self._merge_reverse(nn_indices, nn_distances, ids_new, ind, dist)
+            else:
+                # Exact neighbors of the existing points among the new points
+                ind, dist = self._query(index_data(index, np.arange(N)), exact_index_like(index, data), min(k, n))
+                merge_neighbors(nn_indices, nn_distances, np.arange(N), ind + N, dist)
+
+        self.nn_indices, self.nn_distances = nn_indices, nn_distances
+        self._update_graph()
+        self.query_cache.clear()
+        return ids_new
+
+    def remove(self, ids):
+        """
+        Remove points from the KNN index without rebuilding it. The remaining points are re-indexed to
+        `0, 1, . . .` preserving their order. Points that lose some of their nearest neighbors are queried again
+        to find replacements. For the 'nndescent' backend, this is done using local joins as in the `NN-descent`
+        method. The results of `query_self` are updated accordingly.
+
+        :param ids: integer numpy array with the indices of the points to remove, or a boolean numpy array of
+                    shape `(N, )` that is True for the points to remove.
+        :return: numpy array of shape `(N, )` that maps the old indices to the new ones. Removed points are
+                 mapped to -1.
+        """
+        if self.shared_nearest_neighbors:
+            raise ValueError("Removing points is not supported with the shared nearest neighbors (SNN) distance.")
+
+        N = self.nn_indices.shape[0]
+        mask_keep = np.ones(N, dtype=np.bool_)
+        mask_keep[ids] = False
+        return self._select(np.where(mask_keep)[0])
+
+    def subset(self, rows, n_neighbors=None):
+        """
+        KNN index on a subset of the indexed points, obtained by restricting the nearest neighbor graph to the
+        subset instead of building the index from scratch. Points that lose some of their nearest neighbors are
+        queried again as in the method `remove`. The current KNN index is not modified.
+
+        :param rows: integer numpy array with the indices of the points in the subset. Point `rows[i]` has the
+                     index `i` in the new KNN index.
+        :param n_neighbors: None or an int value specifying the number of nearest neighbors of the new KNN index. It
+                            cannot be larger than the number of neighbors of the current KNN index. If `None`, the
+                            number of neighbors is not changed.
+
+        :return: `KNNIndex` object.
+        """
+        if self.shared_nearest_neighbors:
+            raise ValueError("Subset of the index is not supported with the shared nearest neighbors (SNN) "
+                             "distance.")
+
+        rows = np.asarray(rows, dtype=np.int64)
+        if np.unique(rows).shape[0] < rows.shape[0]:
+            raise ValueError("Input 'rows' should not have repeated values.")
+
+        if n_neighbors is None:
+            n_neighbors = self.n_neighbors
+
+        # Number of neighbors in the graph as in `build_knn_index`
+        k = max(1 + n_neighbors, MIN_N_NEIGHBORS) - 1
+        if k > self.nn_indices.shape[1]:
+            raise ValueError("Number of neighbors {:d} of the subset is larger than that of the KNN index.".
+                             format(n_neighbors))
+
+        obj = copy.copy(self)
+        obj.index_knn = [copy.copy(index) for index in self.index_knn]
+        if isinstance(obj.index_knn[0], NNDescent):
+            # The random state is updated in-place by the queries
+            obj.index_knn[0].rng_state = obj.index_knn[0].rng_state.copy()
+        elif isinstance(obj.index_knn[0], IVFIndex):
+            # Do not overwrite the memory-mapped data file of the current index
+            obj.index_knn[0].data_path = None
+
+        obj.n_neighbors = n_neighbors
+        obj.n_neighbors_snn = min(int(1.2 * n_neighbors), rows.shape[0] - 1)
+        obj.query_cache = QueryCache(max_memory_mb=self.query_cache.max_bytes / float(2 ** 20))
+        obj._select(rows, k=k)
+        return obj
+
+    def _select(self, rows, k=None):
+        """
+        Keep only the indexed points with the given indices, and update their nearest neighbors. Point `rows[i]`
+        is re-indexed to `i`.
+
+        :param rows: integer numpy array with the indices of the points to keep.
+        :param k: None or an int value specifying the number of nearest neighbors to keep per point. If `None`, this
+                  is not changed.
+
+        :return: numpy array of shape `(N, )` that maps the old indices to the new ones. Removed points are
+                 mapped to -1.
+        """
+        index = self.index_knn[0]
+        N = self.nn_indices.shape[0]
+        if k is None:
+            k = self.nn_indices.shape[1]
+
+        if len(rows) <= k:
+            raise ValueError("Number of remaining points should be larger than the number of neighbors {:d}.".
+                             format(k))
+
+        id_map = -1 * np.ones(N, dtype=np.int64)
+        id_map[rows] = np.arange(len(rows))
+        nn_indices, nn_distances = compact_neighbors(
+            id_map[self.nn_indices[rows, :]].astype(self.nn_indices.dtype),
+            self.nn_distances[rows, :].copy()
+        )
+        nn_indices = np.ascontiguousarray(nn_indices[:, :k])
+        nn_distances = np.ascontiguousarray(nn_distances[:, :k])
+        # Points that lost at least one neighbor
+        rows_update = np.where(nn_indices[:, -1] < 0)[0]
+        select_from_index(index, rows)
+        if isinstance(index, NNDescent):
+            nndescent_local_join(index, nn_indices, nn_distances, rows_update)
+            rows_update = rows_update[nn_indices[rows_update, -1] < 0]
+
+        self._refill_neighbors(nn_indices, nn_distances, rows_update)
+
+        self.nn_indices, self.nn_distances = nn_indices, nn_distances
+        self._update_graph()
+        self.query_cache.clear()
+        return id_map
+
+    def _refill_neighbors(self, nn_indices, nn_distances, rows):
+        """
+        Find the missing nearest neighbors of the given indexed points by querying the index, and merge them into
+        `nn_indices` and `nn_distances` in-place. For an `NNDescent` index, the search graph is first rebuilt from
+        the updated neighbor graph, so each query is a graph search instead of a scan over all the points.
+
+        :param nn_indices: integer numpy array of shape `(N, k)` with the nearest neighbors of the indexed points.
+        :param nn_distances: float numpy array of shape `(N, k)` with the nearest neighbor distances.
+        :param rows: integer numpy array with the indices of the points to update.
+        :return: None
+        """
+        if rows.size == 0:
+            return
+
+        index = self.index_knn[0]
+        if isinstance(index, NNDescent):
+            self.nn_indices, self.nn_distances = nn_indices, nn_distances
+            self._update_graph()
+
+        # The points are part of the index, so one extra neighbor is queried
+        ind, dist = self._query(index_data(index, rows), index, nn_indices.shape[1] + 1)
+        merge_neighbors(nn_indices, nn_distances, rows, ind, dist)
+
+    @staticmethod
+    def _merge_reverse(nn_indices, nn_distances, ids, ind, dist):
+        """
+        Reverse update of the nearest neighbors: the point `ids[i]` is a candidate neighbor of each point
+        in `ind[i, :]`.
+        """
+        ind = ind.ravel()
+        mask = ind >= 0
+        merge_neighbors(nn_indices, nn_distances, ind[mask], np.repeat(ids, dist.shape[1])[mask, np.newaxis],
+                        dist.reshape(-1, 1)[mask, :])
+
+    def _update_graph(self):
+        """
+        Update the neighbor graph of an `NNDescent` index from the nearest neighbors of the indexed points. The
+        search graph is then rebuilt from the neighbor graph by the next query.
+        """
+        index = self.index_knn[0]
+        if not isinstance(index, NNDescent):
+            return
+
+        ind, dist = index._neighbor_graph
+        n = self.nn_indices.shape[0]
+        index._neighbor_graph = (
+            np.hstack([np.arange(n)[:, np.newaxis], self.nn_indices]).astype(ind.dtype),
+            np.hstack([np.zeros((n, 1)), self.nn_distances]).astype(dist.dtype)
+        )
+        if hasattr(index, '_search_graph'):
+            del index._search_graph
+
+    def _bytes_per_query_row(self, dim, k):
+        """
+        Rough estimate of the memory used per query row. The exact search calculates a row of distances to all
+        the indexed points. The approximate search keeps a candidate queue that grows with `k`.
+        """
+        n_index = self.nn_indices.shape[0]
+        if self.approx_nearest_neighbors:
+            # `NNDescent.query` uses a queue of size `5 k` by default
+            sz = dim + 3 * 5 * max(k, self.n_neighbors_snn)
+            if isinstance(self.index_knn[0], IVFIndex):
+                # Distances to the centroids of the inverted lists
+                sz += self.index_knn[0].n_lists
+        else:
+            sz = dim + n_index
+
+        if self.shared_nearest_neighbors:
+            sz += self.n_neighbors_snn
+
+        return 8 * sz
+
+    def _search(self, data, k):
+        """
+        Search for the `k` nearest neighbors of each point in `data` using the primary index, or the primary and
+        the secondary index if the SNN distance is used.
+        """
         if self.shared_nearest_neighbors:
             data_neighbors, _ = self._query(data, self.index_knn[0], self.n_neighbors_snn)
             return self._query(data_neighbors, self.index_knn[1], k)
@@ -254,3 +1346,258 @@ class KNNIndex:
             nn_distances, nn_indices = index.kneighbors(data, n_neighbors=k)
 
         return nn_indices, nn_distances
+
+
+def use_partitioned_index(partitioned_index, metric, metric_kwargs, approx_nearest_neighbors,
+                          shared_nearest_neighbors=False):
+    """
+    Check if a single `PartitionedKNNIndex` should be used for class-conditional nearest neighbor queries instead of
+    a separate KNN index per class.
+
+    :param partitioned_index: None or a bool value. If `None`, the partitioned index is used when the search is
+                              exact and the settings are supported.
+    :param metric: distance metric.
+    :param metric_kwargs: keyword arguments of the distance metric.
+    :param approx_nearest_neighbors: True if approximate nearest neighbor search is used.
+    :param shared_nearest_neighbors: True if the SNN distance is used.
+    :return: bool value.
+    """
+    supported = (metric in METRICS_EXACT_KNN) and (not metric_kwargs) and (not shared_nearest_neighbors)
+    if partitioned_index is None:
+        return supported and (not approx_nearest_neighbors)
+
+    if partitioned_index and (not supported):
+        raise ValueError("Partitioned KNN index requires one of the metrics {} without the SNN distance.".
+                         format(', '.join(METRICS_EXACT_KNN)))
+
+    return bool(partitioned_index)
+
+
+class PartitionedKNNIndex:
+    """
+    Exact K nearest neighbors index built once over all the samples, where each sample is tagged with the partitions
+    (e.g. its true class and its predicted class) that it belongs to. A query finds the `k` nearest neighbors of a
+    point within every partition in a single pass over the data, which replaces building and querying a separate
+    `KNNIndex` per partition. Supports the distance metrics in `METRICS_EXACT_KNN`.
+
+    NOTE: only exact search is supported. With approximate search (NN-descent or IVF), the methods still build and
+    query a separate `KNNIndex` per class.
+    """
+    def __init__(self, data, partitions,
+                 neighborhood_constant=NEIGHBORHOOD_CONST, n_neighbors=None,
+                 metric=METRIC_DEF,
+                 n_jobs=1):
+        """
+        :param data: numpy array with the data samples. Has shape `(N, d)`, where `N` is the number of samples and
+                     `d` is the number of features.
+        :param partitions: list of integer numpy arrays, where `partitions[p]` has the index of the samples (rows of
+                           `data`) in partition `p`. The partitions can overlap and need not cover all the samples.
+        :param neighborhood_constant: float value in (0, 1), that specifies the number of nearest neighbors as a
+                                      function of the number of samples in the largest partition.
+        :param n_neighbors: None or int value specifying the number of nearest neighbors. If this value is specified,
+                            the `neighborhood_constant` is ignored.
+        :param metric: string that specifies the distance metric. Should be one of `METRICS_EXACT_KNN`.
+        :param n_jobs: Number of parallel jobs or processes. Set to -1 to use all the available cpu cores.
+        """
+        if metric not in METRICS_EXACT_KNN:
+            raise ValueError("Metric '{}' is not supported. Supported metrics are: {}".
+                             format(metric, ', '.join(METRICS_EXACT_KNN)))
+
+        N = data.shape[0]
+        self.n_partitions = len(partitions)
+        self.partition_sizes = np.array([len(ind) for ind in partitions], dtype=np.int64)
+        self.neighborhood_constant = neighborhood_constant
+        self.n_neighbors = n_neighbors
+        if self.n_neighbors is None:
+            self.n_neighbors = int(np.ceil(np.max(self.partition_sizes) ** self.neighborhood_constant))
+
+        self.metric = metric
+        self.n_jobs = get_num_jobs(n_jobs)
+        # Partitions of each sample in compressed sparse row format. The partitions of sample `j` are given by
+        # `member_part[member_ptr[j]:member_ptr[j + 1]]`
+        rows = np.concatenate([np.asarray(ind, dtype=np.int64) for ind in partitions])
+        parts = np.repeat(np.arange(self.n_partitions, dtype=np.int64), self.partition_sizes)
+        order = np.argsort(rows, kind='mergesort')
+        self.member_part = parts[order]
+        self.member_ptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=N))]).astype(np.int64)
+        self.index_knn = ExactNearestNeighbors(n_neighbors=self.n_neighbors, metric=self.metric,
+                                               n_jobs=self.n_jobs).fit(data)
+
+    def query(self, data, k=None):
+        """
+        Query for the `k` nearest neighbors of each point in `data` within each partition.
+
+        :param data: numpy data array of shape `(n, d)`, where `n` is the number of samples and `d` is the number
+                     of dimensions (features).
+        :param k: number of nearest neighbors to query. If not specified or set to `None`, `k` will be
+                  set to `self.n_neighbors`.
+
+        :return: (nn_indices, nn_distances), where
+            - nn_indices: numpy array of indices of the nearest neighbors. Has shape `(n, n_partitions, k)`. The
+                          indices refer to the rows of the data used to build the index.
+            - nn_distances: numpy array of distances of the nearest neighbors. Has shape `(n, n_partitions, k)`.
+            Partitions with less than `k` samples are padded with the index -1 and the distance `np.inf`.
+        """
+        return self._query(data, k, False)
+
+    def query_self(self, k=None):
+        """
+        Query for the `k` nearest neighbors within each partition of every sample used to build the index. Each
+        sample is excluded from its own set of neighbors.
+
+        :param k: None or an int value specifying the number of neighbors. If `None`, `self.n_neighbors` is used.
+        :return: Same as the method `query`, with `n = N`.
+        """
+        return self._query(self.index_knn.data, k, True)
+
+    def _query(self, data, k, exclude_self):
+        if k is None:
+            k = self.n_neighbors
+
+        nn_distances, nn_indices = self.index_knn.kneighbors_partitioned(
+            data, self.member_ptr, self.member_part, self.n_partitions, k, exclude_self=exclude_self
+        )
+        return nn_indices, nn_distances
+
+    def save(self, path):
+        """
+        Save the index to the directory `path`, which is created if it does not exist. The format is the same as
+        that of `KNNIndex.save`. Use the method `load` to load the saved index.
+
+        :param path: directory path.
+        :return: None
+        """
+        direc = os.path.join(path, 'index_0')
+        if not os.path.isdir(direc):
+            os.makedirs(direc)
+
+        header = {
+            'format_version': KNN_INDEX_FORMAT_VERSION,
+            'params': {
+                'neighborhood_constant': self.neighborhood_constant,
+                'n_neighbors': int(self.n_neighbors),
+                'metric': self.metric,
+                'n_jobs': self.n_jobs
+            },
+            'arrays': {
+                'partition_sizes': save_array(path, 'partition_sizes', self.partition_sizes),
+                'member_part': save_array(path, 'member_part', self.member_part),
+                'member_ptr': save_array(path, 'member_ptr', self.member_ptr)
+            },
+            'indices': [save_exact_index(self.index_knn, direc)]
+        }
+        with open(os.path.join(path, KNN_INDEX_HEADER_FILE), 'w') as fp:
+            json.dump(header, fp, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load an index saved by the method `save`.
+
+        :param path: directory path.
+        :param mmap: Set to True in order to memory-map the data in read-only mode instead of reading it into memory.
+        :return: `PartitionedKNNIndex` object.
+        """
+        with open(os.path.join(path, KNN_INDEX_HEADER_FILE), 'r') as fp:
+            header = json.load(fp)
+
+        if header.get('format_version') != KNN_INDEX_FORMAT_VERSION:
+            raise ValueError("Unsupported format version '{}' of the saved KNN index.".
+                             format(header.get('format_version')))
+
+        params = header['params']
+        obj = cls.__new__(cls)
+        obj.neighborhood_constant = params['neighborhood_constant']
+        obj.n_neighbors = params['n_neighbors']
+        obj.metric = params['metric']
+        obj.n_jobs = params['n_jobs']
+        obj.partition_sizes = load_array(path, header['arrays']['partition_sizes'], None)
+        obj.n_partitions = obj.partition_sizes.shape[0]
+        obj.member_part = load_array(path, header['arrays']['member_part'], None)
+        obj.member_ptr = load_array(path, header['arrays']['member_ptr'], None)
+        obj.index_knn = load_exact_index(header['indices'][0], os.path.join(path, 'index_0'),
+                                         'r' if mmap else None)
+        return obj
+
+
+class KNNGraphCache:
+    """
+    Cache of KNN indices that are reused across data sets with a large overlap, e.g. the training sets of the
+    cross-validation folds. The indices are identified by a key (e.g. the layer and the class), and the data points
+    are identified by a hash of their contents. A KNN index requested for a data set is obtained by restricting the
+    cached index to the matching points (see `KNNIndex.subset`), after adding any new points to the cached index
+    (see `KNNIndex.add`). Only the points that lose some of their nearest neighbors are searched again, which is much
+    faster than building the index (in particular the NN-descent graph) from scratch. After a few folds, the cached
+    index covers the full data set.
+    """
+    # Parameters of `KNNIndex` that can differ between the cached index and the requested index
+    params_ignore = ('neighborhood_constant', 'n_neighbors', 'n_jobs', 'query_cache_mb')
+
+    def __init__(self):
+        # dict mapping the key to a tuple `(index, params, row_map)`, where `row_map` maps the hash of a data point
+        # to its row in the cached index
+        self.entries = dict()
+
+    def __getstate__(self):
+        # The cached indices are not pickled with the objects that use the cache
+        state = self.__dict__.copy()
+        state['entries'] = dict()
+        return state
+
+    @staticmethod
+    def hash_rows(data):
+        """
+        Hash of the contents of each row of the data array.
+        """
+        data = np.ascontiguousarray(data)
+        return [hashlib.blake2b(row.view(np.uint8), digest_size=16).digest() for row in data]
+
+    def get_index(self, key, data, **kwargs):
+        """
+        Get a KNN index for the given data, using the cached index for `key` if possible. Otherwise, a new KNN index
+        is built and cached.
+
+        :param key: hashable key of the KNN index.
+        :param data: numpy data array of shape `(N, d)`, where `N` is the number of samples and `d` is the number
+                     of dimensions (features).
+        :param kwargs: keyword arguments of `KNNIndex`.
+
+        :return: `KNNIndex` object.
+        """
+        N = data.shape[0]
+        hashes = self.hash_rows(data)
+        params = {k: v for k, v in kwargs.items() if k not in self.params_ignore}
+        n_neighbors = kwargs.get('n_neighbors')
+        if n_neighbors is None:
+            n_neighbors = int(np.ceil(N ** kwargs.get('neighborhood_constant', NEIGHBORHOOD_CONST)))
+
+        entry = self.entries.get(key)
+        if (entry is not None) and (entry[1] == params):
+            index, _, row_map = entry
+            rows = np.array([row_map.get(h, -1) for h in hashes], dtype=np.int64)
+            mask_new = rows < 0
+            try:
+                if np.any(mask_new):
+                    # Add the new points to the cached index
+                    rows[mask_new] = index.add(data[mask_new, :])
+                    row_map.update((hashes[i], rows[i]) for i in np.where(mask_new)[0])
+
+                index_sub = index.subset(rows, n_neighbors=n_neighbors)
+                logger.info("Restricted the cached KNN index with {:d} points to {:d} points ({:d} new).".
+                            format(index.nn_indices.shape[0], N, int(np.sum(mask_new))))
+                return index_sub
+            except ValueError as e:
+                logger.info("Cannot use the cached KNN index ({}). Building a new index.".format(e))
+
+        if kwargs.get('shared_nearest_neighbors', False) or (len(set(hashes)) < N):
+            return KNNIndex(data, **kwargs)
+
+        # The cached graph has extra neighbors, so that the graph restricted to a subset is mostly complete and only
+        # a few points have to be searched again. This holds for the exact search as well
+        kwargs_cache = kwargs.copy()
+        kwargs_cache['n_neighbors'] = int(np.ceil(GRAPH_CACHE_NEIGHBORS_FACTOR * n_neighbors))
+
+        # The cached index is not returned, so that it is not modified by the caller
+        index = KNNIndex(data, **kwargs_cache)
+        self.entries[key] = (index, params, dict(zip(hashes, range(N))))
+        return index.subset(np.arange(N), n_neighbors=n_neighbors)
@@ -0,0 +1,520 @@
+"""
+Approximate K nearest neighbors search based on an inverted file (IVF) index for the cosine and euclidean distance
+metrics.
+
+The data is partitioned by a coarse quantizer that is trained using mini-batch k-means on a subset of the data.
+Each data point is assigned to the inverted list of its nearest centroid, and the lists are stored as contiguous
+arrays. A query point searches only the `nprobe` lists whose centroids are nearest to it. The number of lists and
+`nprobe` can be used to trade off recall for speed.
+
+Optionally, the data points in the inverted lists can be compressed using product quantization (PQ or OPQ). The
+lists are then searched using asymmetric distance computation on the compressed codes, and the best candidates are
+re-ranked using exact distances calculated from the original data, which is memory-mapped from a file instead of
+being held in memory.
+
+USAGE:
+```
+from helpers.knn_ivf import IVFIndex
+
+index = IVFIndex(metric='cosine', nprobe=8).fit(data)
+nn_indices, nn_distances = index.query(data_test, k=5)
+
+# Compressed index using OPQ
+index = IVFIndex(metric='cosine', compression='opq').fit(data)
+
+```
+"""
+import os
+import tempfile
+import weakref
+import numpy as np
+from numba import njit, prange
+from sklearn.cluster import MiniBatchKMeans
+from helpers.knn_pq import ProductQuantizer
+from helpers.constants import (
+    METRIC_DEF,
+    SEED_DEFAULT,
+    IVF_LISTS_CONST,
+    IVF_NPROBE,
+    IVF_TRAIN_SAMPLES_PER_LIST,
+    IVF_KMEANS_MAX_ITER,
+    EXACT_KNN_TILE_MB,
+    PQ_SUBSPACE_DIM,
+    PQ_OPQ_ITER,
+    PQ_RERANK_FACTOR,
+    FASTMATH_FLAGS
+)
+
+# Distance metrics supported by the class `IVFIndex`
+METRICS_IVF = ['cosine', 'euclidean']
+# Compression methods supported by the class `IVFIndex`
+COMPRESSION_IVF = ['pq', 'opq']
+
+
+@njit(fastmath=FASTMATH_FLAGS)
+def distance_score(x, y, cosine):
+    """
+    Score that is monotonically increasing in the distance between the vectors `x` and `y`: the cosine distance
+    (for vectors normalized to unit length) or the squared euclidean distance.
+    """
+    s = 0.
+    if cosine:
+        for j in range(x.shape[0]):
+            s += x[j] * y[j]
+
+        return 1. - s
+    else:
+        for j in range(x.shape[0]):
+            diff = x[j] - y[j]
+            s += diff * diff
+
+        return s
+
+
+@njit
+def score_to_distance(v, cosine):
+    if cosine:
+        # Numerical errors can give values slightly outside the range [0, 2]
+        return min(max(v, 0.), 2.)
+    else:
+        return np.sqrt(max(v, 0.))
+
+
+@njit(parallel=True, fastmath=FASTMATH_FLAGS)
+def search_inverted_lists(data, dist_centroids, list_ptr, list_data, list_ids, cosine, nprobe, k):
+    """
+    Search the inverted lists for the `k` nearest neighbors of each query point. The lists are searched in
+    increasing order of the distance of their centroid from the query point. At least `nprobe` lists are searched,
+    and more lists are searched if needed to find `k` candidate points. The query points are processed in parallel.
+
+    :param data: numpy array with the query points. Has shape `(n, d)`.
+    :param dist_centroids: numpy array with a score that increases with the distance of each query point to each
+                           centroid. Has shape `(n, n_lists)`.
+    :param list_ptr: numpy array of shape `(n_lists + 1, )`. The points in list `l` are the rows
+                     `list_ptr[l]` to `list_ptr[l + 1] - 1` of `list_data`.
+    :param list_data: numpy array with the data points ordered by their inverted list. Has shape `(N, d)`.
+    :param list_ids: numpy array with the index of the points in `list_data`. Has shape `(N, )`.
+    :param cosine: Set to True for the cosine distance (with data normalized to unit length), and False for the
+                   euclidean distance.
+    :param nprobe: minimum number of lists searched per query point.
+    :param k: number of nearest neighbors.
+
+    :return: (nn_indices, nn_distances), where both have shape `(n, k)`.
+    """
+    n, d = data.shape
+    n_lists = dist_centroids.shape[1]
+    nn_indices = np.full((n, k), -1, dtype=np.int64)
+    nn_distances = np.full((n, k), np.inf)
+    for i in prange(n):
+        order = np.argsort(dist_centroids[i, :])
+        vals = np.full(k, np.inf)
+        inds = np.full(k, -1, dtype=np.int64)
+        n_scanned = 0
+        for t in range(n_lists):
+            if t >= nprobe and n_scanned >= k:
+                break
+
+            lst = order[t]
+            for r in range(list_ptr[lst], list_ptr[lst + 1]):
+                v = distance_score(data[i, :], list_data[r, :], cosine)
+                if v < vals[k - 1]:
+                    # Insertion into the sorted buffer of the `k` nearest candidates
+                    u = k - 1
+                    while u > 0 and vals[u - 1] > v:
+                        vals[u] = vals[u - 1]
+                        inds[u] = inds[u - 1]
+                        u -= 1
+
+                    vals[u] = v
+                    inds[u] = r
+
+            n_scanned += list_ptr[lst + 1] - list_ptr[lst]
+
+        for u in range(k):
+            if inds[u] < 0:
+                break
+
+            nn_indices[i, u] = list_ids[inds[u]]
+            nn_distances[i, u] = score_to_distance(vals[u], cosine)
+
+    return nn_indices, nn_distances
+
+
+@njit(parallel=True, fastmath=FASTMATH_FLAGS)
+def search_inverted_lists_pq(tables, dist_centroids, list_ptr, list_codes, nprobe, n_cand):
+    """
+    Search the inverted lists of product quantization codes for the `n_cand` nearest candidates of each query
+    point using asymmetric distance computation. The lists are probed in the same way as in the function
+    `search_inverted_lists`.
+
+    :param tables: numpy array of distance lookup tables with shape `(n, m, ks)`. See the method
+                   `ProductQuantizer.distance_tables`.
+    :param dist_centroids: numpy array with a score that increases with the distance of each query point to each
+                           centroid. Has shape `(n, n_lists)`.
+    :param list_ptr: numpy array of shape `(n_lists + 1, )` with the start of each list.
+    :param list_codes: numpy array of codes with shape `(N, m)`, ordered by the inverted list.
+    :param nprobe: minimum number of lists searched per query point.
+    :param n_cand: number of candidates per query point.
+
+    :return: numpy array with the position of the candidates in the inverted lists (i.e. rows of `list_codes`).
+             Has shape `(n, n_cand)`. Missing candidates are set to -1.
+    """
+    n, m, _ = tables.shape
+    n_lists = dist_centroids.shape[1]
+    ind_cand = np.full((n, n_cand), -1, dtype=np.int64)
+    for i in prange(n):
+        order = np.argsort(dist_centroids[i, :])
+        vals = np.full(n_cand, np.inf)
+        inds = np.full(n_cand, -1, dtype=np.int64)
+        n_scanned = 0
+        for t in range(n_lists):
+            if t >= nprobe and n_scanned >= n_cand:
+                break
+
+            lst = order[t]
+            for r in range(list_ptr[lst], list_ptr[lst + 1]):
+                v = 0.
+                for j in range(m):
+                    v += tables[i, j, list_codes[r, j]]
+
+                if v < vals[n_cand - 1]:
+                    u = n_cand - 1
+                    while u > 0 and vals[u - 1] > v:
+                        vals[u] = vals[u - 1]
+                        inds[u] = inds[u - 1]
+                        u -= 1
+
+                    vals[u] = v
+                    inds[u] = r
+
+            n_scanned += list_ptr[lst + 1] - list_ptr[lst]
+
+        ind_cand[i, :] = inds
+
+    return ind_cand
+
+
+@njit(parallel=True, fastmath=FASTMATH_FLAGS)
+def rerank_candidates(data, list_data, list_ids, ind_cand, cosine, k):
+    """
+    Select the `k` nearest neighbors of each query point from its candidates using exact distances.
+
+    :param data: numpy array with the query points. Has shape `(n, d)`.
+    :param list_data: numpy array with the data points ordered by their inverted list. Has shape `(N, d)`.
+    :param list_ids: numpy array with the index of the points in `list_data`. Has shape `(N, )`.
+    :param ind_cand: numpy array with the candidates (rows of `list_data`) of each query point. Has shape
+                     `(n, n_cand)`, where `n_cand >= k`.
+    :param cosine: Set to True for the cosine distance, and False for the euclidean distance.
+    :param k: number of nearest neighbors.
+
+    :return: (nn_indices, nn_distances), where both have shape `(n, k)`.
+    """
+    n, n_cand = ind_cand.shape
+    nn_indices = np.full((n, k), -1, dtype=np.int64)
+    nn_distances = np.full((n, k), np.inf)
+    for i in prange(n):
+        vals = np.full(n_cand, np.inf)
+        for u in range(n_cand):
+            if ind_cand[i, u] >= 0:
+                vals[u] = distance_score(data[i, :], list_data[ind_cand[i, u], :], cosine)
+
+        order = np.argsort(vals)
+        for u in range(k):
+            r = ind_cand[i, order[u]]
+            if r < 0:
+                break
+
+            nn_indices[i, u] = list_ids[r]
+            nn_distances[i, u] = score_to_distance(vals[order[u]], cosine)
+
+    return nn_indices, nn_distances
+
+
+def memory_map_array(arr, path=None, owner=None):
+    """
+    Save an array to a `.npy` file and return it memory-mapped in read-only mode.
+
+    :param arr: numpy array.
+    :param path: None or the path of the `.npy` file. If `None`, a temporary file is used, which is deleted when
+                 the array (and the object `owner`) is no longer in use.
+    :param owner: object whose lifetime the temporary file is tied to, in case the file cannot be deleted while
+                  it is memory-mapped.
+
+    :return: numpy array memory-mapped from the file.
+    """
+    if path is not None:
+        # Write to a temporary file and replace the existing file (if any), so that arrays memory-mapped from the
+        # existing file remain valid
+        path_temp = path + '.tmp'
+        with open(path_temp, 'wb') as fp:
+            np.save(fp, arr, allow_pickle=False)
+
+        os.replace(path_temp, path)
+        return np.load(path, mmap_mode='r', allow_pickle=False)
+
+    fd, path = tempfile.mkstemp(suffix='.npy')
+    os.close(fd)
+    np.save(path, arr, allow_pickle=False)
+    arr_mmap = np.load(path, mmap_mode='r', allow_pickle=False)
+    try:
+        # On POSIX systems the mapping remains valid and the space is released when the array is deleted
+        os.remove(path)
+    except OSError:
+        weakref.finalize(owner if (owner is not None) else arr_mmap, os.remove, path)
+
+    return arr_mmap
+
+
+class IVFIndex:
+    """
+    Approximate K nearest neighbors search using an inverted file index with a mini-batch k-means coarse quantizer.
+    The interface of the `query` method follows that of `pynndescent.NNDescent`.
+    """
+    def __init__(self, n_lists=None, nprobe=IVF_NPROBE, metric=METRIC_DEF,
+                 max_iter=IVF_KMEANS_MAX_ITER, train_samples_per_list=IVF_TRAIN_SAMPLES_PER_LIST,
+                 compression=None, subspace_dim=PQ_SUBSPACE_DIM, rerank_factor=PQ_RERANK_FACTOR,
+                 data_path=None, seed_rng=SEED_DEFAULT):
+        """
+        :param n_lists: None or an int value specifying the number of inverted lists (k-means clusters). If `None`,
+                        this is set to `IVF_LISTS_CONST * sqrt(N)`, where `N` is the number of samples.
+        :param nprobe: number of inverted lists searched per query point. Larger values increase the recall and
+                       the search time.
+        :param metric: distance metric. Should be one of `METRICS_IVF`.
+        :param max_iter: maximum number of iterations (passes over the training samples) of mini-batch k-means.
+        :param train_samples_per_list: maximum number of training samples per inverted list used to train the
+                                       coarse quantizer. Limiting the training set size keeps the build time
+                                       roughly linear in the number of samples.
+        :param compression: None or one of `COMPRESSION_IVF`. If set to 'pq' or 'opq', the data points are
+                            stored in memory as product quantization codes with one byte per `subspace_dim`
+                            dimensions, and the original data is memory-mapped from a file for re-ranking.
+        :param subspace_dim: number of dimensions per subspace of the product quantizer.
+        :param rerank_factor: number of candidates found using the compressed codes, as a multiple of `k`, that
+                              are re-ranked using exact distances. Larger values increase the recall.
+        :param data_path: None or the path of a `.npy` file where the original data is saved when compression is
+                          used. If `None`, a temporary file is used.
+        :param seed_rng: int value specifying the seed for the random number generator.
+        """
+        if metric not in METRICS_IVF:
+            raise ValueError("Metric '{}' is not supported. Supported metrics are: {}".
+                             format(metric, ', '.join(METRICS_IVF)))
+
+        if (compression is not None) and (compression not in COMPRESSION_IVF):
+            raise ValueError("Invalid value '{}' for the input 'compression'. Supported values are: {}".
+                             format(compression, ', '.join(COMPRESSION_IVF)))
+
+        self.n_lists = n_lists
+        self.nprobe = max(1, nprobe)
+        self.metric = metric
+        self.max_iter = max_iter
+        self.train_samples_per_list = train_samples_per_list
+        self.compression = compression
+        self.subspace_dim = subspace_dim
+        self.rerank_factor = max(1, rerank_factor)
+        self.data_path = data_path
+        self.seed_rng = seed_rng
+        # Centroids of the inverted lists. Has shape `(n_lists, d)`
+        self.centroids = None
+        # Inverted lists stored as contiguous arrays. The points in list `l` are the rows
+        # `list_ptr[l]:list_ptr[l + 1]` of `list_data`, and their index in the original data is given by `list_ids`
+        self.list_ptr = None
+        self.list_ids = None
+        self.list_data = None
+        # Product quantizer and the codes of the points in `list_data`. Only used with compression
+        self.pq = None
+        self.list_codes = None
+
+    def fit(self, data):
+        """
+        :param data: numpy data array of shape `(N, d)`, where `N` is the number of samples and `d` is the number
+                     of dimensions (features).
+        :return: self
+        """
+        data = self._prepare(data)
+        N = data.shape[0]
+        if self.n_lists is None:
+            self.n_lists = int(np.ceil(IVF_LISTS_CONST * np.sqrt(N)))
+
+        self.n_lists = max(1, min(self.n_lists, N))
+        # Train the coarse quantizer on a random subset of the data
+        n_train = min(N, self.train_samples_per_list * self.n_lists)
+        np.random.seed(self.seed_rng)
+        if n_train < N:
+            data_train = data[np.random.permutation(N)[:n_train], :]
+        else:
+            data_train = data
+
+        km = MiniBatchKMeans(
+            n_clusters=self.n_lists,
+            init='k-means++',
+            max_iter=self.max_iter,
+            batch_size=min(n_train, max(1024, 4 * self.n_lists)),
+            init_size=min(n_train, 3 * self.n_lists),
+            n_init=1,
+            compute_labels=False,
+            random_state=self.seed_rng
+        )
+        km.fit(data_train)
+        self.centroids = self._prepare(km.cluster_centers_)
+
+        # Assign each point to the list of its nearest centroid, and store the lists contiguously
+        labels = np.zeros(N, dtype=np.int64)
+        for start, end in self._row_tiles(N):
+            labels[start:end] = np.argmin(self._centroid_scores(data[start:end, :]), axis=1)
+
+        counts = np.bincount(labels, minlength=self.n_lists)
+        self.list_ptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.list_ids = np.argsort(labels, kind='mergesort').astype(np.int64)
+        self.list_data = np.ascontiguousarray(data[self.list_ids, :])
+        if self.compression is not None:
+            self.pq = ProductQuantizer(subspace_dim=self.subspace_dim,
+                                       opq_iter=(PQ_OPQ_ITER if self.compression == 'opq' else 0),
+                                       seed_rng=self.seed_rng).fit(data)
+            self.list_codes = np.zeros((N, self.pq.n_subspaces), dtype=np.uint8)
+            for start, end in self._row_tiles(N):
+                self.list_codes[start:end, :] = self.pq.encode(self.list_data[start:end, :])
+
+            # Only the codes are held in memory
+            self.list_data = memory_map_array(self.list_data, path=self.data_path, owner=self)
+
+        return self
+
+    def _prepare(self, data):
+        data = np.array(data, dtype=np.float32, order='C')
+        if self.metric == 'cosine':
+            norms = np.linalg.norm(data, axis=1)
+            # Zero vectors are left as is, which gives them a cosine distance of 1 to every point
+            norms[norms <= 0.] = 1.
+            data /= norms[:, np.newaxis]
+
+        return data
+
+    def _centroid_scores(self, data):
+        """
+        Score that increases with the distance of each row of `data` to each centroid. Has shape
+        `(data.shape[0], n_lists)`.
+        """
+        scores = np.dot(data, self.centroids.T)
+        if self.metric == 'cosine':
+            np.negative(scores, out=scores)
+        else:
+            # Squared euclidean distance without the constant squared norm of the query point
+            scores *= -2.
+            scores += np.einsum('ij,ij->i', self.centroids, self.centroids)[np.newaxis, :]
+
+        return scores
+
+    def _row_tiles(self, n):
+        # Tiles of rows such that the centroid scores (and distance tables) of a tile take about
+        # `EXACT_KNN_TILE_MB` MB
+        sz = self.n_lists
+        if self.pq is not None:
+            sz += self.pq.n_subspaces * self.pq.n_centroids
+
+        rows_tile = max(1, int(EXACT_KNN_TILE_MB * (2 ** 20) / (4. * sz)))
+        for start in range(0, n, rows_tile):
+            yield start, min(start + rows_tile, n)
+
+    def query(self, data, k=10):
+        """
+        Query for the `k` approximate nearest neighbors of each point in `data`.
+
+        :param data: numpy data array of shape `(n, d)`, where `n` is the number of samples and `d` is the number
+                     of dimensions (features).
+        :param k: number of nearest neighbors.
+
+        :return: (nn_indices, nn_distances), where
+            - nn_indices: numpy array of indices of the nearest neighbors. Has shape `(n, k)`.
+            - nn_distances: numpy array of distances of the nearest neighbors. Has shape `(n, k)`.
+            The neighbors of each point are sorted by increasing distance.
+        """
+        N = self.list_data.shape[0]
+        if k > N:
+            raise ValueError("Number of neighbors {:d} cannot be larger than the number of samples {:d}".
+                             format(k, N))
+
+        data = self._prepare(data)
+        n = data.shape[0]
+        cosine = (self.metric == 'cosine')
+        # `np.asarray` gives a plain array view of a memory-mapped array, which can be passed to numba
+        list_data = np.asarray(self.list_data)
+        nn_indices = np.zeros((n, k), dtype=np.int64)
+        nn_distances = np.zeros((n, k))
+        for start, end in self._row_tiles(n):
+            data_tile = data[start:end, :]
+            dist_centroids = self._centroid_scores(data_tile)
+            if self.pq is None:
+                nn_indices[start:end, :], nn_distances[start:end, :] = search_inverted_lists(
+                    data_tile, dist_centroids, self.list_ptr, list_data, self.list_ids, cosine, self.nprobe, k
+                )
+            else:
+                # Candidates based on the compressed codes, followed by re-ranking using exact distances
+                ind_cand = search_inverted_lists_pq(
+                    self.pq.distance_tables(data_tile, self.metric), dist_centroids, self.list_ptr,
+                    self.list_codes, self.nprobe, min(N, self.rerank_factor * k)
+                )
+                nn_indices[start:end, :], nn_distances[start:end, :] = rerank_candidates(
+                    data_tile, list_data, self.list_ids, ind_cand, cosine, k
+                )
+
+        return nn_indices, nn_distances
+
+    def add(self, data):
+        """
+        Add new points to the inverted lists of their nearest centroids. The coarse quantizer (and the product
+        quantizer) are not retrained. The new points are assigned the indices `N, N + 1, . . .`, where `N` is the
+        current number of points.
+
+        :param data: numpy data array of shape `(n, d)` with the new points.
+        :return: None
+        """
+        data = self._prepare(data)
+        N = self.list_ids.shape[0]
+        labels_new = np.zeros(data.shape[0], dtype=np.int64)
+        for start, end in self._row_tiles(data.shape[0]):
+            labels_new[start:end] = np.argmin(self._centroid_scores(data[start:end, :]), axis=1)
+
+        labels = np.concatenate([self._list_labels(), labels_new])
+        order = np.argsort(labels, kind='mergesort')
+        list_data = np.concatenate([np.asarray(self.list_data), data])[order, :]
+        if self.pq is not None:
+            self.list_codes = np.concatenate([self.list_codes, self.pq.encode(data)])[order, :]
+
+        self.list_ids = np.concatenate([self.list_ids, np.arange(N, N + data.shape[0], dtype=np.int64)])[order]
+        self._set_lists(labels[order], list_data)
+
+    def select(self, rows):
+        """
+        Keep only the points with the given indices in the inverted lists. Point `rows[i]` is re-indexed to `i`.
+
+        :param rows: integer numpy array with the indices of the points to keep.
+        :return: None
+        """
+        id_map = -1 * np.ones(self.list_ids.shape[0], dtype=np.int64)
+        id_map[rows] = np.arange(len(rows))
+        keep = id_map[self.list_ids] >= 0
+        labels = self._list_labels()[keep]
+        if self.pq is not None:
+            self.list_codes = self.list_codes[keep, :]
+
+        self.list_ids = id_map[self.list_ids[keep]]
+        self._set_lists(labels, np.asarray(self.list_data)[keep, :])
+
+    def get_data(self, ids):
+        """
+        Get the (normalized, single precision) data points with the given indices.
+        """
+        pos = np.zeros(self.list_ids.shape[0], dtype=np.int64)
+        pos[self.list_ids] = np.arange(self.list_ids.shape[0])
+        return np.asarray(self.list_data)[pos[ids], :]
+
+    def _list_labels(self):
+        # Inverted list of each position in `self.list_data`
+        return np.repeat(np.arange(self.n_lists, dtype=np.int64), np.diff(self.list_ptr))
+
+    def _set_lists(self, labels, list_data):
+        self.list_ptr = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=self.n_lists))]).astype(np.int64)
+        list_data = np.ascontiguousarray(list_data)
+        if self.pq is not None:
+            list_data = memory_map_array(list_data, path=self.data_path, owner=self)
+
+        self.list_data = list_data
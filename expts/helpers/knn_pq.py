@@ -0,0 +1,227 @@
+"""
+Product quantization (PQ) and optimized product quantization (OPQ) for compressing the data stored in a KNN index.
+
+The (optionally rotated) feature space is split into subspaces of `subspace_dim` dimensions, and each subspace is
+quantized using a codebook of up to 256 centroids learned by k-means. A data point is then stored using one byte per
+subspace. Distances from a query point to the encoded points are approximated using asymmetric distance computation
+(ADC), i.e. using a lookup table of the distances from the query point to the centroids of each subspace.
+OPQ additionally learns an orthogonal rotation of the features that reduces the quantization error.
+
+USAGE:
+```
+from helpers.knn_pq import ProductQuantizer
+
+pq = ProductQuantizer(subspace_dim=8, opq_iter=4).fit(data)
+codes = pq.encode(data)
+tables = pq.distance_tables(data_test, metric='euclidean')
+
+```
+"""
+import numpy as np
+from numba import njit, prange
+from helpers.constants import (
+    SEED_DEFAULT,
+    PQ_SUBSPACE_DIM,
+    PQ_NUM_CENTROIDS,
+    PQ_TRAIN_SAMPLES,
+    PQ_KMEANS_ITER,
+    EXACT_KNN_TILE_MB
+)
+
+
+def subspace_inner_products(x, codebooks):
+    """
+    Inner product of each subspace of the data points with the centroids of the subspace codebook, calculated
+    using one matrix multiplication per subspace.
+
+    :param x: numpy array of shape `(n, m * ds)`.
+    :param codebooks: numpy array of shape `(m, ks, ds)`, where `m` is the number of subspaces, `ks` is the number
+                      of centroids per subspace, and `ds` is the subspace dimension.
+
+    :return: numpy array of shape `(n, m, ks)`.
+    """
+    m, ks, ds = codebooks.shape
+    x = x.reshape(x.shape[0], m, ds).transpose(1, 0, 2)
+    return np.matmul(x, codebooks.transpose(0, 2, 1)).transpose(1, 0, 2)
+
+
+def pq_encode(x, codebooks, tile_mb=EXACT_KNN_TILE_MB):
+    """
+    Encode each subspace of the data points using the nearest centroid of the subspace codebook.
+
+    :param x: numpy array of shape `(n, m * ds)`.
+    :param codebooks: numpy array of shape `(m, ks, ds)`.
+    :param tile_mb: approximate memory in MB used for the distances of a tile of rows.
+
+    :return: numpy array of codes with type `uint8` and shape `(n, m)`.
+    """
+    n = x.shape[0]
+    m, ks, _ = codebooks.shape
+    sq_norms = np.einsum('mct,mct->mc', codebooks, codebooks)[np.newaxis, :, :]
+    codes = np.zeros((n, m), dtype=np.uint8)
+    rows_tile = max(1, int(tile_mb * (2 ** 20) / (4. * m * ks)))
+    for start in range(0, n, rows_tile):
+        end = min(start + rows_tile, n)
+        # Squared euclidean distance without the constant squared norm of the data point
+        scores = subspace_inner_products(x[start:end, :], codebooks)
+        scores *= -2.
+        scores += sq_norms
+        codes[start:end, :] = np.argmin(scores, axis=2)
+
+    return codes
+
+
+@njit(parallel=True)
+def pq_update_codebooks(data, codes, codebooks):
+    """
+    k-means update step that sets each centroid to the mean of the points assigned to it. Centroids without any
+    points are not changed. The subspaces are processed in parallel.
+    """
+    n = data.shape[0]
+    m, ks, ds = codebooks.shape
+    codebooks_new = codebooks.copy()
+    for j in prange(m):
+        sums = np.zeros((ks, ds))
+        counts = np.zeros(ks)
+        for i in range(n):
+            c = codes[i, j]
+            counts[c] += 1
+            for t in range(ds):
+                sums[c, t] += data[i, j * ds + t]
+
+        for c in range(ks):
+            if counts[c] > 0:
+                for t in range(ds):
+                    codebooks_new[j, c, t] = sums[c, t] / counts[c]
+
+    return codebooks_new
+
+
+class ProductQuantizer:
+    """
+    Product quantizer with an optional OPQ rotation of the features.
+    """
+    def __init__(self, subspace_dim=PQ_SUBSPACE_DIM, n_centroids=PQ_NUM_CENTROIDS, opq_iter=0,
+                 kmeans_iter=PQ_KMEANS_ITER, train_samples=PQ_TRAIN_SAMPLES, seed_rng=SEED_DEFAULT):
+        """
+        :param subspace_dim: number of dimensions per subspace. Smaller values give a more accurate and less
+                             compressed encoding.
+        :param n_centroids: number of centroids per subspace. Should be at most 256.
+        :param opq_iter: number of iterations used to learn the OPQ rotation. Set to 0 to disable the rotation
+                         (i.e. plain PQ). Note that the rotation matrix has size `d x d`.
+        :param kmeans_iter: number of k-means iterations used to learn the codebooks.
+        :param train_samples: maximum number of samples used for training.
+        :param seed_rng: int value specifying the seed for the random number generator.
+        """
+        if n_centroids > 256:
+            raise ValueError("Number of centroids per subspace cannot be larger than 256.")
+
+        self.subspace_dim = subspace_dim
+        self.n_centroids = n_centroids
+        self.opq_iter = opq_iter
+        self.kmeans_iter = kmeans_iter
+        self.train_samples = train_samples
+        self.seed_rng = seed_rng
+        self.dim = None
+        self.n_subspaces = None
+        # Orthogonal rotation matrix of shape `(d_pad, d_pad)` learned by OPQ, where `d_pad` is the dimension
+        # after zero padding to a multiple of `subspace_dim`. This is `None` for plain PQ
+        self.rotation = None
+        # Codebooks of shape `(n_subspaces, n_centroids, subspace_dim)`
+        self.codebooks = None
+
+    def fit(self, data):
+        """
+        :param data: numpy data array of shape `(N, d)`, where `N` is the number of samples and `d` is the number
+                     of dimensions (features).
+        :return: self
+        """
+        N, self.dim = data.shape
+        self.n_subspaces = int(np.ceil(self.dim / float(self.subspace_dim)))
+        np.random.seed(self.seed_rng)
+        if N > self.train_samples:
+            data = data[np.random.permutation(N)[:self.train_samples], :]
+
+        self.n_centroids = min(self.n_centroids, data.shape[0])
+        # Initialize the codebooks using random samples
+        self.rotation = None
+        x = self.transform(data)
+        ind = np.random.permutation(x.shape[0])[:self.n_centroids]
+        self.codebooks = np.ascontiguousarray(
+            x[ind, :].reshape(self.n_centroids, self.n_subspaces, self.subspace_dim).transpose(1, 0, 2)
+        )
+        if self.opq_iter > 0:
+            # Alternate between updating the codebooks for a fixed rotation, and updating the rotation (solution of
+            # an orthogonal Procrustes problem) for fixed codes
+            x_pad = self._pad(data).astype(np.float64)
+            self.rotation = np.eye(x_pad.shape[1], dtype=np.float32)
+            n_iter = max(1, self.kmeans_iter // 2)
+            for _ in range(self.opq_iter):
+                x = self.transform(data)
+                self._train_codebooks(x, n_iter)
+                y = self.decode(pq_encode(x, self.codebooks)).astype(np.float64)
+                u, _, vt = np.linalg.svd(np.dot(x_pad.T, y))
+                self.rotation = np.dot(u, vt).astype(np.float32)
+
+            x = self.transform(data)
+
+        self._train_codebooks(x, self.kmeans_iter)
+        return self
+
+    def _train_codebooks(self, x, n_iter):
+        for _ in range(n_iter):
+            self.codebooks = pq_update_codebooks(x, pq_encode(x, self.codebooks), self.codebooks)
+
+    def _pad(self, data):
+        d_pad = self.n_subspaces * self.subspace_dim
+        if d_pad == data.shape[1]:
+            return data
+
+        return np.hstack([data, np.zeros((data.shape[0], d_pad - data.shape[1]), dtype=data.dtype)])
+
+    def transform(self, data):
+        """
+        Zero pad the features to a multiple of the subspace dimension and apply the OPQ rotation (if any).
+        """
+        x = self._pad(np.asarray(data, dtype=np.float32))
+        if self.rotation is not None:
+            x = np.dot(x, self.rotation)
+
+        return np.ascontiguousarray(x)
+
+    def encode(self, data):
+        """
+        :param data: numpy data array of shape `(n, d)`.
+        :return: numpy array of codes with type `uint8` and shape `(n, n_subspaces)`.
+        """
+        return pq_encode(self.transform(data), self.codebooks)
+
+    def decode(self, codes):
+        """
+        Reconstruct the transformed (padded and rotated) data from the codes.
+        """
+        y = self.codebooks[np.arange(self.n_subspaces)[np.newaxis, :], codes, :]
+        return y.reshape(codes.shape[0], -1)
+
+    def distance_tables(self, data, metric):
+        """
+        Lookup tables for asymmetric distance computation. The approximate distance score between a query point
+        `i` and an encoded point with codes `c` is `sum_j tables[i, j, c[j]]`.
+
+        :param data: numpy data array of query points with shape `(n, d)`.
+        :param metric: 'euclidean' for the squared euclidean distance, or 'cosine' for the negative inner product
+                       (of data normalized to unit length).
+
+        :return: numpy array of shape `(n, n_subspaces, n_centroids)`.
+        """
+        x = self.transform(data)
+        tables = subspace_inner_products(x, self.codebooks)
+        if metric == 'cosine':
+            np.negative(tables, out=tables)
+        else:
+            tables *= -2.
+            tables += np.einsum('mct,mct->mc', self.codebooks, self.codebooks)[np.newaxis, :, :]
+            x = x.reshape(x.shape[0], self.n_subspaces, self.subspace_dim)
+            tables += np.einsum('imt,imt->im', x, x)[:, :, np.newaxis]
+
+        return np.ascontiguousarray(tables, dtype=np.float32)
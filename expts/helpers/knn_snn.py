@@ -0,0 +1,180 @@
+"""
+Nearest neighbor search based on the shared nearest neighbor (SNN) distance (see `helpers.metrics_custom.distance_SNN`).
+
+Each point is represented by the indices of its `K` nearest neighbors under a primary distance metric. Instead of
+evaluating the SNN distance with a generic nearest neighbor search, the primary neighbor graph is inverted, i.e. for
+each point `j` the list of points that have `j` as one of their neighbors is stored. The size of the neighborhood
+overlap of a query point with every other point is then accumulated by walking the inverted lists of its neighbors.
+Only the points that share at least one neighbor with the query point are visited; all the other points have the
+maximum SNN distance `pi / 2`. The search is exact (up to ties in the distance, which are broken by the index).
+
+USAGE:
+```
+from helpers.knn_snn import SNNIndex
+
+# `nn_indices` has the indices of the primary nearest neighbors of each point
+index = SNNIndex(n_neighbors=10).fit(nn_indices)
+nn_indices_snn, nn_distances_snn = index.query(nn_indices_test, k=10)
+
+```
+"""
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True)
+def snn_search(neighbors_query, neighbors, sizes, inv_ptr, inv_ids, k, n_chunks):
+    """
+    Find the `k` nearest neighbors of each query point based on the SNN distance. The query points are processed in
+    parallel chunks, and each chunk reuses an array with the overlap counts of all the points, which is reset using
+    the list of visited points.
+
+    :param neighbors_query: integer numpy array of shape `(n, s)` with the primary neighbors of the query points.
+                            Negative values are ignored.
+    :param neighbors: integer numpy array of shape `(N, s)` with the primary neighbors of the indexed points.
+    :param sizes: numpy array of shape `(N, )` with the number of primary neighbors of each indexed point.
+    :param inv_ptr: numpy array of shape `(M + 1, )`, where `M` is the number of primary points. The indexed points
+                    that have `j` as a neighbor are `inv_ids[inv_ptr[j]:inv_ptr[j + 1]]`.
+    :param inv_ids: numpy array with the inverted lists.
+    :param k: number of nearest neighbors. Should be `<= N`.
+    :param n_chunks: number of chunks of query points.
+
+    :return: (nn_indices, nn_distances), numpy arrays of shape `(n, k)` sorted by increasing distance.
+    """
+    n, s = neighbors_query.shape
+    N = neighbors.shape[0]
+    M = inv_ptr.shape[0] - 1
+    nn_indices = np.zeros((n, k), dtype=np.int64)
+    nn_distances = np.zeros((n, k))
+    dist_max = 0.5 * np.pi
+    chunk = (n + n_chunks - 1) // n_chunks
+    for t in prange(n_chunks):
+        counts = np.zeros(N, dtype=np.int32)
+        visited = np.zeros(N, dtype=np.int64)
+        vals = np.empty(k)
+        inds = np.empty(k, dtype=np.int64)
+        for i in range(t * chunk, min((t + 1) * chunk, n)):
+            # Overlap counts of the points that share at least one neighbor with the query point
+            n_visited = 0
+            s_x = 0
+            for a in range(s):
+                j = neighbors_query[i, a]
+                if (j < 0) or (j >= M):
+                    continue
+
+                s_x += 1
+                for b in range(inv_ptr[j], inv_ptr[j + 1]):
+                    c = inv_ids[b]
+                    if counts[c] == 0:
+                        visited[n_visited] = c
+                        n_visited += 1
+
+                    counts[c] += 1
+
+            # Sorted buffer of the `k` smallest distances, with ties broken by the index
+            for b in range(k):
+                vals[b] = np.inf
+                inds[b] = N
+
+            for b in range(n_visited):
+                c = visited[b]
+                cs = counts[c] / np.sqrt(s_x * sizes[c])
+                d = np.arccos(max(-1., min(1., cs)))
+                if (d < vals[k - 1]) or ((d == vals[k - 1]) and (c < inds[k - 1])):
+                    r = k - 1
+                    while (r > 0) and ((vals[r - 1] > d) or ((vals[r - 1] == d) and (inds[r - 1] > c))):
+                        vals[r] = vals[r - 1]
+                        inds[r] = inds[r - 1]
+                        r -= 1
+
+                    vals[r] = d
+                    inds[r] = c
+
+            # Fill the remaining neighbors with the points that share no neighbors, in the order of their index
+            c = 0
+            for b in range(k):
+                if inds[b] < N:
+                    continue
+
+                while counts[c] > 0:
+                    c += 1
+
+                vals[b] = dist_max
+                inds[b] = c
+                c += 1
+
+            for b in range(n_visited):
+                counts[visited[b]] = 0
+
+            nn_indices[i, :] = inds
+            nn_distances[i, :] = vals
+
+    return nn_indices, nn_distances
+
+
+class SNNIndex:
+    """
+    Exact nearest neighbor index for the SNN distance based on the inverted primary neighbor graph. It supports the
+    query interfaces of both `NNDescent` (method `query`) and `sklearn.neighbors.NearestNeighbors` (method
+    `kneighbors`), so that it can be used as the secondary index of `KNNIndex`.
+    """
+    def __init__(self, n_neighbors=10, n_jobs=1):
+        """
+        :param n_neighbors: default number of nearest neighbors to query.
+        :param n_jobs: number of parallel jobs, which is used to set the number of chunks of query points.
+        """
+        self.n_neighbors = n_neighbors
+        self.n_jobs = max(1, n_jobs)
+        # Sorted primary neighbors of shape `(N, s)`, number of primary neighbors per point, and the inverted lists
+        self.neighbors = None
+        self.sizes = None
+        self.inv_ptr = None
+        self.inv_ids = None
+
+    def fit(self, neighbors):
+        """
+        :param neighbors: integer numpy array of shape `(N, s)` with the indices of the primary nearest neighbors
+                          of each point. Negative values denote missing neighbors.
+        :return: self
+        """
+        self.neighbors = np.sort(np.asarray(neighbors), axis=1).astype(np.int32)
+        self.sizes = np.sum(self.neighbors >= 0, axis=1).astype(np.int32)
+        N, s = self.neighbors.shape
+        # Inverted lists in CSR format: sort the (neighbor, point) pairs by the neighbor
+        cols = self.neighbors.ravel()
+        rows = np.repeat(np.arange(N, dtype=np.int32), s)
+        mask = cols >= 0
+        cols, rows = cols[mask], rows[mask]
+        M = (cols.max() + 1) if cols.size else 0
+        order = np.argsort(cols, kind='mergesort')
+        self.inv_ptr = np.concatenate([[0], np.cumsum(np.bincount(cols, minlength=M))]).astype(np.int64)
+        self.inv_ids = rows[order]
+        return self
+
+    def query(self, data, k=None):
+        """
+        :param data: integer numpy array of shape `(n, s)` with the indices of the primary nearest neighbors of the
+                     query points.
+        :param k: number of nearest neighbors. Set to `self.n_neighbors` if not specified.
+
+        :return: (nn_indices, nn_distances), numpy arrays of shape `(n, k)`.
+        """
+        if k is None:
+            k = self.n_neighbors
+
+        N = self.neighbors.shape[0]
+        if k > N:
+            raise ValueError("Number of neighbors {:d} cannot be larger than the number of points {:d}.".format(k, N))
+
+        data = np.ascontiguousarray(data, dtype=np.int64)
+        n_chunks = max(1, min(data.shape[0], 4 * self.n_jobs))
+        return snn_search(data, self.neighbors, self.sizes, self.inv_ptr, self.inv_ids, k, n_chunks)
+
+    def kneighbors(self, data, n_neighbors=None):
+        """
+        Same as the method `query`, but the distances and indices are returned in the order used by scikit-learn.
+
+        :return: (nn_distances, nn_indices)
+        """
+        nn_indices, nn_distances = self.query(data, k=n_neighbors)
+        return nn_distances, nn_indices
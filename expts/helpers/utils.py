@@ -64,7 +64,142 @@ def combine_and_vectorize(data_batches):
     return data
 
 
-def extract_layer_embeddings(model, device, data_loader, method='proposed', num_samples=None):
+def allocate_layer_arrays(shapes, n_samples, memmap_dir=None, dtype=np.float32):
+    """
+    Allocate the output arrays of the layer embeddings, optionally as memory-mapped `.npy` files.
+
+    :param shapes: list with the shape of a single sample at each layer, e.g. `(d1, d2, d3)` or `(d1, )`. The
+                   shape is None for the layers that are not selected, which have no output array.
+    :param n_samples: number of samples (rows) of each array.
+    :param memmap_dir: None or the path to a directory, in which case the array of layer `i` is created as the
+                       memory-mapped file `layer_<i>.npy` in the directory.
+    :param dtype: data type of the arrays.
+    :return: list of numpy arrays (or `numpy.memmap` objects), where the i-th array has shape `(n_samples, d_i)`
+             and `d_i` is the vectorized dimension of layer `i`. The list has None for the layers that are not
+             selected.
+    """
+    if memmap_dir is not None:
+        if not os.path.isdir(memmap_dir):
+            os.makedirs(memmap_dir)
+
+    arrays = []
+    for i, sh in enumerate(shapes):
+        if sh is None:
+            # Layer that is not selected
+            arrays.append(None)
+            continue
+
+        shape = (n_samples, int(np.prod(sh)))
+        if memmap_dir is None:
+            arrays.append(np.empty(shape, dtype=dtype))
+        else:
+            arrays.append(np.lib.format.open_memmap(os.path.join(memmap_dir, 'layer_{:d}.npy'.format(i)),
+                                                    mode='w+', dtype=dtype, shape=shape))
+
+    return arrays
+
+
+def truncate_layer_arrays(arrays, n_samples, memmap_dir=None):
+    """
+    Truncate the arrays allocated by the function `allocate_layer_arrays` to their first `n_samples` rows, e.g.
+    when fewer rows than allocated were written. The memory of the unused rows is released, and the memory-mapped
+    files are replaced by files of the truncated size.
+
+    :param arrays: list of numpy arrays (or `numpy.memmap` objects) returned by `allocate_layer_arrays`. The list
+                   can have None for the layers that are not selected.
+    :param n_samples: number of rows to keep.
+    :param memmap_dir: None or the path to the directory of the memory-mapped files. Should be the same value
+                       passed to `allocate_layer_arrays`.
+    :return: list of the truncated arrays (or `numpy.memmap` objects), with None for the layers that are not
+             selected.
+    """
+    arrays_new = []
+    for i, arr in enumerate(arrays):
+        if (arr is None) or (arr.shape[0] == n_samples):
+            arrays_new.append(arr)
+            continue
+
+        if memmap_dir is None:
+            # The array owns its memory, so it can be resized in place
+            arr.resize((n_samples, arr.shape[1]), refcheck=False)
+            arrays_new.append(arr)
+        else:
+            # The rows are copied to a new file of the truncated size, which then replaces the original file
+            fname = os.path.join(memmap_dir, 'layer_{:d}.npy'.format(i))
+            fname_temp = os.path.join(memmap_dir, 'layer_{:d}_temp.npy'.format(i))
+            arr_new = np.lib.format.open_memmap(fname_temp, mode='w+', dtype=arr.dtype,
+                                                shape=(n_samples, arr.shape[1]))
+            arr_new[:] = arr[:n_samples]
+            arr_new.flush()
+            del arr_new
+            os.replace(fname_temp, fname)
+            arrays_new.append(np.load(fname, mmap_mode='r+'))
+
+    return arrays_new
+
+
+def loader_num_samples(data_loader):
+    """
+    Number of samples returned by one pass over a data loader, which accounts for its sampler and for the last
+    incomplete batch that is dropped (`drop_last = True`).
+
+    :param data_loader: torch data loader object which is an instance of `torch.utils.data.DataLoader`.
+    :return: number of samples, or None if it is not known in advance, e.g. with a custom batch sampler or an
+             iterable data set.
+    """
+    if data_loader.batch_size is None:
+        return None
+
+    try:
+        n = len(data_loader.sampler)
+    except TypeError:
+        return None
+
+    if data_loader.drop_last:
+        n = (n // data_loader.batch_size) * data_loader.batch_size
+
+    return n
+
+
+def layer_function_name(method):
+    """
+    Name of the method of the DNN model that returns the layer embeddings used by a detection method. The detection
+    methods with the same name use the same set of layers.
+    """
+    if method in ('mahalanobis', 'proposed', 'dknn', 'trust'):
+        return 'layer_wise'
+    elif method == 'odds':
+        return 'layer_wise_odds_are_odd'
+    elif method in ['lid', 'lid_class_cond']:
+        return 'layer_wise_lid_method'
+    else:
+        raise ValueError("Invalid value '{}' for input 'method'".format(method))
+
+
+def transform_models_to_tensors(transform_models, device):
+    """
+    Copy the mean vector and the projection matrix of the dimension reduction model of each layer to torch tensors
+    on the given device. The tensors stay on the device while the layer embeddings are extracted.
+
+    :param transform_models: list of model dicts, one per layer, as returned by the function
+                             `load_dimension_reduction_models`. The model dict can be None for layers that are not
+                             transformed.
+    :param device: torch device type - cuda or cpu.
+    :return: list with a tuple `(mean_data, transform)` of tensors or None for each layer.
+    """
+    tensors = []
+    for md in transform_models:
+        if md is None:
+            tensors.append(None)
+        else:
+            tensors.append((torch.as_tensor(md['mean_data'], dtype=torch.float32, device=device),
+                            torch.as_tensor(md['transform'], dtype=torch.float32, device=device)))
+
+    return tensors
+
+
+def extract_layer_embeddings(model, device, data_loader, method='proposed', num_samples=None, preallocate=True,
+                             memmap_dir=None, layers=None, predict=True, transform_models=None):
     """
     Extract the layer embeddings produced by a trained DNN model on the given data set. Also, returns the true class
     and the predicted class for each sample.
@@ -74,17 +209,63 @@ def extract_layer_embeddings(model, device, data_loader, method='proposed', num_
     :param data_loader: torch data loader object which is an instancee of `torch.utils.data.DataLoader`.
     :param method: string with the name of the proposed method. Valid choices are ['proposed', 'odds', 'lid'].
     :param num_samples: None or an int value specifying the number of samples to select.
+    :param preallocate: Set to True in order to allocate the (vectorized) output array of each layer after the
+                        first batch, with the number of rows found from the data loader (see the function
+                        `loader_num_samples`). Each batch is then written in place as float32, so the peak memory is
+                        about the size of the outputs. Set to False in order to collect the batches in lists and
+                        combine them at the end, which takes about twice the memory. This is also done if the
+                        number of samples of the data loader is not known in advance.
+    :param memmap_dir: None or the path to a directory in which the output arrays are created as memory-mapped
+                       `.npy` files (see the function `allocate_layer_arrays`). This is used only when
+                       `preallocate = True`.
+    :param layers: None or a list of layer indices (negative values follow the python indexing convention) in
+                   order to calculate only these layers. This is supported for the methods that use the
+                   `layer_wise` method of the model. The selected layers and the predictions are calculated in a
+                   single forward pass, which stops after the deepest layer that is needed. The layers that are
+                   not selected are not stored.
+    :param predict: Set to False if the predicted classes are not required. The logits are then not calculated,
+                    unless the logit layer is selected.
+    :param transform_models: None or a list of dimension reduction model dicts, one per layer (see the function
+                             `load_dimension_reduction_models`). If specified, each batch of the layer embeddings is
+                             projected in torch (in float32) as part of the extraction, and only the reduced
+                             dimension embeddings are stored. The result is the same as applying the function
+                             `transform_data_from_model` to the embeddings of each layer.
 
     :return:
         - embeddings: list of numpy arrays, one per layer, where the i-th array has shape `(N, d_i)`, `N` being
-                      the number of samples and `d_i` being the vectorized dimension of layer `i`.
+                      the number of samples and `d_i` being the vectorized dimension of layer `i`. If `layers` is
+                      specified, the list has None for the layers that are not selected.
         - labels: numpy array of class labels. Has shape `(N, )`.
-        - labels_pred: numpy array of the model-predicted class labels. Has shape `(N, )`.
+        - labels_pred: numpy array of the model-predicted class labels. Has shape `(N, )`. None if
+                       `predict = False`.
         - counts: numpy array of sample counts for each distinct class in `labels`.
     """
     if model.training:
         model.eval()
 
+    if layers is not None:
+        if layer_function_name(method) != 'layer_wise':
+            raise ValueError("Selection of layers is not supported for the method '{}'.".format(method))
+        if len(layers) == 0:
+            raise ValueError("Input 'layers' should be a non-empty list of layer indices.")
+
+    transform_tensors = None
+    if transform_models is not None:
+        if layers is not None:
+            # Only the models of the selected layers are copied to the device
+            n = len(transform_models)
+            keep = {i % n for i in layers}
+            transform_models = [md if (i in keep) else None for i, md in enumerate(transform_models)]
+
+        transform_tensors = transform_models_to_tensors(transform_models, device)
+
+    n_alloc = loader_num_samples(data_loader)
+    if n_alloc is None:
+        preallocate = False
+    elif num_samples:
+        # Batches are included until the number of samples reaches `num_samples`
+        n_alloc = min(n_alloc, int(np.ceil(num_samples / data_loader.batch_size)) * data_loader.batch_size)
+
     labels = []
     labels_pred = []
     embeddings = []
@@ -97,48 +278,83 @@ def extract_layer_embeddings(model, device, data_loader, method='proposed', num_
 
             temp = target.detach().cpu().numpy()
             labels.extend(temp)
+            st = num_samples_partial
             num_samples_partial += temp.shape[0]
             # print(batch_idx)
 
-            # Predicted class
-            outputs = model(data)
-            _, predicted = outputs.max(1)
-            labels_pred.extend(predicted.detach().cpu().numpy())
-            # Layer outputs
-            if method in ('mahalanobis', 'proposed', 'dknn', 'trust'):
-                outputs_layers = model.layer_wise(data)
-            elif method == 'odds':
-                outputs_layers = model.layer_wise_odds_are_odd(data)
-            elif method in ['lid', 'lid_class_cond']:
-                outputs_layers = model.layer_wise_lid_method(data)
-            else:
-                raise ValueError("Invalid value '{}' for input 'method'".format(method))
-
-            if batch_idx > 0:
-                for i in range(n_layers):
-                    embeddings[i].append(outputs_layers[i].detach().cpu().numpy())
+            if layers is None:
+                # Layer outputs
+                outputs_layers = getattr(model, layer_function_name(method))(data)
+                # Predicted class
+                outputs = model(data) if predict else None
             else:
+                # The last layer has the logits. It is calculated in the same forward pass if the predictions are
+                # required, but it is stored only if it is selected
+                outputs_layers = model.layer_wise(data, layers=(list(layers) + [-1]) if predict else layers)
+                outputs = outputs_layers[-1]
+                n = len(outputs_layers)
+                if (n - 1) not in {i % n for i in layers}:
+                    outputs_layers[-1] = None
+
+            if predict:
+                _, predicted = outputs.max(1)
+                labels_pred.extend(predicted.detach().cpu().numpy())
+
+            if transform_tensors is not None:
+                if len(transform_tensors) != len(outputs_layers):
+                    raise ValueError("Expecting {:d} dimension reduction models, but received {:d}.".
+                                     format(len(outputs_layers), len(transform_tensors)))
+
+                # Dimension reduction of the batch
+                outputs_layers = [v if (v is None or tt is None) else
+                                  torch.matmul(v.reshape(v.shape[0], -1) - tt[0], tt[1])
+                                  for v, tt in zip(outputs_layers, transform_tensors)]
+
+            if batch_idx == 0:
                 # First batch
                 n_layers = len(outputs_layers)
-                embeddings = [[v.detach().cpu().numpy()] for v in outputs_layers]
+                if preallocate:
+                    embeddings = allocate_layer_arrays([None if (v is None) else v.shape[1:] for v in outputs_layers],
+                                                       n_alloc, memmap_dir=memmap_dir)
+                else:
+                    embeddings = [[] for _ in range(n_layers)]
+
+            for i in range(n_layers):
+                if outputs_layers[i] is None:
+                    continue
+
+                if preallocate:
+                    # Write the vectorized batch in place
+                    embeddings[i][st:num_samples_partial, :] = \
+                        outputs_layers[i].detach().reshape(temp.shape[0], -1).cpu().numpy()
+                else:
+                    embeddings[i].append(outputs_layers[i].detach().cpu().numpy())
 
             if num_samples:
                 if num_samples_partial >= num_samples:
                     break
 
-    '''
-    `embeddings` will be a list of length equal to the number of layers.
-    `embeddings[i]` will be a list of numpy arrays corresponding to the data batches for layer `i`.
-    `embeddings[i][j]` will be an array of shape `(b, d1, d2, d3)` or `(b, d1)` where `b` is the batch size
-     and the rest are dimensions.
-    '''
-    # This takes up more memory
-    # embeddings = [combine_and_vectorize(v) for v in embeddings]
-    for i in range(n_layers):
-        embeddings[i] = combine_and_vectorize(embeddings[i])
+    if preallocate:
+        # The number of rows can be smaller than the allocated size if the data loader returns fewer samples than
+        # expected
+        embeddings = truncate_layer_arrays(embeddings, num_samples_partial, memmap_dir=memmap_dir)
+        if memmap_dir is not None:
+            for v in embeddings:
+                if v is not None:
+                    v.flush()
+    else:
+        '''
+        `embeddings` will be a list of length equal to the number of layers.
+        `embeddings[i]` will be a list of numpy arrays corresponding to the data batches for layer `i`.
+        `embeddings[i][j]` will be an array of shape `(b, d1, d2, d3)` or `(b, d1)` where `b` is the batch size
+         and the rest are dimensions.
+        '''
+        # This takes up more memory
+        # embeddings = [combine_and_vectorize(v) for v in embeddings]
+        for i in range(n_layers):
+            embeddings[i] = combine_and_vectorize(embeddings[i]) if embeddings[i] else None
 
     labels = np.array(labels, dtype=np.int)
-    labels_pred = np.array(labels_pred, dtype=np.int)
     # Unique label counts
     print("\nNumber of labeled samples per class:")
     labels_uniq, counts = np.unique(labels, return_counts=True)
@@ -148,6 +364,10 @@ def extract_layer_embeddings(model, device, data_loader, method='proposed', num_
     # if (np.max(counts) / np.min(counts)) >= 1.2:
     #    print("WARNING: classes are not balanced.")
 
+    if not predict:
+        return embeddings, labels, None, counts
+
+    labels_pred = np.array(labels_pred, dtype=np.int)
     print("\nNumber of predicted samples per class:")
     preds_uniq, counts_pred = np.unique(labels_pred, return_counts=True)
     for a, b in zip(preds_uniq, counts_pred):
@@ -159,15 +379,34 @@ def extract_layer_embeddings(model, device, data_loader, method='proposed', num_
     return embeddings, labels, labels_pred, counts
 
 
-def helper_layer_embeddings(model, device, data_loader, method, labels_orig):
+def helper_layer_embeddings(model, device, data_loader, method, labels_orig, memmap_dir=None, cache=None,
+                            layers=None, transform_models=None):
+    # If an `EmbeddingCache` is specified, the DNN is run only if the embeddings are not found in the cache
+    if cache is not None:
+        layer_set = layer_function_name(method)
+        if layers is not None:
+            layer_set = '{}_{}'.format(layer_set, '_'.join(map(str, layers)))
+
+        key = cache.make_key(data_loader, layer_set, transform_models=transform_models)
+        result = cache.load(key)
+        if result is not None:
+            return result
+
+        # The embeddings are written directly into the files of the new cache entry
+        memmap_dir = cache.temp_path(key)
+
     layer_embeddings, labels, labels_pred, _ = extract_layer_embeddings(
-        model, device, data_loader, method=method
+        model, device, data_loader, method=method, memmap_dir=memmap_dir, layers=layers,
+        transform_models=transform_models
     )
     # NOTE: `labels` returned by this function should be the same as the `labels_orig`
     if not np.array_equal(labels_orig, labels):
         raise ValueError("Class labels returned by 'extract_layer_embeddings' is different from the original "
                          "labels.")
 
+    if cache is not None:
+        return cache.save(key, memmap_dir, layer_embeddings, labels_pred)
+
     return layer_embeddings, labels_pred
 
 
@@ -200,21 +439,69 @@ def check_label_mismatch(labels, labels_pred, frac=1.0):
         print("Fraction of mismatched samples with different original and predicted labels = {:.4f}".format(d))
 
 
-def load_numpy_data(path):
-    # Utility to load clean data and labels from saved numpy files
-    data_tr = np.load(os.path.join(path, "data_tr.npy"))
+def load_numpy_data(path, mmap_mode='r'):
+    # Utility to load clean data and labels from saved numpy files.
+    # The data arrays are memory-mapped by default, so that only the rows that are used are read from the files
+    data_tr = np.load(os.path.join(path, "data_tr.npy"), mmap_mode=mmap_mode)
     labels_tr = np.load(os.path.join(path, "labels_tr.npy"))
-    data_te = np.load(os.path.join(path, "data_te.npy"))
+    data_te = np.load(os.path.join(path, "data_te.npy"), mmap_mode=mmap_mode)
     labels_te = np.load(os.path.join(path, "labels_te.npy"))
 
     return data_tr, labels_tr, data_te, labels_te
 
 
-def load_adversarial_data(path, max_n_test=None, sampling_type='ranked_by_norm', norm_type='inf', seed=SEED_DEFAULT):
+def read_rows(data, ind):
+    """
+    Read a subset of rows of a (possibly memory-mapped) numpy array into memory. The rows are read in increasing
+    order of their index, so that the reads from the file are sequential, and they are returned in the order of `ind`.
+
+    :param data: numpy array or memory-mapped array.
+    :param ind: numpy array with the row indices.
+    :return: numpy array of shape `(len(ind), ...)`.
+    """
+    ind = np.asarray(ind)
+    order = np.argsort(ind, kind='stable')
+    rows = np.empty((ind.shape[0],) + data.shape[1:], dtype=data.dtype)
+    rows[order] = data[ind[order]]
+    return rows
+
+
+def perturbation_norms(data_adv, data_clean, norm_type='inf', chunk_mb=LOAD_CHUNK_MB):
+    """
+    Norm of the perturbation of each adversarial input. The (possibly memory-mapped) arrays are read in chunks of
+    rows, so that only one chunk is held in memory at a time.
+
+    :param data_adv: numpy array with the adversarial inputs.
+    :param data_clean: numpy array with the corresponding clean inputs.
+    :param norm_type: string or int value specifying the type of norm. Valid values are 'inf' and non-negative
+                      integer values.
+    :param chunk_mb: approximate memory (in MB) of each chunk of the two arrays.
+    :return: numpy array with the norm values.
+    """
+    n = data_adv.shape[0]
+    # expecting 'inf' or a non-negative integer
+    order = np.inf if (norm_type == 'inf') else int(norm_type)
+    row_bytes = 2 * max(1, int(np.prod(data_adv.shape[1:]))) * data_adv.dtype.itemsize
+    chunk = max(1, int(chunk_mb * 2 ** 20) // row_bytes)
+    norm_diff = []
+    for st in range(0, n, chunk):
+        en = min(st + chunk, n)
+        diff = data_adv[st:en].reshape(en - st, -1) - data_clean[st:en].reshape(en - st, -1)
+        norm_diff.append(np.linalg.norm(diff, ord=order, axis=1))
+
+    return np.concatenate(norm_diff) if norm_diff else np.zeros(0)
+
+
+def load_adversarial_data(path, max_n_test=None, sampling_type='ranked_by_norm', norm_type='inf', seed=SEED_DEFAULT,
+                          load_test=True):
     """
     Utility to load adversarial data and labels from saved numpy files. Allows the number of samples from the test
     fold to be specified and has a few sampling options.
 
+    The data files are memory-mapped. The subset of the test fold is selected first, calculating the perturbation
+    norms in chunks if required, and only the selected rows are then read into memory. The arrays of the train fold
+    and of the test fold (if it is not sub-sampled) are returned as read-only memory-mapped arrays.
+
     :param path: path to the directory where the numpy files are saved.
     :param max_n_test: None or an int value specifying the maximum number of samples in the test data fold.
     :param sampling_type: string specifying the type of sampling to use. Valid values are:
@@ -222,26 +509,27 @@ def load_adversarial_data(path, max_n_test=None, sampling_type='ranked_by_norm',
     :param norm_type: string or int value specifying the type of norm. Valid values are 'inf' and non-negative
                       integer values.
     :param seed: seed for the random number generator.
+    :param load_test: Set to False if only the train fold is required. The test fold arrays are then returned as
+                      None.
     :return:
     """
     # Adversarial inputs from the train and test fold
-    data_tr_adv = np.load(os.path.join(path, "data_tr_adv.npy"))
-    data_te_adv = np.load(os.path.join(path, "data_te_adv.npy"))
-
+    data_tr_adv = np.load(os.path.join(path, "data_tr_adv.npy"), mmap_mode='r')
     # Clean inputs corresponding to the adversarial inputs from the train and test fold
-    data_tr_clean = np.load(os.path.join(path, "data_tr_clean.npy"))
-    data_te_clean = np.load(os.path.join(path, "data_te_clean.npy"))
-
+    data_tr_clean = np.load(os.path.join(path, "data_tr_clean.npy"), mmap_mode='r')
     # Predicted (mis-classified) labels
     labels_pred_tr = np.load(os.path.join(path, "labels_tr_adv.npy"))
-    labels_pred_te = np.load(os.path.join(path, "labels_te_adv.npy"))
-    
     # Labels of the original clean inputs from which the adversarial inputs were created
     labels_tr = np.load(os.path.join(path, "labels_tr_clean.npy"))
-    labels_te = np.load(os.path.join(path, "labels_te_clean.npy"))
-
     # Check if the original and adversarial labels are all different
     check_label_mismatch(labels_tr, labels_pred_tr)
+    if not load_test:
+        return data_tr_clean, None, data_tr_adv, labels_tr, None, None
+
+    data_te_adv = np.load(os.path.join(path, "data_te_adv.npy"), mmap_mode='r')
+    data_te_clean = np.load(os.path.join(path, "data_te_clean.npy"), mmap_mode='r')
+    labels_pred_te = np.load(os.path.join(path, "labels_te_adv.npy"))
+    labels_te = np.load(os.path.join(path, "labels_te_clean.npy"))
     check_label_mismatch(labels_te, labels_pred_te)
 
     n_test = labels_te.shape[0]
@@ -262,22 +550,16 @@ def load_adversarial_data(path, max_n_test=None, sampling_type='ranked_by_norm',
             print("Number of adversarial samples from the test fold = {:d}. Selecting a random subset of {:d} "
                   "samples\n".format(n_test, max_n_test))
             ind_test = np.random.permutation(n_test)[:max_n_test]
-        else:
+        elif sampling_type in ('ranked_by_norm', 'importance'):
             # Calculate the norm of the perturbation for adversarial inputs from the test fold
-            diff = data_te_adv.reshape(n_test, -1) - data_te_clean.reshape(n_test, -1)
-            if norm_type == 'inf':
-                norm_diff = np.linalg.norm(diff, ord=np.inf, axis=1)
-            else:
-                # expecting a non-negative integer
-                norm_diff = np.linalg.norm(diff, ord=int(norm_type), axis=1)
-
+            norm_diff = perturbation_norms(data_te_adv, data_te_clean, norm_type=norm_type)
             if sampling_type == 'ranked_by_norm':
                 print("Number of adversarial samples from the test fold = {:d}. Selecting the subset of {:d} samples"
                       " with the smallest perturbation {}-norm\n".format(n_test, max_n_test, norm_type))
                 # Select the `max_n_test` samples with the least norm
                 ind_test = np.argsort(norm_diff)[:max_n_test]
 
-            elif sampling_type == 'importance':
+            else:
                 print("Number of adversarial samples from the test fold = {:d}. Selecting a random subset of {:d} "
                       "samples with importance sampling based on the inverse perturbation {}-norm\n".
                       format(n_test, max_n_test, norm_type))
@@ -287,11 +569,12 @@ def load_adversarial_data(path, max_n_test=None, sampling_type='ranked_by_norm',
                 p = samp_wt / np.sum(samp_wt)
                 ind_test = np.random.choice(n_test, size=max_n_test, replace=False, p=p)
 
-            else:
-                raise ValueError("Invalid value '{}' specified for the input 'sampling_type'".format(sampling_type))
+        else:
+            raise ValueError("Invalid value '{}' specified for the input 'sampling_type'".format(sampling_type))
 
-        return (data_tr_clean, data_te_clean[ind_test, :], data_tr_adv, labels_tr, data_te_adv[ind_test, :],
-                labels_te[ind_test])
+        # Only the selected rows of the test fold are read from the files
+        return (data_tr_clean, read_rows(data_te_clean, ind_test), data_tr_adv, labels_tr,
+                read_rows(data_te_adv, ind_test), labels_te[ind_test])
 
 
 def load_noisy_data(path):
@@ -434,8 +717,9 @@ def list_all_adversarial_subdirs(model_type, fold, attack_type, check_subdirecto
         return [d]
 
 
-def load_adversarial_wrapper(i, model_type, adv_attack, max_attack_prop, num_clean_te, index_adv=0):
-    # Helper function to load adversarial data from the saved numpy files for cross-validation fold `i`
+def load_adversarial_wrapper(i, model_type, adv_attack, max_attack_prop, num_clean_te, index_adv=0, load_test=True):
+    # Helper function to load adversarial data from the saved numpy files for cross-validation fold `i`.
+    # Set `load_test = False` if only the train fold data are required
     if adv_attack != CUSTOM_ATTACK:
         # Load the saved adversarial numpy data generated from this training and test fold
         # numpy_save_path = get_adversarial_data_path(model_type, i + 1, adv_attack, attack_params_list)
@@ -450,7 +734,8 @@ def load_adversarial_wrapper(i, model_type, adv_attack, max_attack_prop, num_cle
             numpy_save_path,
             max_n_test=max_num_adv,
             sampling_type='ranked_by_norm',
-            norm_type=ATTACK_NORM_MAP.get(adv_attack, '2')
+            norm_type=ATTACK_NORM_MAP.get(adv_attack, '2'),
+            load_test=load_test
         )
 
         return data_tr_clean, data_te_clean, data_tr_adv, labels_tr_adv, data_te_adv, labels_te_adv
@@ -460,9 +745,9 @@ def load_adversarial_wrapper(i, model_type, adv_attack, max_attack_prop, num_cle
         # Temporary hack to use backup data directory
         # numpy_save_path = numpy_save_path.replace('varun', 'jayaram', 1)
         # Adversarial inputs from the test fold
-        data_te_adv = np.load(os.path.join(numpy_save_path, "data_te_adv.npy"))
+        data_te_adv = np.load(os.path.join(numpy_save_path, "data_te_adv.npy"), mmap_mode='r')
         # Clean inputs corresponding to the adversarial inputs from the test fold
-        data_te_clean = np.load(os.path.join(numpy_save_path, "data_te_clean.npy"))
+        data_te_clean = np.load(os.path.join(numpy_save_path, "data_te_clean.npy"), mmap_mode='r')
 
         # Predicted (mis-classified) labels
         labels_pred_te = np.load(os.path.join(numpy_save_path, "labels_te_adv.npy"))
@@ -477,8 +762,10 @@ def load_adversarial_wrapper(i, model_type, adv_attack, max_attack_prop, num_cle
         mask_norm = norm_perturb <= np.percentile(norm_perturb[mask], 95.)
         mask_incl = np.logical_and(mask, mask_norm)
 
-        data_te_adv = data_te_adv[mask_incl, :]
-        data_te_clean = data_te_clean[mask_incl, :]
+        # Only the included rows are read from the files
+        ind_incl = np.flatnonzero(mask_incl)
+        data_te_adv = read_rows(data_te_adv, ind_incl)
+        data_te_clean = read_rows(data_te_clean, ind_incl)
         labels_te_adv = labels_te[mask_incl]
         # Check if the original and predicted labels are all different for the adversarial inputs
         check_label_mismatch(labels_te_adv, labels_pred_te[mask_incl])
@@ -487,7 +774,7 @@ def load_adversarial_wrapper(i, model_type, adv_attack, max_attack_prop, num_cle
         # Returning the train fold data from Carlini-Wagner attack instead. This is used only by the supervised
         # detection methods
         data_tr_clean, _, data_tr_adv, labels_tr_adv, _, _ = load_adversarial_wrapper(
-            i, model_type, 'CW', max_attack_prop, num_clean_te
+            i, model_type, 'CW', max_attack_prop, num_clean_te, load_test=False
         )
         # Alternative: return the test fold data in place of the train fold data
         # data_tr_adv = data_te_adv
@@ -140,26 +140,37 @@ class ResNet(nn.Module):
         if layer_index == 7:
             return x
 
-    def layer_wise(self, x):
+    def layer_wise_stages(self):
+        # Functions that map the output of each layer returned by `layer_wise` to the output of the next layer
+        return [
+            lambda x: x,    # 1 (input)
+            lambda x: F.relu(self.bn1(self.conv1(x))),  # 2
+            self.layer1,    # 3
+            self.layer2,    # 4
+            self.layer3,    # 5
+            self.layer4,    # 6
+            lambda x: F.avg_pool2d(x, 4),   # 7
+            lambda x: self.linear(x.view(x.size(0), -1))    # 8 (logits)
+        ]
+
+    def layer_wise(self, x, layers=None):
         # Method to get the layer-wise embeddings for the proposed method
-        # Input is included as the first layer
-        output = [x] #1
-        out = F.relu(self.bn1(self.conv1(x)))
-        output.append(out) #2
-        out = self.layer1(out)
-        output.append(out) #3
-        out = self.layer2(out)
-        output.append(out) #4
-        out = self.layer3(out)
-        output.append(out) #5
-        out = self.layer4(out)
-        output.append(out) #6
-        out = F.avg_pool2d(out, 4)
-        output.append(out) #7
-        out = out.view(out.size(0), -1)
-        # output.append(out)
-        out = self.linear(out)
-        output.append(out) #8 (logits)
+        # Input is included as the first layer. If `layers` is a list of layer indices, only these layers are
+        # returned (the other entries of the list are None), and the forward pass stops after the deepest of them
+        stages = self.layer_wise_stages()
+        n = len(stages)
+        if layers is not None:
+            if len(layers) == 0:
+                raise ValueError("Input 'layers' should be a non-empty list of layer indices.")
+            if any((i < -n) or (i >= n) for i in layers):
+                raise ValueError("Invalid layer indices {} for a model with {:d} layers.".format(list(layers), n))
+
+        keep = set(range(n)) if (layers is None) else {i % n for i in layers}
+        output = [None] * n
+        for i in range(max(keep) + 1):
+            x = stages[i](x)
+            if i in keep:
+                output[i] = x
 
         return output
 
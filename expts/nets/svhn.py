@@ -89,46 +89,36 @@ class SVHN(nn.Module):
         if layer_index == 5:
             return x
 
-    def layer_wise(self, x):
+    def layer_wise_stages(self):
+        # Functions that map the output of each layer returned by `layer_wise` to the output of the next layer
+        return [
+            lambda x: x,    # 1 (input)
+            lambda x: F.relu(self.conv1(x)),    # 2
+            lambda x: self.dropout1(F.max_pool2d(F.relu(self.conv2(x)), 2)),   # 3
+            lambda x: self.dropout2(F.relu(self.fc1(torch.flatten(x, 1)))),    # 4
+            lambda x: self.dropout3(F.relu(self.fc2(x))),  # 5
+            self.fc3    # 6 (logits)
+        ]
+
+    def layer_wise(self, x, layers=None):
         # Method to get the layer-wise embeddings for the proposed method
-        # Input is included as the first layer
-        output = [x]    # 1
-
-        x = self.conv1(x)
-        # output.append(x)
-        x = F.relu(x)
-        output.append(x)    # 2
+        # Input is included as the first layer. If `layers` is a list of layer indices, only these layers are
+        # returned (the other entries of the list are None), and the forward pass stops after the deepest of them
+        stages = self.layer_wise_stages()
+        n = len(stages)
+        if layers is not None:
+            if len(layers) == 0:
+                raise ValueError("Input 'layers' should be a non-empty list of layer indices.")
+            if any((i < -n) or (i >= n) for i in layers):
+                raise ValueError("Invalid layer indices {} for a model with {:d} layers.".format(list(layers), n))
+
+        keep = set(range(n)) if (layers is None) else {i % n for i in layers}
+        output = [None] * n
+        for i in range(max(keep) + 1):
+            x = stages[i](x)
+            if i in keep:
+                output[i] = x
 
-        x = self.conv2(x)
-        # output.append(x)
-        x = F.relu(x)
-        # output.append(x)
-        x = F.max_pool2d(x, 2)
-        # output.append(x)
-        x = self.dropout1(x)
-        output.append(x)    # 3
-
-        x = torch.flatten(x, 1)
-        # output.append(x)
-        x = self.fc1(x)
-        # output.append(x)
-        x = F.relu(x)
-        # output.append(x)
-        x = self.dropout2(x)
-        output.append(x)    # 4
-
-        x = self.fc2(x)
-        # output.append(x)
-        x = F.relu(x)
-        # output.append(x)
-        x = self.dropout3(x)
-        output.append(x)    # 5
-
-        x = self.fc3(x)
-        output.append(x)    # 6 (logits)
-
-        # final = F.log_softmax(x, dim=1)
-        # output.append(x)
         return output
 
     def layer_wise_deep_mahalanobis(self, x):
@@ -39,6 +39,7 @@ from helpers.utils import (
     load_adversarial_wrapper
 )
 from helpers.dimension_reduction_methods import load_dimension_reduction_models
+from helpers.embedding_cache import EmbeddingCache
 from detectors.deep_mahalanobis import (
     get_mahalanobis_scores,
     fit_mahalanobis_scores,
@@ -171,6 +172,9 @@ def main():
                         help='Path to the saved dimension reduction model file. Specify only if the default path '
                              'needs to be changed.')
     parser.add_argument('--output-dir', '-o', default='', help='directory path for saving the results of detection')
+    parser.add_argument('--embedding-cache-dir', '--ecd', default='',
+                        help='directory of the on-disk cache of the layer embeddings and DNN predictions. The '
+                             'embeddings are reused by runs with the same model, data and method')
     parser.add_argument('--max-outlier-prop', '--mop', type=float, default=0.25,
                         help="Maximum proportion of outlier samples in the test fold. Should be a value in (0, 1]")
     parser.add_argument('--num-folds', '--nf', type=int, default=CROSS_VAL_SIZE,
@@ -324,6 +328,8 @@ def main():
 
     # Set model in evaluation mode
     model.eval()
+    # Cache of the layer embeddings and predictions that is shared by the runs with different detection settings
+    embedding_cache = EmbeddingCache(args.embedding_cache_dir, model) if args.embedding_cache_dir else None
 
     # Check if the numpy data directory exists
     d = os.path.join(NUMPY_DATA_PATH, args.model_type)
@@ -363,11 +369,11 @@ def main():
         # bounds = get_data_bounds(np.concatenate([data_tr, data_te], axis=0))
         print("\nCalculating the layer embeddings and DNN predictions for the clean train data split:")
         layer_embeddings_tr, labels_pred_tr = helper_layer_embeddings(
-            model, device, train_fold_loader, args.detection_method, labels_tr
+            model, device, train_fold_loader, args.detection_method, labels_tr, cache=embedding_cache
         )
         print("\nCalculating the layer embeddings and DNN predictions for the clean test data split:")
         layer_embeddings_te, labels_pred_te = helper_layer_embeddings(
-            model, device, test_fold_loader, args.detection_method, labels_te
+            model, device, test_fold_loader, args.detection_method, labels_te, cache=embedding_cache
         )
         # Delete the data loaders in case they are not used further
         del test_fold_loader
@@ -393,7 +399,7 @@ def main():
                                                   device=device, dtype_x=torch.float)
         print("\nCalculating the layer embeddings and DNN predictions for the ood train data split:")
         layer_embeddings_tr_ood, labels_pred_tr_ood = helper_layer_embeddings(
-            model, device, train_fold_loader_ood, args.detection_method, labels_tr_ood
+            model, device, train_fold_loader_ood, args.detection_method, labels_tr_ood, cache=embedding_cache
         )
         '''
         # Data loader for the outlier data from the test fold
@@ -401,7 +407,7 @@ def main():
                                                  device=device, dtype_x=torch.float)
         print("\nCalculating the layer embeddings and DNN predictions for the ood test data split:")
         layer_embeddings_te_ood, labels_pred_te_ood = helper_layer_embeddings(
-            model, device, test_fold_loader_ood, args.detection_method, labels_te_ood
+            model, device, test_fold_loader_ood, args.detection_method, labels_te_ood, cache=embedding_cache
         )
         # Delete the data loaders in case they are not used further
         del test_fold_loader_ood
@@ -34,6 +34,7 @@ from helpers.utils import (
     load_adversarial_wrapper
 )
 from helpers.dimension_reduction_methods import load_dimension_reduction_models
+from helpers.embedding_cache import EmbeddingCache
 from detectors.detector_proposed import DetectorLayerStatistics
 
 
@@ -83,6 +84,8 @@ def gather_test_stats(args):
 
     # Set model in evaluation mode
     model.eval()
+    # Cache of the layer embeddings and predictions that is shared by the runs with different detection settings
+    embedding_cache = EmbeddingCache(args.embedding_cache_dir, model) if args.embedding_cache_dir else None
     # Check if the numpy data directory exists
     d = os.path.join(NUMPY_DATA_PATH, args.model_type)
     if not os.path.isdir(d):
@@ -112,11 +115,11 @@ def gather_test_stats(args):
         # bounds = get_data_bounds(np.concatenate([data_tr, data_te], axis=0))
         print("\nCalculating the layer embeddings and DNN predictions for the clean train data split:")
         layer_embeddings_tr, labels_pred_tr = helper_layer_embeddings(
-            model, device, train_fold_loader, detection_method, labels_tr
+            model, device, train_fold_loader, detection_method, labels_tr, cache=embedding_cache
         )
         print("\nCalculating the layer embeddings and DNN predictions for the clean test data split:")
         layer_embeddings_te, labels_pred_te = helper_layer_embeddings(
-            model, device, test_fold_loader, detection_method, labels_te
+            model, device, test_fold_loader, detection_method, labels_te, cache=embedding_cache
         )
         del train_fold_loader, test_fold_loader
 
@@ -140,11 +143,11 @@ def gather_test_stats(args):
                                                    batch_size=args.batch_size, device=device)
         print("\nCalculating the layer embeddings and DNN predictions for the noisy train data split:")
         layer_embeddings_tr_noisy, labels_pred_tr_noisy = helper_layer_embeddings(
-            model, device, noisy_train_fold_loader, detection_method, labels_tr_noisy
+            model, device, noisy_train_fold_loader, detection_method, labels_tr_noisy, cache=embedding_cache
         )
         print("\nCalculating the layer embeddings and DNN predictions for the noisy test data split:")
         layer_embeddings_te_noisy, labels_pred_te_noisy = helper_layer_embeddings(
-            model, device, noisy_test_fold_loader, detection_method, labels_te_noisy
+            model, device, noisy_test_fold_loader, detection_method, labels_te_noisy, cache=embedding_cache
         )
         del noisy_train_fold_loader, noisy_test_fold_loader
 
@@ -169,12 +172,12 @@ def gather_test_stats(args):
                                                  batch_size=args.batch_size, device=device)
         print("\nCalculating the layer embeddings and DNN predictions for the adversarial train data split:")
         layer_embeddings_tr_adv, labels_pred_tr_adv = helper_layer_embeddings(
-            model, device, adv_train_fold_loader, detection_method, labels_tr_adv
+            model, device, adv_train_fold_loader, detection_method, labels_tr_adv, cache=embedding_cache
         )
         check_label_mismatch(labels_tr_adv, labels_pred_tr_adv)
         print("\nCalculating the layer embeddings and DNN predictions for the adversarial test data split:")
         layer_embeddings_te_adv, labels_pred_te_adv = helper_layer_embeddings(
-            model, device, adv_test_fold_loader, detection_method, labels_te_adv
+            model, device, adv_test_fold_loader, detection_method, labels_te_adv, cache=embedding_cache
         )
         check_label_mismatch(labels_te_adv, labels_pred_te_adv)
         del adv_train_fold_loader, adv_test_fold_loader
@@ -522,6 +525,9 @@ def parse_cli():
                         help='Path to the saved dimension reduction model file. Specify only if the default path '
                              'needs to be changed.')
     parser.add_argument('--output-dir', '-o', default='', help='directory path for saving the results of detection')
+    parser.add_argument('--embedding-cache-dir', '--ecd', default='',
+                        help='directory of the on-disk cache of the layer embeddings and DNN predictions. The '
+                             'embeddings are reused by runs with the same model, data and method')
     parser.add_argument('--adv-attack', '--aa', choices=['FGSM', 'PGD', 'CW', CUSTOM_ATTACK], default='PGD',
                         help='type of adversarial attack')
     # parser.add_argument('--p-norm', '-p', choices=['0', '2', 'inf'], default='inf',
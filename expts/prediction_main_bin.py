@@ -31,6 +31,7 @@ from helpers.utils import (
     load_adversarial_wrapper
 )
 from helpers.dimension_reduction_methods import load_dimension_reduction_models
+from helpers.embedding_cache import EmbeddingCache
 from detectors.detector_proposed import DetectorLayerStatistics
 from detectors.detector_deep_knn import DeepKNN
 
@@ -137,6 +138,9 @@ def main():
                         help='Path to the saved dimension reduction model file. Specify only if the default path '
                              'needs to be changed.')
     parser.add_argument('--output-dir', '-o', default='', help='directory path for saving the results of detection')
+    parser.add_argument('--embedding-cache-dir', '--ecd', default='',
+                        help='directory of the on-disk cache of the layer embeddings and DNN predictions. The '
+                             'embeddings are reused by runs with the same model, data and method')
     parser.add_argument('--adv-attack', '--aa', choices=['FGSM', 'PGD', 'CW', CUSTOM_ATTACK, 'none'], default='PGD',
                         help="Type of adversarial attack. Use 'none' to evaluate on clean samples.")
     parser.add_argument('--max-attack-prop', '--map', type=float, default=0.5,
@@ -246,6 +250,16 @@ def main():
 
     # Set model in evaluation mode
     model.eval()
+    # Cache of the layer embeddings and predictions that is shared by the runs with different detection settings
+    embedding_cache = EmbeddingCache(args.embedding_cache_dir, model) if args.embedding_cache_dir else None
+    # Only the last few layers are calculated and stored if the proposed method uses only them. The other layers
+    # are set to None
+    layers_extract = None
+    if (args.detection_method == 'proposed') and args.use_deep_layers:
+        layers_extract = list(range(-args.num_layers, 0))
+    # The dimension reduction of the proposed method is applied to each batch during the extraction, so that only
+    # the reduced dimension layer embeddings are stored
+    transform_extract = model_dim_reduc if (args.detection_method == 'proposed') else None
 
     # Check if the numpy data directory exists
     d = os.path.join(NUMPY_DATA_PATH, args.model_type)
@@ -282,11 +296,13 @@ def main():
                                              device=device)
         print("\nCalculating the layer embeddings and DNN predictions for the clean train data split:")
         layer_embeddings_tr, labels_pred_tr = helper_layer_embeddings(
-            model, device, train_fold_loader, args.detection_method, labels_tr
+            model, device, train_fold_loader, args.detection_method, labels_tr, cache=embedding_cache,
+            layers=layers_extract, transform_models=transform_extract
         )
         print("\nCalculating the layer embeddings and DNN predictions for the clean test data split:")
         layer_embeddings_te, labels_pred_te = helper_layer_embeddings(
-            model, device, test_fold_loader, args.detection_method, labels_te
+            model, device, test_fold_loader, args.detection_method, labels_te, cache=embedding_cache,
+            layers=layers_extract, transform_models=transform_extract
         )
         del train_fold_loader
         del test_fold_loader
@@ -309,7 +325,8 @@ def main():
                                                      batch_size=args.batch_size, device=device)
             print("\nCalculating the layer embeddings and DNN predictions for the adversarial test data split:")
             layer_embeddings_te_adv, labels_pred_te_adv = helper_layer_embeddings(
-                model, device, adv_test_fold_loader, args.detection_method, labels_te_adv
+                model, device, adv_test_fold_loader, args.detection_method, labels_te_adv, cache=embedding_cache,
+                layers=layers_extract, transform_models=transform_extract
             )
             check_label_mismatch(labels_te_adv, labels_pred_te_adv)
             del adv_test_fold_loader
@@ -342,7 +359,6 @@ def main():
                     print("Using only the last {:d} layer embeddings from the {:d} layers for the proposed method.".
                           format(args.num_layers, nl))
 
-            mod_dr = None if (model_dim_reduc is None) else model_dim_reduc[st_ind:]
             det_model = DetectorLayerStatistics(
                 layer_statistic=args.test_statistic,
                 score_type=args.score_type,
@@ -350,8 +366,11 @@ def main():
                 pvalue_fusion=args.pvalue_fusion,
                 use_top_ranked=args.use_top_ranked,
                 num_top_ranked=args.num_layers,
+                # Dimension reduction is already applied during the extraction of the layer embeddings. The models
+                # are kept by the detector, so that a saved detector can transform the layer embeddings it is given
                 skip_dim_reduction=(not apply_dim_reduc),
-                model_dim_reduction=mod_dr,
+                model_dim_reduction=None if (model_dim_reduc is None) else model_dim_reduc[st_ind:],
+                dim_reduction_applied=True,
                 n_neighbors=n_neighbors,
                 n_jobs=args.n_jobs,
                 seed_rng=args.seed
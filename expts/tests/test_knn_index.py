@@ -0,0 +1,156 @@
+"""
+Tests for the incremental updates of the KNN index (`KNNIndex.add`, `KNNIndex.remove`, and `KNNGraphCache`), which
+are compared against a KNN index rebuilt from scratch on the same data, and for the cache of query results
+(`QueryCache`).
+
+USAGE:
+cd expts
+python -m pytest tests
+
+"""
+import numpy as np
+import pytest
+from helpers.knn_index import KNNIndex, KNNGraphCache, QueryCache
+
+
+N_NEIGHBORS = 10
+
+
+def clustered_data(n, dim=16, n_clusters=20, seed=123):
+    rng = np.random.RandomState(seed)
+    centers = 4. * rng.randn(n_clusters, dim)
+    labels = rng.randint(0, n_clusters, size=n)
+    return (centers[labels, :] + rng.randn(n, dim)).astype(np.float32)
+
+
+def recall(nn_indices_true, nn_indices):
+    k = nn_indices_true.shape[1]
+    return np.mean([len(set(a) & set(b)) / float(k) for a, b in zip(nn_indices_true, nn_indices[:, :k])])
+
+
+@pytest.mark.parametrize('metric', ['euclidean', 'cosine', 'manhattan'])
+def test_add_exact_matches_rebuild(metric):
+    data = clustered_data(1500)
+    index = KNNIndex(data[:1200], n_neighbors=N_NEIGHBORS, metric=metric, approx_nearest_neighbors=False)
+    ids_new = index.add(data[1200:])
+    np.testing.assert_array_equal(ids_new, np.arange(1200, 1500))
+
+    index_ref = KNNIndex(data, n_neighbors=N_NEIGHBORS, metric=metric, approx_nearest_neighbors=False)
+    nn_indices, nn_distances = index.query_self(k=N_NEIGHBORS)
+    nn_indices_ref, nn_distances_ref = index_ref.query_self(k=N_NEIGHBORS)
+    np.testing.assert_allclose(nn_distances, nn_distances_ref, rtol=1e-5, atol=1e-5)
+    assert recall(nn_indices_ref, nn_indices) > 0.999
+
+    # Queries on the updated index
+    data_test = clustered_data(100, seed=7)
+    nn_indices, nn_distances = index.query(data_test, k=N_NEIGHBORS)
+    nn_indices_ref, nn_distances_ref = index_ref.query(data_test, k=N_NEIGHBORS)
+    np.testing.assert_allclose(nn_distances, nn_distances_ref, rtol=1e-5, atol=1e-5)
+    assert recall(nn_indices_ref, nn_indices) > 0.999
+
+
+def test_remove_exact_matches_rebuild():
+    data = clustered_data(1500)
+    index = KNNIndex(data, n_neighbors=N_NEIGHBORS, approx_nearest_neighbors=False)
+    ids = np.random.RandomState(1).choice(1500, size=400, replace=False)
+    id_map = index.remove(ids)
+    mask_keep = np.ones(1500, dtype=np.bool_)
+    mask_keep[ids] = False
+    assert np.all(id_map[ids] == -1)
+    np.testing.assert_array_equal(id_map[mask_keep], np.arange(1100))
+
+    index_ref = KNNIndex(data[mask_keep, :], n_neighbors=N_NEIGHBORS, approx_nearest_neighbors=False)
+    nn_indices, nn_distances = index.query_self(k=N_NEIGHBORS)
+    nn_indices_ref, nn_distances_ref = index_ref.query_self(k=N_NEIGHBORS)
+    np.testing.assert_allclose(nn_distances, nn_distances_ref, rtol=1e-5, atol=1e-5)
+    assert recall(nn_indices_ref, nn_indices) > 0.999
+
+
+@pytest.mark.parametrize('backend', ['nndescent', 'ivf'])
+def test_add_approx_close_to_rebuild(backend):
+    data = clustered_data(3000)
+    index = KNNIndex(data[:2500], n_neighbors=N_NEIGHBORS, approx_nearest_neighbors=True, backend=backend)
+    index.add(data[2500:])
+    nn_indices, _ = index.query_self(k=N_NEIGHBORS)
+    assert np.all(nn_indices >= 0)
+
+    # Recall with respect to the exact neighbors should be close to that of an approximate index rebuilt on all
+    # the data
+    index_exact = KNNIndex(data, n_neighbors=N_NEIGHBORS, approx_nearest_neighbors=False)
+    index_ref = KNNIndex(data, n_neighbors=N_NEIGHBORS, approx_nearest_neighbors=True, backend=backend)
+    nn_indices_exact, _ = index_exact.query_self(k=N_NEIGHBORS)
+    recall_ref = recall(nn_indices_exact, index_ref.query_self(k=N_NEIGHBORS)[0])
+    assert recall(nn_indices_exact, nn_indices) > recall_ref - 0.02
+
+
+def test_add_then_remove_restores_index():
+    data = clustered_data(1200)
+    index = KNNIndex(data[:1000], n_neighbors=N_NEIGHBORS, approx_nearest_neighbors=False)
+    nn_indices_ref, nn_distances_ref = index.query_self(k=N_NEIGHBORS)
+    ids_new = index.add(data[1000:])
+    index.remove(ids_new)
+    nn_indices, nn_distances = index.query_self(k=N_NEIGHBORS)
+    np.testing.assert_allclose(nn_distances, nn_distances_ref, rtol=1e-5, atol=1e-5)
+    assert recall(nn_indices_ref, nn_indices) > 0.999
+
+
+@pytest.mark.parametrize('approx', [False, True])
+def test_graph_cache_folds_match_rebuild(approx):
+    data = clustered_data(2000)
+    folds = np.array_split(np.random.RandomState(3).permutation(2000), 4)
+    cache = KNNGraphCache()
+    for i in range(len(folds)):
+        rows = np.sort(np.concatenate([f for j, f in enumerate(folds) if j != i]))
+        index = cache.get_index('layer', data[rows, :], n_neighbors=N_NEIGHBORS, approx_nearest_neighbors=approx)
+        nn_indices, _ = index.query_self(k=N_NEIGHBORS)
+        assert nn_indices.shape[0] == rows.shape[0]
+        index_exact = KNNIndex(data[rows, :], n_neighbors=N_NEIGHBORS, approx_nearest_neighbors=False)
+        nn_indices_exact, _ = index_exact.query_self(k=N_NEIGHBORS)
+        assert recall(nn_indices_exact, nn_indices) > (0.97 if approx else 0.999)
+
+
+def test_query_cache_serves_smaller_k(monkeypatch):
+    data = clustered_data(1000)
+    data_test = clustered_data(100, seed=7)
+    index = KNNIndex(data, n_neighbors=N_NEIGHBORS, approx_nearest_neighbors=False)
+    assert index.query_cache.max_bytes > 0
+    nn_indices_ref, nn_distances_ref = index.query(data_test, k=5)
+    index.query_cache.clear()
+
+    index.query(data_test, k=N_NEIGHBORS)
+    # The query with a smaller `k` should be answered by slicing the cached result, without a search
+    def search_fail(*args, **kwargs):
+        raise AssertionError("The query was not answered from the cache.")
+
+    monkeypatch.setattr(index, '_search', search_fail)
+    nn_indices, nn_distances = index.query(data_test, k=5)
+    np.testing.assert_array_equal(nn_indices, nn_indices_ref)
+    np.testing.assert_allclose(nn_distances, nn_distances_ref)
+    # The cached arrays are not modified by the caller
+    nn_distances[:] = -1.
+    np.testing.assert_allclose(index.query(data_test, k=5)[1], nn_distances_ref)
+
+    # The approximate index does not cache by default
+    index_approx = KNNIndex(data, n_neighbors=N_NEIGHBORS, approx_nearest_neighbors=True)
+    assert index_approx.query_cache.max_bytes == 0
+
+
+def test_query_cache_lru_eviction():
+    rng = np.random.RandomState(5)
+    # Each entry has 1000 x 10 int64 indices and float64 distances, i.e. 160000 bytes
+    entries = [(rng.randint(0, 100, size=(1000, 10)), rng.rand(1000, 10)) for _ in range(3)]
+    cache = QueryCache(max_memory_mb=2.5 * 160000 / 2 ** 20)
+    cache.put('a', *entries[0])
+    cache.put('b', *entries[1])
+    # Using entry 'a' makes 'b' the least recently used entry, which is evicted by the next entry
+    assert cache.get('a', 5) is not None
+    cache.put('c', *entries[2])
+    assert cache.get('b', 5) is None
+    assert (cache.get('a', 10) is not None) and (cache.get('c', 10) is not None)
+    assert cache.n_bytes <= cache.max_bytes
+    # A larger `k` than the cached result is not answered
+    assert cache.get('a', 11) is None
+    # An entry larger than the budget is not cached
+    cache.put('d', np.zeros((3000, 10), dtype=np.int64), np.zeros((3000, 10)))
+    assert cache.get('d', 1) is None
+    assert cache.get('a', 1) is not None